@@ -0,0 +1,112 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Windowed batching of concurrent requests.
+
+The launch coalescer, the power action batcher and the snapshot batcher
+gather the calls made with the same key for a few seconds and serve
+them with one aws request. The first call of a key opens a batch and
+its window, the batch is dispatched from a green thread when the window
+closes or it is full, and every call waits for its own result.
+"""
+
+import collections
+
+import eventlet
+from eventlet import event
+
+
+class Batch(object):
+    """The calls gathered under one key.
+
+    The keyword arguments of the call opening the batch are kept as
+    attributes, for the dispatch of the batch.
+    """
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+        # member id -> value, in joining order, and event receiving the
+        # result of the member
+        self.members = collections.OrderedDict()
+        self.done = {}
+        self.timer = None
+
+
+class WindowBatcher(object):
+    """Gathers the calls made with the same key for a window.
+
+    Subclasses implement _window and _dispatch, and _max_size when their
+    batches are bounded.
+    """
+
+    def __init__(self):
+        self._batches = {}
+
+    def _window(self):
+        """Return the seconds a batch waits for more members."""
+        raise NotImplementedError()
+
+    def _max_size(self):
+        """Return the most members of a batch, None when unbounded."""
+        return None
+
+    def _dispatch(self, batch):
+        """Serve a batch, return {member id: result}.
+
+        A result that is an exception is raised to its member, a member
+        without a result gets None. An exception raised fails every
+        member.
+        """
+        raise NotImplementedError()
+
+    def _join(self, key, member_id, value=None, **attrs):
+        """Add a member to the batch of key, return its result.
+
+        Members joining with the same id share their result.
+
+        :param attrs: kept on the batch when the member opens it.
+        """
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = Batch(**attrs)
+            self._batches[key] = batch
+            batch.timer = eventlet.spawn_after(self._window(), self._flush,
+                                               key, batch)
+        done = batch.done.get(member_id)
+        if done is None:
+            done = event.Event()
+            batch.done[member_id] = done
+        batch.members[member_id] = value
+        max_size = self._max_size()
+        if max_size and len(batch.members) >= max_size:
+            # cancel() yields, the batch must not take new members then
+            del self._batches[key]
+            batch.timer.cancel()
+            eventlet.spawn_n(self._flush, key, batch)
+        return done.wait()
+
+    def _flush(self, key, batch):
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+        try:
+            results = self._dispatch(batch)
+            for member_id, done in batch.done.items():
+                result = results.get(member_id)
+                if isinstance(result, Exception):
+                    done.send_exception(result)
+                else:
+                    done.send(result)
+        except Exception as e:
+            # fail the members not handed a result yet
+            for done in batch.done.values():
+                if not done.ready():
+                    done.send_exception(e)
@@ -0,0 +1,57 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Small in-process caches shared by the aws drivers."""
+
+import copy
+import time
+
+
+class ExpiringCache(object):
+    """A dict whose entries expire ``ttl`` seconds after being set.
+
+    Values are deep copied on the way in and out so callers can modify
+    what they get back. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.time():
+            self._data.pop(key, None)
+            return default
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        self._data[key] = (time.time() + self.ttl, copy.deepcopy(value))
+
+    def pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            return entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,268 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Capacity of the aws account, as reported to the schedulers."""
+
+import eventlet
+import time
+
+from jacket import conf
+from jacket.i18n import _LI
+from jacket.i18n import _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+capacity_opts = [
+    cfg.IntOpt('capacity_refresh_interval',
+               default=300,
+               help='Seconds the account vCPU quota and the inventory of '
+                    'running instances are reused before they are read '
+                    'from aws again.'),
+    cfg.IntOpt('vcpu_quota',
+               default=0,
+               help='vCPU quota of the account for on-demand standard '
+                    'instances. Read from the Service Quotas api when 0.'),
+    cfg.IntOpt('memory_mb_per_vcpu',
+               default=8192,
+               help='Memory reported per vCPU of capacity. aws has no '
+                    'memory quota, the default keeps memory from limiting '
+                    'scheduling before vCPUs do.'),
+    cfg.ListOpt('ebs_pool_types',
+                default=['gp2', 'gp3'],
+                help='EBS volume types reported as storage pools by the '
+                     'volume driver. A volume whose type sets no EBS '
+                     'volume type gets the type of its pool, only list '
+                     'provisioned iops or throughput optimized types when '
+                     'volume types are pinned to their pool.'),
+    cfg.IntOpt('volume_stats_refresh_interval',
+               default=300,
+               help='Seconds the EBS storage quotas and the provisioned '
+                    'volume sizes are reused before they are read from aws '
+                    'again in the background.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(capacity_opts, 'aws')
+
+# "Running On-Demand Standard (A, C, D, H, I, M, R, T, Z) instances"
+VCPU_QUOTA_CODE = 'L-1216C47A'
+STANDARD_FAMILIES = ('a', 'c', 'd', 'h', 'i', 'm', 'r', 't', 'z')
+# families starting like a standard one but counted by another quota
+OTHER_FAMILIES = ('inf', 'mac', 'hpc')
+
+# DescribeInstanceTypes accepts at most 100 instance types per request
+DESCRIBE_TYPES_BATCH = 100
+
+# reported when the quota cannot be read, as the driver always did
+UNKNOWN_VCPUS = 999999
+
+ACTIVE_STATES = ['pending', 'running', 'stopping']
+
+# per EBS volume type: storage quota code (TiB), and the largest iops and
+# throughput (MiB/s) a single volume can be provisioned with
+EBS_TYPES = {
+    'standard': ('L-9CF3C2EB', 200, 90),
+    'gp2': ('L-D18FCD1D', 16000, 250),
+    'gp3': ('L-7A658B76', 16000, 1000),
+    'io1': ('L-FD252861', 64000, 1000),
+    'io2': ('L-09BD8365', 64000, 1000),
+    'st1': ('L-82ACEF56', 500, 500),
+    'sc1': ('L-17AF77E8', 250, 250),
+}
+
+DESCRIBE_VOLUMES_PAGE_SIZE = 500
+
+
+def is_standard_type(instance_type):
+    family = instance_type.split('.')[0]
+    return family[:1] in STANDARD_FAMILIES and \
+        not family.startswith(OTHER_FAMILIES)
+
+
+class Capacity(object):
+
+    def __init__(self, vcpus, memory_mb, vcpus_used, memory_mb_used):
+        self.vcpus = vcpus
+        self.memory_mb = memory_mb
+        self.vcpus_used = vcpus_used
+        self.memory_mb_used = memory_mb_used
+
+
+class CapacityTracker(object):
+    """Tracks the vCPU capacity of the account.
+
+    The capacity offered to the scheduler is the vCPU quota minus what
+    instances not managed by the driver use, the instances of the driver
+    are reported as used. The quota and the running instances are read
+    at most every CONF.aws.capacity_refresh_interval seconds, the sizes of
+    the instance types are cached for the lifetime of the process. Until
+    the first successful read the capacity is reported as unlimited.
+    """
+
+    def __init__(self, aws_client, managed_tag):
+        self._aws_client = aws_client
+        self._managed_tag = managed_tag
+        self._type_sizes = {}
+        self._capacity = None
+        self._refreshed_at = None
+
+    def get(self, context):
+        if self._refreshed_at is None or \
+                self._refreshed_at + CONF.aws.capacity_refresh_interval \
+                <= time.time():
+            # a failed refresh is retried at the next interval only
+            self._refreshed_at = time.time()
+            try:
+                self._capacity = self._read(context)
+            except Exception as e:
+                LOG.warn(_LW("Refresh aws capacity failed, the error is: "
+                             "%s"), e)
+        if self._capacity is None:
+            return Capacity(UNKNOWN_VCPUS,
+                            UNKNOWN_VCPUS * CONF.aws.memory_mb_per_vcpu, 0, 0)
+        return self._capacity
+
+    def _read(self, context):
+        aws_client = self._aws_client.get_aws_client(context)
+        quota = CONF.aws.vcpu_quota or int(aws_client.get_service_quota(
+            'ec2', VCPU_QUOTA_CODE))
+
+        filters = [{'Name': 'instance-state-name', 'Values': ACTIVE_STATES}]
+        instances = []
+        for page in aws_client.paginate('describe_instances', 'Reservations',
+                                        Filters=filters, MaxResults=1000):
+            for reservation in page:
+                instances.extend(reservation.get('Instances', []))
+        self._load_type_sizes(aws_client,
+                              set(i['InstanceType'] for i in instances))
+
+        foreign_vcpus = 0
+        vcpus_used = 0
+        memory_mb_used = 0
+        for instance in instances:
+            vcpus, memory_mb = self._type_sizes[instance['InstanceType']]
+            tags = [tag['Key'] for tag in instance.get('Tags', [])]
+            if self._managed_tag in tags:
+                vcpus_used += vcpus
+                memory_mb_used += memory_mb
+            elif is_standard_type(instance['InstanceType']):
+                foreign_vcpus += vcpus
+
+        vcpus = max(quota - foreign_vcpus, 0)
+        capacity = Capacity(vcpus, vcpus * CONF.aws.memory_mb_per_vcpu,
+                            vcpus_used, memory_mb_used)
+        LOG.info(_LI("aws capacity: %(vcpus)s vcpus of a quota of %(quota)s, "
+                     "%(used)s used by %(n)s instances"),
+                 {'vcpus': vcpus, 'quota': quota, 'used': vcpus_used,
+                  'n': len(instances)})
+        return capacity
+
+    def _load_type_sizes(self, aws_client, instance_types):
+        unknown = sorted(t for t in instance_types
+                         if t not in self._type_sizes)
+        for i in range(0, len(unknown), DESCRIBE_TYPES_BATCH):
+            batch = unknown[i:i + DESCRIBE_TYPES_BATCH]
+            for info in aws_client.describe_instance_types(
+                    InstanceTypes=batch):
+                self._type_sizes[info['InstanceType']] = (
+                    info['VCpuInfo']['DefaultVCpus'],
+                    info['MemoryInfo']['SizeInMiB'])
+
+
+class VolumeCapacityTracker(object):
+    """Tracks the capacity of the account per EBS volume type.
+
+    A pool is reported per type in CONF.aws.ebs_pool_types. Its capacity
+    is the storage quota of the type, the provisioned capacity the sum of
+    the sizes of the volumes of that type. Reading them takes a request
+    per quota and a DescribeVolumes sweep, so it runs in a green thread
+    and get() always answers from the last read. Capacity is 'unknown'
+    until the first read and for quotas that cannot be read.
+    """
+
+    def __init__(self, aws_client):
+        self._aws_client = aws_client
+        self._pools = None
+        self._refreshed_at = None
+        self._refreshing = False
+
+    def get(self, context):
+        if not self._refreshing and (
+                self._refreshed_at is None or
+                self._refreshed_at + CONF.aws.volume_stats_refresh_interval
+                <= time.time()):
+            self._refreshing = True
+            eventlet.spawn_n(self._refresh, context)
+        if self._pools is None:
+            return [self._pool(volume_type, None, 0)
+                    for volume_type in self.pool_types()]
+        return self._pools
+
+    @staticmethod
+    def pool_types():
+        """Return the EBS volume types reported as pools."""
+        return [t for t in CONF.aws.ebs_pool_types if t in EBS_TYPES]
+
+    def _pool(self, volume_type, quota_gb, provisioned_gb):
+        quota_code, max_iops, max_throughput = EBS_TYPES[volume_type]
+        if quota_gb is None:
+            total = free = 'unknown'
+        else:
+            total = quota_gb
+            free = max(quota_gb - provisioned_gb, 0)
+        return {'pool_name': volume_type,
+                'total_capacity_gb': total,
+                'free_capacity_gb': free,
+                'provisioned_capacity_gb': provisioned_gb,
+                'reserved_percentage': 0,
+                'thin_provisioning_support': False,
+                'thick_provisioning_support': True,
+                'ebs_volume_type': volume_type,
+                'max_iops': max_iops,
+                'max_throughput_mibps': max_throughput}
+
+    def _refresh(self, context):
+        try:
+            self._pools = self._read(context)
+        except Exception as e:
+            LOG.warn(_LW("Refresh aws volume capacity failed, the error is: "
+                         "%s"), e)
+        finally:
+            self._refreshed_at = time.time()
+            self._refreshing = False
+
+    def _read(self, context):
+        aws_client = self._aws_client.get_aws_client(context)
+        provisioned = dict((volume_type, 0) for volume_type in EBS_TYPES)
+        for page in aws_client.paginate(
+                'describe_volumes', 'Volumes',
+                MaxResults=DESCRIBE_VOLUMES_PAGE_SIZE):
+            for volume in page:
+                volume_type = volume.get('VolumeType')
+                if volume_type in provisioned:
+                    provisioned[volume_type] += volume.get('Size', 0)
+
+        pools = []
+        for volume_type in self.pool_types():
+            quota_code = EBS_TYPES[volume_type][0]
+            try:
+                quota_gb = int(aws_client.get_service_quota(
+                    'ebs', quota_code) * 1024)
+            except Exception as e:
+                LOG.warn(_LW("Read %(type)s storage quota failed, the error "
+                             "is: %(e)s"), {'type': volume_type, 'e': e})
+                quota_gb = None
+            pools.append(self._pool(volume_type, quota_gb,
+                                    provisioned[volume_type]))
+        return pools
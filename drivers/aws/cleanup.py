@@ -0,0 +1,243 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Background deletion of provider resources left by failed operations.
+
+Failure paths hand the provider resource they created to a CleanupQueue
+instead of deleting it inline, so the original error reaches the caller
+without waiting for a delete waiter. The queue deletes the resources
+from a green thread, retries failed deletes with exponential backoff and
+can journal pending items to a file so they survive a restart.
+"""
+
+import eventlet
+import os
+import threading
+import time
+
+from jacket import conf
+from jacket import context as req_context
+from jacket.i18n import _LE
+from jacket.i18n import _LI
+from jacket.i18n import _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+LOG = logging.getLogger(__name__)
+
+cleanup_opts = [
+    cfg.StrOpt('cleanup_journal_dir',
+               help='Directory the pending cleanups of failed operations '
+                    'are journaled to, so that they are resumed after a '
+                    'restart. Cleanups are only kept in memory when unset.'),
+    cfg.IntOpt('cleanup_workers',
+               default=4,
+               help='Number of provider resources deleted concurrently by '
+                    'the cleanup queue.'),
+    cfg.IntOpt('cleanup_max_attempts',
+               default=10,
+               help='Number of times the deletion of a resource is tried '
+                    'before it is given up and reported as leaked.'),
+    cfg.IntOpt('cleanup_retry_interval',
+               default=10,
+               help='Seconds to wait before retrying a failed deletion, '
+                    'doubled on every further attempt.'),
+    cfg.IntOpt('cleanup_max_retry_interval',
+               default=600,
+               help='Upper bound of the wait between two deletion '
+                    'attempts.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(cleanup_opts, 'aws')
+
+INSTANCE = 'instance'
+VOLUME = 'volume'
+SNAPSHOT = 'snapshot'
+
+NOT_FOUND_CODES = ('InvalidInstanceID.NotFound', 'InvalidVolume.NotFound',
+                   'InvalidSnapshot.NotFound')
+
+
+def is_not_found(e):
+    response = getattr(e, 'response', None)
+    if response:
+        code = response.get('Error', {}).get('Code')
+    else:
+        code = getattr(e, 'kwargs', {}).get('error_code')
+    return code in NOT_FOUND_CODES
+
+
+class CleanupQueue(object):
+    """Deletes provider resources in the background.
+
+    :param aws_client: the AwsClient of the driver owning the queue.
+    :param name: name of the journal file, unique per service.
+    """
+
+    def __init__(self, aws_client, name):
+        self._aws_client = aws_client
+        self._name = name
+        self._items = {}
+        self._lock = threading.Lock()
+        self._worker = None
+        self._pool = eventlet.GreenPool(CONF.aws.cleanup_workers)
+        self._stats = {'enqueued': 0, 'deleted': 0, 'retried': 0,
+                       'leaked': 0}
+        self._load_journal()
+
+    @property
+    def _journal_path(self):
+        if CONF.aws.cleanup_journal_dir:
+            return os.path.join(CONF.aws.cleanup_journal_dir,
+                                'aws_cleanup_%s.json' % self._name)
+
+    def _load_journal(self):
+        path = self._journal_path
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                items = jsonutils.loads(f.read())
+        except Exception as e:
+            LOG.error(_LE("Load cleanup journal %(path)s failed: %(e)s"),
+                      {'path': path, 'e': e})
+            return
+        for item in items:
+            # journals of older releases kept the flag of in-flight items
+            item.pop('in_progress', None)
+            self._items[self._key(item)] = item
+        if self._items:
+            LOG.info(_LI("Resume %(n)s pending aws cleanups from %(path)s"),
+                     {'n': len(self._items), 'path': path})
+            self._ensure_worker()
+
+    def _save_journal(self):
+        path = self._journal_path
+        if not path:
+            return
+        tmp_path = path + '.tmp'
+        # an item being deleted is due again after a restart
+        items = [dict((key, value) for key, value in item.items()
+                      if key != 'in_progress')
+                 for item in self._items.values()]
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(jsonutils.dumps(items))
+            os.rename(tmp_path, path)
+        except Exception as e:
+            LOG.error(_LE("Save cleanup journal %(path)s failed: %(e)s"),
+                      {'path': path, 'e': e})
+
+    @staticmethod
+    def _key(item):
+        return '%s:%s' % (item['resource_type'], item['resource_id'])
+
+    def enqueue(self, project_id, resource_type, resource_id):
+        """Schedule the deletion of a provider resource."""
+        item = {'project_id': project_id,
+                'resource_type': resource_type,
+                'resource_id': resource_id,
+                'attempts': 0,
+                'next_attempt': time.time()}
+        with self._lock:
+            self._items[self._key(item)] = item
+            self._stats['enqueued'] += 1
+            self._save_journal()
+        LOG.info(_LI("Schedule deletion of aws %(type)s %(id)s"),
+                 {'type': resource_type, 'id': resource_id})
+        self._ensure_worker()
+
+    def stats(self):
+        """Return counters of the queue for monitoring."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._items)
+        stats['running'] = self._pool.running()
+        return stats
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.dead:
+            self._worker = eventlet.spawn(self._run)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._items:
+                    return
+                now = time.time()
+                due = [item for item in self._items.values()
+                       if item['next_attempt'] <= now and
+                       not item.get('in_progress')]
+                for item in due:
+                    item['in_progress'] = True
+                next_attempt = min(item['next_attempt']
+                                   for item in self._items.values())
+            for item in due:
+                self._pool.spawn_n(self._process, item)
+            if not due:
+                eventlet.sleep(max(min(next_attempt - now, 1), 0.1))
+            else:
+                eventlet.sleep(0)
+
+    def _process(self, item):
+        try:
+            self._delete(item)
+        except Exception as e:
+            if is_not_found(e):
+                self._done(item, 'deleted')
+            else:
+                self._retry(item, e)
+        else:
+            self._done(item, 'deleted')
+
+    def _delete(self, item):
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id=item['project_id'])
+        aws_client = self._aws_client.get_aws_client(context)
+        resource_id = item['resource_id']
+        if item['resource_type'] == INSTANCE:
+            aws_client.delete_instances(InstanceIds=[resource_id])
+        elif item['resource_type'] == VOLUME:
+            aws_client.delete_volume(VolumeId=resource_id)
+        elif item['resource_type'] == SNAPSHOT:
+            aws_client.delete_snapshot(SnapshotId=resource_id)
+
+    def _done(self, item, counter):
+        with self._lock:
+            self._items.pop(self._key(item), None)
+            self._stats[counter] += 1
+            self._save_journal()
+
+    def _retry(self, item, e):
+        item['attempts'] += 1
+        if item['attempts'] >= CONF.aws.cleanup_max_attempts:
+            LOG.error(_LE("Give up deleting aws %(type)s %(id)s after "
+                          "%(n)s attempts, it is leaked: %(e)s"),
+                      {'type': item['resource_type'],
+                       'id': item['resource_id'],
+                       'n': item['attempts'], 'e': e})
+            self._done(item, 'leaked')
+            return
+        delay = min(CONF.aws.cleanup_retry_interval *
+                    2 ** (item['attempts'] - 1),
+                    CONF.aws.cleanup_max_retry_interval)
+        LOG.warn(_LW("Delete aws %(type)s %(id)s failed, retry in "
+                     "%(delay)ss: %(e)s"),
+                 {'type': item['resource_type'], 'id': item['resource_id'],
+                  'delay': delay, 'e': e})
+        with self._lock:
+            item['next_attempt'] = time.time() + delay
+            item.pop('in_progress', None)
+            self._stats['retried'] += 1
+            self._save_journal()
@@ -11,24 +11,92 @@
 #    under the License.
 
 import boto3
+import functools
+import time
+import uuid
 
 from botocore import exceptions
+from jacket import conf
 from jacket.db.extend import api as db_api
+from jacket.drivers.aws import cache
+from jacket.drivers.aws import cleanup
 from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws import waiters
 from jacket.i18n import _LE
+from jacket.i18n import _LW
+from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import excutils
 
 LOG = logging.getLogger(__name__)
 
+client_opts = [
+    cfg.IntOpt('create_retries',
+               default=3,
+               help='Number of times a create request carrying an '
+                    'idempotency token, or a start or stop of instances, '
+                    'is re-issued after a network error or a transient aws '
+                    'error.'),
+    cfg.FloatOpt('create_retry_interval',
+                 default=1.0,
+                 help='Seconds to wait before the first re-issue of a create '
+                      'request, doubled on every further attempt.'),
+    cfg.IntOpt('snapshot_state_cache_ttl',
+               default=3600,
+               help='Seconds the final state (completed or error) of a '
+                    'snapshot is cached. Pending snapshots are never '
+                    'cached. The cache is disabled when 0.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(client_opts, 'aws')
+
+NETWORK_ERRORS = (exceptions.EndpointConnectionError,
+                  exceptions.ConnectionClosedError,
+                  exceptions.ReadTimeoutError,
+                  exceptions.ConnectTimeoutError)
+
+TRANSIENT_ERROR_CODES = ('RequestLimitExceeded', 'InternalError',
+                         'ServiceUnavailable', 'Unavailable')
+
+# NOTE: aws accepts client tokens of at most 64 ascii characters.
+CLIENT_TOKEN_MAX_LEN = 64
+
+DESCRIBE_SNAPSHOTS_PAGE_SIZE = 1000
+
+SNAPSHOT_FINAL_STATES = ('completed', 'error')
+
+
+def client_token(caa_id):
+    """Build the idempotency token of a create request for a caa resource.
+
+    The token is unique per create call so that re-creating a resource
+    with the same caa id (rebuild, retype) never matches an earlier one,
+    while re-issuing the same call always does.
+    """
+    token = '%s-%s' % (caa_id, uuid.uuid4().hex[:12])
+    return token[-CLIENT_TOKEN_MAX_LEN:]
+
+
+def is_transient_error(e):
+    if isinstance(e, NETWORK_ERRORS):
+        return True
+    if isinstance(e, exceptions.ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        return code in TRANSIENT_ERROR_CODES
+    return False
+
 
 class AwsClient(object):
 
     def __init__(self, *args, **kwargs):
         self._boto3client = None
+        # set by the drivers, failed creates are then rolled back in the
+        # background instead of inline
+        self.cleanup_queue = None
         super(AwsClient, self).__init__(*args, **kwargs)
 
-    def create_ec2_client(self, context=None):
+    def _client_kwargs(self, context):
         project_info = db_api.project_mapper_get(context, context.project_id)
         if not project_info:
             project_info = db_api.project_mapper_get(context,
@@ -43,32 +111,30 @@ class AwsClient(object):
         kwargs['aws_access_key_id'] = username
         kwargs['aws_secret_access_key'] = password
         kwargs['region_name'] = region_name
-        return boto3.client('ec2', **kwargs)
+        return kwargs
+
+    def create_ec2_client(self, context=None):
+        return boto3.client('ec2', **self._client_kwargs(context))
 
     def create_resource_client(self, context=None):
-        project_info = db_api.project_mapper_get(context, context.project_id)
-        if not project_info:
-            project_info = db_api.project_mapper_get(context,
-                                                     "aws_default")
-        if not project_info:
-            raise exception_ex.AccountNotConfig()
+        return boto3.resource('ec2', **self._client_kwargs(context))
 
-        username = project_info.pop('aws_access_key_id', None)
-        password = project_info.pop("aws_secret_access_key", None)
-        region_name = project_info.pop("region", None)
-        kwargs = {}
-        kwargs['aws_access_key_id'] = username
-        kwargs['aws_secret_access_key'] = password
-        kwargs['region_name'] = region_name
-        return boto3.resource('ec2', **kwargs)
+    def create_quotas_client(self, context=None):
+        return boto3.client('service-quotas', **self._client_kwargs(context))
 
     def get_aws_client(self, context):
         if self._boto3client is None:
             try:
                 ec2_client = self.create_ec2_client(context)
                 resource_client = self.create_resource_client(context)
-                self._boto3client = AwsClientPlugin(ec2_client,
-                                                    resource_client)
+                # only capacity reporting needs it, it is created on use
+                create_quotas_client = functools.partial(
+                    self.create_quotas_client, context)
+                self._boto3client = AwsClientPlugin(
+                    ec2_client, resource_client,
+                    create_quotas_client=create_quotas_client,
+                    cleanup_queue=self.cleanup_queue,
+                    project_id=context.project_id)
             except Exception:
                 LOG.error(_LE('Create aws client failed.'))
                 raise exception_ex.OsAwsConnectFailed
@@ -78,22 +144,95 @@ class AwsClient(object):
 
 class AwsClientPlugin(object):
 
-    def __init__(self, ec2_client=None, res_client=None, **kwargs):
+    def __init__(self, ec2_client=None, res_client=None, cleanup_queue=None,
+                 project_id=None, quotas_client=None,
+                 create_quotas_client=None, **kwargs):
         self._ec2_client = ec2_client
         self._ec2_resource = res_client
+        self._quotas_client = quotas_client
+        self._create_quotas_client = create_quotas_client
+        self._cleanup_queue = cleanup_queue
+        self._project_id = project_id
+        self._waiters = waiters.Waiters(ec2_client)
+        self._snapshot_states = cache.ExpiringCache(
+            CONF.aws.snapshot_state_cache_ttl)
+
+    def _cleanup(self, resource_type, resource_id):
+        """Delete a resource left behind by a failed create."""
+        if self._cleanup_queue:
+            self._cleanup_queue.enqueue(self._project_id, resource_type,
+                                        resource_id)
+        elif resource_type == cleanup.INSTANCE:
+            self.delete_instances(InstanceIds=[resource_id])
+        elif resource_type == cleanup.VOLUME:
+            self.delete_volume(VolumeId=resource_id)
+        elif resource_type == cleanup.SNAPSHOT:
+            self.delete_snapshot(SnapshotId=resource_id)
+
+    def _call_with_retries(self, func, find_existing=None, **kwargs):
+        """Call func, re-issuing it after transient errors.
+
+        Only requests that are safe to repeat may be passed in, either
+        because they carry a ClientToken or because find_existing can
+        return what an earlier attempt already created.
+        """
+        attempt = 0
+        while True:
+            try:
+                if attempt and find_existing:
+                    existing = find_existing(**kwargs)
+                    if existing:
+                        return existing
+                return func(**kwargs)
+            except Exception as e:
+                if attempt >= CONF.aws.create_retries or \
+                        not is_transient_error(e):
+                    raise
+                attempt += 1
+                delay = CONF.aws.create_retry_interval * 2 ** (attempt - 1)
+                name = getattr(func, '__name__', func)
+                LOG.warn(_LW("Aws request %(func)s failed, retry %(n)s in "
+                             "%(delay)ss. error_msg: %(e)s"),
+                         {'func': name, 'n': attempt, 'delay': delay,
+                          'e': e})
+                time.sleep(delay)
 
     def create_tags(self, **kwargs):
         self._ec2_client.create_tags(**kwargs)
 
+    def create_placement_group(self, **kwargs):
+        self._ec2_client.create_placement_group(**kwargs)
+
+    def create_launch_template(self, **kwargs):
+        response = self._ec2_client.create_launch_template(**kwargs)
+        return response.get('LaunchTemplate')
+
+    def create_launch_template_version(self, **kwargs):
+        response = self._ec2_client.create_launch_template_version(**kwargs)
+        return response.get('LaunchTemplateVersion')
+
+    def describe_launch_templates(self, **kwargs):
+        response = self._ec2_client.describe_launch_templates(**kwargs)
+        return response.get('LaunchTemplates', [])
+
+    def describe_launch_template_versions(self, **kwargs):
+        response = self._ec2_client.describe_launch_template_versions(
+            **kwargs)
+        return response.get('LaunchTemplateVersions', [])
+
     def create_volume(self, **kwargs):
         vol = None
         try:
-            vol = self._ec2_client.create_volume(**kwargs)
-            waiter = self._ec2_client.get_waiter('volume_available')
-            waiter.wait(VolumeIds=[vol['VolumeId']])
+            if 'ClientToken' in kwargs:
+                vol = self._call_with_retries(self._ec2_client.create_volume,
+                                              **kwargs)
+            else:
+                vol = self._ec2_client.create_volume(**kwargs)
+            self._waiters.wait('volume_available',
+                               VolumeIds=[vol['VolumeId']])
         except Exception as e:
             if vol:
-                self.delete_volume(VolumeId=vol['VolumeId'])
+                self._cleanup(cleanup.VOLUME, vol['VolumeId'])
             if isinstance(e, exceptions.ClientError):
                 reason = e.response.get('Error', {}).get('Message', 'Unkown')
                 LOG.error(_LE("Aws create volume failed! error_msg: %s"),
@@ -107,26 +246,37 @@ class AwsClientPlugin(object):
     def delete_volume(self, **kwargs):
         try:
             self._ec2_client.delete_volume(**kwargs)
-            waiter = self._ec2_client.get_waiter('volume_deleted')
-            waiter.wait(VolumeIds=[kwargs['VolumeId']])
+            self._waiters.wait('volume_deleted',
+                               VolumeIds=[kwargs['VolumeId']])
         except Exception as e:
             if isinstance(e, exceptions.ClientError):
                 reason = e.response.get('Error', {}).get('Message', 'Unkown')
                 LOG.error(_LE("Aws delete volume failed! error_msg: %s"),
                           reason)
-                raise exception_ex.ProviderDeleteVolumeFailed(reason=reason)
+                code = e.response.get('Error', {}).get('Code')
+                raise exception_ex.ProviderDeleteVolumeFailed(reason=reason,
+                                                              error_code=code)
             else:
                 raise
 
-    def create_snapshot(self, **kwargs):
+    def create_snapshot(self, wait=True, **kwargs):
+        """Create a snapshot and return it as described by CreateSnapshot.
+
+        :param wait: wait for the snapshot to complete before returning.
+        """
         snapshot = None
         try:
-            snapshot = self._ec2_client.create_snapshot(**kwargs)
-            waiter = self._ec2_client.get_waiter('snapshot_completed')
-            waiter.wait(VolumeIds=[snapshot['SnapshotId']])
+            if 'TagSpecifications' in kwargs:
+                snapshot = self._call_with_retries(
+                    self._ec2_client.create_snapshot,
+                    find_existing=self._find_created_snapshot, **kwargs)
+            else:
+                snapshot = self._ec2_client.create_snapshot(**kwargs)
+            if wait:
+                self.wait_snapshot_completed(snapshot['SnapshotId'])
         except Exception as e:
             if snapshot:
-                self.delete_snapshot(SnapshotId=snapshot['SnapshotId'])
+                self._cleanup(cleanup.SNAPSHOT, snapshot['SnapshotId'])
             if isinstance(e, exceptions.ClientError):
                 reason = e.response.get('Error', {}).get('Message', 'Unkown')
                 LOG.error(_LE("Aws create snapshot failed! error_msg: %s"),
@@ -137,17 +287,129 @@ class AwsClientPlugin(object):
         else:
             return snapshot
 
+    def create_snapshots(self, wait=True, **kwargs):
+        """Snapshot the volumes of an instance at the same point in time.
+
+        Return the snapshots as described by CreateSnapshots.
+
+        :param wait: wait for the snapshots to complete before returning.
+        """
+        snapshots = []
+        try:
+            snapshots = self._ec2_client.create_snapshots(
+                **kwargs).get('Snapshots', [])
+            if wait and snapshots:
+                snapshot_ids = [s['SnapshotId'] for s in snapshots]
+                self._waiters.wait('snapshot_completed',
+                                   SnapshotIds=snapshot_ids)
+                for snapshot_id in snapshot_ids:
+                    self._remember_snapshot_state(snapshot_id, 'completed')
+        except Exception as e:
+            for snapshot in snapshots:
+                self._cleanup(cleanup.SNAPSHOT, snapshot['SnapshotId'])
+            if isinstance(e, exceptions.ClientError):
+                reason = e.response.get('Error', {}).get('Message', 'Unkown')
+                LOG.error(_LE("Aws create snapshots failed! error_msg: %s"),
+                          reason)
+                raise exception_ex.ProviderCreateSnapshotFailed(reason=reason)
+            else:
+                raise
+        else:
+            return snapshots
+
+    def wait_snapshot_completed(self, snapshot_id):
+        """Wait for a snapshot to complete, unless it is known to be."""
+        if self._snapshot_states.get(snapshot_id) == 'completed':
+            return
+        self._waiters.wait('snapshot_completed', SnapshotIds=[snapshot_id])
+        self._remember_snapshot_state(snapshot_id, 'completed')
+
+    def _find_created_snapshot(self, **kwargs):
+        """Find a snapshot an earlier CreateSnapshot call already made.
+
+        CreateSnapshot takes no ClientToken, the snapshot is found by the
+        tags it was created with instead.
+        """
+        filters = [{'Name': 'volume-id', 'Values': [kwargs['VolumeId']]}]
+        for spec in kwargs.get('TagSpecifications', []):
+            for tag in spec.get('Tags', []):
+                filters.append({'Name': 'tag:%s' % tag['Key'],
+                                'Values': [tag['Value']]})
+        response = self._ec2_client.describe_snapshots(OwnerIds=['self'],
+                                                       Filters=filters)
+        snapshots = response.get('Snapshots', [])
+        if snapshots:
+            return snapshots[0]
+
     def describe_volumes(self, **kwargs):
         response = self._ec2_client.describe_volumes(**kwargs)
         volumes = response.get('Volumes', [])
         return volumes
 
     def describe_snapshots(self, **kwargs):
-        response = self._ec2_client.describe_snapshots(**kwargs)
-        snapshots = response.get('Snapshots', [])
+        """Describe the snapshots owned by the account.
+
+        Without OwnerIds aws evaluates the filters against every public
+        snapshot of the region, so the query is always scoped to the
+        account unless the caller asks otherwise.
+        """
+        kwargs.setdefault('OwnerIds', ['self'])
+        if 'SnapshotIds' not in kwargs:
+            # MaxResults cannot be combined with SnapshotIds
+            kwargs.setdefault('MaxResults', DESCRIBE_SNAPSHOTS_PAGE_SIZE)
+        snapshots = []
+        for page in self.paginate('describe_snapshots', 'Snapshots',
+                                  **kwargs):
+            snapshots.extend(page)
+        for snapshot in snapshots:
+            self._remember_snapshot_state(snapshot.get('SnapshotId'),
+                                          snapshot.get('State'))
         return snapshots
 
+    def _remember_snapshot_state(self, snapshot_id, state):
+        if state in SNAPSHOT_FINAL_STATES:
+            self._snapshot_states.set(snapshot_id, state)
+        else:
+            self._snapshot_states.pop(snapshot_id)
+
+    def get_snapshot_state(self, snapshot_id):
+        """Return the state of a snapshot, None if it does not exist."""
+        state = self._snapshot_states.get(snapshot_id)
+        if state is not None:
+            return state
+        try:
+            snapshots = self.describe_snapshots(SnapshotIds=[snapshot_id])
+        except exceptions.ClientError as e:
+            if cleanup.is_not_found(e):
+                return None
+            raise
+        if snapshots:
+            return snapshots[0].get('State')
+
+    def paginate(self, operation, result_key, before_call=None, **kwargs):
+        """Yield the pages of a paginated ec2 describe call.
+
+        :param before_call: called before every request, e.g. to throttle.
+        """
+        func = getattr(self._ec2_client, operation)
+        while True:
+            if before_call:
+                before_call()
+            response = func(**kwargs)
+            yield response.get(result_key, [])
+            next_token = response.get('NextToken')
+            if not next_token:
+                return
+            kwargs['NextToken'] = next_token
+
+    def describe_tags(self, **kwargs):
+        tags = []
+        for page in self.paginate('describe_tags', 'Tags', **kwargs):
+            tags.extend(page)
+        return tags
+
     def delete_snapshot(self, **kwargs):
+        self._snapshot_states.pop(kwargs.get('SnapshotId'))
         try:
             self._ec2_client.delete_snapshot(**kwargs)
         except Exception as e:
@@ -155,46 +417,69 @@ class AwsClientPlugin(object):
                 reason = e.response.get('Error', {}).get('Message', 'Unkown')
                 LOG.error(_LE("Aws delete snapshot failed! error_msg: %s"),
                           reason)
-                raise exception_ex.ProviderDeleteSnapshotFailed(reason=reason)
+                code = e.response.get('Error', {}).get('Code')
+                raise exception_ex.ProviderDeleteSnapshotFailed(
+                    reason=reason, error_code=code)
             else:
                 raise
 
-    def create_instance(self, **kwargs):
+    def create_instance(self, wait=True, **kwargs):
+        """Run instances and return them as described by RunInstances.
+
+        :param wait: wait for the instances to be running before returning.
+        """
         instance_ids = []
+        kwargs.setdefault('MinCount', 1)
+        kwargs.setdefault('MaxCount', 1)
         try:
-            response = self._ec2_client.run_instances(**kwargs)
+            if 'ClientToken' in kwargs:
+                response = self._call_with_retries(
+                    self._ec2_client.run_instances, **kwargs)
+            else:
+                response = self._ec2_client.run_instances(**kwargs)
             instances = response.get('Instances', [])
             for instance in instances:
                 instance_ids.append(instance.get('InstanceId'))
-            waiter = self._ec2_client.get_waiter('instance_running')
-            waiter.wait(InstanceIds=instance_ids)
-            return instance_ids
+            if wait:
+                self.wait_instances_running(InstanceIds=instance_ids)
+            return instances
         except Exception:
             with excutils.save_and_reraise_exception():
-                if instance_ids:
-                    self.delete_instances(InstanceIds=instance_ids)
-        return instance_ids
+                for instance_id in instance_ids:
+                    self._cleanup(cleanup.INSTANCE, instance_id)
 
-    def start_instances(self, **kwargs):
-        self._ec2_client.start_instances(**kwargs)
+    def wait_instances_running(self, **kwargs):
         instance_ids = kwargs.get('InstanceIds', [])
         if instance_ids:
-            waiter = self._ec2_client.get_waiter('instance_running')
-            waiter.wait(InstanceIds=instance_ids)
+            self._waiters.wait('instance_running', InstanceIds=instance_ids)
+
+    def start_instances(self, wait=True, **kwargs):
+        """Start instances.
 
-    def stop_instances(self, **kwargs):
-        self._ec2_client.stop_instances(**kwargs)
+        :param wait: wait for the instances to be running before returning.
+        """
+        # starting the same instances again is harmless
+        self._call_with_retries(self._ec2_client.start_instances, **kwargs)
         instance_ids = kwargs.get('InstanceIds', [])
-        if instance_ids:
-            waiter = self._ec2_client.get_waiter('instance_stopped')
-            waiter.wait(InstanceIds=instance_ids)
+        if wait and instance_ids:
+            self._waiters.wait('instance_running', InstanceIds=instance_ids)
+
+    def stop_instances(self, wait=True, **kwargs):
+        """Stop instances.
+
+        :param wait: wait for the instances to be stopped before returning.
+        """
+        # stopping the same instances again is harmless
+        self._call_with_retries(self._ec2_client.stop_instances, **kwargs)
+        instance_ids = kwargs.get('InstanceIds', [])
+        if wait and instance_ids:
+            self._waiters.wait('instance_stopped', InstanceIds=instance_ids)
 
     def delete_instances(self, **kwargs):
         self._ec2_client.terminate_instances(**kwargs)
         instance_ids = kwargs.get('InstanceIds', [])
         if instance_ids:
-            waiter = self._ec2_client.get_waiter('instance_terminated')
-            waiter.wait(InstanceIds=instance_ids)
+            self._waiters.wait('instance_terminated', InstanceIds=instance_ids)
 
     def describe_instances(self, **kwargs):
         instances = []
@@ -204,6 +489,21 @@ class AwsClientPlugin(object):
             instances.extend(reservation.get('Instances'))
         return instances
 
+    def describe_instance_types(self, **kwargs):
+        instance_types = []
+        for page in self.paginate('describe_instance_types', 'InstanceTypes',
+                                  **kwargs):
+            instance_types.extend(page)
+        return instance_types
+
+    def get_service_quota(self, service_code, quota_code):
+        """Return the applied value of a service quota of the account."""
+        if self._quotas_client is None and self._create_quotas_client:
+            self._quotas_client = self._create_quotas_client()
+        response = self._quotas_client.get_service_quota(
+            ServiceCode=service_code, QuotaCode=quota_code)
+        return response['Quota']['Value']
+
     def reboot_instances(self, **kwargs):
         self._ec2_client.reboot_instances(**kwargs)
 
@@ -211,17 +511,13 @@ class AwsClientPlugin(object):
         self._ec2_client.detach_volume(**kwargs)
         volume_id = kwargs.get('VolumeId')
         if volume_id:
-            volume_ids = [volume_id]
-            waiter = self._ec2_client.get_waiter('volume_available')
-            waiter.wait(VolumeIds=volume_ids)
+            self._waiters.wait('volume_available', VolumeIds=[volume_id])
 
     def attach_volume(self, **kwargs):
         self._ec2_client.attach_volume(**kwargs)
         volume_id = kwargs.get('VolumeId')
         if volume_id:
-            volume_ids = [volume_id]
-            waiter = self._ec2_client.get_waiter('volume_in_use')
-            waiter.wait(VolumeIds=volume_ids)
+            self._waiters.wait('volume_in_use', VolumeIds=[volume_id])
 
     def describe_images(self, **kwargs):
         response = self._ec2_client.describe_images(**kwargs)
@@ -0,0 +1,234 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Snapshots of clone sources shared by the clones of a source.
+
+A clone is created from a snapshot of its source volume. Without the
+cache every clone takes, waits for and deletes a snapshot of its own.
+With clone_snapshot_cache, the snapshot of a source is kept and reused by
+later clones of the same source while it still holds the data of the
+source:
+
+- while it is younger than clone_snapshot_max_age, or
+- while the source is detached and has not been updated since the
+  snapshot was taken, and still is the same provider volume.
+
+A snapshot is deleted, through the cleanup queue, once it is replaced or
+invalidated and no clone uses it any more, or clone_snapshot_linger
+seconds after the last clone using it finished. The cache lives in
+memory only, the snapshots it held when the driver stopped are deleted
+by sweep() when it starts again. The snapshots are tagged with the host
+of the driver, a sweep only deletes the snapshots of its own host, not
+those of another volume service sharing the account.
+"""
+
+import contextlib
+
+import eventlet
+from eventlet import event
+
+from jacket import conf
+from jacket.drivers.aws import cleanup
+from jacket.drivers.aws import client
+from jacket.i18n import _LI
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+LOG = logging.getLogger(__name__)
+
+clone_snapshot_opts = [
+    cfg.BoolOpt('clone_snapshot_cache',
+                default=False,
+                help='Reuse the snapshot of a source volume for the clones '
+                     'of that volume.'),
+    cfg.IntOpt('clone_snapshot_max_age',
+               default=0,
+               help='Seconds a cached snapshot is reused for even if its '
+                    'source was attached or updated since. With 0 it is '
+                    'only reused while the source is unmodified.'),
+    cfg.IntOpt('clone_snapshot_linger',
+               default=600,
+               help='Seconds a cached snapshot no clone uses is kept '
+                    'before it is deleted.'),
+    cfg.ListOpt('clone_snapshot_sweep_projects',
+                default=['aws_default'],
+                help='Projects whose accounts are swept at startup for the '
+                     'cached snapshots left by a restart of this host.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(clone_snapshot_opts, 'aws')
+
+# tag of the cached snapshots, valued with the host and a token unique
+# per snapshot
+CLONE_SOURCE_TAG = 'caa_clone_source'
+
+
+class _Entry(object):
+
+    def __init__(self, project_id, provider_volume_id):
+        self.project_id = project_id
+        self.provider_volume_id = provider_volume_id
+        self.snapshot_id = None
+        # the data of the source at this time is in the snapshot
+        self.created_at = timeutils.utcnow()
+        # clones using the snapshot, the one creating it included
+        self.refs = 1
+        self.retired = False
+        self.ready = event.Event()
+        self.timer = None
+
+
+class CloneSnapshotCache(object):
+    """Hands out snapshots of clone sources, keyed by source volume id.
+
+    :param aws_client: the AwsClient of the driver.
+    :param cleanup_queue: the CleanupQueue deleting unused snapshots.
+    :param host: the host of the driver, the snapshots are tagged with.
+    """
+
+    def __init__(self, aws_client, cleanup_queue, host):
+        self._aws_client = aws_client
+        self._cleanup_queue = cleanup_queue
+        self._host = host
+        self._entries = {}
+
+    @contextlib.contextmanager
+    def snapshot(self, context, source, provider_volume_id):
+        """Yield the id of a completed snapshot of a source volume."""
+        if not CONF.aws.clone_snapshot_cache:
+            aws_client = self._aws_client.get_aws_client(context)
+            snapshot = aws_client.create_snapshot(VolumeId=provider_volume_id)
+            try:
+                yield snapshot['SnapshotId']
+            finally:
+                aws_client.delete_snapshot(SnapshotId=snapshot['SnapshotId'])
+            return
+
+        entry = self._acquire(context, source, provider_volume_id)
+        try:
+            yield entry.snapshot_id
+        finally:
+            self._release(source.id, entry)
+
+    def sweep(self, context):
+        """Delete the snapshots of this host no entry holds.
+
+        :param context: a context of the project whose account is swept.
+        :returns: the number of snapshots queued for deletion.
+        """
+        held = set(entry.snapshot_id for entry in self._entries.values())
+        filters = [{'Name': 'tag:%s' % CLONE_SOURCE_TAG,
+                    'Values': ['%s:*' % self._host]}]
+        snapshots = self._aws_client.get_aws_client(context).\
+            describe_snapshots(Filters=filters)
+        count = 0
+        for snapshot in snapshots:
+            if snapshot['SnapshotId'] not in held:
+                self._cleanup_queue.enqueue(context.project_id,
+                                            cleanup.SNAPSHOT,
+                                            snapshot['SnapshotId'])
+                count += 1
+        if count:
+            LOG.info(_LI("Queued %d cached clone snapshots left by a "
+                         "restart for deletion"), count)
+        return count
+
+    def invalidate(self, source_id):
+        """Stop handing out the snapshot of a source, e.g. on its deletion."""
+        entry = self._entries.get(source_id)
+        if entry:
+            self._retire(source_id, entry)
+
+    def _reusable(self, entry, source, provider_volume_id):
+        if entry.provider_volume_id != provider_volume_id:
+            return False
+        age = timeutils.delta_seconds(entry.created_at, timeutils.utcnow())
+        if age <= CONF.aws.clone_snapshot_max_age:
+            return True
+        updated_at = getattr(source, 'updated_at', None)
+        return (getattr(source, 'attach_status', None) == 'detached' and
+                updated_at is not None and
+                timeutils.normalize_time(updated_at) <= entry.created_at)
+
+    def _acquire(self, context, source, provider_volume_id):
+        entry = self._entries.get(source.id)
+        if entry and self._reusable(entry, source, provider_volume_id):
+            # taken before the timer is cancelled, cancelling may yield
+            entry.refs += 1
+            if entry.timer:
+                entry.timer.cancel()
+                entry.timer = None
+            try:
+                entry.ready.wait()
+            except Exception:
+                self._release(source.id, entry)
+                raise
+            LOG.info(_LI("Clone volume %(id)s from cached snapshot "
+                         "%(snap)s"), {'id': source.id,
+                                       'snap': entry.snapshot_id})
+            return entry
+        if entry:
+            self._retire(source.id, entry)
+
+        entry = _Entry(context.project_id, provider_volume_id)
+        self._entries[source.id] = entry
+        tags = [{'Key': CLONE_SOURCE_TAG,
+                 'Value': '%s:%s' % (self._host,
+                                     client.client_token(source.id))}]
+        try:
+            snapshot = self._aws_client.get_aws_client(context).\
+                create_snapshot(VolumeId=provider_volume_id,
+                                TagSpecifications=[{'ResourceType': 'snapshot',
+                                                    'Tags': tags}])
+        except Exception as e:
+            if self._entries.get(source.id) is entry:
+                del self._entries[source.id]
+            entry.retired = True
+            entry.ready.send_exception(e)
+            raise
+        entry.snapshot_id = snapshot['SnapshotId']
+        entry.ready.send(entry.snapshot_id)
+        return entry
+
+    def _release(self, source_id, entry):
+        entry.refs -= 1
+        if entry.refs:
+            return
+        if entry.retired:
+            self._delete(entry)
+        else:
+            entry.timer = eventlet.spawn_after(CONF.aws.clone_snapshot_linger,
+                                               self._expire, source_id, entry)
+
+    def _expire(self, source_id, entry):
+        entry.timer = None
+        if not entry.refs:
+            self._retire(source_id, entry)
+
+    def _retire(self, source_id, entry):
+        if self._entries.get(source_id) is entry:
+            del self._entries[source_id]
+        if entry.retired:
+            return
+        entry.retired = True
+        timer, entry.timer = entry.timer, None
+        if not entry.refs:
+            self._delete(entry)
+        if timer:
+            timer.cancel()
+
+    def _delete(self, entry):
+        if entry.snapshot_id:
+            self._cleanup_queue.enqueue(entry.project_id, cleanup.SNAPSHOT,
+                                        entry.snapshot_id)
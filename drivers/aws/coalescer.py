@@ -0,0 +1,99 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Coalescing of concurrent identical launches into one RunInstances."""
+
+from jacket import conf
+from jacket.drivers.aws import batching
+from jacket.drivers.aws import exception_ex
+from jacket.i18n import _LI
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+LOG = logging.getLogger(__name__)
+
+coalescer_opts = [
+    cfg.BoolOpt('coalesce_run_instances',
+                default=False,
+                help='Launch instances spawned concurrently with identical '
+                     'arguments with a single RunInstances request.'),
+    cfg.FloatOpt('coalesce_window',
+                 default=0.2,
+                 help='Seconds a launch waits for identical launches to '
+                      'join its RunInstances request.'),
+    cfg.IntOpt('coalesce_max_count',
+               default=100,
+               help='Maximum number of instances launched by one coalesced '
+                    'RunInstances request.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(coalescer_opts, 'aws')
+
+# arguments that may differ between the launches of one request
+PER_LAUNCH_KEYS = ('ClientToken', 'MinCount', 'MaxCount')
+
+
+class RunInstancesCoalescer(batching.WindowBatcher):
+    """Gathers identical launches for CONF.aws.coalesce_window seconds.
+
+    The first launch of a batch opens the window, the batch is launched
+    when the window closes or it is full. The instances are handed out in
+    launch index order. When aws launches fewer instances than asked, the
+    launches left without one fail.
+    """
+
+    def __init__(self, aws_client):
+        super(RunInstancesCoalescer, self).__init__()
+        self._aws_client = aws_client
+
+    @staticmethod
+    def _key(context, create_args, wait):
+        shared = dict((key, value) for key, value in create_args.items()
+                      if key not in PER_LAUNCH_KEYS)
+        return (context.project_id, wait,
+                jsonutils.dumps(shared, sort_keys=True))
+
+    def launch(self, context, caa_id, create_args, wait=True):
+        """Launch one instance, return it as described by RunInstances."""
+        key = self._key(context, create_args, wait)
+        return self._join(key, caa_id, context=context,
+                          create_args=create_args, wait=wait)
+
+    def _window(self):
+        return CONF.aws.coalesce_window
+
+    def _max_size(self):
+        return CONF.aws.coalesce_max_count
+
+    def _dispatch(self, batch):
+        count = len(batch.members)
+        create_args = dict(batch.create_args, MinCount=1, MaxCount=count)
+        instances = self._aws_client.get_aws_client(batch.context)\
+            .create_instance(wait=batch.wait, **create_args)
+        if count > 1:
+            LOG.info(_LI("Launched %(n)s of %(count)s coalesced instances "
+                         "with one request"),
+                     {'n': len(instances), 'count': count})
+        instances = sorted(instances,
+                           key=lambda node: node.get('AmiLaunchIndex', 0))
+        results = {}
+        for index, caa_id in enumerate(batch.members):
+            if index < len(instances):
+                results[caa_id] = [instances[index]]
+            else:
+                msg = 'aws launched %s of %s coalesced instances' % (
+                    len(instances), count)
+                results[caa_id] = exception_ex.ProviderCreateInstanceFailed(
+                    reason=msg)
+        return results
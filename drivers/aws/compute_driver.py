@@ -17,6 +17,7 @@
 
 import botocore
 import copy
+import eventlet
 from jacket.compute.cloud import power_state
 from jacket.compute import exception
 from jacket.compute.virt import driver
@@ -24,20 +25,49 @@ from jacket.compute.virt import hardware
 from jacket import conf
 from jacket import context as req_context
 from jacket.db.extend import api as caa_db_api
+from jacket.drivers.aws import cache
+from jacket.drivers.aws import capacity
+from jacket.drivers.aws import cleanup
 from jacket.drivers.aws import client
+from jacket.drivers.aws import coalescer
+from jacket.drivers.aws import device_allocator
 from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws import instance_tracker
+from jacket.drivers.aws import launch_options
+from jacket.drivers.aws import launch_templates
+from jacket.drivers.aws import power_batcher
+from jacket.drivers.aws import reconcile
+from jacket.drivers.aws import tag_index
 from jacket.i18n import _LE
 from jacket.i18n import _LI
+from jacket.i18n import _LW
+from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
+from oslo_service import loopingcall
 from oslo_utils import excutils
-import re
-import string
 import traceback
 import uuid
 
 LOG = logging.getLogger(__name__)
+
+aws_opts = [
+    cfg.IntOpt('launch_info_cache_ttl',
+               default=300,
+               help='Seconds the per-project launch arguments and the block '
+                    'device mappings of provider images are cached for '
+                    'spawn, 0 disables the cache.'),
+    cfg.BoolOpt('spawn_wait_running',
+                default=True,
+                help='Wait for a new instance to be running before spawn '
+                     'returns. When disabled spawn returns once the '
+                     'instance is pending and its mapper is written, and '
+                     'the running state is waited for in the background. '
+                     'Instances booted with volumes always wait.'),
+]
+
 CONF = conf.CONF
+CONF.register_opts(aws_opts, 'aws')
 
 AWS_INSTANCE_PENDING = 0
 AWS_INSTANCE_RUNNING = 16
@@ -52,6 +82,12 @@ AWS_POWER_STATE = {
     AWS_INSTANCE_TERMINATED: power_state.CRASHED,
 }
 
+# stable state name -> code
+AWS_STATE_CODES = {
+    'running': AWS_INSTANCE_RUNNING,
+    'stopped': AWS_INSTANCE_STOPPED,
+}
+
 AWS_INSTANCE_TAG = 'caa_instance_id'
 AWS_VOLUME_TAG = 'caa_volume_id'
 
@@ -60,6 +96,30 @@ class AwsComputeDriver(driver.ComputeDriver):
     def __init__(self, virtapi):
         self.caa_db_api = caa_db_api
         self.aws_client = client.AwsClient()
+        self._cleanup_queue = cleanup.CleanupQueue(self.aws_client, 'compute')
+        self.aws_client.cleanup_queue = self._cleanup_queue
+        self._tag_index = tag_index.TagIndex(self.aws_client)
+        self._reconciler = reconcile.Reconciler(self.aws_client,
+                                                self.caa_db_api)
+        self._reconcile_timer = None
+        self._capacity = capacity.CapacityTracker(self.aws_client,
+                                                  AWS_INSTANCE_TAG)
+        self._device_allocator = device_allocator.DeviceAllocator()
+        self._placement_groups = launch_options.PlacementGroups(
+            self.aws_client)
+        self._launch_templates = launch_templates.LaunchTemplates(
+            self.aws_client)
+        self._coalescer = coalescer.RunInstancesCoalescer(self.aws_client)
+        self._instance_tracker = instance_tracker.InstanceStateTracker(
+            self.aws_client)
+        self._power_batcher = power_batcher.PowerActionBatcher(
+            self.aws_client)
+        self._launch_info_cache = cache.ExpiringCache(
+            CONF.aws.launch_info_cache_ttl)
+        self._image_bdm_cache = cache.ExpiringCache(
+            CONF.aws.launch_info_cache_ttl)
+        # instance type -> number of its instance store volumes
+        self._instance_store_disks = {}
         super(AwsComputeDriver, self).__init__(virtapi)
 
     def after_detach_volume_fail(self, job_detail_info, **kwargs):
@@ -156,6 +216,7 @@ class AwsComputeDriver(driver.ComputeDriver):
 
         # volume id for caa
         volume_id = str(uuid.uuid4())
+        kwargs['ClientToken'] = client.client_token(volume_id)
         provider_snapshot_id = None
         # if image id is not None and image id is base vm
         if image_id and image_id == "base":
@@ -164,9 +225,9 @@ class AwsComputeDriver(driver.ComputeDriver):
                 provider_image_id = \
                     self._get_provider_base_image_id(context, image_id)
                 # get base vm image snapshot id in aws
-                kwargs = {'ImageIds': [provider_image_id]}
+                image_kwargs = {'ImageIds': [provider_image_id]}
                 images = self.aws_client.get_aws_client(context)\
-                                        .describe_images(**kwargs)
+                                        .describe_images(**image_kwargs)
                 image = images[0]
                 block_device_mappings = image.get('BlockDeviceMappings')
                 for bdm in block_device_mappings:
@@ -199,12 +260,15 @@ class AwsComputeDriver(driver.ComputeDriver):
             tags = [{'Key': 'caa_volume_id', 'Value': volume_id}]
             aws_client.create_tags(Resources=[volume['VolumeId']],
                                    Tags=tags)
+            self._tag_index.add(context, tag_index.VOLUME, volume_id,
+                                volume['VolumeId'])
         except Exception as e:
             _msg = "Aws create volume error: %s" % traceback.format_exc(e)
             if volume:
                 LOG.error(_msg)
-                self.aws_client.get_aws_client(context)\
-                               .delete_volume(VolumeId=volume['VolumeId'])
+                self._cleanup_queue.enqueue(context.project_id,
+                                            cleanup.VOLUME,
+                                            volume['VolumeId'])
             raise exception_ex.ProviderCreateVolumeFailed(reason=_msg)
 
         # 4. create volume mapper
@@ -217,8 +281,8 @@ class AwsComputeDriver(driver.ComputeDriver):
             _msg = (_LE("volume_mapper_create failed! vol: %(id)s,ex: %(ex)s"),
                     {'id': volume['VolumeId'], 'ex': ex})
             LOG.error(_msg)
-            aws_client = self.aws_client.get_aws_client(context)
-            aws_client.delete_volume(VolumeId=volume['VolumeId'])
+            self._cleanup_queue.enqueue(context.project_id, cleanup.VOLUME,
+                                        volume['VolumeId'])
             raise exception_ex.ProviderCreateVolumeFailed(reason=_msg)
 
         return volume_id
@@ -229,20 +293,19 @@ class AwsComputeDriver(driver.ComputeDriver):
             aws_volume_id = self._get_provider_volume_id(context,
                                                          volume_id)
             if not aws_volume_id:
-                aws_volumes = self._get_provider_volume(context, volume_id)
-                if not aws_volumes:
+                volume_ids = self._get_provider_volume(context, volume_id)
+                if not volume_ids:
                     LOG.error('the volume %s not found' % volume_id)
                     return
-                volume_ids = []
-                for aws_volume in aws_volumes:
-                    volume_ids.append(aws_volume.get('VolumeId'))
-                self.aws_client.get_aws_client(context)\
-                               .delete_volume(VolumeIds=volume_ids)
             else:
                 LOG.debug('Delete the volume %s on aws',
                           aws_volume_id)
+                volume_ids = [aws_volume_id]
+            for aws_volume_id in volume_ids:
                 self.aws_client.get_aws_client(context)\
-                               .delete_volume(VolumeIds=[aws_volume_id])
+                               .delete_volume(VolumeId=aws_volume_id)
+                self._tag_index.discard(context, tag_index.VOLUME,
+                                        aws_volume_id)
         except Exception as e:
             with excutils.save_and_reraise_exception():
                 LOG.error(_LE('Error from delete volume. '
@@ -274,14 +337,23 @@ class AwsComputeDriver(driver.ComputeDriver):
                 raise exception.VolumeNotFound(volume_id=caa_volume_id)
             if mountpoint:
                 device_name = self._trans_device_name(mountpoint)
+                self._device_allocator.reserve_device(aws_instance_id,
+                                                      device_name)
             else:
                 device_name = self._get_device_name(context, aws_instance_id)
             LOG.debug('Attach volume %s to instance %s on aws'
                       % (aws_volume_id, aws_instance_id))
-            self.aws_client.get_aws_client(context)\
-                           .attach_volume(VolumeId=aws_volume_id,
-                                          InstanceId=aws_instance_id,
-                                          Device=device_name)
+            try:
+                self.aws_client.get_aws_client(context)\
+                               .attach_volume(VolumeId=aws_volume_id,
+                                              InstanceId=aws_instance_id,
+                                              Device=device_name)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._device_allocator.release(aws_instance_id,
+                                                   device_name)
+            self._device_allocator.commit(aws_instance_id, device_name,
+                                          volume_id=aws_volume_id)
             LOG.debug('Attach volume %s to instance %s success'
                       % (instance.uuid, connection_info['data']['volume_id']))
         except Exception as e:
@@ -291,48 +363,27 @@ class AwsComputeDriver(driver.ComputeDriver):
                           instance=instance)
 
     def _get_device_name(self, context, instance_id):
-        try:
+        """Reserve a free device name on the provider instance.
+
+        The name stays reserved until the attach is committed or released
+        on the device allocator. The instance is only described when its
+        device mappings are not cached yet.
+        """
+        def _load_device_names():
             kwargs = {'InstanceIds': [instance_id]}
             instances = self.aws_client.get_aws_client(context)\
                             .describe_instances(**kwargs)
-            bdms = instances[0].get('BlockDeviceMappings')
-            used_letters = set()
-            if bdms:
-                for bdm in bdms:
-                    device_name = bdm.get('DeviceName')
-                    used_letters.add(self._get_device_letter(device_name))
-            device_name = 'dev/sd' + self._get_unused_letter(used_letters)
-            return device_name
+            bdms = instances[0].get('BlockDeviceMappings') or []
+            return [bdm.get('DeviceName') for bdm in bdms]
+
+        try:
+            return self._device_allocator.reserve(instance_id,
+                                                  loader=_load_device_names)
         except Exception as e:
             LOG.error(_LE('Get device name error. '
                           'Error=%(e)s'), {'e': e})
             raise exception_ex.AttachVolumeFailed()
 
-    def _strip_dev(self, device_name):
-        """remove leading '/dev/'."""
-        _dev = re.compile('^/dev/')
-        return _dev.sub('', device_name) if device_name else device_name
-
-    def _strip_prefix(self, device_name):
-        """remove both leading /dev/ and xvd or sd or hd."""
-        _pref = re.compile('^((x?h|s)d)')
-        device_name = self._strip_dev(device_name)
-        return _pref.sub('', device_name)
-
-    def _get_device_letter(self, device_name):
-        _nums = re.compile('\d+')
-        letter = self._strip_prefix(device_name)
-        # NOTE(vish): delete numbers in case we have something like
-        #             /dev/sda1
-        return _nums.sub('', letter)
-
-    def _get_unused_letter(self, used_letters):
-        all_letters = set(list(string.ascii_lowercase))
-        letters = list(all_letters - used_letters)
-        # NOTE(vish): prepend ` so all shorter sequences sort first
-        letters.sort(key=lambda x: x.rjust(2, '`'))
-        return letters[0]
-
     def destroy(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True, migrate_data=None):
         """Destroy the specified instance from the Hypervisor."""
@@ -342,15 +393,10 @@ class AwsComputeDriver(driver.ComputeDriver):
             aws_instance_id = self._get_provider_instance_id(context,
                                                              instance.uuid)
             if not aws_instance_id:
-                filters = [{'Name': 'tag:caa_instance_id',
-                           'Values': [instance.uuid]}]
-                instances = self.aws_client.get_aws_client(context)\
-                                           .describe_instances(Filters=filters)
-                if not instances:
+                instance_ids = self._get_provider_instance(context,
+                                                           instance.uuid)
+                if not instance_ids:
                     LOG.warn('Instance %s not found on aws' % instance.uuid)
-                else:
-                    for node in instances:
-                        instance_ids.append(node.get('InstanceId'))
             else:
                 LOG.debug('delete the instance %s on aws',
                           aws_instance_id)
@@ -358,6 +404,11 @@ class AwsComputeDriver(driver.ComputeDriver):
             if instance_ids:
                 self.aws_client.get_aws_client(context)\
                                .delete_instances(InstanceIds=instance_ids)
+                for instance_id in instance_ids:
+                    self._device_allocator.forget(instance_id)
+                    self._instance_tracker.forget(instance_id)
+                    self._tag_index.discard(context, tag_index.INSTANCE,
+                                            instance_id)
         except botocore.exceptions.ClientError as e:
             reason = e.response.get('Error', {}).get('Message', 'Unkown')
             LOG.error('Delete instance failed, the error is: %s' % reason)
@@ -408,7 +459,7 @@ class AwsComputeDriver(driver.ComputeDriver):
                 elif len(aws_instances) > 1:
                     raise exception_ex.MultiInstanceConfusion
                 else:
-                    aws_instance_id = aws_instances[0].get('InstanceId')
+                    aws_instance_id = aws_instances[0]
             if not aws_volume_id:
                 aws_volumes = self._get_provider_volume(context, caa_volume_id)
                 if not aws_volumes:
@@ -417,12 +468,14 @@ class AwsComputeDriver(driver.ComputeDriver):
                 elif len(aws_volumes) > 1:
                     raise exception_ex.MultiVolumeConfusion
                 else:
-                    aws_volume_id = aws_volumes[0].get('VolumeId')
+                    aws_volume_id = aws_volumes[0]
             LOG.debug('Detach volume %s from instance %s on aws'
                       % (aws_volume_id, aws_instance_id))
             self.aws_client.get_aws_client(context)\
                            .detach_volume(VolumeId=aws_volume_id,
                                           InstanceId=aws_instance_id)
+            self._device_allocator.release_volume(aws_instance_id,
+                                                  aws_volume_id)
             LOG.debug('Detach volume %s from instance %s success'
                       % (instance.uuid, connection_info['data']['volume_id']))
         except botocore.exceptions.ClientError as e:
@@ -466,11 +519,14 @@ class AwsComputeDriver(driver.ComputeDriver):
 
     def get_available_resource(self, nodename):
         """Retrieve resource information."""
-        return {'vcpus': 999999,
-                'memory_mb': 999999,
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id='aws_default')
+        account = self._capacity.get(context)
+        return {'vcpus': account.vcpus,
+                'memory_mb': account.memory_mb,
                 'local_gb': 99999999,
-                'vcpus_used': 0,
-                'memory_mb_used': 99999999,
+                'vcpus_used': account.vcpus_used,
+                'memory_mb_used': account.memory_mb_used,
                 'local_gb_used': 99999999,
                 'hypervisor_type': 'aws',
                 'hypervisor_version': 5005000,
@@ -495,6 +551,13 @@ class AwsComputeDriver(driver.ComputeDriver):
             LOG.error('Cannot get the aws_instance_id of % s'
                       % instance.uuid)
             raise exception.InstanceNotFound(instance_id=instance.uuid)
+        cached = self._instance_tracker.state(aws_instance_id)
+        if cached:
+            return hardware.InstanceInfo(
+                state=AWS_POWER_STATE.get(cached.get('Code')),
+                max_mem_kb=0,
+                mem_kb=0,
+                num_cpu=1)
         try:
             LOG.debug('Get info the instance %s on aws',
                       aws_instance_id)
@@ -506,6 +569,8 @@ class AwsComputeDriver(driver.ComputeDriver):
                 raise exception.InstanceNotFound(instance_id=instance.uuid)
             instance = instances[0]
             state = AWS_POWER_STATE.get(instance.get('State').get('Code'))
+            self._instance_tracker.remember(aws_instance_id,
+                                            instance.get('State'))
         except botocore.exceptions.ClientError as e:
             reason = e.response.get('Error', {}).get('Message', 'Unkown')
             with excutils.save_and_reraise_exception():
@@ -528,7 +593,20 @@ class AwsComputeDriver(driver.ComputeDriver):
                 'host': 'fakehost'}
 
     def init_host(self, host):
-        pass
+        if CONF.aws.reconcile_interval > 0:
+            self._reconcile_timer = loopingcall.FixedIntervalLoopingCall(
+                self._reconcile_mappers)
+            self._reconcile_timer.start(
+                interval=CONF.aws.reconcile_interval,
+                initial_delay=CONF.aws.reconcile_interval)
+
+    def _reconcile_mappers(self):
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id='aws_default')
+        try:
+            self._reconciler.run(context)
+        except Exception as e:
+            LOG.error(_LE('Reconcile mappers failed, the error is: %s'), e)
 
     def power_off(self, instance, timeout=0, retry_interval=0):
         """Power off the specified instance."""
@@ -542,9 +620,12 @@ class AwsComputeDriver(driver.ComputeDriver):
             if aws_instance_id:
                 LOG.debug('Power off the instance %s on aws',
                           aws_instance_id)
-                instance_ids = [aws_instance_id]
-                self.aws_client.get_aws_client(context)\
-                               .stop_instances(InstanceIds=instance_ids)
+                state = self._change_power_state(
+                    context, aws_instance_id, 'stop_instances', 'stopped')
+                if state not in (None, 'stopped'):
+                    reason = 'aws instance %s is %s' % (aws_instance_id,
+                                                        state)
+                    raise exception.InstancePowerOffFailure(reason=reason)
                 LOG.debug('Stop server: %s success' % instance.uuid)
             else:
                 LOG.error('Cannot get the aws_instance_id of % s'
@@ -568,6 +649,50 @@ class AwsComputeDriver(driver.ComputeDriver):
                               'Error=%(e)s'), {'e': e},
                           instance=instance)
 
+    def _change_power_state(self, context, aws_instance_id, action,
+                            target):
+        """Start or stop an instance as CONF.aws.power_action_policy says.
+
+        :param action: start_instances or stop_instances.
+        :param target: the state the change leads to.
+        :returns: the state the instance reached, or None when the change
+                  is left to the instance tracker.
+        """
+        instance_ids = [aws_instance_id]
+        policy = CONF.aws.power_action_policy
+        if aws_instance_id in self._instance_tracker.tracked():
+            # aws refuses a change while the previous one is in progress
+            self._instance_tracker.wait(aws_instance_id,
+                                        CONF.aws.power_action_deadline)
+        change = getattr(self.aws_client.get_aws_client(context), action)
+        if CONF.aws.batch_power_actions:
+            # the batch is waited for by the tracker, whatever the policy
+            self._power_batcher.change(context, aws_instance_id, action)
+        elif policy == 'wait':
+            change(InstanceIds=instance_ids)
+            self._instance_tracker.remember(
+                aws_instance_id, {'Code': AWS_STATE_CODES[target],
+                                  'Name': target})
+            return target
+        else:
+            change(wait=False, InstanceIds=instance_ids)
+        self._instance_tracker.track(context, aws_instance_id, target)
+        if policy == 'wait':
+            state = self._instance_tracker.wait(aws_instance_id,
+                                                CONF.aws.waiter_timeout)
+            if state is None:
+                reason = ('aws instance %s did not become %s within %ss'
+                          % (aws_instance_id, target,
+                             CONF.aws.waiter_timeout))
+                if action == 'start_instances':
+                    raise exception.InstancePowerOnFailure(reason=reason)
+                raise exception.InstancePowerOffFailure(reason=reason)
+            return state
+        if policy == 'deadline':
+            return self._instance_tracker.wait(
+                aws_instance_id, CONF.aws.power_action_deadline)
+        return None
+
     def power_on(self, context, instance, network_info,
                  block_device_info=None):
         """Power on the specified instance."""
@@ -578,9 +703,12 @@ class AwsComputeDriver(driver.ComputeDriver):
             if aws_instance_id:
                 LOG.debug('Power on the instance %s on aws',
                           aws_instance_id)
-                instance_ids = [aws_instance_id]
-                self.aws_client.get_aws_client(context)\
-                               .start_instances(InstanceIds=instance_ids)
+                state = self._change_power_state(
+                    context, aws_instance_id, 'start_instances', 'running')
+                if state not in (None, 'running'):
+                    reason = 'aws instance %s is %s' % (aws_instance_id,
+                                                        state)
+                    raise exception.InstancePowerOnFailure(reason=reason)
                 LOG.debug('Start server: %s success' % instance.uuid)
             else:
                 LOG.error('Cannot get the aws_instance_id of % s'
@@ -648,18 +776,25 @@ class AwsComputeDriver(driver.ComputeDriver):
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info=None, block_device_info=None):
         LOG.debug("Start to create server", instance=instance)
-        base_image_id = None
         flavor = instance.get_flavor()
         root_size = flavor.root_gb
-        sub_flavor_id = self._get_provider_flavor_id(context,
-                                                     flavor.flavorid)
-        if not sub_flavor_id:
-            raise exception.FlavorNotFound(flavor_id=flavor.flavorid)
         block_device_info = block_device_info or {}
         attached_bdms = copy.deepcopy(block_device_info
                                       .get('block_device_mapping', []))
+        root_options = launch_options.get_root_options(flavor.extra_specs)
+        # NOTE: the flavor, project and image lookups do not depend on each
+        # other, resolve them concurrently and only wait for them in the
+        # order the errors used to be reported in.
+        pool = eventlet.GreenPool()
+        flavor_gt = pool.spawn(self._get_provider_flavor_id, context,
+                               flavor.flavorid)
+        project_gt = pool.spawn(self._get_project_launch_info, context,
+                                instance)
+        image_gt = None
         if instance.image_ref:
-            base_image_id = self._get_provider_base_image_id(context)
+            image_gt = pool.spawn(self._resolve_image, pool, context,
+                                  self._get_provider_base_image_id,
+                                  root_size, root_options, context)
         else:
             if block_device_info:
                 bdms = block_device_info.get('block_device_mapping', [])
@@ -667,40 +802,64 @@ class AwsComputeDriver(driver.ComputeDriver):
                     bdms = sorted(bdms, key=lambda bdm: bdm['boot_index'])
                     bdm = bdms[0]
                     root_size = bdm.get('size')
-                    base_image_id = self._get_image_id_from_bdm(context, bdm)
+                    image_gt = pool.spawn(self._resolve_image, pool, context,
+                                          self._get_image_id_from_bdm,
+                                          root_size, root_options, context,
+                                          bdm)
                     attached_bdms.remove(bdm)
+
+        sub_flavor_id = flavor_gt.wait()
+        if not sub_flavor_id:
+            raise exception.FlavorNotFound(flavor_id=flavor.flavorid)
+        base_image_id = sub_bdms_gt = None
+        if image_gt is not None:
+            base_image_id, sub_bdms_gt = image_gt.wait()
         if not base_image_id:
             LOG.error(_LE('Create instance failed.The base image not found'),
                       instance=instance)
             msg = 'The base image not found on aws'
             raise exception_ex.ProviderCreateInstanceFailed(reason=msg)
-        project_mapper = self._get_project_mapper(context,
-                                                  context.project_id)
-        nics = self._get_provider_nics(context, project_mapper)
-        bdms = self._build_sub_bdm(context, base_image_id, root_size)
-        availability_zone = project_mapper.get("availability_zone", None)
-        security_groups = self._get_provider_security_groups_list(
-            context, project_mapper
-        )
+        launch_info = project_gt.wait()
+        project_mapper = launch_info['project_mapper']
+        options = launch_options.get_options(flavor.extra_specs,
+                                             project_mapper)
+        placement_group = self._placement_groups.get(
+            context, instance, options.get(launch_options.PLACEMENT_STRATEGY))
+        bdms = sub_bdms_gt.wait()
+        if flavor.ephemeral_gb:
+            bdms.extend(self._get_instance_store_bdms(context, sub_flavor_id,
+                                                      bdms))
         user_data = self._get_user_data(injected_files)
-        create_args = self._build_create_args(base_image_id, sub_flavor_id,
-                                              availability_zone, nics,
-                                              security_groups=security_groups,
-                                              user_data=user_data,
-                                              block_device_mapping=bdms)
-        instance_ids = self._create_instance(context, instance, attached_bdms,
-                                             **create_args)
+        create_args = self._build_create_args(
+            base_image_id, sub_flavor_id,
+            launch_info['availability_zone'],
+            launch_info['nics'],
+            security_groups=launch_info['security_groups'],
+            user_data=user_data,
+            block_device_mapping=bdms,
+            options=options,
+            placement_group=placement_group)
+        create_args['ClientToken'] = client.client_token(instance.uuid)
+        if CONF.aws.use_launch_templates:
+            try:
+                create_args = self._launch_templates.prepare(context,
+                                                             create_args)
+            except Exception as e:
+                LOG.warn(_LW('Launch template unavailable, launch with all '
+                             'arguments. Error=%(e)s'), {'e': e},
+                         instance=instance)
+        wait_running = CONF.aws.spawn_wait_running or bool(attached_bdms)
+        instances = self._create_instance(context, instance, attached_bdms,
+                                          wait=wait_running, **create_args)
+        instance_ids = [node.get('InstanceId') for node in instances]
         try:
-            kwargs = {'InstanceIds': instance_ids}
-            instances = self.aws_client.get_aws_client(context)\
-                            .describe_instances(**kwargs)
-            nics = instances[0].get('NetworkInterfaces')
-            if nics:
-                for nic in nics:
-                    if nic.get('SubnetId') == project_mapper.get('net_api'):
-                        ip = nic.get('PrivateIpAddresses')[0]\
-                                .get('PrivateIpAddress')
-                        instance.system_metadata['management_ip'] = ip
+            ip = self._get_management_ip(context, instances[0],
+                                         project_mapper)
+            if ip:
+                instance.system_metadata['management_ip'] = ip
+            else:
+                LOG.warn(_LW('No ip of instance %s on the net_api subnet'),
+                         instance_ids[0], instance=instance)
             instance.system_metadata['instance_id'] = instance_ids[0]
             LOG.debug('Instance metadata info instance_id: %(id)s ,'
                       'ip: %(ip)s',
@@ -712,16 +871,81 @@ class AwsComputeDriver(driver.ComputeDriver):
                                                    instance.uuid,
                                                    instance.project_id,
                                                    values)
-            LOG.info(_LI("Instance spawned successfully."), instance=instance)
         except Exception as e:
             LOG.error(_LE('save instance info failed! '
                           'Error=%(e)s'), {'e': e, },
                       instance=instance)
-
-            self.aws_client.get_aws_client(context)\
-                           .delete_instances(InstanceIds=instance_ids)
+            for instance_id in instance_ids:
+                self._cleanup_queue.enqueue(context.project_id,
+                                            cleanup.INSTANCE, instance_id)
             msg = 'Instance_mapper_create failed'
             raise exception_ex.ProviderCreateInstanceFailed(reason=msg)
+        if wait_running:
+            LOG.info(_LI("Instance spawned successfully."), instance=instance)
+        else:
+            eventlet.spawn_n(self._wait_instance_running, context, instance,
+                             instance_ids)
+
+    def _get_management_ip(self, context, provider_instance, project_mapper):
+        """Find the private ip on the net_api subnet of an instance.
+
+        RunInstances already returns the network interfaces, the instance
+        is only described when the response lacks them.
+        """
+        nics = provider_instance.get('NetworkInterfaces')
+        if not nics:
+            kwargs = {'InstanceIds': [provider_instance.get('InstanceId')]}
+            instances = self.aws_client.get_aws_client(context)\
+                            .describe_instances(**kwargs)
+            nics = instances[0].get('NetworkInterfaces') if instances else []
+        for nic in nics or []:
+            if nic.get('SubnetId') == project_mapper.get('net_api'):
+                addresses = nic.get('PrivateIpAddresses')
+                if addresses:
+                    return addresses[0].get('PrivateIpAddress')
+                return nic.get('PrivateIpAddress')
+
+    def _wait_instance_running(self, context, instance, instance_ids):
+        try:
+            self.aws_client.get_aws_client(context)\
+                           .wait_instances_running(InstanceIds=instance_ids)
+            LOG.info(_LI("Instance spawned successfully."), instance=instance)
+        except Exception as e:
+            LOG.error(_LE('Instance %(ids)s did not reach running on aws. '
+                          'Error=%(e)s'), {'ids': instance_ids, 'e': e},
+                      instance=instance)
+
+    def _resolve_image(self, pool, context, get_image_id, root_size,
+                       root_options, *args):
+        """Look up the provider image and start describing its bdms."""
+        image_id = get_image_id(*args)
+        if not image_id:
+            return None, None
+        return image_id, pool.spawn(self._build_sub_bdm, context, image_id,
+                                    root_size, root_options)
+
+    def _get_project_launch_info(self, context, instance):
+        """Return the per-project arguments of RunInstances.
+
+        They only depend on the project mapper, so they are cached per
+        project for CONF.aws.launch_info_cache_ttl seconds.
+        """
+        launch_info = self._launch_info_cache.get(context.project_id)
+        if launch_info is not None:
+            return launch_info
+        project_mapper = self._get_project_mapper(context,
+                                                  context.project_id)
+        launch_info = {
+            'project_mapper': project_mapper,
+            'nics': self._get_provider_nics(context, instance,
+                                            project_mapper),
+            'security_groups': self._get_provider_security_groups_list(
+                context, project_mapper),
+            'availability_zone': project_mapper.get('availability_zone',
+                                                    None),
+        }
+        self._launch_info_cache.set(context.project_id, launch_info)
+        return launch_info
 
     def _attach_bdm_to_instance(self, context, instance, instance_id, bdms):
         try:
@@ -755,17 +979,29 @@ class AwsComputeDriver(driver.ComputeDriver):
                 break
         return is_right
 
-    def _create_instance(self, context, instance, bdms, **kwargs):
+    def _create_instance(self, context, instance, bdms, wait=True, **kwargs):
         LOG.debug('Create instance: %s', kwargs)
         instance_ids = []
         try:
-            instance_ids = self.aws_client.get_aws_client(context)\
-                                          .create_instance(**kwargs)
+            if CONF.aws.coalesce_run_instances:
+                instances = self._coalescer.launch(context, instance.uuid,
+                                                   kwargs, wait=wait)
+            else:
+                instances = self.aws_client.get_aws_client(context)\
+                                           .create_instance(wait=wait,
+                                                            **kwargs)
+            instance_ids = [node.get('InstanceId') for node in instances]
             if instance_ids:
                 tags = [{'Key': 'caa_instance_id', 'Value': instance.uuid}]
                 self.aws_client.get_aws_client(context)\
-                               .create_tags(Resources=[instance_ids],
+                               .create_tags(Resources=instance_ids,
                                             Tags=tags)
+                for instance_id in instance_ids:
+                    self._tag_index.add(context, tag_index.INSTANCE,
+                                        instance.uuid, instance_id)
+                device_names = [bdm.get('DeviceName') for bdm in
+                                kwargs.get('BlockDeviceMappings') or []]
+                self._device_allocator.load(instance_ids[0], device_names)
                 if bdms:
                     if not self._check_bdms(bdms):
                         msg = 'Create instance failed,the bdms info error'
@@ -783,7 +1019,10 @@ class AwsComputeDriver(driver.ComputeDriver):
                             InstanceId=instance_ids[0],
                             Device=mountpoint
                         )
-                return instance_ids
+                        self._device_allocator.commit(instance_ids[0],
+                                                      mountpoint,
+                                                      volume_id=volume_id)
+                return instances
             else:
                 msg = 'Create instance on aws failed'
                 raise exception_ex.ProviderCreateInstanceFailed(reason=msg)
@@ -792,13 +1031,15 @@ class AwsComputeDriver(driver.ComputeDriver):
                 LOG.error(_LE('Error from create instance. '
                               'Error=%(e)s'), {'e': e},
                           instance=instance)
-                if instance_ids:
-                    self.aws_client.get_aws_client(context)\
-                                   .delete_instances(InstanceIds=instance_ids)
+                for instance_id in instance_ids:
+                    self._cleanup_queue.enqueue(context.project_id,
+                                                cleanup.INSTANCE, instance_id)
+                    self._device_allocator.forget(instance_id)
 
     def _build_create_args(self, image_id, instance_type, availability_zone,
                            nics, security_groups=None, user_data=None,
-                           block_device_mapping=None):
+                           block_device_mapping=None, options=None,
+                           placement_group=None):
         create_args = {}
         create_args['ImageId'] = image_id
         create_args['InstanceType'] = instance_type
@@ -811,6 +1052,9 @@ class AwsComputeDriver(driver.ComputeDriver):
             create_args['BlockDeviceMappings'] = block_device_mapping
         if security_groups:
             create_args['SecurityGroupIds'] = security_groups
+        if options or placement_group:
+            launch_options.apply_options(create_args, options or {},
+                                         placement_group)
         return create_args
 
     def _get_user_data(self, injected_files):
@@ -892,14 +1136,13 @@ class AwsComputeDriver(driver.ComputeDriver):
 
         try:
             kargs['VolumeId'] = lxc_volume_id
-            # 2.1 create snapshot
+            # 2.1 create snapshot, tagged on creation so that a retry
+            # after a network error finds it
+            tags = [{'Key': 'caa_snapshot_id', 'Value': image_id}]
+            kargs['TagSpecifications'] = [{'ResourceType': 'snapshot',
+                                           'Tags': tags}]
             aws_client = self.aws_client.get_aws_client(context)
             snapshot = aws_client.create_snapshot(**kargs)
-
-            # 2.2 create snapshot tag
-            tags = [{'Key': 'caa_snapshot_id', 'Value': image_id}]
-            aws_client.create_tags(Resources=[snapshot['SnapshotId']],
-                                   Tags=tags)
         except Exception as e:
             _msg = "Upload image to aws error: %s" % traceback.format_exc(e)
             LOG.error(_msg)
@@ -942,18 +1185,26 @@ class AwsComputeDriver(driver.ComputeDriver):
             return provider_volume_id
 
     def _get_provider_instance(self, context, instance_id):
+        """Return the ids of the aws instances tagged with instance_id."""
+        if self._tag_index.enabled():
+            return self._tag_index.lookup(context, tag_index.INSTANCE,
+                                          instance_id)
         filters = [{'Name': 'tag:caa_instance_id',
                     'Values': [instance_id]}]
         instances = self.aws_client.get_aws_client(context)\
                                    .describe_instances(Filters=filters)
-        return instances
+        return [instance.get('InstanceId') for instance in instances]
 
     def _get_provider_volume(self, context, volume_id):
+        """Return the ids of the aws volumes tagged with volume_id."""
+        if self._tag_index.enabled():
+            return self._tag_index.lookup(context, tag_index.VOLUME,
+                                          volume_id)
         filters = [{'Name': 'tag:caa_volume_id',
                     'Values': [volume_id]}]
         volumes = self.aws_client.get_aws_client(context)\
                                  .describe_volumes(Filters=filters)
-        return volumes
+        return [volume.get('VolumeId') for volume in volumes]
 
     def _trans_device_name(self, orig_device_name):
         return '/dev/sd' + orig_device_name[-1]
@@ -967,7 +1218,12 @@ class AwsComputeDriver(driver.ComputeDriver):
         return dest_flavor_id
 
     def _get_provider_base_image_id(self, context, image_id=None):
-        project_mapper = self._get_project_mapper(context, context.project_id)
+        launch_info = self._launch_info_cache.get(context.project_id)
+        if launch_info is not None:
+            project_mapper = launch_info['project_mapper']
+        else:
+            project_mapper = self._get_project_mapper(context,
+                                                      context.project_id)
         return project_mapper.get("base_linux_image", None)
 
     def _get_provider_image_id(self, context, image_id):
@@ -1008,18 +1264,45 @@ class AwsComputeDriver(driver.ComputeDriver):
                      'DeleteOnTermination': True})
         return nics
 
-    def _build_sub_bdm(self, context, image_id, root_size):
+    def _get_instance_store_bdms(self, context, instance_type, bdms):
+        """Map the instance store volumes of an instance type."""
+        disk_count = self._instance_store_disks.get(instance_type)
+        if disk_count is None:
+            try:
+                infos = self.aws_client.get_aws_client(context)\
+                                       .describe_instance_types(
+                                           InstanceTypes=[instance_type])
+            except botocore.exceptions.ClientError as e:
+                LOG.warn(_LW('Describe instance type %(type)s failed, the '
+                             'error is: %(e)s'),
+                         {'type': instance_type, 'e': e})
+                return []
+            disks = infos[0].get('InstanceStorageInfo', {}).get('Disks', []) \
+                if infos else []
+            disk_count = sum(disk.get('Count', 0) for disk in disks)
+            self._instance_store_disks[instance_type] = disk_count
+        if not disk_count:
+            LOG.warn(_LW('The flavor asks for ephemeral disks but %s has no '
+                         'instance store'), instance_type)
+        return launch_options.instance_store_mappings(disk_count, bdms)
+
+    def _build_sub_bdm(self, context, image_id, root_size, root_options=None):
         sub_bdms = []
         try:
-            kwargs = {'ImageIds': [image_id]}
-            images = self.aws_client.get_aws_client(context)\
-                                    .describe_images(**kwargs)
-            image = images[0]
-            block_device_mappings = image.get('BlockDeviceMappings')
+            block_device_mappings = self._image_bdm_cache.get(image_id)
+            if block_device_mappings is None:
+                kwargs = {'ImageIds': [image_id]}
+                images = self.aws_client.get_aws_client(context)\
+                                        .describe_images(**kwargs)
+                image = images[0]
+                block_device_mappings = image.get('BlockDeviceMappings')
+                self._image_bdm_cache.set(image_id, block_device_mappings)
             for bdm in block_device_mappings:
                 device_name = bdm.get('DeviceName')
-                if device_name == '/dev/sda1' or device_name == '/dev/xvda':
-                    bdm.get('Ebs', {})['VolumeSize'] = root_size
+                if device_name in launch_options.ROOT_DEVICE_NAMES:
+                    ebs = bdm.setdefault('Ebs', {})
+                    ebs['VolumeSize'] = root_size
+                    launch_options.apply_root_options(ebs, root_options)
                     break
             sub_bdms.extend(block_device_mappings)
             return sub_bdms
@@ -0,0 +1,157 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Per-instance device name allocation for volumes attached on aws."""
+
+import re
+import string
+
+from jacket.drivers.aws import exception_ex
+from oslo_concurrency import lockutils
+
+_DEV_RE = re.compile('^/dev/')
+_PREFIX_RE = re.compile('^(xv|x?h|s)d')
+_NUMS_RE = re.compile(r'\d+')
+
+# NOTE: single letters are handed out as /dev/sdX, the extended namespace
+#       (two letters) as /dev/xvdXY.
+_SINGLE_LETTERS = list(string.ascii_lowercase)
+_EXTENDED_LETTERS = [a + b for a in string.ascii_lowercase
+                     for b in string.ascii_lowercase]
+ALL_LETTERS = _SINGLE_LETTERS + _EXTENDED_LETTERS
+
+
+def strip_dev(device_name):
+    """remove leading '/dev/'."""
+    return _DEV_RE.sub('', device_name) if device_name else device_name
+
+
+def strip_prefix(device_name):
+    """remove both leading /dev/ and xvd or sd or hd."""
+    device_name = strip_dev(device_name)
+    return _PREFIX_RE.sub('', device_name) if device_name else device_name
+
+
+def get_device_letter(device_name):
+    letter = strip_prefix(device_name)
+    # NOTE(vish): delete numbers in case we have something like
+    #             /dev/sda1
+    return _NUMS_RE.sub('', letter) if letter else letter
+
+
+def get_device_name(letter):
+    if len(letter) == 1:
+        return '/dev/sd' + letter
+    return '/dev/xvd' + letter
+
+
+class DeviceAllocator(object):
+    """Tracks the device letters in use on each provider instance.
+
+    Known mappings are cached per instance so that attaching a volume does
+    not need to describe the instance. Letters handed out by reserve() stay
+    reserved until commit() or release() is called, so concurrent attaches
+    to the same instance never pick the same device.
+    """
+
+    def __init__(self):
+        self._used = {}
+        self._reserved = {}
+        self._volumes = {}
+
+    def _lock(self, instance_id):
+        return lockutils.lock('aws-devices-%s' % instance_id)
+
+    def is_loaded(self, instance_id):
+        return instance_id in self._used
+
+    def load(self, instance_id, device_names):
+        """Seed the cache of an instance with its known device names."""
+        with self._lock(instance_id):
+            self._load(instance_id, device_names)
+
+    def _load(self, instance_id, device_names):
+        used = set()
+        for device_name in device_names or []:
+            letter = get_device_letter(device_name)
+            if letter:
+                used.add(letter)
+        self._used[instance_id] = used
+        self._reserved.setdefault(instance_id, set())
+        self._volumes.setdefault(instance_id, {})
+
+    def reserve(self, instance_id, loader=None):
+        """Reserve the first free device name of an instance.
+
+        :param loader: callable returning the device names of the instance,
+                       only called when the instance is not cached yet.
+        """
+        with self._lock(instance_id):
+            if not self.is_loaded(instance_id):
+                self._load(instance_id, loader() if loader else [])
+            taken = self._used[instance_id] | self._reserved[instance_id]
+            for letter in ALL_LETTERS:
+                if letter not in taken:
+                    self._reserved[instance_id].add(letter)
+                    return get_device_name(letter)
+        raise exception_ex.NoFreeDeviceName(instance_id=instance_id)
+
+    def reserve_device(self, instance_id, device_name):
+        """Reserve an explicitly requested device name."""
+        letter = get_device_letter(device_name)
+        with self._lock(instance_id):
+            self._reserved.setdefault(instance_id, set()).add(letter)
+        return device_name
+
+    def commit(self, instance_id, device_name, volume_id=None):
+        """Mark a reserved device name as attached."""
+        letter = get_device_letter(device_name)
+        with self._lock(instance_id):
+            self._reserved.get(instance_id, set()).discard(letter)
+            if self.is_loaded(instance_id):
+                self._used[instance_id].add(letter)
+            if volume_id:
+                self._volumes.setdefault(instance_id, {})[volume_id] = letter
+
+    def release(self, instance_id, device_name):
+        """Give back a reserved or attached device name."""
+        letter = get_device_letter(device_name)
+        with self._lock(instance_id):
+            self._reserved.get(instance_id, set()).discard(letter)
+            volumes = self._volumes.get(instance_id, {})
+            for volume_id, vol_letter in list(volumes.items()):
+                if vol_letter == letter:
+                    del volumes[volume_id]
+            if self.is_loaded(instance_id):
+                self._used[instance_id].discard(letter)
+
+    def release_volume(self, instance_id, volume_id):
+        """Give back the device name a volume was attached on."""
+        with self._lock(instance_id):
+            letter = self._volumes.get(instance_id, {}).pop(volume_id, None)
+            if not self.is_loaded(instance_id):
+                return
+            if letter:
+                self._used[instance_id].discard(letter)
+            else:
+                # NOTE: the volume was attached before this process knew
+                # about it, the next allocation has to reload the instance.
+                self._used.pop(instance_id, None)
+
+    def forget(self, instance_id):
+        with self._lock(instance_id):
+            self._forget(instance_id)
+
+    def _forget(self, instance_id):
+        self._used.pop(instance_id, None)
+        self._reserved.pop(instance_id, None)
+        self._volumes.pop(instance_id, None)
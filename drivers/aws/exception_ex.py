@@ -64,3 +64,15 @@ class ProviderImageNotFount(JacketException):
 
 class AttachVolumeFailed(JacketException):
     msg_fmt = _("Attach volume on provider cloud failed")
+
+
+class NoFreeDeviceName(JacketException):
+    msg_fmt = _("No free device name left on instance %(instance_id)s")
+
+
+class InvalidVolumeQos(JacketException):
+    msg_fmt = _("Invalid aws specs of volume type %(type_id)s: %(reason)s")
+
+
+class InvalidLaunchOption(JacketException):
+    msg_fmt = _("Invalid aws launch option %(key)s=%(value)s: %(reason)s")
@@ -0,0 +1,87 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Crash-consistent snapshots of the volumes of an instance.
+
+CreateSnapshots snapshots every volume attached to an instance at the
+same point in time with one request. The drivers use it for the
+snapshots of a consistency group, and with instance_backups for the
+backups of attached volumes started together: a backup waits
+instance_backup_window seconds for the backups of the other volumes of
+its instance and all are taken with one request. The batches are kept
+per instance, a failure only fails the backups of that instance.
+"""
+
+from jacket import conf
+from jacket.drivers.aws import batching
+from jacket.i18n import _LI
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import uuidutils
+
+LOG = logging.getLogger(__name__)
+
+group_snapshot_opts = [
+    cfg.BoolOpt('instance_backups',
+                default=False,
+                help='Take the backups of the volumes of one instance '
+                     'started together with one CreateSnapshots request, '
+                     'so that they are crash consistent.'),
+    cfg.FloatOpt('instance_backup_window',
+                 default=0.5,
+                 help='Seconds the backup of an attached volume waits for '
+                      'the backups of the other volumes of its instance.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(group_snapshot_opts, 'aws')
+
+# tag of the snapshots taken together, valued with the id of the group
+GROUP_TAG = 'caa_snapshot_group'
+
+
+class SnapshotBatcher(batching.WindowBatcher):
+    """Gathers the snapshots of an instance for instance_backup_window.
+
+    :param create_snapshots: called as create_snapshots(context, volumes,
+                             group_id, wait=wait, instance_id=instance_id)
+                             with {caa id: volume} to snapshot a batch,
+                             returns {caa id: provider snapshot}.
+    """
+
+    def __init__(self, create_snapshots):
+        super(SnapshotBatcher, self).__init__()
+        self._create_snapshots = create_snapshots
+
+    def snapshot(self, context, caa_id, volume, instance_id, wait=True):
+        """Snapshot one volume, return it as described by CreateSnapshot.
+
+        :param instance_id: the provider instance the volume is attached
+                            to.
+        """
+        key = (context.project_id, instance_id, wait)
+        return self._join(key, caa_id, volume, context=context,
+                          instance_id=instance_id, wait=wait)
+
+    def _window(self):
+        return CONF.aws.instance_backup_window
+
+    def _dispatch(self, batch):
+        group_id = uuidutils.generate_uuid()
+        snapshots = self._create_snapshots(batch.context, batch.members,
+                                           group_id, wait=batch.wait,
+                                           instance_id=batch.instance_id)
+        if len(snapshots) > 1:
+            LOG.info(_LI("Took %(count)s snapshots together as group "
+                         "%(group)s"), {'count': len(snapshots),
+                                        'group': group_id})
+        return snapshots
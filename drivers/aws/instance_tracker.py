@@ -0,0 +1,156 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Background tracking of instance power state changes.
+
+Stopping or starting an instance takes from seconds to minutes. With the
+wait power_action_policy the compute driver holds its worker until the
+change completed, as it always did. With deadline it waits at most
+power_action_deadline seconds, with track it returns once aws accepted
+the change. The tracker then polls the changing instances of a driver,
+all of a project in one DescribeInstances request, until they reach
+their target state. An instance still seen in its previous state has not
+been changed yet, eventual consistency, so it is only given up on in
+another stable state after a transition was seen.
+
+Every state the tracker or a power action observes is kept for
+instance_state_cache_ttl seconds, get_info answers from it.
+"""
+
+import eventlet
+from eventlet import event
+
+from jacket import conf
+from jacket.drivers.aws import cache
+from jacket.drivers.aws import poller
+from jacket.i18n import _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+instance_tracker_opts = [
+    cfg.StrOpt('power_action_policy',
+               default='wait',
+               choices=('wait', 'deadline', 'track'),
+               help='How power_on and power_off return: wait for '
+                    'the instance to reach its new state, wait at most '
+                    'power_action_deadline seconds, or return once aws '
+                    'accepted the change. Unfinished changes are tracked '
+                    'in the background.'),
+    cfg.IntOpt('power_action_deadline',
+               default=30,
+               help='Seconds a power action waits for its instance with '
+                    'the deadline policy.'),
+    cfg.IntOpt('instance_poll_interval',
+               default=5,
+               help='Seconds between two polls of the instances changing '
+                    'state.'),
+    cfg.IntOpt('instance_state_cache_ttl',
+               default=10,
+               help='Seconds an observed instance state answers get_info, '
+                    '0 disables the cache.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(instance_tracker_opts, 'aws')
+
+STABLE_STATES = ('running', 'stopped', 'terminated')
+
+
+class InstanceStateTracker(poller.ResourcePoller):
+    """Polls instances changing state from a green thread.
+
+    :param aws_client: the AwsClient of the driver owning the tracker.
+    """
+
+    DESCRIBE = 'describe_instances'
+    ID_FILTER = 'instance-id'
+    ID_KEY = 'InstanceId'
+    RESOURCES = 'changing aws instances'
+
+    def __init__(self, aws_client):
+        super(InstanceStateTracker, self).__init__(aws_client)
+        # items: provider id -> {'project_id', 'target', 'moved', 'done'},
+        # moved once the instance was seen changing
+        self._states = cache.ExpiringCache(CONF.aws.instance_state_cache_ttl)
+
+    def track(self, context, instance_id, target):
+        """Poll an instance until it reaches its target state."""
+        self._states.pop(instance_id)
+        with self._lock:
+            item = self._items.get(instance_id)
+            if item is None:
+                item = {'done': event.Event()}
+                self._items[instance_id] = item
+            item.update(project_id=context.project_id, target=target,
+                        moved=False)
+        self._start()
+
+    def wait(self, instance_id, timeout):
+        """Wait for a tracked instance, return its state or None."""
+        with self._lock:
+            item = self._items.get(instance_id)
+        if item is None:
+            state = self.state(instance_id)
+            return state.get('Name') if state else None
+        with eventlet.Timeout(timeout, False):
+            return item['done'].wait()
+        return None
+
+    def forget(self, instance_id):
+        self._states.pop(instance_id)
+        with self._lock:
+            item = self._items.pop(instance_id, None)
+        if item:
+            item['done'].send(None)
+
+    def tracked(self):
+        with self._lock:
+            return dict((instance_id, item['target'])
+                        for instance_id, item in self._items.items())
+
+    def remember(self, instance_id, state):
+        """Keep a state of an instance as described by aws."""
+        self._states.set(instance_id, state)
+
+    def state(self, instance_id):
+        """Return the cached state of an instance, or None."""
+        return self._states.get(instance_id)
+
+    def _interval(self):
+        return CONF.aws.instance_poll_interval
+
+    def _resource_id(self, instance_id, item):
+        return instance_id
+
+    def _observe(self, context, instance_id, item, instance):
+        state = instance.get('State') if instance else None
+        name = state.get('Name') if state else None
+        if state:
+            self.remember(instance_id, state)
+        if name and name not in STABLE_STATES:
+            item['moved'] = True
+            return
+        if name not in (None, item['target'], 'terminated') and \
+                not item['moved']:
+            # described before the change took effect
+            return
+        with self._lock:
+            if self._items.get(instance_id) is not item:
+                return
+            del self._items[instance_id]
+        if name != item['target']:
+            LOG.warn(_LW("Aws instance %(id)s is %(state)s instead of "
+                         "%(target)s"), {'id': instance_id, 'state': name,
+                                         'target': item['target']})
+        item['done'].send(name)
@@ -0,0 +1,304 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""RunInstances options taken from flavor extra specs and project mappers.
+
+Flavor extra specs win over the project mapper keys of the same name
+without the ``aws:`` prefix:
+
+* aws:ebs_optimized: true or false,
+* aws:tenancy: default, dedicated or host,
+* aws:cpu_cores and aws:cpu_threads_per_core: the CpuOptions,
+* aws:interface_type: interface or efa, set on every network interface,
+* aws:placement_strategy: cluster, spread or partition.
+
+The root volume of the image is tuned with flavor extra specs only:
+
+* aws:root_volume_type, aws:root_iops and aws:root_throughput, checked
+  against the EBS limits of the volume type,
+* aws:root_encrypted and aws:root_kms_key_id.
+
+With server_group_placement, instances of a server group are launched
+into a placement group created for that group on first use. Without
+aws:placement_strategy the strategy follows the group policy, cluster for
+affinity and spread for anti-affinity.
+"""
+
+from botocore import exceptions
+from jacket import conf
+from jacket.drivers.aws import device_allocator
+from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws import volume_qos
+from jacket.i18n import _LI
+from jacket.i18n import _LW
+from oslo_concurrency import lockutils
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import importutils
+from oslo_utils import strutils
+
+compute_objects = importutils.try_import('jacket.objects.compute')
+
+LOG = logging.getLogger(__name__)
+
+launch_options_opts = [
+    cfg.BoolOpt('server_group_placement',
+                default=False,
+                help='Launch the instances of a server group into a '
+                     'placement group of their own. A cluster placement '
+                     'group can fail launches for lack of capacity that '
+                     'would succeed without it.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(launch_options_opts, 'aws')
+
+EBS_OPTIMIZED = 'ebs_optimized'
+TENANCY = 'tenancy'
+CPU_CORES = 'cpu_cores'
+CPU_THREADS_PER_CORE = 'cpu_threads_per_core'
+INTERFACE_TYPE = 'interface_type'
+PLACEMENT_STRATEGY = 'placement_strategy'
+
+KEYS = (EBS_OPTIMIZED, TENANCY, CPU_CORES, CPU_THREADS_PER_CORE,
+        INTERFACE_TYPE, PLACEMENT_STRATEGY)
+
+TENANCIES = ('default', 'dedicated', 'host')
+INTERFACE_TYPES = ('interface', 'efa')
+PLACEMENT_STRATEGIES = ('cluster', 'spread', 'partition')
+
+GROUP_POLICY_STRATEGIES = {'affinity': 'cluster',
+                           'soft-affinity': 'cluster',
+                           'anti-affinity': 'spread',
+                           'soft-anti-affinity': 'spread'}
+
+PLACEMENT_GROUP_PREFIX = 'caa-'
+
+ROOT_VOLUME_TYPE = 'aws:root_volume_type'
+ROOT_IOPS = 'aws:root_iops'
+ROOT_THROUGHPUT = 'aws:root_throughput'
+ROOT_ENCRYPTED = 'aws:root_encrypted'
+ROOT_KMS_KEY_ID = 'aws:root_kms_key_id'
+
+ROOT_DEVICE_NAMES = ('/dev/sda1', '/dev/xvda')
+
+# root volumes of images without a volume type are gp2
+DEFAULT_ROOT_VOLUME_TYPE = 'gp2'
+
+
+def _invalid(key, value, reason):
+    raise exception_ex.InvalidLaunchOption(key=key, value=value,
+                                           reason=reason)
+
+
+def _choice(key, value, choices):
+    if value not in choices:
+        _invalid(key, value, 'must be one of %s' % ', '.join(choices))
+    return value
+
+
+def _positive_int(key, value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = 0
+    if value <= 0:
+        _invalid(key, value, 'must be a positive integer')
+    return value
+
+
+def get_options(flavor_specs, project_mapper):
+    """Merge and check the launch options of a flavor and a project."""
+    options = {}
+    for key in KEYS:
+        value = (flavor_specs or {}).get('aws:' + key)
+        if value is None:
+            value = (project_mapper or {}).get(key)
+        if value is not None:
+            options[key] = value
+
+    if EBS_OPTIMIZED in options:
+        try:
+            options[EBS_OPTIMIZED] = strutils.bool_from_string(
+                options[EBS_OPTIMIZED], strict=True)
+        except ValueError:
+            _invalid(EBS_OPTIMIZED, options[EBS_OPTIMIZED],
+                     'must be a boolean')
+    if TENANCY in options:
+        _choice(TENANCY, options[TENANCY], TENANCIES)
+    for key in (CPU_CORES, CPU_THREADS_PER_CORE):
+        if key in options:
+            options[key] = _positive_int(key, options[key])
+    if INTERFACE_TYPE in options:
+        _choice(INTERFACE_TYPE, options[INTERFACE_TYPE], INTERFACE_TYPES)
+    if PLACEMENT_STRATEGY in options:
+        _choice(PLACEMENT_STRATEGY, options[PLACEMENT_STRATEGY],
+                PLACEMENT_STRATEGIES)
+    return options
+
+
+def apply_options(create_args, options, placement_group=None):
+    """Set the launch options on the arguments of RunInstances."""
+    if EBS_OPTIMIZED in options:
+        create_args['EbsOptimized'] = options[EBS_OPTIMIZED]
+    placement = create_args.setdefault('Placement', {})
+    if TENANCY in options:
+        placement['Tenancy'] = options[TENANCY]
+    if placement_group:
+        placement['GroupName'] = placement_group
+    cpu_options = {}
+    if CPU_CORES in options:
+        cpu_options['CoreCount'] = options[CPU_CORES]
+    if CPU_THREADS_PER_CORE in options:
+        cpu_options['ThreadsPerCore'] = options[CPU_THREADS_PER_CORE]
+    if cpu_options:
+        create_args['CpuOptions'] = cpu_options
+    if INTERFACE_TYPE in options:
+        create_args['NetworkInterfaces'] = [
+            dict(nic, InterfaceType=options[INTERFACE_TYPE])
+            for nic in create_args.get('NetworkInterfaces', [])]
+    return create_args
+
+
+def get_root_options(flavor_specs):
+    """Return the Ebs settings of the root volume asked by a flavor."""
+    specs = flavor_specs or {}
+    options = {}
+    if ROOT_VOLUME_TYPE in specs:
+        options['VolumeType'] = _choice(ROOT_VOLUME_TYPE,
+                                        specs[ROOT_VOLUME_TYPE],
+                                        sorted(volume_qos.EBS_LIMITS))
+    if ROOT_IOPS in specs:
+        options['Iops'] = _positive_int(ROOT_IOPS, specs[ROOT_IOPS])
+    if ROOT_THROUGHPUT in specs:
+        options['Throughput'] = _positive_int(ROOT_THROUGHPUT,
+                                              specs[ROOT_THROUGHPUT])
+    if ROOT_ENCRYPTED in specs:
+        try:
+            options['Encrypted'] = strutils.bool_from_string(
+                specs[ROOT_ENCRYPTED], strict=True)
+        except ValueError:
+            _invalid(ROOT_ENCRYPTED, specs[ROOT_ENCRYPTED],
+                     'must be a boolean')
+    if ROOT_KMS_KEY_ID in specs:
+        options['Encrypted'] = True
+        options['KmsKeyId'] = specs[ROOT_KMS_KEY_ID]
+    return options
+
+
+def apply_root_options(ebs, options):
+    """Tune the Ebs mapping of a root volume, checking the EBS limits."""
+    if not options:
+        return ebs
+    if 'VolumeType' in options:
+        # iops and throughput of the image do not carry over to another
+        # volume type
+        ebs.pop('Iops', None)
+        ebs.pop('Throughput', None)
+    ebs.update(options)
+    _validate_root(ebs)
+    return ebs
+
+
+def _validate_root(ebs):
+    """Check the Ebs mapping of a root volume against the EBS limits.
+
+    Without a VolumeSize the root volume gets the size of the image
+    snapshot, which is not known here, so iops per GiB are left to aws.
+    """
+    volume_type = ebs.get('VolumeType', DEFAULT_ROOT_VOLUME_TYPE)
+    if volume_type not in volume_qos.ROOT_VOLUME_TYPES:
+        _invalid(ROOT_VOLUME_TYPE, volume_type,
+                 'root volumes must be one of %s' %
+                 ', '.join(volume_qos.ROOT_VOLUME_TYPES))
+    reason = volume_qos.check_limits(volume_type, ebs,
+                                     ebs.get('VolumeSize') or None)
+    if reason:
+        _invalid(ROOT_VOLUME_TYPE, volume_type, reason)
+
+
+def instance_store_mappings(disk_count, block_device_mappings):
+    """Map the instance store volumes on device names still free."""
+    if any(bdm.get('VirtualName') for bdm in block_device_mappings):
+        # the image maps them itself
+        return []
+    used = set(device_allocator.get_device_letter(bdm.get('DeviceName'))
+               for bdm in block_device_mappings)
+    used.add('a')
+    letters = [letter for letter in device_allocator.ALL_LETTERS
+               if letter not in used]
+    return [{'DeviceName': device_allocator.get_device_name(letter),
+             'VirtualName': 'ephemeral%d' % i}
+            for i, letter in enumerate(letters[:disk_count])]
+
+
+class PlacementGroups(object):
+    """Creates the placement groups of server groups on first use."""
+
+    def __init__(self, aws_client):
+        self._aws_client = aws_client
+        self._known = set()
+        if CONF.aws.server_group_placement and compute_objects is None:
+            LOG.warn(_LW("Server groups can not be read, instances are "
+                         "launched into no placement group"))
+
+    @staticmethod
+    def _get_server_group(context, instance):
+        if compute_objects is None:
+            return None
+        try:
+            return compute_objects.InstanceGroup.get_by_instance_uuid(
+                context, instance.uuid)
+        except Exception:
+            return None
+
+    def get(self, context, instance, strategy=None):
+        """Return the placement group the instance is launched into."""
+        if not CONF.aws.server_group_placement:
+            if strategy:
+                LOG.warn(_LW("server_group_placement is off, the placement "
+                             "strategy %s is ignored"), strategy,
+                         instance=instance)
+            return None
+        group = self._get_server_group(context, instance)
+        if group is None:
+            if strategy:
+                LOG.warn(_LW("The instance is in no server group, the "
+                             "placement strategy %s is ignored"), strategy,
+                         instance=instance)
+            return None
+        if not strategy:
+            for policy in group.policies or []:
+                strategy = GROUP_POLICY_STRATEGIES.get(policy)
+                if strategy:
+                    break
+        if not strategy:
+            return None
+        name = PLACEMENT_GROUP_PREFIX + group.uuid
+        if name not in self._known:
+            with lockutils.lock('aws-placement-group-%s' % name):
+                if name not in self._known:
+                    self._create(context, name, strategy)
+                    self._known.add(name)
+        return name
+
+    def _create(self, context, name, strategy):
+        try:
+            self._aws_client.get_aws_client(context).create_placement_group(
+                GroupName=name, Strategy=strategy)
+            LOG.info(_LI("Created placement group %(name)s with strategy "
+                         "%(strategy)s"), {'name': name,
+                                           'strategy': strategy})
+        except exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code != 'InvalidPlacementGroup.Duplicate':
+                raise
@@ -0,0 +1,145 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Launch templates holding the shared arguments of RunInstances.
+
+A template is kept per project, provider flavor, image, subnets and
+security groups. The other shared arguments (cpu and ebs options) are
+stored as template versions: when they change a new version is created
+and the drift is logged. RunInstances then only carries what differs per
+instance, the placement included as its group follows the server group.
+
+The digest of the data sent is kept as the description of a version,
+aws describes a version's data in another shape than it was sent.
+"""
+
+import hashlib
+
+from botocore import exceptions
+from jacket import conf
+from jacket.i18n import _LI
+from jacket.i18n import _LW
+from oslo_concurrency import lockutils
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+LOG = logging.getLogger(__name__)
+
+launch_template_opts = [
+    cfg.BoolOpt('use_launch_templates',
+                default=False,
+                help='Launch instances from launch templates created per '
+                     'project, flavor, image, subnets and security groups '
+                     'instead of passing every argument to RunInstances.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(launch_template_opts, 'aws')
+
+TEMPLATE_PREFIX = 'caa-'
+
+# RunInstances arguments that stay per instance
+INSTANCE_KEYS = ('ClientToken', 'UserData', 'MinCount', 'MaxCount',
+                 'TagSpecifications', 'BlockDeviceMappings', 'Placement')
+# arguments selecting the template, the others select its version
+IDENTITY_KEYS = ('ImageId', 'InstanceType', 'NetworkInterfaces',
+                 'SecurityGroupIds')
+
+NOT_FOUND_CODES = ('InvalidLaunchTemplateName.NotFoundException',
+                   'InvalidLaunchTemplateId.NotFound')
+
+
+def template_name(project_id, template_data):
+    identity = jsonutils.dumps(
+        [project_id] + [template_data.get(key) for key in IDENTITY_KEYS],
+        sort_keys=True)
+    return TEMPLATE_PREFIX + hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def _digest(template_data):
+    data = jsonutils.dumps(template_data, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class LaunchTemplates(object):
+    """Caches the launch template and version of each launch config."""
+
+    def __init__(self, aws_client):
+        self._aws_client = aws_client
+        # template name -> {'id': ..., 'version': ..., 'digest': ...,
+        #                   'data': ...}, data only when sent by this driver
+        self._templates = {}
+
+    def prepare(self, context, create_args):
+        """Return RunInstances arguments launching from a template."""
+        template_data = dict((key, value)
+                             for key, value in create_args.items()
+                             if key not in INSTANCE_KEYS)
+        name = template_name(context.project_id, template_data)
+        digest = _digest(template_data)
+        aws_client = self._aws_client.get_aws_client(context)
+        with lockutils.lock('aws-launch-template-%s' % name):
+            template = self._templates.get(name)
+            if template is None:
+                template = self._load(aws_client, name)
+            if template is None:
+                response = aws_client.create_launch_template(
+                    LaunchTemplateName=name, VersionDescription=digest,
+                    LaunchTemplateData=template_data)
+                template = {'id': response['LaunchTemplateId'],
+                            'version': response['LatestVersionNumber']}
+                LOG.info(_LI("Created launch template %s"), name)
+            elif template['digest'] != digest:
+                data = template.get('data') or {}
+                changed = sorted(
+                    key for key in set(data) | set(template_data)
+                    if data.get(key) != template_data.get(key))
+                response = aws_client.create_launch_template_version(
+                    LaunchTemplateId=template['id'],
+                    VersionDescription=digest,
+                    LaunchTemplateData=template_data)
+                template['version'] = response['VersionNumber']
+                LOG.info(_LI("Launch config of template %(name)s drifted in "
+                             "%(keys)s, created version %(version)s"),
+                         {'name': name, 'keys': changed,
+                          'version': template['version']})
+            template['digest'] = digest
+            template['data'] = template_data
+            self._templates[name] = template
+
+        run_args = dict((key, value) for key, value in create_args.items()
+                        if key in INSTANCE_KEYS)
+        run_args['LaunchTemplate'] = {'LaunchTemplateId': template['id'],
+                                      'Version': str(template['version'])}
+        return run_args
+
+    def _load(self, aws_client, name):
+        """Find a template created before the driver was restarted."""
+        try:
+            templates = aws_client.describe_launch_templates(
+                LaunchTemplateNames=[name])
+        except exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in NOT_FOUND_CODES:
+                return None
+            raise
+        if not templates:
+            return None
+        template_id = templates[0]['LaunchTemplateId']
+        versions = aws_client.describe_launch_template_versions(
+            LaunchTemplateId=template_id, Versions=['$Latest'])
+        if not versions:
+            LOG.warn(_LW("Launch template %s has no version"), name)
+            return None
+        return {'id': template_id,
+                'version': versions[0]['VersionNumber'],
+                'digest': versions[0].get('VersionDescription')}
@@ -0,0 +1,118 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Background polling of provider resources changing state.
+
+The instance and snapshot trackers poll the resources of a driver from
+one green thread, started with the first tracked resource and ended once
+none is left. The resources of a project are described together, with
+filtered describe requests of at most FILTER_MAX_VALUES ids each.
+"""
+
+import collections
+import threading
+
+import eventlet
+
+from jacket import context as req_context
+from jacket.i18n import _LW
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# most values of a describe filter
+FILTER_MAX_VALUES = 200
+
+
+class ResourcePoller(object):
+    """Polls the tracked resources of a driver.
+
+    The items are kept in self._items under self._lock, keyed as the
+    subclass chooses, each with the 'project_id' it is polled for.
+    Subclasses set the class attributes and implement _interval,
+    _resource_id and _observe.
+
+    :param aws_client: the AwsClient of the driver owning the poller.
+    """
+
+    # describe method of AwsClientPlugin, its id filter, the id of a
+    # described resource and the resources named in logs
+    DESCRIBE = None
+    ID_FILTER = None
+    ID_KEY = None
+    RESOURCES = None
+
+    def __init__(self, aws_client):
+        self._aws_client = aws_client
+        self._items = {}
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def _interval(self):
+        """Return the seconds between two polls."""
+        raise NotImplementedError()
+
+    def _resource_id(self, key, item):
+        """Return the provider id of a tracked item."""
+        raise NotImplementedError()
+
+    def _observe(self, context, key, item, resource):
+        """Handle a described item, resource is None when it is gone."""
+        raise NotImplementedError()
+
+    def _start(self):
+        if self._worker is None or self._worker.dead:
+            self._worker = eventlet.spawn(self._run)
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self._interval())
+            if not self.poll():
+                return
+
+    def poll(self):
+        """Poll the tracked resources once, return how many are left."""
+        with self._lock:
+            projects = collections.defaultdict(dict)
+            for key, item in self._items.items():
+                resource_id = self._resource_id(key, item)
+                projects[item['project_id']][resource_id] = (key, item)
+        for project_id, items in projects.items():
+            context = req_context.RequestContext(is_admin=True,
+                                                 project_id=project_id)
+            try:
+                described = self._describe(context, list(items))
+                for resource_id, (key, item) in items.items():
+                    self._observe(context, key, item,
+                                  described.get(resource_id))
+            except Exception as e:
+                LOG.warn(_LW("Poll of the %(resources)s of project "
+                             "%(project)s failed: %(e)s"),
+                         {'resources': self.RESOURCES,
+                          'project': project_id, 'e': e})
+        with self._lock:
+            return len(self._items)
+
+    def _describe(self, context, resource_ids):
+        """Return {provider id: resource} of resource_ids still on aws."""
+        describe = getattr(self._aws_client.get_aws_client(context),
+                           self.DESCRIBE)
+        described = {}
+        for start in range(0, len(resource_ids), FILTER_MAX_VALUES):
+            # unlike a list of ids, a filter does not fail the whole
+            # request when one of the resources is gone
+            filters = [{'Name': self.ID_FILTER,
+                        'Values': resource_ids[start:start +
+                                               FILTER_MAX_VALUES]}]
+            for resource in describe(Filters=filters):
+                described[resource[self.ID_KEY]] = resource
+        return described
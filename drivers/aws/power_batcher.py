@@ -0,0 +1,118 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Batching of concurrent power actions into one Start/StopInstances.
+
+Scheduled stops and starts of many instances arrive as as many power_off
+and power_on calls at once. With batch_power_actions the changes a
+project asks for within power_action_window seconds are made with one
+StartInstances or StopInstances request. A project uses one account and
+region, so the batches are kept per project.
+
+Aws refuses the whole request when one of its instances can not change.
+The batch is then split in halves until the instances at fault are
+alone, each of them fails on its own and the others are changed. The
+client re-issues a request after a transient error, any other error
+fails the batch.
+"""
+
+from botocore import exceptions
+from jacket import conf
+from jacket.drivers.aws import batching
+from jacket.i18n import _LI
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+power_batcher_opts = [
+    cfg.BoolOpt('batch_power_actions',
+                default=False,
+                help='Start or stop the instances of a project powered on '
+                     'or off together with one request.'),
+    cfg.FloatOpt('power_action_window',
+                 default=0.2,
+                 help='Seconds a power action waits for the power actions '
+                      'of other instances to join its request.'),
+    cfg.IntOpt('power_action_batch_size',
+               default=1000,
+               help='Maximum number of instances started or stopped by one '
+                    'request.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(power_batcher_opts, 'aws')
+
+ACTIONS = ('start_instances', 'stop_instances')
+
+# errors aws gives for the request when some of its instances are at fault
+INSTANCE_ERROR_CODES = ('IncorrectInstanceState',)
+INSTANCE_ERROR_PREFIX = 'InvalidInstanceID.'
+
+
+def _is_instance_error(e):
+    if not isinstance(e, exceptions.ClientError):
+        return False
+    code = e.response.get('Error', {}).get('Code', '')
+    return (code in INSTANCE_ERROR_CODES or
+            code.startswith(INSTANCE_ERROR_PREFIX))
+
+
+class PowerActionBatcher(batching.WindowBatcher):
+    """Gathers the power actions of a project for power_action_window.
+
+    The changes are made without waiting for the instances, their
+    completion is left to the caller, usually an InstanceStateTracker.
+    """
+
+    def __init__(self, aws_client):
+        super(PowerActionBatcher, self).__init__()
+        self._aws_client = aws_client
+
+    def change(self, context, instance_id, action):
+        """Start or stop one instance, raise the error aws gave for it.
+
+        :param action: start_instances or stop_instances.
+        """
+        key = (context.project_id, action)
+        self._join(key, instance_id, context=context, action=action)
+
+    def _window(self):
+        return CONF.aws.power_action_window
+
+    def _max_size(self):
+        return CONF.aws.power_action_batch_size
+
+    def _dispatch(self, batch):
+        count = len(batch.members)
+        change = getattr(self._aws_client.get_aws_client(batch.context),
+                         batch.action)
+        errors = self._change(change, list(batch.members))
+        if count > 1:
+            LOG.info(_LI("Made %(action)s of %(count)s instances with one "
+                         "batch, %(failed)s failed"),
+                     {'action': batch.action, 'count': count,
+                      'failed': len(errors)})
+        return errors
+
+    def _change(self, change, instance_ids):
+        """Change instances, return {provider id: error} of the failed."""
+        try:
+            change(wait=False, InstanceIds=instance_ids)
+        except Exception as e:
+            if len(instance_ids) == 1 or not _is_instance_error(e):
+                return dict((instance_id, e) for instance_id in instance_ids)
+            middle = len(instance_ids) // 2
+            errors = self._change(change, instance_ids[:middle])
+            errors.update(self._change(change, instance_ids[middle:]))
+            return errors
+        return {}
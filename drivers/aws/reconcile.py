@@ -0,0 +1,303 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Reconciliation of the jacket mapper tables with the resources on aws.
+
+The aws side is read with one paginated DescribeTags sweep per resource
+type. The mapper rows of the tagged caa ids are read one by one with
+``<table>_mapper_get``, or all at once when the jacket db api offers a
+bulk ``<table>_mapper_all``. Mapped provider ids that carry no caa tag
+and the resources lacking a row are checked with batched describe calls.
+The run reports three kinds of drift:
+
+* missing: a tagged aws resource that has no mapper row,
+* stale: a mapper row pointing at a resource that is gone while another
+  resource carries its caa tag,
+* orphan: a mapper row pointing at a resource that is gone. Only a bulk
+  read finds the rows of caa ids no resource is tagged with. The jacket
+  db api has no ``<table>_mapper_all``, so against it orphans are never
+  found.
+
+A table the db api can not read is skipped with a warning.
+
+Spawns and creates tag their resource before they write its mapper, so
+resources younger than CONF.aws.reconcile_grace_period are not reported
+missing. Drift is only reported: the owning project of a resource
+without a row is not known to the reconciliation, and a row pointing at
+a gone resource may still be needed to finish an operation.
+"""
+
+import calendar
+import datetime
+import eventlet
+import time
+
+from jacket import conf
+from jacket import exception
+from jacket.i18n import _LI
+from jacket.i18n import _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+reconcile_opts = [
+    cfg.IntOpt('reconcile_interval',
+               default=0,
+               help='Seconds between two reconciliations of the mapper '
+                    'tables with aws. Reconciliation is disabled when 0.'),
+    cfg.IntOpt('reconcile_grace_period',
+               default=300,
+               help='Seconds a new aws resource may go without a mapper '
+                    'row before the reconciliation reports it missing.'),
+    cfg.ListOpt('reconcile_resources',
+                default=['instance', 'volume', 'snapshot'],
+                help='Resource types the reconciliation checks.'),
+    cfg.IntOpt('reconcile_workers',
+               default=2,
+               help='Number of aws requests the reconciliation issues '
+                    'concurrently.'),
+    cfg.IntOpt('reconcile_batch_size',
+               default=200,
+               help='Number of resources checked per batch.'),
+    cfg.IntOpt('reconcile_api_budget',
+               default=1000,
+               help='Maximum number of aws requests of one reconciliation. '
+                    'A run that exhausts it stops and reports what it '
+                    'found so far.'),
+    cfg.FloatOpt('reconcile_api_rate',
+                 default=2.0,
+                 help='Maximum number of aws requests per second issued by '
+                      'the reconciliation, leaving the rest of the account '
+                      'rate limit to foreground requests.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(reconcile_opts, 'aws')
+
+
+class _Kind(object):
+
+    def __init__(self, resource_type, tag_key, tables, operation,
+                 result_key, id_key, id_filter, time_key,
+                 describe_kwargs=None):
+        self.resource_type = resource_type
+        self.tag_key = tag_key
+        # mapper table name -> mapper value holding the provider id
+        self.tables = tables
+        self.operation = operation
+        self.result_key = result_key
+        self.id_key = id_key
+        self.id_filter = id_filter
+        # field holding the creation time of a described resource
+        self.time_key = time_key
+        self.describe_kwargs = describe_kwargs or {}
+
+
+KINDS = {
+    'instance': _Kind('instance', 'caa_instance_id',
+                      {'instance': 'provider_instance_id'},
+                      'describe_instances', 'Reservations', 'InstanceId',
+                      'instance-id', 'LaunchTime'),
+    'volume': _Kind('volume', 'caa_volume_id',
+                    {'volume': 'provider_volume_id'},
+                    'describe_volumes', 'Volumes', 'VolumeId', 'volume-id',
+                    'CreateTime'),
+    # NOTE: snapshots and backups both carry the caa_snapshot_id tag, the
+    # backup rows are written to volume_backup but read through backup
+    'snapshot': _Kind('snapshot', 'caa_snapshot_id',
+                      {'volume_snapshot': 'provider_snapshot_id',
+                       'backup': 'provider_backup_id'},
+                      'describe_snapshots', 'Snapshots', 'SnapshotId',
+                      'snapshot-id', 'StartTime', {'OwnerIds': ['self']}),
+}
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class ApiBudget(object):
+    """Caps the number and the rate of aws requests of one run."""
+
+    def __init__(self, max_calls, rate):
+        self.max_calls = max_calls
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.calls = 0
+        self._next_call = 0
+
+    def spend(self):
+        if self.calls >= self.max_calls:
+            raise BudgetExhausted()
+        self.calls += 1
+        now = time.time()
+        if self._next_call > now:
+            eventlet.sleep(self._next_call - now)
+            now = self._next_call
+        self._next_call = now + self.interval
+
+
+def _created_before(kind, resource, oldest):
+    """Whether a described resource was created before oldest."""
+    created_at = resource.get(kind.time_key)
+    if isinstance(created_at, datetime.datetime):
+        created_at = calendar.timegm(created_at.utctimetuple())
+    return created_at is None or created_at <= oldest
+
+
+def _batches(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Reconciler(object):
+
+    def __init__(self, aws_client, caa_db_api):
+        self._aws_client = aws_client
+        self._db_api = caa_db_api
+
+    def run(self, context):
+        """Reconcile the mappers of the context's project with aws.
+
+        :returns: a report with the drift found per resource type.
+        """
+        budget = ApiBudget(CONF.aws.reconcile_api_budget,
+                           CONF.aws.reconcile_api_rate)
+        report = {'complete': True, 'api_calls': 0}
+        try:
+            for name in CONF.aws.reconcile_resources:
+                kind = KINDS.get(name)
+                if kind is None:
+                    LOG.warn(_LW("Unknown reconcile resource %s"), name)
+                    continue
+                report[name] = self._reconcile(context, kind, budget)
+        except BudgetExhausted:
+            LOG.warn(_LW("Reconciliation stopped after %s aws requests, "
+                         "the api budget is exhausted"), budget.calls)
+            report['complete'] = False
+        report['api_calls'] = budget.calls
+        LOG.info(_LI("Reconciliation of project %(project)s: %(report)s"),
+                 {'project': context.project_id, 'report': report})
+        return report
+
+    def _reconcile(self, context, kind, budget):
+        tagged = self._read_tags(context, kind, budget)
+        mappers = self._read_mappers(context, kind, tagged)
+
+        result = {'missing': [], 'stale': [], 'orphan': []}
+        unverified = []
+        mapped_ids = set()
+        for table, rows in mappers.items():
+            for caa_id, provider_id in rows.items():
+                mapped_ids.add(caa_id)
+                if provider_id not in tagged.get(caa_id, ()):
+                    unverified.append((table, caa_id, provider_id))
+        unmapped = [(caa_id, tagged[caa_id])
+                    for caa_id in set(tagged) - mapped_ids]
+
+        described = self._describe(
+            context, kind, budget,
+            [item[2] for item in unverified] +
+            [provider_id for _caa_id, provider_ids in unmapped
+             for provider_id in provider_ids])
+        oldest = time.time() - CONF.aws.reconcile_grace_period
+        for caa_id, provider_ids in unmapped:
+            # skip resources gone since the sweep or still being created
+            provider_ids = [provider_id for provider_id in provider_ids
+                            if provider_id in described and
+                            _created_before(kind, described[provider_id],
+                                            oldest)]
+            if provider_ids:
+                result['missing'].append((caa_id, sorted(provider_ids)))
+        for table, caa_id, provider_id in unverified:
+            if provider_id in described:
+                # an untagged resource, e.g. created before tagging failed
+                continue
+            if caa_id in tagged:
+                result['stale'].append((table, caa_id, provider_id,
+                                        sorted(tagged[caa_id])))
+            else:
+                result['orphan'].append((table, caa_id, provider_id))
+        result['missing'].sort()
+        return result
+
+    def _read_mappers(self, context, kind, tagged):
+        """Return {table: {caa_id: provider_id}} of a resource type."""
+        mappers = {}
+        for table, value_key in kind.tables.items():
+            read_all = getattr(self._db_api, '%s_mapper_all' % table, None)
+            read = getattr(self._db_api, '%s_mapper_get' % table, None)
+            if read_all is not None:
+                rows = read_all(context) or {}
+            elif read is not None:
+                rows = self._read_rows(context, read, tagged)
+            else:
+                LOG.warn(_LW("Cannot read the %s mappers, skip them"),
+                         table)
+                continue
+            mappers[table] = dict((caa_id, values.get(value_key))
+                                  for caa_id, values in rows.items()
+                                  if values.get(value_key))
+        return mappers
+
+    def _read_rows(self, context, read, caa_ids):
+        """Read the mapper rows of caa_ids one by one."""
+        rows = {}
+        for batch in _batches(caa_ids, CONF.aws.reconcile_batch_size):
+            for caa_id in batch:
+                try:
+                    values = read(context, caa_id)
+                except exception.EntityNotFound:
+                    continue
+                if values:
+                    rows[caa_id] = values
+            # let foreground requests use the db between two batches
+            eventlet.sleep(0)
+        return rows
+
+    def _read_tags(self, context, kind, budget):
+        """Return {caa_id: set(provider_ids)} of the tagged resources."""
+        aws_client = self._aws_client.get_aws_client(context)
+        filters = [{'Name': 'key', 'Values': [kind.tag_key]},
+                   {'Name': 'resource-type', 'Values': [kind.resource_type]}]
+        tagged = {}
+        for page in aws_client.paginate('describe_tags', 'Tags',
+                                        before_call=budget.spend,
+                                        Filters=filters, MaxResults=1000):
+            for tag in page:
+                tagged.setdefault(tag['Value'], set()).add(tag['ResourceId'])
+        return tagged
+
+    def _describe(self, context, kind, budget, provider_ids):
+        """Return {provider_id: resource} of provider_ids still on aws."""
+        aws_client = self._aws_client.get_aws_client(context)
+        described = {}
+
+        def _describe(batch):
+            kwargs = dict(kind.describe_kwargs)
+            kwargs['Filters'] = [{'Name': kind.id_filter, 'Values': batch}]
+            found = {}
+            for page in aws_client.paginate(kind.operation, kind.result_key,
+                                            before_call=budget.spend,
+                                            **kwargs):
+                if kind.result_key == 'Reservations':
+                    page = [instance for reservation in page
+                            for instance in reservation.get('Instances', [])]
+                found.update((item[kind.id_key], item) for item in page)
+            return found
+
+        pool = eventlet.GreenPool(CONF.aws.reconcile_workers)
+        batches = _batches(set(provider_ids), CONF.aws.reconcile_batch_size)
+        for found in pool.imap(_describe, batches):
+            described.update(found)
+        return described
@@ -0,0 +1,139 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Background tracking of provider snapshots until they complete.
+
+With async_snapshots the drivers return as soon as aws accepted a
+snapshot and its mapper is written, instead of holding a worker until the
+snapshot completes, which takes tens of minutes for large volumes. The
+volume and backup managers mark the snapshot or backup available as soon
+as the driver returns, volumes are only created from the snapshot once
+it completed. The tracker then polls the pending snapshots of a driver,
+all of a project in one DescribeSnapshots request, and hands their final
+state to the driver, which marks a failed one in error. Progress is not
+reported, it would be written over the available status.
+
+The pending snapshots are tagged with the caa id, so a restarted driver
+resumes tracking them with resume().
+"""
+
+from jacket import conf
+from jacket.drivers.aws import poller
+from jacket.i18n import _LE
+from jacket.i18n import _LI
+from jacket.i18n import _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+snapshot_tracker_opts = [
+    cfg.BoolOpt('async_snapshots',
+                default=True,
+                help='Return from snapshot and backup creation once aws '
+                     'accepted the snapshot, and track its completion in '
+                     'the background. Volumes are only created from a '
+                     'snapshot once it completed.'),
+    cfg.IntOpt('snapshot_poll_interval',
+               default=10,
+               help='Seconds between two polls of the pending snapshots.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(snapshot_tracker_opts, 'aws')
+
+FINAL_STATES = ('completed', 'error')
+
+# tag holding the caa id of the snapshot or backup a snapshot was taken for
+TAG_KEY = 'caa_snapshot_id'
+
+
+class SnapshotTracker(poller.ResourcePoller):
+    """Polls pending provider snapshots from a green thread.
+
+    :param aws_client: the AwsClient of the driver owning the tracker.
+    :param on_update: called as on_update(context, caa_id, state) once a
+                      snapshot reaches a final state, or with None as
+                      state when the snapshot disappeared.
+    """
+
+    DESCRIBE = 'describe_snapshots'
+    ID_FILTER = 'snapshot-id'
+    ID_KEY = 'SnapshotId'
+    RESOURCES = 'pending aws snapshots'
+
+    def __init__(self, aws_client, on_update):
+        super(SnapshotTracker, self).__init__(aws_client)
+        # items: caa id -> {'project_id', 'snapshot_id'}
+        self._on_update = on_update
+
+    def track(self, context, caa_id, snapshot_id):
+        with self._lock:
+            self._items[caa_id] = {'project_id': context.project_id,
+                                   'snapshot_id': snapshot_id}
+        self._start()
+
+    def resume(self, context, owned):
+        """Track the pending snapshots of the context's account again.
+
+        :param owned: called as owned(context, caa_id), whether a pending
+                      snapshot tagged with caa_id belongs to the driver.
+        :returns: the number of snapshots tracked again.
+        """
+        filters = [{'Name': 'status', 'Values': ['pending']},
+                   {'Name': 'tag-key', 'Values': [TAG_KEY]}]
+        snapshots = self._aws_client.get_aws_client(context).\
+            describe_snapshots(Filters=filters)
+        count = 0
+        for snapshot in snapshots:
+            tags = dict((tag['Key'], tag['Value'])
+                        for tag in snapshot.get('Tags', []))
+            caa_id = tags.get(TAG_KEY)
+            if caa_id and owned(context, caa_id):
+                self.track(context, caa_id, snapshot['SnapshotId'])
+                count += 1
+        if count:
+            LOG.info(_LI("Resumed tracking of %d pending aws snapshots"),
+                     count)
+        return count
+
+    def forget(self, caa_id):
+        with self._lock:
+            self._items.pop(caa_id, None)
+
+    def tracked(self):
+        with self._lock:
+            return dict((caa_id, item['snapshot_id'])
+                        for caa_id, item in self._items.items())
+
+    def _interval(self):
+        return CONF.aws.snapshot_poll_interval
+
+    def _resource_id(self, caa_id, item):
+        return item['snapshot_id']
+
+    def _observe(self, context, caa_id, item, snapshot):
+        state = snapshot.get('State') if snapshot else None
+        if state is not None and state not in FINAL_STATES:
+            return
+        with self._lock:
+            if self._items.get(caa_id) is not item:
+                return
+            del self._items[caa_id]
+        if state is None:
+            LOG.warn(_LW("Tracked aws snapshot %(snap)s of %(id)s is gone"),
+                     {'snap': item['snapshot_id'], 'id': caa_id})
+        try:
+            self._on_update(context, caa_id, state)
+        except Exception as e:
+            LOG.error(_LE("Update of snapshot %(id)s to %(state)s failed: "
+                          "%(e)s"), {'id': caa_id, 'state': state, 'e': e})
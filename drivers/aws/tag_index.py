@@ -0,0 +1,160 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Local index from caa ids to the provider resources tagged with them."""
+
+import time
+
+from jacket import conf
+from jacket.i18n import _LI
+from oslo_concurrency import lockutils
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+tag_index_opts = [
+    cfg.IntOpt('tag_index_ttl',
+               default=600,
+               help='Seconds the index of caa_*_id tags is trusted before '
+                    'it is rebuilt from DescribeTags. Resources are looked '
+                    'up with a tag filter for every call when set to 0.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(tag_index_opts, 'aws')
+
+INSTANCE = 'instance'
+VOLUME = 'volume'
+SNAPSHOT = 'snapshot'
+
+TAG_KEYS = {INSTANCE: 'caa_instance_id',
+            VOLUME: 'caa_volume_id',
+            SNAPSHOT: 'caa_snapshot_id'}
+
+DESCRIBE_TAGS_PAGE_SIZE = 1000
+
+
+class _ProjectIndex(object):
+
+    def __init__(self):
+        self.built_at = None
+        self.ids = dict((resource_type, {}) for resource_type in TAG_KEYS)
+        self.owners = dict((resource_type, {}) for resource_type in TAG_KEYS)
+
+    def is_fresh(self):
+        return self.built_at is not None and \
+            self.built_at + CONF.aws.tag_index_ttl > time.time()
+
+    def add(self, resource_type, caa_id, provider_id):
+        self.ids[resource_type].setdefault(caa_id, set()).add(provider_id)
+        self.owners[resource_type][provider_id] = caa_id
+
+    def discard(self, resource_type, provider_id):
+        caa_id = self.owners[resource_type].pop(provider_id, None)
+        provider_ids = self.ids[resource_type].get(caa_id)
+        if provider_ids is not None:
+            provider_ids.discard(provider_id)
+            if not provider_ids:
+                del self.ids[resource_type][caa_id]
+
+
+class TagIndex(object):
+    """Maps caa ids to provider resource ids, per project.
+
+    The index is built from one paginated DescribeTags sweep and kept up to
+    date by the drivers when they tag or delete resources, so looking up a
+    resource whose mapper is missing does not scan the account with a tag
+    filter. The sweep is repeated once the index is older than
+    CONF.aws.tag_index_ttl.
+
+    Another service or process may tag resources after the sweep, so a
+    caa id missing from an index it did not just build is looked up with
+    a DescribeTags filtered on its value, and what is found is added.
+    """
+
+    def __init__(self, aws_client):
+        self._aws_client = aws_client
+        self._projects = {}
+
+    @staticmethod
+    def enabled():
+        return CONF.aws.tag_index_ttl > 0
+
+    def _get(self, context):
+        """Return the index of a project and whether this call built it."""
+        project_id = context.project_id
+        index = self._projects.get(project_id)
+        if index is not None and index.is_fresh():
+            return index, False
+        with lockutils.lock('aws-tag-index-%s' % project_id):
+            index = self._projects.get(project_id)
+            if index is not None and index.is_fresh():
+                return index, False
+            index = self._build(context)
+            self._projects[project_id] = index
+        return index, True
+
+    def _build(self, context):
+        index = _ProjectIndex()
+        start = time.time()
+        filters = [{'Name': 'key', 'Values': list(TAG_KEYS.values())}]
+        tags = self._aws_client.get_aws_client(context).describe_tags(
+            Filters=filters, MaxResults=DESCRIBE_TAGS_PAGE_SIZE)
+        for tag in tags:
+            resource_type = tag.get('ResourceType')
+            if TAG_KEYS.get(resource_type) != tag.get('Key'):
+                continue
+            index.add(resource_type, tag.get('Value'), tag.get('ResourceId'))
+        index.built_at = start
+        LOG.info(_LI("Built aws tag index of project %(project)s from "
+                     "%(n)s tags"),
+                 {'project': context.project_id, 'n': len(tags)})
+        return index
+
+    def lookup(self, context, resource_type, caa_id):
+        """Return the ids of the provider resources tagged with caa_id."""
+        index, built = self._get(context)
+        provider_ids = index.ids[resource_type].get(caa_id)
+        if not provider_ids and not built:
+            provider_ids = self._refresh(context, index, resource_type,
+                                         caa_id)
+        return sorted(provider_ids or ())
+
+    def _refresh(self, context, index, resource_type, caa_id):
+        filters = [{'Name': 'key', 'Values': [TAG_KEYS[resource_type]]},
+                   {'Name': 'value', 'Values': [caa_id]},
+                   {'Name': 'resource-type', 'Values': [resource_type]}]
+        tags = self._aws_client.get_aws_client(context).describe_tags(
+            Filters=filters)
+        for tag in tags:
+            index.add(resource_type, caa_id, tag.get('ResourceId'))
+        return index.ids[resource_type].get(caa_id)
+
+    def add(self, context, resource_type, caa_id, provider_id):
+        """Record a resource the driver just tagged with caa_id."""
+        index = self._projects.get(context.project_id)
+        if index is not None:
+            index.add(resource_type, caa_id, provider_id)
+
+    def discard(self, context, resource_type, provider_id):
+        """Forget a resource the driver just deleted."""
+        index = self._projects.get(context.project_id)
+        if index is not None:
+            index.discard(resource_type, provider_id)
+
+    def invalidate(self, context=None):
+        """Force the next lookup to sweep the tags again."""
+        if context is None:
+            self._projects.clear()
+        else:
+            self._projects.pop(context.project_id, None)
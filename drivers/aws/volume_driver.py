@@ -16,11 +16,20 @@
 Volume Drivers for Amazon EC2 Block Storage
 """
 
+import collections
+
 from jacket import conf
 from jacket import context as req_context
 from jacket.db.extend import api as caa_db_api
+from jacket.drivers.aws import capacity
+from jacket.drivers.aws import cleanup
 from jacket.drivers.aws import client
+from jacket.drivers.aws import clone_snapshots
 from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws import group_snapshots
+from jacket.drivers.aws import snapshot_tracker
+from jacket.drivers.aws import tag_index
+from jacket.drivers.aws import volume_qos
 from jacket import exception
 from jacket.i18n import _LE, _LI, _
 from jacket.storage.backup.driver import BackupDriver
@@ -33,14 +42,29 @@ LOG = logging.getLogger(__name__)
 
 CONF = conf.CONF
 
+# get_backup_driver builds a driver per backup request. The backup drivers
+# of a process share their clients, snapshot tracker and batcher, so that
+# concurrent backups are batched and tracked together and the backup
+# cleanup journal is loaded once.
+_BACKUP_STATE = {}
+
 
 class BaseDriver(object):
+    CLEANUP_QUEUE_NAME = 'volume'
 
     def __init__(self, *args, **kwargs):
         super(BaseDriver, self).__init__(*args, **kwargs)
-        self._aws_client = client.AwsClient()
+        self._init_clients()
+        self._volume_type_args = volume_qos.VolumeTypeArgs()
         self.caa_db_api = caa_db_api
 
+    def _init_clients(self):
+        self._aws_client = client.AwsClient()
+        self._cleanup_queue = cleanup.CleanupQueue(self._aws_client,
+                                                   self.CLEANUP_QUEUE_NAME)
+        self._aws_client.cleanup_queue = self._cleanup_queue
+        self._tag_index = tag_index.TagIndex(self._aws_client)
+
     def _get_project_mapper(self, context, project_id=None):
         if project_id is None:
             project_id = 'aws_default'
@@ -61,6 +85,13 @@ class BaseDriver(object):
             LOG.error(_LE("type_mapper not found! ex = %s"), ex)
         return provider_type
 
+    @staticmethod
+    def _get_pool_volume_type(volume):
+        """Return the EBS volume type of the pool the volume was put on."""
+        pool = (getattr(volume, 'host', None) or '').partition('#')[2]
+        if pool in capacity.VolumeCapacityTracker.pool_types():
+            return pool
+
     def _get_provider_az(self, context, availability_zone):
         provider_az = None
         try:
@@ -85,6 +116,9 @@ class BaseDriver(object):
         return provider_volume_id
 
     def _get_provider_volume(self, context, volume_id):
+        if self._tag_index.enabled():
+            return self._tag_index.lookup(context, tag_index.VOLUME,
+                                          volume_id)
         volumes = []
         filters = [{'Name': 'tag:caa_volume_id',
                     'Values': [volume_id]}]
@@ -95,6 +129,8 @@ class BaseDriver(object):
         return volumes
 
     def _get_provider_snapshot(self, context, os_id):
+        if self._tag_index.enabled():
+            return self._tag_index.lookup(context, tag_index.SNAPSHOT, os_id)
         snapshots = []
         filters = [{'Name': 'tag:caa_snapshot_id',
                     'Values': [os_id]}]
@@ -119,9 +155,9 @@ class BaseDriver(object):
 
     def _create_volume(self, volume, context, new_size=None,
                        new_type=None, snapshot=None):
-        provider_type = self._get_provider_type_name(
-            context, new_type or volume.volume_type_id
-        )
+        type_id = new_type.get('id') if isinstance(new_type, dict) \
+            else new_type or volume.volume_type_id
+        provider_type = self._get_provider_type_name(context, type_id)
         provider_az = self._get_provider_az(
             context, volume.availability_zone
         )
@@ -130,12 +166,28 @@ class BaseDriver(object):
                    volume.id)
             LOG.error(msg)
             raise cinder_ex.VolumeBackendAPIException(data=msg)
+        try:
+            type_args = self._volume_type_args.get(context, type_id)
+            volume_type = (type_args.pop('VolumeType', None) or
+                           provider_type or
+                           self._get_pool_volume_type(volume) or
+                           'standard')
+            volume_qos.validate(type_id, volume_type, type_args,
+                                new_size or volume.size)
+        except exception_ex.InvalidVolumeQos as ex:
+            msg = (_("create provider volume failed vol:%(id)s, %(ex)s") %
+                   {'id': volume.id, 'ex': ex})
+            LOG.error(msg)
+            raise cinder_ex.VolumeBackendAPIException(data=msg)
         volume_args = {'AvailabilityZone': provider_az,
-                       'VolumeType': provider_type or 'standard',
+                       'VolumeType': volume_type,
                        'Size': new_size or volume.size}
+        volume_args.update(type_args)
         if snapshot:
             volume_args['SnapshotId'] = snapshot
+        volume_args['ClientToken'] = client.client_token(volume.id)
 
+        provider_vol = None
         try:
             provider_vol = self._aws_client.get_aws_client(context).\
                 create_volume(**volume_args)
@@ -144,7 +196,13 @@ class BaseDriver(object):
             self._aws_client.get_aws_client(context).\
                 create_tags(Resources=[provider_vol['VolumeId']],
                             Tags=tags)
+            self._tag_index.add(context, tag_index.VOLUME, volume.id,
+                                provider_vol['VolumeId'])
         except Exception as ex:
+            if provider_vol:
+                self._cleanup_queue.enqueue(context.project_id,
+                                            cleanup.VOLUME,
+                                            provider_vol['VolumeId'])
             LOG.error(_LE("create provider volume failed! vol:%(id)s,"
                           " ex = %(ex)s"), {'id': volume.id, 'ex': ex})
             msg = (_("create provider volume failed vol:%s") % volume.id)
@@ -152,18 +210,18 @@ class BaseDriver(object):
 
         return provider_vol
 
-    def _create_snapshot(self, context, provider_vol, os_id):
+    def _create_snapshot(self, context, provider_vol, os_id, wait=True):
         try:
-            snapshot_args = {'VolumeId': provider_vol}
-            provider_snap = self._aws_client.get_aws_client(context).\
-                create_snapshot(**snapshot_args)
-            # create remote volume mapper
+            # tag on creation, a retry after a network error finds the
+            # snapshot by its tag
             tags = [{'Key': 'caa_snapshot_id', 'Value': os_id}]
-            self._aws_client.get_aws_client(context).\
-                create_tags(
-                Resources=[provider_snap['SnapshotId']],
-                Tags=tags
-            )
+            tag_specs = [{'ResourceType': 'snapshot', 'Tags': tags}]
+            snapshot_args = {'VolumeId': provider_vol,
+                             'TagSpecifications': tag_specs}
+            provider_snap = self._aws_client.get_aws_client(context).\
+                create_snapshot(wait=wait, **snapshot_args)
+            self._tag_index.add(context, tag_index.SNAPSHOT, os_id,
+                                provider_snap['SnapshotId'])
         except Exception as ex:
             LOG.error(_LE("create provider snapshot failed! os_id:%(os_id)s,"
                           " ex = %(ex)s"), {'os_id': os_id, 'ex': ex})
@@ -171,12 +229,178 @@ class BaseDriver(object):
             raise cinder_ex.VolumeBackendAPIException(data=msg)
         return provider_snap
 
+    def _wait_snapshot_usable(self, context, provider_snap):
+        """Wait for the snapshot a volume is created from to complete.
+
+        A gone or failed snapshot fails at once, a completed one costs no
+        request once its final state is cached.
+        """
+        aws_client = self._aws_client.get_aws_client(context)
+        state = aws_client.get_snapshot_state(provider_snap)
+        if state is None or state == 'error':
+            reason = 'aws snapshot %s is %s' % (provider_snap,
+                                                state or 'gone')
+            raise exception_ex.ProviderCreateVolumeFailed(reason=reason)
+        if state != 'completed':
+            aws_client.wait_snapshot_completed(provider_snap)
+
+    def _delete_provider_snapshot(self, context, provider_snap):
+        """Delete a snapshot, one already gone counts as deleted."""
+        try:
+            self._aws_client.get_aws_client(context).\
+                delete_snapshot(SnapshotId=provider_snap)
+        except Exception as e:
+            if not cleanup.is_not_found(e):
+                raise
+            LOG.info(_LI("Aws snapshot %s is already deleted"),
+                     provider_snap)
+        self._tag_index.discard(context, tag_index.SNAPSHOT, provider_snap)
+
+    def _get_attached_instance_id(self, context, volume):
+        """Return the provider instance a volume is attached to, if any."""
+        if getattr(volume, 'attach_status', None) != 'attached':
+            return None
+        for attachment in getattr(volume, 'volume_attachment', None) or []:
+            try:
+                instance_mapper = self.caa_db_api.instance_mapper_get(
+                    context, attachment['instance_uuid'])
+            except exception.EntityNotFound:
+                continue
+            provider_instance_id = instance_mapper.get('provider_instance_id')
+            if provider_instance_id:
+                return provider_instance_id
+        return None
+
+    def _create_snapshots(self, context, volumes, group_id, wait=True,
+                          instance_id=None):
+        """Snapshot several volumes, those of an instance at once.
+
+        The volumes attached to the same instance are snapshotted with one
+        CreateSnapshots request, so that their snapshots are crash
+        consistent. The other volumes of the instance are excluded from
+        the request. The other volumes, and those the request did not
+        cover, are snapshotted one by one.
+
+        :param volumes: {caa id: volume}
+        :param group_id: tagged on the snapshots taken at once.
+        :param instance_id: the provider instance all the volumes are
+                            attached to, looked up per volume if None.
+        :returns: {caa id: provider snapshot}
+        """
+        snapshots = {}
+        try:
+            aws_client = self._aws_client.get_aws_client(context)
+            provider_vols = {}
+            instances = collections.defaultdict(list)
+            for caa_id, volume in volumes.items():
+                provider_vols[caa_id] = self._get_provider_volume_id(context,
+                                                                     volume)
+                attached_to = instance_id or \
+                    self._get_attached_instance_id(context, volume)
+                if attached_to:
+                    instances[attached_to].append(caa_id)
+            instances = dict((attached_to, members) for attached_to, members
+                             in instances.items() if len(members) > 1)
+            caa_ids = dict((provider_vol, caa_id) for caa_id, provider_vol
+                           in provider_vols.items())
+            tags = [{'Key': group_snapshots.GROUP_TAG, 'Value': group_id}]
+            described = {}
+            if instances:
+                # unlike InstanceIds, a filter does not fail the whole
+                # request when one of the instances is gone
+                filters = [{'Name': 'instance-id',
+                            'Values': list(instances)}]
+                for instance in aws_client.describe_instances(
+                        Filters=filters):
+                    described[instance['InstanceId']] = instance
+            for attached_to, members in instances.items():
+                instance = described.get(attached_to)
+                if instance is None:
+                    continue
+                spec = self._instance_specification(
+                    instance, set(provider_vols[m] for m in members))
+                for snapshot in aws_client.create_snapshots(
+                        wait=wait, InstanceSpecification=spec,
+                        TagSpecifications=[{'ResourceType': 'snapshot',
+                                            'Tags': tags}]):
+                    caa_id = caa_ids.get(snapshot['VolumeId'])
+                    if caa_id:
+                        snapshots[caa_id] = snapshot
+                    else:
+                        # attached since the instance was described
+                        self._cleanup_queue.enqueue(context.project_id,
+                                                    cleanup.SNAPSHOT,
+                                                    snapshot['SnapshotId'])
+            for caa_id, snapshot in snapshots.items():
+                # as _create_snapshot tags on creation, a snapshot is found
+                # by the caa id it was taken for
+                aws_client.create_tags(
+                    Resources=[snapshot['SnapshotId']],
+                    Tags=[{'Key': 'caa_snapshot_id', 'Value': caa_id}])
+                self._tag_index.add(context, tag_index.SNAPSHOT, caa_id,
+                                    snapshot['SnapshotId'])
+            for caa_id, provider_vol in provider_vols.items():
+                if caa_id not in snapshots:
+                    snapshots[caa_id] = self._create_snapshot(
+                        context, provider_vol, caa_id, wait=wait)
+        except Exception as ex:
+            for snapshot in snapshots.values():
+                self._cleanup_queue.enqueue(context.project_id,
+                                            cleanup.SNAPSHOT,
+                                            snapshot['SnapshotId'])
+            LOG.error(_LE("create provider snapshots of group %(id)s "
+                          "failed! ex = %(ex)s"), {'id': group_id, 'ex': ex})
+            msg = (_("create provider snapshots failed group:%s") % group_id)
+            raise cinder_ex.VolumeBackendAPIException(data=msg)
+        return snapshots
+
+    @staticmethod
+    def _instance_specification(instance, provider_vols):
+        """Return a CreateSnapshots spec of the given volumes only."""
+        root_device = instance.get('RootDeviceName')
+        exclude_boot = True
+        excluded = []
+        for bdm in instance.get('BlockDeviceMappings', []):
+            volume_id = bdm.get('Ebs', {}).get('VolumeId')
+            if volume_id is None:
+                continue
+            if bdm.get('DeviceName') == root_device:
+                exclude_boot = volume_id not in provider_vols
+            elif volume_id not in provider_vols:
+                excluded.append(volume_id)
+        spec = {'InstanceId': instance['InstanceId'],
+                'ExcludeBootVolume': exclude_boot}
+        if excluded:
+            spec['ExcludeDataVolumeIds'] = excluded
+        return spec
+
 
 class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
     CLOUD_DRIVER = True
 
     def __init__(self, *args, **kwargs):
         super(AwsVolumeDriver, self).__init__(*args, **kwargs)
+        self._capacity = capacity.VolumeCapacityTracker(self._aws_client)
+        self._snapshot_tracker = snapshot_tracker.SnapshotTracker(
+            self._aws_client, self._snapshot_updated)
+        self._clone_snapshots = clone_snapshots.CloneSnapshotCache(
+            self._aws_client, self._cleanup_queue, self.host)
+
+    def _snapshot_updated(self, context, snapshot_id, state):
+        # the volume manager marked the snapshot available already
+        if state == 'completed':
+            return
+        LOG.error(_LE("Aws snapshot of snapshot %(id)s failed, "
+                      "state: %(state)s"),
+                  {'id': snapshot_id, 'state': state})
+        self.db.snapshot_update(context, snapshot_id, {'status': 'error'})
+
+    def _snapshot_owned(self, context, snapshot_id):
+        try:
+            self.db.snapshot_get(context, snapshot_id)
+        except cinder_ex.SnapshotNotFound:
+            return False
+        return True
 
     def _modify_volume(self, volume, new_size=None, new_type=None):
         context = req_context.RequestContext(is_admin=True,
@@ -208,11 +432,13 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
                                                  context.project_id, values)
         except Exception as ex:
             LOG.error(_LE("volume_mapper_create failed! ex = %s"), ex)
-            self._aws_client.get_aws_client(context).\
-                delete_volume(VolumeId=provider_vol['VolumeId'])
+            self._cleanup_queue.enqueue(context.project_id, cleanup.VOLUME,
+                                        provider_vol['VolumeId'])
             raise
+        self._clone_snapshots.invalidate(volume.id)
         self._aws_client.get_aws_client(context).\
             delete_volume(VolumeId=old_vol)
+        self._tag_index.discard(context, tag_index.VOLUME, old_vol)
         LOG.debug('create volume %s success.' % volume.id)
 
     def check_for_setup_error(self):
@@ -263,6 +489,7 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
             raise exception_ex.ProviderImageNotFount(reason=_msg)
 
         kargs['SnapshotId'] = snapshot_id
+        kargs['ClientToken'] = client.client_token(volume.id)
 
         # 3. Create volume by snapshot and volume parameters
         provider_volume = None
@@ -272,14 +499,15 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
             tags = [{'Key': 'caa_volume_id', 'Value': volume.id}]
             aws_client.create_tags(Resources=[provider_volume['VolumeId']],
                                    Tags=tags)
+            self._tag_index.add(context, tag_index.VOLUME, volume.id,
+                                provider_volume['VolumeId'])
         except Exception as e:
             _msg = "Aws create volume from image(snapshot) error: %s" % \
                 traceback.format_exc(e)
             if provider_volume:
-                args = {}
-                args['VolumeId'] = provider_volume['VolumeId']
-                self._aws_client.get_aws_client(context)\
-                                .delete_volume(**args)
+                self._cleanup_queue.enqueue(context.project_id,
+                                            cleanup.VOLUME,
+                                            provider_volume['VolumeId'])
             raise exception_ex.ProviderCreateVolumeFailed(reason=_msg)
 
         # 4. create volume mapper
@@ -290,10 +518,8 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
         except Exception as e:
             _msg = 'Create volume mapper error: %s' % traceback.format_exc(e)
             LOG.exception(_msg)
-            args = {}
-            args['VolumeId'] = provider_volume['VolumeId']
-            aws_client = self._aws_client.get_aws_client(context)
-            provider_volume = aws_client.delete_volume(**args)
+            self._cleanup_queue.enqueue(context.project_id, cleanup.VOLUME,
+                                        provider_volume['VolumeId'])
             raise exception_ex.ProviderCreateVolumeFailed(reason=_msg)
 
     def copy_volume_to_image(self, context, volume, image_service, image_meta):
@@ -303,25 +529,18 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
         """Create a clone of the specified volume."""
         context = req_context.RequestContext(is_admin=True,
                                              project_id=volume.project_id)
-        snapshot = None
         try:
             src_vol = self._get_provider_volume_id(context, src_vref)
-            snapshot = self._aws_client.get_aws_client(context).\
-                create_snapshot(VolumeId=src_vol)
-            provider_vol = self._create_volume(volume,
-                                               context,
-                                               snapshot=snapshot['SnapshotId'])
+            with self._clone_snapshots.snapshot(context, src_vref,
+                                                src_vol) as snapshot_id:
+                provider_vol = self._create_volume(volume,
+                                                   context,
+                                                   snapshot=snapshot_id)
         except Exception as ex:
             LOG.error(_LE("create_cloned_volume failed! volume:%(id)s,"
                           "ex: %(ex)s"), {'id': volume.id, 'ex': ex})
             msg = (_("create_cloned_volume failed! volume:%s") % volume.id)
             raise cinder_ex.VolumeBackendAPIException(data=msg)
-        finally:
-            if snapshot:
-                self._aws_client.get_aws_client(context).\
-                    delete_snapshot(
-                    SnapshotId=snapshot['SnapshotId']
-                )
         # create local volume mapper
         try:
             values = {'provider_volume_id': provider_vol['VolumeId']}
@@ -330,8 +549,8 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
         except Exception as ex:
             LOG.error(_LE("volume_mapper_create failed! vol:%(id)s,"
                           " ex = %(ex)s"), {'id': volume.id, 'ex': ex})
-            self._aws_client.get_aws_client(context).\
-                delete_volume(VolumeId=provider_vol['VolumeId'])
+            self._cleanup_queue.enqueue(context.project_id, cleanup.VOLUME,
+                                        provider_vol['VolumeId'])
             msg = (_("volume_mapper_create failed! volume:%s") % volume.id)
             raise cinder_ex.VolumeBackendAPIException(data=msg)
 
@@ -358,8 +577,8 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
         except Exception as ex:
             msg = (_("volume_mapper_create failed! vol: %(id)s,ex: %(ex)s"),
                    {'id': volume.id, 'ex': ex})
-            self._aws_client.get_aws_client(context).\
-                delete_volume(VolumeId=provider_vol['VolumeId'])
+            self._cleanup_queue.enqueue(context.project_id, cleanup.VOLUME,
+                                        provider_vol['VolumeId'])
             raise cinder_ex.VolumeBackendAPIException(data=msg)
 
         LOG.debug('create volume %s success.' % volume.id)
@@ -367,6 +586,7 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
     def delete_volume(self, volume):
         context = req_context.RequestContext(is_admin=True,
                                              project_id=volume.project_id)
+        self._clone_snapshots.invalidate(volume.id)
         try:
             vol_id = self._get_provider_volume_id(context, volume)
             if not vol_id:
@@ -376,9 +596,11 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
                 for vol in volumes:
                     self._aws_client.get_aws_client(context).\
                         delete_volume(VolumeId=vol)
+                    self._tag_index.discard(context, tag_index.VOLUME, vol)
             else:
                 self._aws_client.get_aws_client(context).\
                     delete_volume(VolumeId=vol_id)
+                self._tag_index.discard(context, tag_index.VOLUME, vol_id)
         except Exception as ex:
             LOG.error(_LE("delete volume failed! vol:%(id)s,ex = %(ex)s"),
                       {'id': volume.id, 'ex': ex})
@@ -413,6 +635,8 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
         try:
             provider_snap = self._get_provider_snapshot_id(context,
                                                            snapshot.id)
+            if provider_snap:
+                self._wait_snapshot_usable(context, provider_snap)
             vol = self._create_volume(volume, context, snapshot=provider_snap)
         except Exception as ex:
             LOG.error(_LE('create_volume_from_snapshot failed,'
@@ -429,8 +653,8 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
                                                  context.project_id, values)
         except Exception as ex:
             LOG.error(_LE("volume_mapper_create failed! ex = %s"), ex)
-            self._aws_client.get_aws_client(context).\
-                delete_volume(VolumeId=vol['VolumeId'])
+            self._cleanup_queue.enqueue(context.project_id, cleanup.VOLUME,
+                                        vol['VolumeId'])
             msg = (_("create_volume_from_snapshot failed! volume:%s") %
                    volume.id)
             raise cinder_ex.VolumeBackendAPIException(data=msg)
@@ -441,11 +665,13 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
         context = req_context.RequestContext(is_admin=True,
                                              project_id=snapshot.project_id)
         volume = snapshot.volume
+        wait = not CONF.aws.async_snapshots
         try:
             provider_vol = self._get_provider_volume_id(context, volume)
             provider_snap = self._create_snapshot(context,
                                                   provider_vol,
-                                                  snapshot.id)
+                                                  snapshot.id,
+                                                  wait=wait)
         except Exception as ex:
             LOG.error(_LE("create snapshot %(id)s failed! ex = %(ex)s"),
                       {'id': snapshot.id, 'ex': ex})
@@ -462,31 +688,30 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
             LOG.error(_LE("create snapshot mapper failed! snapshot:%(id)s,"
                           "ex = %(ex)s"),
                       {'id': snapshot.id, 'ex': ex})
-            self._aws_client.get_aws_client(context).\
-                delete_snapshot(
-                SnapshotId=provider_snap['SnapshotId']
-            )
+            self._cleanup_queue.enqueue(context.project_id, cleanup.SNAPSHOT,
+                                        provider_snap['SnapshotId'])
             msg = (_("create_snapshot failed! snapshot:%s") % snapshot.id)
             raise cinder_ex.VolumeBackendAPIException(data=msg)
 
+        if not wait:
+            self._snapshot_tracker.track(context, snapshot.id,
+                                         provider_snap['SnapshotId'])
         LOG.info(_LI("create snapshot:%s success!"), snapshot.id)
 
     def delete_snapshot(self, snapshot):
         """Delete a snapshot."""
         context = req_context.RequestContext(is_admin=True,
                                              project_id=snapshot.project_id)
-
+        self._snapshot_tracker.forget(snapshot.id)
         try:
             provider_snap = self._get_provider_snapshot_id(context,
                                                            snapshot.id)
             if provider_snap:
-                self._aws_client.get_aws_client(context).\
-                    delete_snapshot(SnapshotId=provider_snap)
+                self._delete_provider_snapshot(context, provider_snap)
             else:
                 snapshots = self._get_provider_snapshot(context, snapshot.id)
                 for snap in snapshots:
-                    self._aws_client.get_aws_client(context).\
-                        delete_snapshot(SnapshotId=snap)
+                    self._delete_provider_snapshot(context, snap)
         except Exception as ex:
             LOG.error(_LE("delete snapshot failed! snapshot:%(id)s,"
                           "ex = %(ex)s"), {'id': snapshot.id, 'ex': ex})
@@ -505,28 +730,122 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
 
         LOG.info(_LI("delete snapshot(%s) success!"), snapshot.id)
 
+    def create_consistencygroup(self, context, group):
+        """Create a consistency group, aws has nothing to create."""
+        return {'status': 'available'}
+
+    def update_consistencygroup(self, context, group,
+                                add_volumes=None, remove_volumes=None):
+        """Change the volumes of a consistency group."""
+        return None, None, None
+
+    def delete_consistencygroup(self, context, group, volumes):
+        """Delete a consistency group and its volumes."""
+        model_update = {'status': 'deleted'}
+        volumes_update = []
+        for volume in volumes:
+            try:
+                self.delete_volume(volume)
+                volumes_update.append({'id': volume.id, 'status': 'deleted'})
+            except Exception:
+                model_update['status'] = 'error_deleting'
+                volumes_update.append({'id': volume.id,
+                                       'status': 'error_deleting'})
+        return model_update, volumes_update
+
+    def create_cgsnapshot(self, context, cgsnapshot, snapshots):
+        """Snapshot the volumes of a consistency group at once."""
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id=cgsnapshot.project_id)
+        wait = not CONF.aws.async_snapshots
+        volumes = dict((snapshot.id, snapshot.volume)
+                       for snapshot in snapshots)
+        provider_snaps = self._create_snapshots(context, volumes,
+                                                cgsnapshot.id, wait=wait)
+
+        # create the volume snapshot mappers once all snapshots are taken
+        try:
+            for snapshot in snapshots:
+                values = {"provider_snapshot_id":
+                          provider_snaps[snapshot.id]['SnapshotId']}
+                self.caa_db_api.volume_snapshot_mapper_create(
+                    context, snapshot.id, context.project_id, values)
+        except Exception as ex:
+            LOG.error(_LE("create snapshot mappers failed! cgsnapshot:%(id)s,"
+                          "ex = %(ex)s"), {'id': cgsnapshot.id, 'ex': ex})
+            for provider_snap in provider_snaps.values():
+                self._cleanup_queue.enqueue(context.project_id,
+                                            cleanup.SNAPSHOT,
+                                            provider_snap['SnapshotId'])
+            msg = (_("create_cgsnapshot failed! cgsnapshot:%s") %
+                   cgsnapshot.id)
+            raise cinder_ex.VolumeBackendAPIException(data=msg)
+
+        snapshots_update = []
+        for snapshot in snapshots:
+            if not wait:
+                self._snapshot_tracker.track(
+                    context, snapshot.id,
+                    provider_snaps[snapshot.id]['SnapshotId'])
+            snapshots_update.append({'id': snapshot.id,
+                                     'status': 'available'})
+        LOG.info(_LI("create cgsnapshot:%s success!"), cgsnapshot.id)
+        return {'status': 'available'}, snapshots_update
+
+    def delete_cgsnapshot(self, context, cgsnapshot, snapshots):
+        """Delete the snapshots of a consistency group."""
+        model_update = {'status': 'deleted'}
+        snapshots_update = []
+        for snapshot in snapshots:
+            try:
+                self.delete_snapshot(snapshot)
+                snapshots_update.append({'id': snapshot.id,
+                                         'status': 'deleted'})
+            except Exception:
+                model_update['status'] = 'error_deleting'
+                snapshots_update.append({'id': snapshot.id,
+                                         'status': 'error_deleting'})
+        return model_update, snapshots_update
+
     def do_setup(self, context):
         """Instantiate common class and log in storage system."""
-        pass
+        for project_id in CONF.aws.clone_snapshot_sweep_projects:
+            context = req_context.RequestContext(is_admin=True,
+                                                 project_id=project_id)
+            try:
+                self._clone_snapshots.sweep(context)
+            except Exception as e:
+                LOG.error(_LE("Sweep of the cached clone snapshots of "
+                              "project %(project)s failed, the error is: "
+                              "%(e)s"), {'project': project_id, 'e': e})
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id='aws_default')
+        if not CONF.aws.async_snapshots:
+            return
+        try:
+            self._snapshot_tracker.resume(context, self._snapshot_owned)
+        except Exception as e:
+            LOG.error(_LE("Resume tracking of the pending aws snapshots "
+                          "failed, the error is: %s"), e)
 
     def ensure_export(self, context, volume):
         """Synchronously recreate an export for a volume."""
         pass
 
     def _update_volume_pool_info(self):
-        return {'total_capacity_gb': 1000,
-                'free_capacity_gb': 1000}
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id='aws_default')
+        return self._capacity.get(context)
 
     def _update_volume_stats(self):
         backend_name = self.configuration.safe_get('volume_backend_name')
-        pool_info = self._update_volume_pool_info()
         data = {'volume_backend_name': backend_name or 'AWS',
                 'vendor_name': 'Open Source',
                 'driver_version': self.VERSION,
                 'storage_protocol': 'EBS',
                 'reserved_percentage': 0,
-                'total_capacity_gb': pool_info.get('total_capacity_gb', 1000),
-                'free_capacity_gb': pool_info.get('free_capacity_gb', 1000)}
+                'consistencygroup_support': True,
+                'pools': self._update_volume_pool_info()}
         self._stats = data
 
     def get_volume_stats(self, refresh=False):
@@ -582,9 +901,56 @@ class AwsVolumeDriver(BaseDriver, driver.VolumeDriver):
 
 
 class AwsBackupDriver(BackupDriver, BaseDriver):
+    CLEANUP_QUEUE_NAME = 'backup'
+
+    def _init_clients(self):
+        if not _BACKUP_STATE:
+            # the callbacks of the shared tracker and batcher are those of
+            # the first driver, the others only differ in their context
+            super(AwsBackupDriver, self)._init_clients()
+            _BACKUP_STATE.update(
+                aws_client=self._aws_client,
+                cleanup_queue=self._cleanup_queue,
+                tag_index=self._tag_index,
+                snapshot_tracker=snapshot_tracker.SnapshotTracker(
+                    self._aws_client, self._backup_updated),
+                snapshot_batcher=group_snapshots.SnapshotBatcher(
+                    self._create_snapshots))
+        self._aws_client = _BACKUP_STATE['aws_client']
+        self._cleanup_queue = _BACKUP_STATE['cleanup_queue']
+        self._tag_index = _BACKUP_STATE['tag_index']
+        self._snapshot_tracker = _BACKUP_STATE['snapshot_tracker']
+        self._snapshot_batcher = _BACKUP_STATE['snapshot_batcher']
+
+    def _backup_updated(self, context, backup_id, state):
+        # the backup manager marked the backup available already
+        if state == 'completed':
+            return
+        LOG.error(_LE("Aws snapshot of backup %(id)s failed, "
+                      "state: %(state)s"),
+                  {'id': backup_id, 'state': state})
+        self.db.backup_update(context, backup_id, {
+            'status': 'error',
+            'fail_reason': 'aws snapshot state: %s' % state})
+
+    def _backup_owned(self, context, backup_id):
+        try:
+            self.db.backup_get(context, backup_id)
+        except cinder_ex.BackupNotFound:
+            return False
+        return True
 
-    def __init__(self, context, db_driver=None):
-        super(AwsBackupDriver, self).__init__(context, db_driver)
+    def check_for_setup_error(self):
+        """Resume tracking the snapshots of pending backups."""
+        if not CONF.aws.async_snapshots:
+            return
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id='aws_default')
+        try:
+            self._snapshot_tracker.resume(context, self._backup_owned)
+        except Exception as e:
+            LOG.error(_LE("Resume tracking of the pending aws snapshots "
+                          "failed, the error is: %s"), e)
 
     def _get_provider_backup_id(self, context, backup):
         backup_mapper = self.caa_db_api.backup_mapper_get(context,
@@ -597,11 +963,19 @@ class AwsBackupDriver(BackupDriver, BaseDriver):
         context = req_context.RequestContext(is_admin=True,
                                              project_id=backup.project_id)
         volume = self.db.volume_get(context, backup.volume_id)
+        wait = not CONF.aws.async_snapshots
         try:
-            provider_vol = self._get_provider_volume_id(context, volume)
-            provider_snap = self._create_snapshot(context,
-                                                  provider_vol,
-                                                  backup.id)
+            instance_id = CONF.aws.instance_backups and \
+                self._get_attached_instance_id(context, volume)
+            if instance_id:
+                provider_snap = self._snapshot_batcher.snapshot(
+                    context, backup.id, volume, instance_id, wait=wait)
+            else:
+                provider_vol = self._get_provider_volume_id(context, volume)
+                provider_snap = self._create_snapshot(context,
+                                                      provider_vol,
+                                                      backup.id,
+                                                      wait=wait)
         except Exception as ex:
             msg = (_("Backup failed,backup_id:%(id)s,ex:%(ex)s") %
                    {'id': backup.id, 'ex': ex})
@@ -619,12 +993,13 @@ class AwsBackupDriver(BackupDriver, BaseDriver):
             msg = (_("create backup mapper failed! backup:%(id)s,ex = %(ex)s"),
                    {'id': backup.id, 'ex': ex})
             LOG.error(msg)
-            self._aws_client.get_aws_client(context).\
-                delete_snapshot(
-                SnapshotId=provider_snap['SnapshotId']
-            )
+            self._cleanup_queue.enqueue(context.project_id, cleanup.SNAPSHOT,
+                                        provider_snap['SnapshotId'])
             raise cinder_ex.BackupOperationError(msg)
 
+        if not wait:
+            self._snapshot_tracker.track(context, backup.id,
+                                         provider_snap['SnapshotId'])
         LOG.info(_LI("create backup(%(id)s) success!"), backup.id)
 
     def restore(self, backup, volume_id, volume_file):
@@ -635,6 +1010,8 @@ class AwsBackupDriver(BackupDriver, BaseDriver):
         try:
             old_vol = self._get_provider_volume_id(context, volume)
             provider_snap = self._get_provider_backup_id(context, backup)
+            if provider_snap:
+                self._wait_snapshot_usable(context, provider_snap)
             vol = self._create_volume(volume, context, snapshot=provider_snap)
         except Exception as e:
             msg = _LE("Restore failed,backup_id:%(id)s, "
@@ -652,12 +1029,13 @@ class AwsBackupDriver(BackupDriver, BaseDriver):
             msg = (_("backup mapper delete failed,backup_id:%(id)s,ex:%(ex)s")
                    % {'id': backup.id, 'ex': ex})
             LOG.error(msg)
-            self._aws_client.get_aws_client(context).\
-                delete_volume(VolumeId=vol['VolumeId'])
+            self._cleanup_queue.enqueue(context.project_id, cleanup.VOLUME,
+                                        vol['VolumeId'])
             raise cinder_ex.BackupOperationError(msg)
         else:
             self._aws_client.get_aws_client(context).\
                 delete_volume(VolumeId=old_vol)
+            self._tag_index.discard(context, tag_index.VOLUME, old_vol)
 
         LOG.debug('restore volume %s success.' % volume.id)
 
@@ -665,18 +1043,17 @@ class AwsBackupDriver(BackupDriver, BaseDriver):
         """Delete a saved backup."""
         context = req_context.RequestContext(is_admin=True,
                                              project_id=backup.project_id)
+        self._snapshot_tracker.forget(backup.id)
         try:
             provider_snap = self._get_provider_backup_id(context, backup)
             if not provider_snap:
-                snapshots = self._get_provider_snapshot(backup.id)
+                snapshots = self._get_provider_snapshot(context, backup.id)
                 # if len(volumes) > 1,there must have been an error,we should
                 # delete all volumes
                 for snapshot in snapshots:
-                    self._aws_client.get_aws_client(context).\
-                        delete_snapshot(SnapshotId=snapshot)
+                    self._delete_provider_snapshot(context, snapshot)
             else:
-                self._aws_client.get_aws_client(context).\
-                    delete_snapshot(SnapshotId=provider_snap)
+                self._delete_provider_snapshot(context, provider_snap)
         except Exception as ex:
             msg = (_LE("backup delete failed,backup_id:%(id)s, ex:%(ex)s") %
                    {'id': backup.id, 'ex': ex})
@@ -0,0 +1,173 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Translation of volume type specs into EBS CreateVolume arguments.
+
+A volume type selects the EBS volume type and its performance with the
+extra specs or the back-end qos specs:
+
+* aws:volume_type: gp2, gp3, io1, io2, st1, sc1 or standard,
+* aws:iops: provisioned iops, gp3, io1 and io2 only,
+* aws:throughput: provisioned throughput in MiB/s, gp3 only.
+
+Qos specs win over extra specs of the same key.
+"""
+
+from jacket import conf
+from jacket.drivers.aws import cache
+from jacket.drivers.aws import exception_ex
+from jacket.i18n import _LE
+from jacket.storage.volume import volume_types
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+volume_qos_opts = [
+    cfg.IntOpt('volume_type_cache_ttl',
+               default=300,
+               help='Seconds the EBS arguments translated from the specs of '
+                    'a volume type are cached.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(volume_qos_opts, 'aws')
+
+SPEC_VOLUME_TYPE = 'aws:volume_type'
+SPEC_IOPS = 'aws:iops'
+SPEC_THROUGHPUT = 'aws:throughput'
+
+QOS_CONSUMERS = ('back-end', 'both')
+
+# iops range, iops per GiB of size, throughput range (MiB/s) and the
+# throughput per provisioned iops, for the types that take them
+EBS_LIMITS = {
+    'gp3': {'iops': (3000, 16000), 'iops_per_gb': 500,
+            'throughput': (125, 1000), 'throughput_per_iops': 0.25},
+    'io1': {'iops': (100, 64000), 'iops_per_gb': 50},
+    'io2': {'iops': (100, 64000), 'iops_per_gb': 500},
+    'gp2': {},
+    'st1': {},
+    'sc1': {},
+    'standard': {},
+}
+
+# gp3 volumes get this many iops when none are provisioned
+GP3_BASELINE_IOPS = 3000
+
+# st1 and sc1 volumes can not be booted from
+ROOT_VOLUME_TYPES = ('standard', 'gp2', 'gp3', 'io1', 'io2')
+
+
+def _to_int(type_id, key, value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise exception_ex.InvalidVolumeQos(
+            type_id=type_id, reason='%s is not an integer: %s' % (key, value))
+
+
+def translate(type_id, extra_specs, qos_specs):
+    """Return the CreateVolume arguments requested by a volume type."""
+    specs = dict((k, v) for k, v in (extra_specs or {}).items()
+                 if k.startswith('aws:'))
+    qos = qos_specs or {}
+    if qos.get('consumer') in QOS_CONSUMERS:
+        specs.update((k, v) for k, v in (qos.get('specs') or {}).items()
+                     if k.startswith('aws:'))
+
+    args = {}
+    if SPEC_VOLUME_TYPE in specs:
+        volume_type = specs[SPEC_VOLUME_TYPE]
+        if volume_type not in EBS_LIMITS:
+            raise exception_ex.InvalidVolumeQos(
+                type_id=type_id,
+                reason='unknown volume type %s' % volume_type)
+        args['VolumeType'] = volume_type
+    if SPEC_IOPS in specs:
+        args['Iops'] = _to_int(type_id, SPEC_IOPS, specs[SPEC_IOPS])
+    if SPEC_THROUGHPUT in specs:
+        args['Throughput'] = _to_int(type_id, SPEC_THROUGHPUT,
+                                     specs[SPEC_THROUGHPUT])
+    return args
+
+
+def check_limits(volume_type, args, size):
+    """Return why volume arguments break the EBS limits, None if they do not.
+
+    :param size: size of the volume in GiB, None when it is not known yet,
+                 the iops per GiB are not checked then.
+    """
+    limits = EBS_LIMITS.get(volume_type, {})
+    iops = args.get('Iops')
+    throughput = args.get('Throughput')
+
+    if iops is not None:
+        if 'iops' not in limits:
+            return '%s volumes take no iops' % volume_type
+        low, high = limits['iops']
+        if not low <= iops <= high:
+            return '%s iops must be in [%s, %s]' % (volume_type, low, high)
+        # gp3 volumes of any size take their baseline iops
+        baseline = GP3_BASELINE_IOPS if volume_type == 'gp3' else 0
+        if size is not None and \
+                iops > max(limits['iops_per_gb'] * size, baseline):
+            return '%s iops exceed %s per GiB of a %s GiB volume' % (
+                iops, limits['iops_per_gb'], size)
+    elif volume_type in ('io1', 'io2'):
+        return '%s volumes need %s' % (volume_type, SPEC_IOPS)
+
+    if throughput is not None:
+        if 'throughput' not in limits:
+            return '%s volumes take no throughput' % volume_type
+        low, high = limits['throughput']
+        if not low <= throughput <= high:
+            return '%s throughput must be in [%s, %s]' % (volume_type, low,
+                                                          high)
+        max_throughput = limits['throughput_per_iops'] * (
+            iops or GP3_BASELINE_IOPS)
+        if throughput > max_throughput:
+            return 'throughput %s exceeds %s MiB/s for %s iops' % (
+                throughput, max_throughput, iops or GP3_BASELINE_IOPS)
+    return None
+
+
+def validate(type_id, volume_type, args, size):
+    """Check the arguments of a volume against the EBS limits."""
+    reason = check_limits(volume_type, args, size)
+    if reason:
+        raise exception_ex.InvalidVolumeQos(type_id=type_id, reason=reason)
+
+
+class VolumeTypeArgs(object):
+    """Caches the CreateVolume arguments of volume types by type id."""
+
+    def __init__(self):
+        self._cache = cache.ExpiringCache(CONF.aws.volume_type_cache_ttl)
+
+    def get(self, context, type_id):
+        if not type_id:
+            return {}
+        args = self._cache.get(type_id)
+        if args is not None:
+            return args
+        try:
+            extra_specs = volume_types.get_volume_type_extra_specs(type_id)
+            qos_specs = volume_types.get_volume_type_qos_specs(
+                type_id).get('qos_specs')
+        except Exception as e:
+            LOG.error(_LE("Read specs of volume type %(type_id)s failed, "
+                          "ex = %(ex)s"), {'type_id': type_id, 'ex': e})
+            return {}
+        args = translate(type_id, extra_specs, qos_specs)
+        self._cache.set(type_id, args)
+        return args
@@ -0,0 +1,155 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Adaptive polling of the ec2 waiters."""
+
+import math
+import time
+
+from botocore import exceptions
+from jacket import conf
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+waiter_opts = [
+    cfg.BoolOpt('adaptive_waiters',
+                default=True,
+                help='Poll waiters with short delays growing up to the max '
+                     'delay, the first poll waiting for most of the time '
+                     'the same waiter recently took, at most the max delay. '
+                     'When false waiters poll every max delay seconds.'),
+    cfg.FloatOpt('waiter_initial_delay',
+                 default=1.0,
+                 help='Seconds before the first poll of an adaptive waiter, '
+                      'doubled after every poll up to the max delay.'),
+    cfg.FloatOpt('waiter_max_delay',
+                 default=15.0,
+                 help='Maximum seconds between two polls of a waiter.'),
+    cfg.DictOpt('waiter_max_delays',
+                default={},
+                help='waiter_max_delay per waiter name, e.g. '
+                     'volume_in_use:5,snapshot_completed:60.'),
+    cfg.FloatOpt('waiter_timeout',
+                 default=600.0,
+                 help='Seconds a waiter polls before failing.'),
+    cfg.DictOpt('waiter_timeouts',
+                default={'snapshot_completed': '7200'},
+                help='waiter_timeout per waiter name. Snapshots of large '
+                     'volumes take well over the default timeout.'),
+    cfg.FloatOpt('waiter_history_weight',
+                 default=0.3,
+                 help='Weight of the latest wait in the moving average of '
+                      'the time a waiter takes.'),
+]
+
+CONF = conf.CONF
+CONF.register_opts(waiter_opts, 'aws')
+
+# part of the average time a waiter takes slept before its first poll
+FIRST_POLL_FRACTION = 0.8
+
+
+def _per_waiter(values, name, default):
+    return float(values.get(name, default))
+
+
+def _pending(e):
+    """Whether a waiter failed only for running out of attempts."""
+    return e.kwargs.get('reason', '').startswith('Max attempts exceeded')
+
+
+class Waiters(object):
+    """Waits on the ec2 waiters of a client.
+
+    Every poll is one call of the boto3 waiter with MaxAttempts 1, the
+    delays between polls are chosen here. The time a waiter takes is
+    averaged per region and waiter name. A wait sleeps most of that
+    average before its first poll, a waiter never seen complete
+    CONF.aws.waiter_initial_delay seconds, neither longer than the max
+    delay. The delay then doubles after every poll, up to the max delay.
+
+    :param clock: function returning the current time, time.time if None.
+    :param sleep: function sleeping for the given seconds, time.sleep if
+                  None.
+    """
+
+    def __init__(self, ec2_client, clock=None, sleep=None):
+        self._ec2_client = ec2_client
+        meta = getattr(ec2_client, 'meta', None)
+        self._region = getattr(meta, 'region_name', None)
+        self.clock = clock
+        self.sleep = sleep
+        # (region, waiter name) -> moving average of the seconds it took
+        self._averages = {}
+
+    def average(self, name):
+        return self._averages.get((self._region, name))
+
+    def wait(self, name, **kwargs):
+        """Wait like ec2_client.get_waiter(name).wait(**kwargs).
+
+        :raises: botocore.exceptions.WaiterError when the waiter reaches
+                 a failure state or times out.
+        """
+        waiter = self._ec2_client.get_waiter(name)
+        timeout = _per_waiter(CONF.aws.waiter_timeouts, name,
+                              CONF.aws.waiter_timeout)
+        max_delay = _per_waiter(CONF.aws.waiter_max_delays, name,
+                                CONF.aws.waiter_max_delay)
+        if not CONF.aws.adaptive_waiters:
+            attempts = max(int(math.ceil(timeout / max_delay)), 1)
+            waiter.wait(WaiterConfig={'Delay': max_delay,
+                                      'MaxAttempts': attempts}, **kwargs)
+            return
+
+        clock = self.clock or time.time
+        sleep = self.sleep or time.sleep
+        started = clock()
+        deadline = started + timeout
+        for delay in self._delays(name, max_delay):
+            sleep(max(min(delay, deadline - clock()), 0))
+            try:
+                waiter.wait(WaiterConfig={'Delay': 0, 'MaxAttempts': 1},
+                            **kwargs)
+            except exceptions.WaiterError as e:
+                if not _pending(e) or clock() >= deadline:
+                    raise
+            else:
+                self._observe(name, clock() - started)
+                return
+
+    def _delays(self, name, max_delay):
+        delay = CONF.aws.waiter_initial_delay
+        average = self.average(name)
+        if average:
+            # a long wait, e.g. of a large snapshot, must not keep the
+            # next wait on the same waiter from polling for as long
+            yield min(average * FIRST_POLL_FRACTION, max_delay)
+            # later polls step through the part of the average not slept
+            delay = max(delay, average * (1 - FIRST_POLL_FRACTION) / 2)
+        while True:
+            yield min(delay, max_delay)
+            delay *= 2
+
+    def _observe(self, name, seconds):
+        key = (self._region, name)
+        average = self._averages.get(key)
+        if average is None:
+            average = seconds
+        else:
+            average += CONF.aws.waiter_history_weight * (seconds - average)
+        self._averages[key] = average
+        LOG.debug("Waiter %(name)s took %(seconds).1fs, average "
+                  "%(average).1fs", {'name': name, 'seconds': seconds,
+                                     'average': average})
@@ -0,0 +1,135 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Throughput of the compute driver hot paths.
+
+Boots --count instances and takes them through get_info, power off and
+on, attaching and detaching a volume, and destroy::
+
+    python -m jacket.tests.storage.unit.volume.drivers.aws.bench_compute \\
+        --count 50 --concurrency 10 --output compute.json
+"""
+
+import uuid
+
+import eventlet
+
+from jacket import context as req_context
+from jacket.drivers.aws import compute_driver
+from jacket.tests.storage.unit.volume.drivers.aws import benchmark
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+
+PROJECT_ID = 'bench'
+FLAVOR_ID = 'bench-flavor'
+INSTANCE_TYPE = 't2.micro'
+
+
+class FakeFlavor(object):
+
+    def __init__(self):
+        self.flavorid = FLAVOR_ID
+        self.root_gb = 8
+        self.ephemeral_gb = 0
+        self.extra_specs = {}
+
+
+class FakeInstance(object):
+
+    def __init__(self):
+        self.uuid = str(uuid.uuid4())
+        self.project_id = PROJECT_ID
+        self.image_ref = 'bench-image'
+        self.system_metadata = {}
+        self.flavor = FakeFlavor()
+
+    def get_flavor(self):
+        return self.flavor
+
+    def save(self):
+        pass
+
+
+def build_driver(ec2, db):
+    driver = compute_driver.AwsComputeDriver(None)
+    driver.caa_db_api = db
+    fake_ec2.connect(driver.aws_client, ec2)
+    return driver
+
+
+def setup_project(context, ec2, db):
+    db.project_mapper_create(context, PROJECT_ID, PROJECT_ID, {
+        'net_data': 'subnet-data',
+        'net_api': 'subnet-api',
+        'availability_zone': ec2.availability_zone,
+        'base_linux_image': ec2.add_image(name='bench'),
+    })
+    db.flavor_mapper_create(context, FLAVOR_ID, PROJECT_ID,
+                            {'dest_flavor_id': INSTANCE_TYPE})
+
+
+def create_volumes(context, ec2, db, count):
+    """Create available volumes for the attach phase, untimed."""
+    volume_ids = []
+    for _i in range(count):
+        volume = ec2.create_volume(Size=1,
+                                   AvailabilityZone=ec2.availability_zone)
+        volume_id = str(uuid.uuid4())
+        db.volume_mapper_create(context, volume_id, PROJECT_ID,
+                                {'provider_volume_id': volume['VolumeId']})
+        volume_ids.append(volume_id)
+    provider_ids = [db.volume_mapper_get(context, v)['provider_volume_id']
+                    for v in volume_ids]
+    ec2.get_waiter('volume_available').wait(VolumeIds=provider_ids)
+    return volume_ids
+
+
+def run(args):
+    ec2 = benchmark.make_ec2(args)
+    db = benchmark.FakeCaaDb()
+    context = req_context.RequestContext(is_admin=True,
+                                         project_id=PROJECT_ID)
+    setup_project(context, ec2, db)
+    driver = build_driver(ec2, db)
+    instances = [FakeInstance() for _i in range(args.count)]
+    volumes = dict((instance.uuid, volume_id) for instance, volume_id in
+                   zip(instances, create_volumes(context, ec2, db,
+                                                 args.count)))
+
+    def _connection_info(instance):
+        return {'data': {'volume_id': volumes[instance.uuid]}}
+
+    phases = [
+        ('spawn', lambda i: driver.spawn(context, i, None, [], None)),
+        ('get_info', driver.get_info),
+        ('power_off', driver.power_off),
+        ('power_on', lambda i: driver.power_on(context, i, None)),
+        ('attach_volume', lambda i: driver.attach_volume(
+            context, _connection_info(i), i)),
+        ('detach_volume', lambda i: driver.detach_volume(
+            _connection_info(i), i, None)),
+        ('destroy', lambda i: driver.destroy(context, i, None)),
+    ]
+    return [benchmark.run_phase(name, operation, instances,
+                                args.concurrency, ec2)
+            for name, operation in phases]
+
+
+def main(argv=None):
+    eventlet.monkey_patch()
+    parser = benchmark.build_parser(__doc__.splitlines()[0])
+    args = parser.parse_args(argv)
+    benchmark.apply_options(args.option)
+    benchmark.report('compute', args, run(args))
+
+
+if __name__ == '__main__':
+    main()
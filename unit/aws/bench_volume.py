@@ -0,0 +1,250 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Throughput of the volume and backup drivers.
+
+Runs every operation of the drivers in turn on --count volumes, then a
+mixed workload of --count operations at each concurrency of --scaling::
+
+    python -m jacket.tests.storage.unit.volume.drivers.aws.bench_volume \\
+        --count 20 --scaling 1,4,16 --output volume.json
+"""
+
+import collections
+import random
+import uuid
+
+import eventlet
+
+from jacket import context as req_context
+from jacket.drivers.aws import volume_driver
+from jacket.tests.storage.unit.volume.drivers.aws import benchmark
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+from oslo_utils import timeutils
+
+PROJECT_ID = 'bench'
+POOL_TYPE = 'gp2'
+RETYPE_TYPE_ID = 'bench-gp3'
+FAKE_DB = 'jacket.tests.storage.unit.volume.drivers.aws.fake_db'
+
+# operations of the mixed workload and their weights
+MIX = (('create_delete_volume', 4), ('snapshot', 3), ('clone', 1),
+       ('extend', 1), ('backup', 1))
+
+
+class FakeVolume(object):
+
+    def __init__(self, size):
+        self.id = str(uuid.uuid4())
+        self.project_id = PROJECT_ID
+        self.size = size
+        self.volume_type_id = None
+        self.availability_zone = 'nova'
+        self.host = 'bench@aws#%s' % POOL_TYPE
+        self.attach_status = 'detached'
+        self.volume_attachment = []
+        self.updated_at = timeutils.utcnow()
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, volume):
+        self.id = str(uuid.uuid4())
+        self.project_id = PROJECT_ID
+        self.volume = volume
+        self.volume_id = volume.id
+        self.volume_size = volume.size
+
+
+class FakeBackup(object):
+
+    def __init__(self, volume):
+        self.id = str(uuid.uuid4())
+        self.project_id = PROJECT_ID
+        self.volume_id = volume.id
+
+
+class FakeStorageDb(object):
+    """The storage db calls the volume and backup drivers make."""
+
+    def __init__(self):
+        self.volumes = {}
+        self.snapshots = collections.defaultdict(dict)
+        self.backups = collections.defaultdict(dict)
+
+    def volume_get(self, context, volume_id):
+        return self.volumes[volume_id]
+
+    def snapshot_update(self, context, snapshot_id, values):
+        self.snapshots[snapshot_id].update(values)
+
+    def backup_update(self, context, backup_id, values):
+        self.backups[backup_id].update(values)
+
+
+class Workload(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.ec2 = benchmark.make_ec2(args)
+        self.db = benchmark.FakeCaaDb()
+        self.storage_db = FakeStorageDb()
+        self.context = req_context.RequestContext(is_admin=True,
+                                                  project_id=PROJECT_ID)
+        self.db.project_mapper_create(
+            self.context, PROJECT_ID, PROJECT_ID,
+            {'provider_az': self.ec2.availability_zone})
+        self.driver = volume_driver.AwsVolumeDriver()
+        # a workload stands for a process of its own
+        volume_driver._BACKUP_STATE.clear()
+        self.backup_driver = volume_driver.AwsBackupDriver(self.context,
+                                                           FAKE_DB)
+        for driver in (self.driver, self.backup_driver):
+            driver.db = self.storage_db
+            driver.caa_db_api = self.db
+            fake_ec2.connect(driver._aws_client, self.ec2)
+            driver._volume_type_args._cache.set(RETYPE_TYPE_ID,
+                                                {'VolumeType': 'gp3'})
+
+    def new_volume(self):
+        volume = FakeVolume(self.args.volume_size)
+        self.storage_db.volumes[volume.id] = volume
+        return volume
+
+    def attach(self, volumes):
+        """Attach created volumes to a new instance, as nova would."""
+        instance_id = self.ec2.run_instances(
+            ImageId=self.ec2.add_image(), MinCount=1,
+            MaxCount=1)['Instances'][0]['InstanceId']
+        caa_instance_id = str(uuid.uuid4())
+        self.db.instance_mapper_create(self.context, caa_instance_id,
+                                       PROJECT_ID,
+                                       {'provider_instance_id': instance_id})
+        self.ec2.sleep(self.ec2.transitions['instance_running'])
+        for index, volume in enumerate(volumes):
+            mapper = self.db.volume_mapper_get(self.context, volume.id)
+            self.ec2.attach_volume(VolumeId=mapper['provider_volume_id'],
+                                   InstanceId=instance_id,
+                                   Device='/dev/sd%s' % chr(ord('f') + index))
+            volume.attach_status = 'attached'
+            volume.volume_attachment = [{'instance_uuid': caa_instance_id}]
+        return instance_id
+
+    def phase(self, name, operation, items, concurrency=None):
+        return benchmark.run_phase(name, operation, items,
+                                   concurrency or self.args.concurrency,
+                                   self.ec2)
+
+    def extend(self, volume):
+        self.driver.extend_volume(volume, volume.size + 1)
+        volume.size += 1
+
+    def retype(self, volume):
+        self.driver.retype(self.context, volume, {'id': RETYPE_TYPE_ID}, {},
+                           None)
+
+    def mixed(self, item):
+        name, volume = item
+        if name == 'create_delete_volume':
+            new = self.new_volume()
+            self.driver.create_volume(new)
+            self.driver.delete_volume(new)
+        elif name == 'snapshot':
+            snapshot = FakeSnapshot(volume)
+            self.driver.create_snapshot(snapshot)
+            self.driver.delete_snapshot(snapshot)
+        elif name == 'clone':
+            clone = self.new_volume()
+            self.driver.create_cloned_volume(clone, volume)
+            self.driver.delete_volume(clone)
+        elif name == 'extend':
+            self.extend(volume)
+        elif name == 'backup':
+            backup = FakeBackup(volume)
+            self.backup_driver.backup(backup, None)
+            self.backup_driver.delete(backup)
+
+    def run(self, scaling):
+        driver = self.driver
+        count = self.args.count
+        volumes = [self.new_volume() for _i in range(count)]
+        snapshots = [FakeSnapshot(volume) for volume in volumes]
+        restored = [(self.new_volume(), snapshot) for snapshot in snapshots]
+        clones = [(self.new_volume(), volume) for volume in volumes]
+        # clones of one source, the case of clone_snapshot_cache
+        golden = [(self.new_volume(), volumes[0]) for _i in range(count)]
+        backups = [FakeBackup(volume) for volume in volumes]
+        results = [
+            self.phase('create_volume', driver.create_volume, volumes),
+            self.phase('create_snapshot', driver.create_snapshot, snapshots),
+            self.phase('create_volume_from_snapshot',
+                       lambda p: driver.create_volume_from_snapshot(*p),
+                       restored),
+            self.phase('create_cloned_volume',
+                       lambda p: driver.create_cloned_volume(*p), clones),
+            self.phase('create_cloned_volume_one_source',
+                       lambda p: driver.create_cloned_volume(*p), golden),
+            self.phase('extend_volume', self.extend, volumes),
+            self.phase('retype', self.retype, [p[0] for p in restored]),
+            self.phase('backup',
+                       lambda b: self.backup_driver.backup(b, None), backups),
+            self.phase('restore',
+                       lambda b: self.backup_driver.restore(b, b.volume_id,
+                                                            None), backups),
+            self.phase('delete_backup', self.backup_driver.delete, backups),
+            self.phase('delete_snapshot', driver.delete_snapshot, snapshots),
+        ]
+
+        bases = [self.new_volume() for _i in range(count)]
+        for base in bases:
+            driver.create_volume(base)
+        # the same operations at every concurrency
+        rng = random.Random(self.args.seed)
+        names = [name for name, weight in MIX for _i in range(weight)]
+        items = [(rng.choice(names), base) for base in bases]
+        for concurrency in scaling:
+            result = self.phase('mixed', self.mixed, items, concurrency)
+            result['mix'] = dict(collections.Counter(n for n, _b in items))
+            results.append(result)
+
+        results.append(self.phase(
+            'delete_volume', driver.delete_volume,
+            volumes + bases +
+            [p[0] for p in restored + clones + golden]))
+        return results
+
+
+def build_parser():
+    parser = benchmark.build_parser(__doc__.splitlines()[0])
+    parser.add_argument('--volume-size', type=int, default=1,
+                        help='Size in GiB of the volumes created.')
+    parser.add_argument('--scaling',
+                        help='Comma separated concurrencies the mixed '
+                             'workload is run at, --concurrency by default.')
+    return parser
+
+
+def run(args):
+    scaling = [int(c) for c in args.scaling.split(',')] if args.scaling \
+        else [args.concurrency]
+    return Workload(args).run(scaling)
+
+
+def main(argv=None):
+    eventlet.monkey_patch()
+    args = build_parser().parse_args(argv)
+    benchmark.apply_options(args.option)
+    benchmark.report('volume', args, run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Harness of the driver benchmarks.
+
+The benchmarks drive the real drivers against fake_ec2.FakeEc2Client and
+FakeCaaDb. Each benchmark runs a sequence of phases, one per driver
+operation. A phase runs the operation once per item on a pool of green
+threads and reports:
+
+- ops/sec, and the p50 and p99 latency of the operation;
+- the ec2 calls made per operation, in total and per action;
+- the seconds per operation spent in ec2 waiters.
+
+Durations are wall seconds of the scaled simulation. Divide them by the
+time_scale recorded with the results to get aws seconds.
+"""
+
+import argparse
+import collections
+import datetime
+import functools
+import json
+import sys
+import time
+
+import eventlet
+
+from jacket import conf
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+
+CONF = conf.CONF
+
+
+class FakeCaaDb(object):
+    """In-memory stand-in for jacket.db.extend.api.
+
+    Answers ``<table>_mapper_get/create/update/delete/all`` for every
+    table. Mappers are keyed by caa id, project mappers by project id.
+    """
+
+    OPERATIONS = ('get', 'create', 'update', 'delete', 'all')
+
+    # the backup driver writes volume_backup mappers and reads them back
+    # through backup_mapper_get
+    TABLES = {'backup': 'volume_backup'}
+
+    def __init__(self):
+        self.tables = collections.defaultdict(dict)
+
+    def __getattr__(self, name):
+        table, sep, operation = name.rpartition('_mapper_')
+        if not sep or operation not in self.OPERATIONS:
+            raise AttributeError(name)
+        return functools.partial(getattr(self, '_' + operation),
+                                 self.TABLES.get(table, table))
+
+    def _get(self, table, context, caa_id, project_id=None):
+        return dict(self.tables[table].get(caa_id, {}))
+
+    def _create(self, table, context, caa_id, project_id, values):
+        self.tables[table][caa_id] = dict(values)
+
+    def _update(self, table, context, caa_id, project_id, values):
+        self.tables[table].setdefault(caa_id, {}).update(values)
+
+    def _delete(self, table, context, caa_id, project_id=None):
+        self.tables[table].pop(caa_id, None)
+
+    def _all(self, table, context):
+        return dict((caa_id, dict(values))
+                    for caa_id, values in self.tables[table].items())
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile, None for no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def run_phase(name, operation, items, concurrency, ec2):
+    """Run operation(item) for every item on concurrency green threads."""
+    calls = collections.Counter(ec2.calls)
+    waited = sum(ec2.waiter_seconds.values())
+    latencies = []
+    errors = []
+
+    def _run(item):
+        started = time.time()
+        try:
+            operation(item)
+        except Exception as e:
+            errors.append(e)
+        else:
+            latencies.append(time.time() - started)
+
+    started = time.time()
+    pool = eventlet.GreenPool(concurrency)
+    for item in items:
+        pool.spawn_n(_run, item)
+    pool.waitall()
+    seconds = time.time() - started
+
+    ops = len(items) or 1
+    api_calls = ec2.calls - calls
+    result = {
+        'operation': name,
+        'ops': len(items),
+        'errors': len(errors),
+        'concurrency': concurrency,
+        'seconds': seconds,
+        'ops_per_sec': len(latencies) / seconds if seconds else None,
+        'p50_seconds': percentile(latencies, 50),
+        'p99_seconds': percentile(latencies, 99),
+        'api_calls_per_op': float(sum(api_calls.values())) / ops,
+        'api_calls': dict(api_calls),
+        'waiter_seconds_per_op':
+            (sum(ec2.waiter_seconds.values()) - waited) / ops,
+    }
+    if errors:
+        result['error_sample'] = repr(errors[0])
+    return result
+
+
+def build_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--count', type=int, default=20,
+                        help='Operations per phase.')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Operations running at once.')
+    parser.add_argument('--time-scale', type=float, default=0.01,
+                        help='Factor applied to every simulated duration.')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='Median seconds of an ec2 call.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the simulation.')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='Override an option of the [aws] group, e.g. '
+                             'coalesce_run_instances=true.')
+    parser.add_argument('--output',
+                        help='Write the results as json to this file.')
+    return parser
+
+
+def make_ec2(args):
+    return fake_ec2.FakeEc2Client(
+        latency={'*': fake_ec2.lognormal(args.latency, 0.5)},
+        time_scale=args.time_scale, seed=args.seed, sleep=eventlet.sleep)
+
+
+def apply_options(options):
+    for option in options:
+        name, _sep, value = option.partition('=')
+        try:
+            # numbers, true/false and lists are given as json
+            value = json.loads(value)
+        except ValueError:
+            pass
+        CONF.set_override(name, value, 'aws')
+
+
+def report(benchmark, args, results):
+    """Print the results, and write them to args.output if given."""
+    line = '%-28s %5s %5s %6s %9s %9s %9s %9s %9s\n'
+    sys.stdout.write(line % ('operation', 'conc', 'ops', 'errors',
+                             'ops/sec', 'p50 s', 'p99 s', 'calls/op',
+                             'wait s/op'))
+    for result in results:
+        sys.stdout.write(line % (
+            result['operation'], result['concurrency'], result['ops'],
+            result['errors'],
+            _fmt(result['ops_per_sec']), _fmt(result['p50_seconds']),
+            _fmt(result['p99_seconds']), _fmt(result['api_calls_per_op']),
+            _fmt(result['waiter_seconds_per_op'])))
+    if args.output:
+        document = {
+            'benchmark': benchmark,
+            'started_at': datetime.datetime.utcnow().isoformat(),
+            'config': vars(args),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+
+def _fmt(value):
+    return '-' if value is None else '%.3f' % value
@@ -0,0 +1,95 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Counting of the remote calls a driver makes.
+
+The AwsClientPlugin a driver gets and its caa_db_api are wrapped, every
+method called through them is counted as '<prefix>.<method>'::
+
+    recorder = call_recorder.CallRecorder()
+    recorder.record_aws(driver.aws_client)
+    driver.caa_db_api = recorder.wrap(driver.caa_db_api, 'db')
+    with recorder.measure() as calls:
+        driver.get_info(instance)
+    calls  # Counter({'db.instance_mapper_get': 1,
+           #          'aws.describe_instances': 1})
+
+Calls the plugin makes to itself, waiter polls and pages of paginated
+calls included, are not counted, so the counts do not depend on timing.
+The requests a FakeEc2Client gets can be counted as well, as
+'<prefix>.<action>', to catch a plugin method making more requests than
+it did. Waiter polls are left out of those too::
+
+    recorder.record_ec2(ec2)
+    calls  # Counter({..., 'ec2.describe_instances': 1})
+"""
+
+import collections
+import contextlib
+
+
+class _Recording(object):
+
+    def __init__(self, target, calls, prefix):
+        self._target = target
+        self._calls = calls
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+        key = '%s.%s' % (self._prefix, name)
+
+        def _record(*args, **kwargs):
+            self._calls[key] += 1
+            return value(*args, **kwargs)
+        return _record
+
+
+class CallRecorder(object):
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        # (FakeEc2Client, prefix) whose requests are counted
+        self._ec2_clients = []
+
+    def wrap(self, target, prefix):
+        """Return a proxy of target counting the methods called on it."""
+        return _Recording(target, self.calls, prefix)
+
+    def record_aws(self, aws_client, prefix='aws'):
+        """Count the calls made on the plugins aws_client hands out."""
+        get_aws_client = aws_client.get_aws_client
+        aws_client.get_aws_client = lambda context: self.wrap(
+            get_aws_client(context), prefix)
+
+    def record_ec2(self, ec2, prefix='ec2'):
+        """Count the requests a FakeEc2Client gets but its waiter polls."""
+        self._ec2_clients.append((ec2, prefix))
+
+    def _requests(self):
+        requests = collections.Counter()
+        for ec2, prefix in self._ec2_clients:
+            for action, count in (ec2.calls - ec2.waiter_calls).items():
+                requests['%s.%s' % (prefix, action)] += count
+        return requests
+
+    @contextlib.contextmanager
+    def measure(self):
+        """Yield a Counter filled with the calls made in the block."""
+        before = collections.Counter(self.calls)
+        requests = self._requests()
+        calls = collections.Counter()
+        yield calls
+        calls.update(self.calls - before)
+        calls.update(self._requests() - requests)
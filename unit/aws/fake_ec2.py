@@ -0,0 +1,911 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""In-memory stand-in for the boto3 ec2 client.
+
+FakeEc2Client implements the ec2 calls AwsClientPlugin makes, keeping
+instances, volumes, snapshots, images and their tags in memory and moving
+them through the states aws does. It is passed where a boto3 ec2 client
+is expected::
+
+    ec2 = fake_ec2.FakeEc2Client(
+        latency={'*': fake_ec2.lognormal(0.15, 0.4)},
+        throttle={'run_instances': (2, 5)}, time_scale=0.01, seed=1)
+    plugin = AwsClientPlugin(ec2)
+
+Every call has its parameters checked the way boto3 does, then sleeps
+for a latency drawn from its distribution, then may be throttled or fail
+with an injected error, then takes effect.
+State changes complete after the durations in TRANSITIONS. Latencies,
+transitions and waiter delays are multiplied by time_scale, so a run
+with time_scale=0.01 takes a hundredth of the time it would against aws.
+Random draws come from one generator seeded by seed, ids included.
+"""
+
+import collections
+import copy
+import fnmatch
+import random
+import time
+
+from botocore import exceptions
+import mock
+import testtools
+
+from jacket.drivers.aws import client
+
+# seconds each state change takes on aws
+TRANSITIONS = {
+    'instance_running': 30.0,
+    'instance_stopping': 20.0,
+    'instance_terminating': 30.0,
+    'volume_creating': 5.0,
+    'volume_deleting': 5.0,
+    'volume_attaching': 3.0,
+    'volume_detaching': 5.0,
+    'snapshot_completing': 60.0,
+    # added per GiB of the volume
+    'snapshot_completing_per_gib': 2.0,
+}
+
+INSTANCE_STATE_CODES = {'pending': 0, 'running': 16, 'shutting-down': 32,
+                        'terminated': 48, 'stopping': 64, 'stopped': 80}
+
+# delay and max attempts of the boto3 ec2 waiters
+WAITER_DELAY = 15
+WAITER_MAX_ATTEMPTS = 40
+
+
+def constant(seconds):
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    """Latency with the given median and a long tail, like most apis."""
+    return lambda rng: median * rng.lognormvariate(0, sigma)
+
+
+def client_error(code, message, operation):
+    return exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': message}}, operation)
+
+
+# parameters of each action, the required ones first
+PARAMETERS = {
+    'run_instances': (
+        ('MinCount', 'MaxCount'),
+        ('ImageId', 'InstanceType', 'ClientToken', 'UserData', 'Placement',
+         'NetworkInterfaces', 'SecurityGroupIds', 'SecurityGroups',
+         'SubnetId', 'KeyName', 'BlockDeviceMappings', 'TagSpecifications',
+         'LaunchTemplate', 'EbsOptimized', 'CpuOptions',
+         'IamInstanceProfile', 'Monitoring', 'DisableApiTermination',
+         'InstanceInitiatedShutdownBehavior', 'PrivateIpAddress',
+         'MetadataOptions', 'DryRun')),
+    'describe_instances': (
+        (), ('InstanceIds', 'Filters', 'MaxResults', 'NextToken', 'DryRun')),
+    'start_instances': (('InstanceIds',), ('DryRun',)),
+    'stop_instances': (('InstanceIds',), ('Force', 'Hibernate', 'DryRun')),
+    'terminate_instances': (('InstanceIds',), ('DryRun',)),
+    'reboot_instances': (('InstanceIds',), ('DryRun',)),
+    'create_volume': (
+        ('AvailabilityZone',),
+        ('Size', 'SnapshotId', 'VolumeType', 'Iops', 'Throughput',
+         'Encrypted', 'KmsKeyId', 'TagSpecifications', 'ClientToken',
+         'MultiAttachEnabled', 'DryRun')),
+    'delete_volume': (('VolumeId',), ('DryRun',)),
+    'describe_volumes': (
+        (), ('VolumeIds', 'Filters', 'MaxResults', 'NextToken', 'DryRun')),
+    'attach_volume': (('Device', 'InstanceId', 'VolumeId'), ('DryRun',)),
+    'detach_volume': (('VolumeId',),
+                      ('InstanceId', 'Device', 'Force', 'DryRun')),
+    'create_snapshot': (('VolumeId',),
+                        ('Description', 'TagSpecifications', 'DryRun')),
+    'create_snapshots': (('InstanceSpecification',),
+                         ('Description', 'TagSpecifications',
+                          'CopyTagsFromSource', 'DryRun')),
+    'delete_snapshot': (('SnapshotId',), ('DryRun',)),
+    'describe_snapshots': (
+        (), ('SnapshotIds', 'OwnerIds', 'RestorableByUserIds', 'Filters',
+             'MaxResults', 'NextToken', 'DryRun')),
+    'describe_images': (
+        (), ('ImageIds', 'Owners', 'ExecutableUsers', 'Filters',
+             'IncludeDeprecated', 'DryRun')),
+    'create_tags': (('Resources', 'Tags'), ('DryRun',)),
+    'describe_tags': ((), ('Filters', 'MaxResults', 'NextToken', 'DryRun')),
+}
+
+
+def _validate(action, kwargs):
+    """Reject parameters boto3 would reject before sending the request."""
+    required, optional = PARAMETERS[action]
+    errors = ['Missing required parameter in input: "%s"' % name
+              for name in required if name not in kwargs]
+    errors.extend('Unknown parameter in input: "%s"' % name
+                  for name in sorted(kwargs)
+                  if name not in required and name not in optional)
+    if errors:
+        raise exceptions.ParamValidationError(report='\n'.join(errors))
+
+
+def _state_name(instance):
+    return instance['State']['Name']
+
+
+# filter name -> values of a resource
+INSTANCE_FILTERS = {
+    'instance-id': lambda i: [i['InstanceId']],
+    'instance-state-name': lambda i: [_state_name(i)],
+    'image-id': lambda i: [i['ImageId']],
+    'instance-type': lambda i: [i['InstanceType']],
+    'reservation-id': lambda i: [i['_reservation']],
+    'client-token': lambda i: [i.get('ClientToken')],
+}
+VOLUME_FILTERS = {
+    'volume-id': lambda v: [v['VolumeId']],
+    'status': lambda v: [v['State']],
+    'volume-type': lambda v: [v['VolumeType']],
+    'size': lambda v: [str(v['Size'])],
+    'availability-zone': lambda v: [v['AvailabilityZone']],
+    'snapshot-id': lambda v: [v.get('SnapshotId')],
+    'attachment.instance-id': lambda v: [a['InstanceId']
+                                         for a in v['Attachments']],
+}
+SNAPSHOT_FILTERS = {
+    'snapshot-id': lambda s: [s['SnapshotId']],
+    'volume-id': lambda s: [s['VolumeId']],
+    'status': lambda s: [s['State']],
+}
+IMAGE_FILTERS = {
+    'image-id': lambda i: [i['ImageId']],
+    'name': lambda i: [i['Name']],
+    'state': lambda i: [i['State']],
+}
+TAG_FILTERS = {
+    'key': lambda t: [t['Key']],
+    'value': lambda t: [t['Value']],
+    'resource-id': lambda t: [t['ResourceId']],
+    'resource-type': lambda t: [t['ResourceType']],
+}
+
+
+def _matches(item, filters, fields):
+    tags = dict((tag['Key'], tag['Value']) for tag in item.get('Tags', []))
+    for spec in filters or []:
+        name = spec['Name']
+        if name.startswith('tag:'):
+            values = [tags[name[4:]]] if name[4:] in tags else []
+        elif name == 'tag-key':
+            values = list(tags)
+        elif name in fields:
+            values = fields[name](item)
+        else:
+            raise client_error('InvalidParameterValue',
+                               'The filter %s is invalid' % name, 'Describe')
+        # filter values may hold the * and ? wildcards
+        if not any(fnmatch.fnmatchcase(str(value), str(pattern))
+                   for value in values for pattern in spec['Values']):
+            return False
+    return True
+
+
+def _public(item):
+    return dict((key, copy.deepcopy(value)) for key, value in item.items()
+                if not key.startswith('_'))
+
+
+class _TokenBucket(object):
+
+    def __init__(self, rate, burst, clock):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated_at = clock()
+
+    def take(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def _instances(response):
+    return [instance for reservation in response['Reservations']
+            for instance in reservation['Instances']]
+
+
+# waiter name -> operation, items of the response, success states, failure
+# states and whether the resource being gone is success
+WAITERS = {
+    'instance_running': ('describe_instances', _instances, ('running',),
+                         ('shutting-down', 'terminated', 'stopping'), False),
+    'instance_stopped': ('describe_instances', _instances, ('stopped',),
+                         ('pending', 'terminated'), False),
+    'instance_terminated': ('describe_instances', _instances,
+                            ('terminated',), ('pending', 'stopping'), False),
+    'volume_available': ('describe_volumes', lambda r: r['Volumes'],
+                         ('available',), ('deleted',), False),
+    'volume_in_use': ('describe_volumes', lambda r: r['Volumes'],
+                      ('in-use',), ('deleted',), False),
+    'volume_deleted': ('describe_volumes', lambda r: r['Volumes'],
+                       ('deleted',), (), True),
+    'snapshot_completed': ('describe_snapshots', lambda r: r['Snapshots'],
+                           ('completed',), ('error',), False),
+}
+
+
+class FakeWaiter(object):
+    """Polls the simulator like the boto3 waiter of the same name."""
+
+    def __init__(self, client, name, operation, items, success,
+                 failure=(), not_found_success=False):
+        self.client = client
+        self.name = name
+        self.operation = operation
+        self.items = items
+        self.success = success
+        self.failure = failure
+        self.not_found_success = not_found_success
+
+    def wait(self, **kwargs):
+        started = self.client.clock()
+        try:
+            self._wait(**kwargs)
+        finally:
+            self.client.waiter_seconds[self.name] += \
+                self.client.clock() - started
+
+    def _wait(self, WaiterConfig=None, **kwargs):
+        config = WaiterConfig or {}
+        delay = config.get('Delay', WAITER_DELAY)
+        max_attempts = config.get('MaxAttempts', WAITER_MAX_ATTEMPTS)
+        response = None
+        for attempt in range(max_attempts):
+            self.client.waiter_calls[self.operation] += 1
+            try:
+                response = getattr(self.client, self.operation)(**kwargs)
+            except exceptions.ClientError as e:
+                not_found = e.response['Error']['Code'].endswith('.NotFound')
+                if not_found and self.not_found_success:
+                    return
+                # a resource just created may not be visible yet
+                if not (not_found and attempt == 0):
+                    raise exceptions.WaiterError(
+                        name=self.name, reason=str(e),
+                        last_response=e.response)
+            else:
+                states = [self.state(item) for item in self.items(response)]
+                if states and all(s in self.success for s in states):
+                    return
+                if any(s in self.failure for s in states):
+                    raise exceptions.WaiterError(
+                        name=self.name,
+                        reason='Waiter encountered a terminal failure state',
+                        last_response=response)
+            if attempt + 1 < max_attempts:
+                self.client.sleep(delay)
+        raise exceptions.WaiterError(name=self.name,
+                                     reason='Max attempts exceeded',
+                                     last_response=response)
+
+    @staticmethod
+    def state(item):
+        state = item['State']
+        return state['Name'] if isinstance(state, dict) else state
+
+
+class FakeEc2Client(object):
+    """A stateful, in-process ec2 client.
+
+    :param latency: {action: distribution} of the seconds a call takes,
+                    '*' for the actions not listed. A distribution is a
+                    callable taking the random generator.
+    :param throttle: {action: (rate, burst)} token buckets, calls beyond
+                     them fail with RequestLimitExceeded. '*' is a bucket
+                     shared by the actions not listed.
+    :param errors: {action: probability} of failing with InternalError.
+    :param transitions: overrides of TRANSITIONS.
+    :param instance_limit: most instances that can be active at once,
+                           launches beyond it fail with
+                           InsufficientInstanceCapacity.
+    :param time_scale: factor applied to every simulated duration.
+    :param seed: seed of the random generator.
+    :param clock: function returning the current time.
+    :param sleep: function sleeping for the given seconds, e.g.
+                  eventlet.sleep when driven from green threads.
+    """
+
+    def __init__(self, latency=None, throttle=None, errors=None,
+                 transitions=None, instance_limit=None, time_scale=1.0,
+                 seed=None, clock=time.time, sleep=time.sleep,
+                 availability_zone='us-east-1a'):
+        self.latency = latency or {}
+        self.errors = errors or {}
+        self.transitions = dict(TRANSITIONS, **(transitions or {}))
+        self.instance_limit = instance_limit
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.clock = clock
+        self._sleep = sleep
+        self.availability_zone = availability_zone
+        self._buckets = dict(
+            (action, _TokenBucket(rate, burst, clock))
+            for action, (rate, burst) in (throttle or {}).items())
+        self._injected = collections.defaultdict(collections.deque)
+        # number of calls per action, waiter polls included
+        self.calls = collections.Counter()
+        # number of the calls per action that were waiter polls
+        self.waiter_calls = collections.Counter()
+        # seconds spent in waiters per waiter name
+        self.waiter_seconds = collections.Counter()
+
+        self.instances = collections.OrderedDict()
+        self.volumes = collections.OrderedDict()
+        self.snapshots = collections.OrderedDict()
+        self.images = collections.OrderedDict()
+        self._tokens = {}
+        self._addresses = 0
+
+    # simulation
+
+    def sleep(self, seconds):
+        self._sleep(seconds * self.time_scale)
+
+    def simulated_time(self):
+        """The clock in aws seconds, the clock sleep is measured by."""
+        return self.clock() / self.time_scale
+
+    def inject_error(self, action, code, message='Injected error', times=1):
+        """Make the next calls of action fail with the given error code."""
+        for _i in range(times):
+            self._injected[action].append((code, message))
+
+    def _new_id(self, prefix):
+        return '%s-%017x' % (prefix, self.rng.getrandbits(68))
+
+    def _new_ip(self):
+        self._addresses += 1
+        return '10.%d.%d.%d' % (self._addresses >> 16 & 255,
+                                self._addresses >> 8 & 255,
+                                self._addresses & 255)
+
+    def _call(self, action, kwargs):
+        _validate(action, kwargs)
+        self.calls[action] += 1
+        distribution = self.latency.get(action, self.latency.get('*'))
+        if distribution:
+            self.sleep(distribution(self.rng))
+        bucket = self._buckets.get(action, self._buckets.get('*'))
+        if bucket and not bucket.take():
+            raise client_error('RequestLimitExceeded',
+                               'Request limit exceeded.', action)
+        if self._injected[action]:
+            code, message = self._injected[action].popleft()
+            raise client_error(code, message, action)
+        if self.rng.random() < self.errors.get(action, 0):
+            raise client_error('InternalError',
+                               'An internal error has occurred', action)
+
+    def _schedule(self, item, field, value, transition, extra=0):
+        """Set field to value once transition has elapsed."""
+        seconds = self.transitions[transition] + extra
+        at = self.clock() + seconds * self.time_scale
+        item.setdefault('_pending', []).append((at, field, value))
+
+    def _advance(self, item):
+        now = self.clock()
+        pending = item.get('_pending', [])
+        for change in sorted(pending, key=lambda change: change[0]):
+            at, field, value = change
+            if at > now:
+                break
+            pending.remove(change)
+            if callable(value):
+                value(item)
+            elif field == 'State' and isinstance(item['State'], dict):
+                item['State'] = {'Name': value,
+                                 'Code': INSTANCE_STATE_CODES[value]}
+            else:
+                item[field] = value
+
+    def _get(self, store, resource_id, code, operation):
+        item = store.get(resource_id)
+        if item is None or item.get('_deleted'):
+            raise client_error(
+                code, "The id '%s' does not exist" % resource_id, operation)
+        self._advance(item)
+        if item.get('_deleted'):
+            raise client_error(
+                code, "The id '%s' does not exist" % resource_id, operation)
+        return item
+
+    def _select(self, store, ids, code, operation, filters, fields):
+        if ids:
+            items = [self._get(store, i, code, operation) for i in ids]
+        else:
+            items = []
+            for item in list(store.values()):
+                self._advance(item)
+                if not item.get('_deleted'):
+                    items.append(item)
+        return [item for item in items if _matches(item, filters, fields)]
+
+    @staticmethod
+    def _page(items, kwargs, result_key):
+        start = int(kwargs.get('NextToken') or 0)
+        max_results = kwargs.get('MaxResults')
+        end = start + max_results if max_results else len(items)
+        response = {result_key: items[start:end]}
+        if end < len(items):
+            response['NextToken'] = str(end)
+        return response
+
+    @staticmethod
+    def _apply_tag_specs(item, resource_type, kwargs):
+        for spec in kwargs.get('TagSpecifications', []):
+            if spec.get('ResourceType') == resource_type:
+                item['Tags'].extend(copy.deepcopy(spec.get('Tags', [])))
+
+    def add_image(self, image_id=None, name=None, snapshot_id=None,
+                  root_size=8, tags=None):
+        """Register an available image with an EBS root device."""
+        image_id = image_id or self._new_id('ami')
+        bdm = {'DeviceName': '/dev/sda1',
+               'Ebs': {'SnapshotId': snapshot_id or self._new_id('snap'),
+                       'VolumeSize': root_size,
+                       'VolumeType': 'gp2',
+                       'DeleteOnTermination': True}}
+        self.images[image_id] = {'ImageId': image_id,
+                                 'Name': name or image_id,
+                                 'State': 'available',
+                                 'RootDeviceName': '/dev/sda1',
+                                 'BlockDeviceMappings': [bdm],
+                                 'Tags': list(tags or [])}
+        return image_id
+
+    # instances
+
+    def _active_instances(self):
+        return [i for i in self.instances.values()
+                if _state_name(i) not in ('shutting-down', 'terminated')]
+
+    def run_instances(self, **kwargs):
+        self._call('run_instances', kwargs)
+        token = kwargs.get('ClientToken')
+        if token and ('instance', token) in self._tokens:
+            return copy.deepcopy(self._tokens[('instance', token)])
+        image_id = kwargs.get('ImageId')
+        if image_id not in self.images:
+            raise client_error('InvalidAMIID.NotFound',
+                               "The image id '[%s]' does not exist"
+                               % image_id, 'RunInstances')
+        count = kwargs['MaxCount']
+        if self.instance_limit is not None:
+            count = min(count,
+                        self.instance_limit - len(self._active_instances()))
+            if count < kwargs['MinCount']:
+                raise client_error('InsufficientInstanceCapacity',
+                                   'Insufficient capacity.', 'RunInstances')
+        reservation_id = self._new_id('r')
+        instances = []
+        for index in range(count):
+            instance_id = self._new_id('i')
+            nics = [{'NetworkInterfaceId': self._new_id('eni'),
+                     'SubnetId': nic.get('SubnetId'),
+                     'PrivateIpAddress': self._new_ip(),
+                     'Attachment': {'DeviceIndex': nic.get('DeviceIndex',
+                                                           0)}}
+                    for nic in kwargs.get('NetworkInterfaces') or [{}]]
+            instance = {'InstanceId': instance_id,
+                        'ImageId': image_id,
+                        'InstanceType': kwargs.get('InstanceType',
+                                                   'm1.small'),
+                        'AmiLaunchIndex': index,
+                        'State': {'Name': 'pending', 'Code': 0},
+                        'Placement': {
+                            'AvailabilityZone': self.availability_zone},
+                        'PrivateIpAddress': nics[0]['PrivateIpAddress'],
+                        'NetworkInterfaces': nics,
+                        'BlockDeviceMappings': [],
+                        'ClientToken': token or '',
+                        'Tags': [],
+                        '_reservation': reservation_id}
+            self._apply_tag_specs(instance, 'instance', kwargs)
+            self._schedule(instance, 'State', 'running', 'instance_running')
+            self.instances[instance_id] = instance
+            instances.append(_public(instance))
+        response = {'ReservationId': reservation_id, 'Instances': instances}
+        if token:
+            self._tokens[('instance', token)] = response
+        return copy.deepcopy(response)
+
+    def describe_instances(self, **kwargs):
+        self._call('describe_instances', kwargs)
+        instances = self._select(self.instances, kwargs.get('InstanceIds'),
+                                 'InvalidInstanceID.NotFound',
+                                 'DescribeInstances', kwargs.get('Filters'),
+                                 INSTANCE_FILTERS)
+        reservations = collections.OrderedDict()
+        for instance in instances:
+            reservation = reservations.setdefault(
+                instance['_reservation'],
+                {'ReservationId': instance['_reservation'], 'Instances': []})
+            reservation['Instances'].append(_public(instance))
+        return self._page(list(reservations.values()), kwargs,
+                          'Reservations')
+
+    def _change_instances(self, action, kwargs, allowed, state, final,
+                          transition):
+        self._call(action, kwargs)
+        changes = []
+        for instance_id in kwargs['InstanceIds']:
+            instance = self._get(self.instances, instance_id,
+                                 'InvalidInstanceID.NotFound', action)
+            previous = instance['State']
+            if _state_name(instance) not in allowed:
+                raise client_error(
+                    'IncorrectInstanceState',
+                    "The instance '%s' is not in a state from which it can "
+                    "be %s." % (instance_id, state), action)
+            if _state_name(instance) != final:
+                instance['_pending'] = []
+                instance['State'] = {'Name': state,
+                                     'Code': INSTANCE_STATE_CODES[state]}
+                self._schedule(instance, 'State', final, transition)
+            changes.append({'InstanceId': instance_id,
+                            'PreviousState': dict(previous),
+                            'CurrentState': dict(instance['State'])})
+        return changes
+
+    def start_instances(self, **kwargs):
+        changes = self._change_instances(
+            'start_instances', kwargs, ('pending', 'running', 'stopped'),
+            'pending', 'running', 'instance_running')
+        return {'StartingInstances': changes}
+
+    def stop_instances(self, **kwargs):
+        changes = self._change_instances(
+            'stop_instances', kwargs,
+            ('pending', 'running', 'stopping', 'stopped'),
+            'stopping', 'stopped', 'instance_stopping')
+        return {'StoppingInstances': changes}
+
+    def terminate_instances(self, **kwargs):
+        changes = self._change_instances(
+            'terminate_instances', kwargs,
+            tuple(INSTANCE_STATE_CODES), 'shutting-down', 'terminated',
+            'instance_terminating')
+        for change in changes:
+            for volume in self.volumes.values():
+                if any(a['InstanceId'] == change['InstanceId']
+                       for a in volume['Attachments']):
+                    volume['Attachments'] = []
+                    volume['State'] = 'available'
+        return {'TerminatingInstances': changes}
+
+    def reboot_instances(self, **kwargs):
+        self._call('reboot_instances', kwargs)
+        for instance_id in kwargs['InstanceIds']:
+            self._get(self.instances, instance_id,
+                      'InvalidInstanceID.NotFound', 'RebootInstances')
+        return {}
+
+    # volumes
+
+    def create_volume(self, **kwargs):
+        self._call('create_volume', kwargs)
+        token = kwargs.get('ClientToken')
+        if token and ('volume', token) in self._tokens:
+            return copy.deepcopy(self._tokens[('volume', token)])
+        size = kwargs.get('Size')
+        snapshot_id = kwargs.get('SnapshotId')
+        if snapshot_id:
+            snapshot = self._get(self.snapshots, snapshot_id,
+                                 'InvalidSnapshot.NotFound', 'CreateVolume')
+            if snapshot['State'] != 'completed':
+                raise client_error('IncorrectState',
+                                   'Snapshot %s is not completed'
+                                   % snapshot_id, 'CreateVolume')
+            if size and size < snapshot['VolumeSize']:
+                raise client_error('InvalidParameterValue',
+                                   'Volume of %sGiB is smaller than '
+                                   'snapshot %s' % (size, snapshot_id),
+                                   'CreateVolume')
+            size = size or snapshot['VolumeSize']
+        if not size:
+            raise client_error('MissingParameter',
+                               'The request must contain the parameter size '
+                               'or snapshotId', 'CreateVolume')
+        volume_id = self._new_id('vol')
+        volume = {'VolumeId': volume_id,
+                  'Size': size,
+                  'SnapshotId': snapshot_id or '',
+                  'AvailabilityZone': kwargs.get('AvailabilityZone',
+                                                 self.availability_zone),
+                  'State': 'creating',
+                  'VolumeType': kwargs.get('VolumeType', 'gp2'),
+                  'Encrypted': kwargs.get('Encrypted', False),
+                  'Attachments': [],
+                  'Tags': []}
+        for key in ('Iops', 'Throughput', 'KmsKeyId'):
+            if key in kwargs:
+                volume[key] = kwargs[key]
+        self._apply_tag_specs(volume, 'volume', kwargs)
+        self._schedule(volume, 'State', 'available', 'volume_creating')
+        self.volumes[volume_id] = volume
+        response = _public(volume)
+        if token:
+            self._tokens[('volume', token)] = response
+        return copy.deepcopy(response)
+
+    def delete_volume(self, **kwargs):
+        self._call('delete_volume', kwargs)
+        volume = self._get(self.volumes, kwargs['VolumeId'],
+                           'InvalidVolume.NotFound', 'DeleteVolume')
+        if volume['State'] != 'available':
+            raise client_error('VolumeInUse',
+                               'Volume %s is currently attached'
+                               % volume['VolumeId'], 'DeleteVolume')
+        volume['State'] = 'deleting'
+        self._schedule(volume, '_deleted', True, 'volume_deleting')
+        return {}
+
+    def describe_volumes(self, **kwargs):
+        self._call('describe_volumes', kwargs)
+        volumes = self._select(self.volumes, kwargs.get('VolumeIds'),
+                               'InvalidVolume.NotFound', 'DescribeVolumes',
+                               kwargs.get('Filters'), VOLUME_FILTERS)
+        return self._page([_public(v) for v in volumes], kwargs, 'Volumes')
+
+    def attach_volume(self, **kwargs):
+        self._call('attach_volume', kwargs)
+        volume = self._get(self.volumes, kwargs['VolumeId'],
+                           'InvalidVolume.NotFound', 'AttachVolume')
+        instance = self._get(self.instances, kwargs['InstanceId'],
+                             'InvalidInstanceID.NotFound', 'AttachVolume')
+        if volume['State'] != 'available':
+            raise client_error('VolumeInUse',
+                               'vol %s is already attached to an instance'
+                               % volume['VolumeId'], 'AttachVolume')
+        if _state_name(instance) not in ('running', 'stopped'):
+            raise client_error('IncorrectState',
+                               'Instance %s is not running or stopped'
+                               % instance['InstanceId'], 'AttachVolume')
+        attachment = {'VolumeId': volume['VolumeId'],
+                      'InstanceId': instance['InstanceId'],
+                      'Device': kwargs['Device'],
+                      'State': 'attaching'}
+        volume['State'] = 'in-use'
+        volume['Attachments'] = [attachment]
+        instance['BlockDeviceMappings'].append(
+            {'DeviceName': kwargs['Device'],
+             'Ebs': {'VolumeId': volume['VolumeId'], 'Status': 'attached'}})
+
+        def _attached(item):
+            for a in item['Attachments']:
+                a['State'] = 'attached'
+        self._schedule(volume, 'Attachments', _attached, 'volume_attaching')
+        return dict(attachment)
+
+    def detach_volume(self, **kwargs):
+        self._call('detach_volume', kwargs)
+        volume = self._get(self.volumes, kwargs['VolumeId'],
+                           'InvalidVolume.NotFound', 'DetachVolume')
+        if not volume['Attachments']:
+            raise client_error('IncorrectState',
+                               'Volume %s is in the available state'
+                               % volume['VolumeId'], 'DetachVolume')
+        attachment = volume['Attachments'][0]
+        attachment['State'] = 'detaching'
+        instance = self.instances.get(attachment['InstanceId'])
+        if instance:
+            instance['BlockDeviceMappings'] = [
+                bdm for bdm in instance['BlockDeviceMappings']
+                if bdm.get('Ebs', {}).get('VolumeId') != volume['VolumeId']]
+
+        def _detached(item):
+            item['Attachments'] = []
+            item['State'] = 'available'
+        self._schedule(volume, 'Attachments', _detached, 'volume_detaching')
+        return dict(attachment)
+
+    # snapshots
+
+    def create_snapshot(self, **kwargs):
+        self._call('create_snapshot', kwargs)
+        volume = self._get(self.volumes, kwargs['VolumeId'],
+                           'InvalidVolume.NotFound', 'CreateSnapshot')
+        return _public(self._new_snapshot(volume, kwargs))
+
+    def create_snapshots(self, **kwargs):
+        self._call('create_snapshots', kwargs)
+        spec = kwargs['InstanceSpecification']
+        instance = self._get(self.instances, spec.get('InstanceId'),
+                             'InvalidInstanceID.NotFound', 'CreateSnapshots')
+        excluded = set(spec.get('ExcludeDataVolumeIds', []))
+        snapshots = []
+        for bdm in instance['BlockDeviceMappings']:
+            volume = self.volumes.get(bdm.get('Ebs', {}).get('VolumeId'))
+            if volume is None or volume['VolumeId'] in excluded:
+                continue
+            if (spec.get('ExcludeBootVolume') and
+                    bdm['DeviceName'] == instance.get('RootDeviceName')):
+                continue
+            snapshot = self._new_snapshot(volume, kwargs)
+            if kwargs.get('CopyTagsFromSource') == 'volume':
+                snapshot['Tags'].extend(copy.deepcopy(volume['Tags']))
+            snapshots.append(_public(snapshot))
+        return {'Snapshots': snapshots}
+
+    def _new_snapshot(self, volume, kwargs):
+        snapshot_id = self._new_id('snap')
+        snapshot = {'SnapshotId': snapshot_id,
+                    'VolumeId': volume['VolumeId'],
+                    'VolumeSize': volume['Size'],
+                    'Description': kwargs.get('Description', ''),
+                    'State': 'pending',
+                    'Progress': '0%',
+                    'StartTime': self.clock(),
+                    'OwnerId': '000000000000',
+                    'Encrypted': volume['Encrypted'],
+                    'Tags': []}
+        self._apply_tag_specs(snapshot, 'snapshot', kwargs)
+
+        def _completed(item):
+            item['State'] = 'completed'
+            item['Progress'] = '100%'
+        self._schedule(snapshot, 'State', _completed, 'snapshot_completing',
+                       volume['Size'] *
+                       self.transitions['snapshot_completing_per_gib'])
+        snapshot['_completes_at'] = snapshot['_pending'][-1][0]
+        self.snapshots[snapshot_id] = snapshot
+        return snapshot
+
+    def delete_snapshot(self, **kwargs):
+        self._call('delete_snapshot', kwargs)
+        snapshot = self._get(self.snapshots, kwargs['SnapshotId'],
+                             'InvalidSnapshot.NotFound', 'DeleteSnapshot')
+        snapshot['_deleted'] = True
+        return {}
+
+    def describe_snapshots(self, **kwargs):
+        self._call('describe_snapshots', kwargs)
+        snapshots = self._select(self.snapshots, kwargs.get('SnapshotIds'),
+                                 'InvalidSnapshot.NotFound',
+                                 'DescribeSnapshots', kwargs.get('Filters'),
+                                 SNAPSHOT_FILTERS)
+        for snapshot in snapshots:
+            if snapshot['State'] == 'pending':
+                self._update_progress(snapshot)
+        return self._page([_public(s) for s in snapshots], kwargs,
+                          'Snapshots')
+
+    def _update_progress(self, snapshot):
+        started = snapshot['StartTime']
+        done = (self.clock() - started) / \
+            max(snapshot['_completes_at'] - started, 1e-9)
+        snapshot['Progress'] = '%d%%' % min(int(done * 100), 99)
+
+    # images and tags
+
+    def describe_images(self, **kwargs):
+        self._call('describe_images', kwargs)
+        images = self._select(self.images, kwargs.get('ImageIds'),
+                              'InvalidAMIID.NotFound', 'DescribeImages',
+                              kwargs.get('Filters'), IMAGE_FILTERS)
+        return {'Images': [_public(i) for i in images]}
+
+    def _tagged(self):
+        stores = (('instance', self.instances, 'InstanceId'),
+                  ('volume', self.volumes, 'VolumeId'),
+                  ('snapshot', self.snapshots, 'SnapshotId'),
+                  ('image', self.images, 'ImageId'))
+        for resource_type, store, id_key in stores:
+            for item in store.values():
+                if not item.get('_deleted'):
+                    yield resource_type, item[id_key], item
+
+    def create_tags(self, **kwargs):
+        self._call('create_tags', kwargs)
+        resources = dict((resource_id, item) for _type, resource_id, item
+                         in self._tagged())
+        for resource_id in kwargs['Resources']:
+            if resource_id not in resources:
+                raise client_error('InvalidID',
+                                   "The ID '%s' is not valid" % resource_id,
+                                   'CreateTags')
+        for resource_id in kwargs['Resources']:
+            tags = resources[resource_id]['Tags']
+            for tag in kwargs['Tags']:
+                tags[:] = [t for t in tags if t['Key'] != tag['Key']]
+                tags.append(dict(tag))
+        return {}
+
+    def describe_tags(self, **kwargs):
+        self._call('describe_tags', kwargs)
+        tags = []
+        for resource_type, resource_id, item in self._tagged():
+            for tag in item['Tags']:
+                tag = {'Key': tag['Key'], 'Value': tag['Value'],
+                       'ResourceId': resource_id,
+                       'ResourceType': resource_type}
+                if _matches(tag, kwargs.get('Filters'), TAG_FILTERS):
+                    tags.append(tag)
+        return self._page(tags, kwargs, 'Tags')
+
+    # waiters
+
+    def get_waiter(self, name):
+        if name not in WAITERS:
+            raise ValueError('Waiter does not exist: %s' % name)
+        return FakeWaiter(self, name, *WAITERS[name])
+
+
+class FakeClock(object):
+    """Time that only advances when slept, to run a client on."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def connect(aws_client, ec2):
+    """Make the AwsClient of a driver talk to the simulator."""
+    aws_client.create_ec2_client = lambda context=None: ec2
+    aws_client.create_resource_client = lambda context=None: None
+    aws_client.create_quotas_client = lambda context=None: None
+    get_aws_client = aws_client.get_aws_client
+
+    def _sleep(seconds):
+        # sleeps between waiter polls count as time spent in waiters
+        started = ec2.clock()
+        ec2.sleep(seconds)
+        ec2.waiter_seconds['polling'] += ec2.clock() - started
+
+    def _get_aws_client(context):
+        plugin = get_aws_client(context)
+        # waiters poll on the simulated clock
+        plugin._waiters.clock = ec2.simulated_time
+        plugin._waiters.sleep = _sleep
+        return plugin
+    aws_client.get_aws_client = _get_aws_client
+
+
+class TrackerTestCase(testtools.TestCase):
+    """Runs against a simulator on a FakeClock, through an AwsClient.
+
+    eventlet.spawn is patched, the tests poll the trackers themselves.
+    """
+
+    def setUp(self):
+        super(TrackerTestCase, self).setUp()
+        self.clock = FakeClock()
+        self.ec2 = FakeEc2Client(clock=self.clock.time,
+                                 sleep=self.clock.sleep, seed=1)
+        self.aws_client = client.AwsClient()
+        connect(self.aws_client, self.ec2)
+        spawn = mock.patch('eventlet.spawn')
+        self.spawn_mock = spawn.start()
+        self.addCleanup(spawn.stop)
@@ -15,8 +15,11 @@ import mock
 import testtools
 
 from jacket import context
+from jacket.drivers.aws.cleanup import CleanupQueue
 from jacket.drivers.aws.client import AwsClientPlugin
 from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws.snapshot_tracker import SnapshotTracker
+from jacket.drivers.aws import volume_driver
 from jacket.drivers.aws.volume_driver import AwsBackupDriver
 from jacket.drivers.aws.volume_driver import BaseDriver
 from jacket.i18n import _
@@ -54,6 +57,9 @@ class TestAwsBackupDriver(testtools.TestCase):
     def setUp(self):
         """Initialise variable common to all the test cases."""
         super(TestAwsBackupDriver, self).setUp()
+        state = mock.patch.dict(volume_driver._BACKUP_STATE, clear=True)
+        state.start()
+        self.addCleanup(state.stop)
         self.ctx = context.RequestContext('fake', 'fake', is_admin=False)
         self.volume = fake_volume.fake_volume_obj(self.ctx)
         self.backup = fake_backup.fake_backup_obj(self.ctx)
@@ -75,12 +81,37 @@ class TestAwsBackupDriver(testtools.TestCase):
     @mock.patch.object(AwsClientPlugin, 'create_tags', mock.MagicMock())
     @mock.patch('jacket.db.extend.api.volume_backup_mapper_create',
                 mock.MagicMock())
+    @mock.patch.object(SnapshotTracker, 'track')
     @mock.patch.object(AwsClientPlugin, 'create_snapshot')
-    def test_create_backup(self, mock_create):
+    def test_create_backup(self, mock_create, mock_track):
         mock_create.return_value = self.fake_snap
         self.driver.backup(self.backup, 'fake')
-        create_args = {'VolumeId': 'fake'}
-        mock_create.assert_called_once_with(**create_args)
+        tags = [{'Key': 'caa_snapshot_id', 'Value': self.backup.id}]
+        create_args = {'VolumeId': 'fake',
+                       'TagSpecifications': [{'ResourceType': 'snapshot',
+                                              'Tags': tags}]}
+        mock_create.assert_called_once_with(wait=False, **create_args)
+        mock_track.assert_called_once_with(mock.ANY, self.backup.id, 'fake')
+
+    def test_backup_updated(self):
+        self.driver.db = mock.MagicMock()
+        self.driver._backup_updated(self.ctx, 'backup', 'completed')
+        self.driver._backup_updated(self.ctx, 'backup', 'error')
+        self.assertEqual(
+            [mock.call(self.ctx, 'backup', {
+                'status': 'error',
+                'fail_reason': 'aws snapshot state: error'})],
+            self.driver.db.backup_update.call_args_list)
+
+    @mock.patch.object(SnapshotTracker, 'resume')
+    def test_setup_resumes_tracking(self, mock_resume):
+        self.driver.db = mock.MagicMock()
+        self.driver.check_for_setup_error()
+        context, owned = mock_resume.call_args[0]
+        self.assertTrue(owned(context, 'backup'))
+        self.driver.db.backup_get.side_effect = \
+            cinder_ex.BackupNotFound(backup_id='backup')
+        self.assertFalse(owned(context, 'backup'))
 
     @mock.patch.object(BaseDriver, '_get_provider_volume_id',
                        mock.MagicMock(return_value='fake'))
@@ -115,6 +146,16 @@ class TestAwsBackupDriver(testtools.TestCase):
                           self.driver.delete,
                           self.backup)
 
+    @mock.patch.object(AwsBackupDriver, '_get_provider_backup_id',
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch('jacket.db.extend.api.volume_backup_mapper_delete')
+    @mock.patch.object(AwsClientPlugin, 'delete_snapshot')
+    def test_delete_backup_already_gone(self, mock_delete, mock_mapper):
+        mock_delete.side_effect = exception_ex.ProviderDeleteSnapshotFailed(
+            reason='', error_code='InvalidSnapshot.NotFound')
+        self.driver.delete(self.backup)
+        self.assertTrue(mock_mapper.called)
+
     @mock.patch.object(AwsBackupDriver, '_get_provider_backup_id')
     @mock.patch.object(BaseDriver, '_get_provider_snapshot')
     @mock.patch.object(AwsClientPlugin, 'delete_snapshot')
@@ -136,19 +177,40 @@ class TestAwsBackupDriver(testtools.TestCase):
                 mock.MagicMock())
     @mock.patch.object(BaseDriver, '_create_volume')
     @mock.patch.object(AwsClientPlugin, 'delete_volume')
-    def test_restore(self, mock_delete, mock_create_volume):
+    @mock.patch.object(AwsClientPlugin, 'get_snapshot_state',
+                       mock.MagicMock(return_value='pending'))
+    @mock.patch.object(AwsClientPlugin, 'wait_snapshot_completed')
+    def test_restore(self, mock_wait, mock_delete, mock_create_volume):
         mock_create_volume.return_value = self.fake_ebs
         self.driver.restore(self.backup, self.volume.id, '')
+        mock_wait.assert_called_once_with('fake_backup')
         mock_delete.assert_called_once_with(VolumeId='old_fake')
 
+    @mock.patch.object(BaseDriver, '_get_provider_volume_id',
+                       mock.MagicMock(return_value='old_fake'))
+    @mock.patch.object(AwsBackupDriver, '_get_provider_backup_id',
+                       mock.MagicMock(return_value='fake_backup'))
+    @mock.patch.object(BaseDriver, '_create_volume')
+    @mock.patch.object(AwsClientPlugin, 'get_snapshot_state',
+                       mock.MagicMock(return_value=None))
+    def test_restore_gone_backup(self, mock_create_volume):
+        self.assertRaises(cinder_ex.BackupOperationError,
+                          self.driver.restore,
+                          self.backup,
+                          self.volume.id,
+                          '')
+        self.assertFalse(mock_create_volume.called)
+
     @mock.patch.object(BaseDriver, '_get_provider_volume_id',
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(AwsBackupDriver, '_get_provider_backup_id',
                        mock.MagicMock(return_value='fake_backup'))
     @mock.patch('jacket.db.extend.api.volume_mapper_update')
     @mock.patch.object(BaseDriver, '_create_volume')
-    @mock.patch.object(AwsClientPlugin, 'delete_volume')
-    def test_restore_failed(self, mock_delete,
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    @mock.patch.object(AwsClientPlugin, 'get_snapshot_state',
+                       mock.MagicMock(return_value='completed'))
+    def test_restore_failed(self, mock_enqueue,
                             mock_create_volume,
                             mock_update):
         mock_create_volume.return_value = self.fake_ebs
@@ -158,4 +220,5 @@ class TestAwsBackupDriver(testtools.TestCase):
                           self.backup,
                           self.volume.id,
                           '')
-        mock_delete.assert_called_once_with(VolumeId='fake')
+        mock_enqueue.assert_called_once_with(self.backup.project_id, 'volume',
+                                             'fake')
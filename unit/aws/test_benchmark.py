@@ -0,0 +1,91 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import testtools
+
+from jacket import conf
+from jacket.tests.storage.unit.volume.drivers.aws import bench_compute
+from jacket.tests.storage.unit.volume.drivers.aws import bench_volume
+from jacket.tests.storage.unit.volume.drivers.aws import benchmark
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+
+CONF = conf.CONF
+
+
+class BenchmarkTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(BenchmarkTestCase, self).setUp()
+        self.args = benchmark.build_parser('test').parse_args(
+            ['--count', '3', '--concurrency', '2', '--time-scale', '0.0001',
+             '--latency', '0'])
+
+    def test_fake_caa_db(self):
+        db = benchmark.FakeCaaDb()
+        db.volume_mapper_create(None, 'caa-1', 'p', {'provider_volume_id': 1})
+        db.volume_mapper_update(None, 'caa-1', 'p', {'other': 2})
+        self.assertEqual({'provider_volume_id': 1, 'other': 2},
+                         db.volume_mapper_get(None, 'caa-1'))
+        self.assertEqual(['caa-1'], list(db.volume_mapper_all(None)))
+        db.volume_mapper_delete(None, 'caa-1', 'p')
+        self.assertEqual({}, db.volume_mapper_get(None, 'caa-1'))
+        self.assertRaises(AttributeError, getattr, db, 'volume_get')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, benchmark.percentile(values, 50))
+        self.assertEqual(99, benchmark.percentile(values, 99))
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_run_phase_counts_calls_and_errors(self):
+        ec2 = fake_ec2.FakeEc2Client(time_scale=0.0001)
+
+        def _operation(size):
+            ec2.create_volume(Size=size, AvailabilityZone='az')
+            if size > 2:
+                raise ValueError()
+
+        result = benchmark.run_phase('create', _operation, [1, 2, 3], 2, ec2)
+        self.assertEqual(3, result['ops'])
+        self.assertEqual(1, result['errors'])
+        self.assertEqual({'create_volume': 3}, result['api_calls'])
+        self.assertEqual(1.0, result['api_calls_per_op'])
+        self.assertIn('ValueError', result['error_sample'])
+
+    def test_apply_options(self):
+        self.addCleanup(CONF.clear_override, 'coalesce_run_instances', 'aws')
+        self.addCleanup(CONF.clear_override, 'coalesce_max_count', 'aws')
+        benchmark.apply_options(['coalesce_run_instances=true',
+                                 'coalesce_max_count=7'])
+        self.assertTrue(CONF.aws.coalesce_run_instances)
+        self.assertEqual(7, CONF.aws.coalesce_max_count)
+
+    def test_compute_benchmark(self):
+        results = bench_compute.run(self.args)
+        self.assertEqual(['spawn', 'get_info', 'power_off', 'power_on',
+                          'attach_volume', 'detach_volume', 'destroy'],
+                         [result['operation'] for result in results])
+        self.assertEqual([0] * 7, [result['errors'] for result in results])
+        self.assertEqual(1.0, results[1]['api_calls_per_op'])
+
+    def test_volume_benchmark(self):
+        args = bench_volume.build_parser().parse_args(
+            ['--count', '2', '--time-scale', '0.0001', '--latency', '0',
+             '--scaling', '1,2'])
+        results = bench_volume.run(args)
+        self.assertEqual([0] * len(results),
+                         [result['errors'] for result in results])
+        mixed = [result for result in results
+                 if result['operation'] == 'mixed']
+        self.assertEqual([1, 2], [result['concurrency'] for result in mixed])
+        self.assertEqual(mixed[0]['mix'], mixed[1]['mix'])
+        self.assertEqual('delete_volume', results[-1]['operation'])
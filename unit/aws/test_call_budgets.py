@@ -0,0 +1,332 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Upper bounds on the remote calls of each driver entry point.
+
+A change making an operation call aws or the caa db more often than its
+budget fails here. The aws calls are counted twice: as the AwsClientPlugin
+methods called ('aws.*') and as the requests the simulator gets ('ec2.*'),
+waiter polls left out, so a plugin method making more requests is caught
+as well. Lower the budget when an operation gets cheaper, raise it only
+on purpose.
+"""
+
+import eventlet
+import mock
+import testtools
+
+from jacket import conf
+from jacket import context as req_context
+from jacket.tests.storage.unit.volume.drivers.aws import bench_compute
+from jacket.tests.storage.unit.volume.drivers.aws import bench_volume
+from jacket.tests.storage.unit.volume.drivers.aws import benchmark
+from jacket.tests.storage.unit.volume.drivers.aws import call_recorder
+
+CONF = conf.CONF
+
+COMPUTE_BUDGETS = {
+    'spawn_cold': {'aws.describe_images': 1, 'aws.create_instance': 1,
+                   'aws.create_tags': 1, 'db.project_mapper_get': 1,
+                   'db.flavor_mapper_get': 1,
+                   'db.instance_mapper_create': 1,
+                   'ec2.describe_images': 1, 'ec2.run_instances': 1,
+                   'ec2.create_tags': 1},
+    'spawn': {'aws.create_instance': 1, 'aws.create_tags': 1,
+              'db.flavor_mapper_get': 1, 'db.instance_mapper_create': 1,
+              'ec2.run_instances': 1, 'ec2.create_tags': 1},
+    'get_info': {'aws.describe_instances': 1, 'db.instance_mapper_get': 1,
+                 'ec2.describe_instances': 1},
+    'power_off': {'aws.stop_instances': 1, 'db.instance_mapper_get': 1,
+                  'ec2.stop_instances': 1},
+    'power_on': {'aws.start_instances': 1, 'db.instance_mapper_get': 1,
+                 'ec2.start_instances': 1},
+    'power_off_batched': {'aws.stop_instances': 1,
+                          'db.instance_mapper_get': 8,
+                          'ec2.stop_instances': 1},
+    'reboot': {'aws.reboot_instances': 1, 'db.instance_mapper_get': 1,
+               'ec2.reboot_instances': 1},
+    'attach_volume': {'aws.attach_volume': 1, 'db.instance_mapper_get': 1,
+                      'db.volume_mapper_get': 1, 'ec2.attach_volume': 1},
+    'detach_volume': {'aws.detach_volume': 1, 'db.instance_mapper_get': 1,
+                      'db.volume_mapper_get': 1, 'ec2.detach_volume': 1},
+    'destroy': {'aws.delete_instances': 1, 'db.instance_mapper_get': 1,
+                'db.instance_mapper_delete': 1,
+                'ec2.terminate_instances': 1},
+}
+
+_CREATE_VOLUME = {'aws.create_volume': 1, 'aws.create_tags': 1,
+                  'db.project_mapper_get': 2, 'db.volume_mapper_create': 1,
+                  'ec2.create_volume': 1, 'ec2.create_tags': 1}
+_REPLACE_VOLUME = {'aws.create_snapshot': 1, 'aws.create_volume': 1,
+                   'aws.create_tags': 1, 'aws.delete_snapshot': 1,
+                   'aws.delete_volume': 1, 'db.project_mapper_get': 2,
+                   'db.volume_mapper_get': 1, 'db.volume_mapper_update': 1,
+                   'ec2.create_snapshot': 1, 'ec2.create_volume': 1,
+                   'ec2.create_tags': 1, 'ec2.delete_snapshot': 1,
+                   'ec2.delete_volume': 1}
+
+VOLUME_BUDGETS = {
+    'create_volume': _CREATE_VOLUME,
+    'create_snapshot': {'aws.create_snapshot': 1, 'db.volume_mapper_get': 1,
+                        'db.volume_snapshot_mapper_create': 1,
+                        'ec2.create_snapshot': 1},
+    'create_volume_from_snapshot': dict(
+        _CREATE_VOLUME, **{'aws.get_snapshot_state': 1,
+                           'aws.wait_snapshot_completed': 1,
+                           'db.volume_snapshot_mapper_get': 1,
+                           'ec2.describe_snapshots': 1}),
+    'create_cloned_volume': dict(
+        _CREATE_VOLUME, **{'aws.create_snapshot': 1,
+                           'aws.delete_snapshot': 1,
+                           'db.volume_mapper_get': 1,
+                           'ec2.create_snapshot': 1,
+                           'ec2.delete_snapshot': 1}),
+    'create_cloned_volume_cached': dict(
+        _CREATE_VOLUME, **{'db.volume_mapper_get': 1}),
+    'extend_volume': _REPLACE_VOLUME,
+    'retype': _REPLACE_VOLUME,
+    'delete_snapshot': {'aws.delete_snapshot': 1,
+                        'db.volume_snapshot_mapper_get': 1,
+                        'db.volume_snapshot_mapper_delete': 1,
+                        'ec2.delete_snapshot': 1},
+    'delete_volume': {'aws.delete_volume': 1, 'db.volume_mapper_get': 1,
+                      'db.volume_mapper_delete': 1, 'ec2.delete_volume': 1},
+    'backup': {'aws.create_snapshot': 1, 'db.volume_mapper_get': 1,
+               'db.volume_backup_mapper_create': 1,
+               'ec2.create_snapshot': 1},
+    'restore': {'aws.get_snapshot_state': 1,
+                'aws.wait_snapshot_completed': 1, 'aws.create_volume': 1,
+                'aws.create_tags': 1, 'aws.delete_volume': 1,
+                'db.project_mapper_get': 2, 'db.backup_mapper_get': 1,
+                'db.volume_mapper_get': 1, 'db.volume_mapper_update': 1,
+                'ec2.describe_snapshots': 1, 'ec2.create_volume': 1,
+                'ec2.create_tags': 1, 'ec2.delete_volume': 1},
+    'create_cgsnapshot': {'aws.describe_instances': 1,
+                          'aws.create_snapshots': 1, 'aws.create_tags': 8,
+                          'db.volume_mapper_get': 8,
+                          'db.instance_mapper_get': 8,
+                          'db.volume_snapshot_mapper_create': 8,
+                          'ec2.describe_instances': 1,
+                          'ec2.create_snapshots': 1, 'ec2.create_tags': 8},
+    'instance_backup': {'aws.describe_instances': 1,
+                        'aws.create_snapshots': 1, 'aws.create_tags': 8,
+                        'db.volume_mapper_get': 8,
+                        'db.instance_mapper_get': 8,
+                        'db.volume_backup_mapper_create': 8,
+                        'ec2.describe_instances': 1,
+                        'ec2.create_snapshots': 1, 'ec2.create_tags': 8},
+    'delete_backup': {'aws.delete_snapshot': 1, 'db.backup_mapper_get': 1,
+                      'db.volume_backup_mapper_delete': 1,
+                      'ec2.delete_snapshot': 1},
+}
+
+
+def _args():
+    return bench_volume.build_parser().parse_args(
+        ['--latency', '0', '--time-scale', '0.0001'])
+
+
+class CallBudgetTestCase(testtools.TestCase):
+
+    budgets = None
+
+    def setUp(self):
+        super(CallBudgetTestCase, self).setUp()
+        self.recorder = call_recorder.CallRecorder()
+
+    def record(self, driver, aws_client, db):
+        self.recorder.record_aws(aws_client)
+        driver.caa_db_api = self.recorder.wrap(db, 'db')
+
+    def assertWithinBudget(self, operation, func, *args):
+        budget = self.budgets[operation]
+        with self.recorder.measure() as calls:
+            func(*args)
+        over = dict((call, count) for call, count in calls.items()
+                    if count > budget.get(call, 0))
+        if over:
+            self.fail('%s made %s, over its budget of %s' % (
+                operation, sorted(over.items()), sorted(budget.items())))
+
+
+class ComputeCallBudgetTestCase(CallBudgetTestCase):
+
+    budgets = COMPUTE_BUDGETS
+
+    def setUp(self):
+        super(ComputeCallBudgetTestCase, self).setUp()
+        self.ec2 = benchmark.make_ec2(_args())
+        db = benchmark.FakeCaaDb()
+        self.context = req_context.RequestContext(
+            is_admin=True, project_id=bench_compute.PROJECT_ID)
+        bench_compute.setup_project(self.context, self.ec2, db)
+        self.driver = bench_compute.build_driver(self.ec2, db)
+        self.record(self.driver, self.driver.aws_client, db)
+        self.recorder.record_ec2(self.ec2)
+        self.connection_info = {'data': {
+            'volume_id': bench_compute.create_volumes(self.context, self.ec2,
+                                                      db, 1)[0]}}
+
+    def _spawn(self, instance):
+        self.driver.spawn(self.context, instance, None, [], None)
+
+    def _spawned(self):
+        # the first spawn fills the caches of the later ones
+        self._spawn(bench_compute.FakeInstance())
+        instance = bench_compute.FakeInstance()
+        self._spawn(instance)
+        return instance
+
+    def test_spawn_cold(self):
+        self.assertWithinBudget('spawn_cold', self._spawn,
+                                bench_compute.FakeInstance())
+
+    def test_spawn(self):
+        self._spawn(bench_compute.FakeInstance())
+        self.assertWithinBudget('spawn', self._spawn,
+                                bench_compute.FakeInstance())
+
+    def test_get_info(self):
+        self.assertWithinBudget('get_info', self.driver.get_info,
+                                self._spawned())
+
+    def test_power_off_on(self):
+        instance = self._spawned()
+        self.assertWithinBudget('power_off', self.driver.power_off, instance)
+        self.assertWithinBudget('power_on', self.driver.power_on,
+                                self.context, instance, None)
+
+    def test_power_off_batched(self):
+        for name, value in (('batch_power_actions', True),
+                            ('power_action_window', 0.01),
+                            ('power_action_policy', 'track')):
+            self.addCleanup(CONF.clear_override, name, 'aws')
+            CONF.set_override(name, value, 'aws')
+        instances = [self._spawned() for _i in range(8)]
+
+        def _power_off_all():
+            threads = [eventlet.spawn(self.driver.power_off, instance)
+                       for instance in instances]
+            for thread in threads:
+                thread.wait()
+        # the instance tracker does not poll
+        with mock.patch.object(self.driver._instance_tracker, '_run'):
+            self.assertWithinBudget('power_off_batched', _power_off_all)
+
+    def test_reboot(self):
+        self.assertWithinBudget('reboot', self.driver.reboot, self.context,
+                                self._spawned(), None, 'SOFT')
+
+    def test_attach_detach_volume(self):
+        instance = self._spawned()
+        self.assertWithinBudget('attach_volume', self.driver.attach_volume,
+                                self.context, self.connection_info, instance)
+        self.assertWithinBudget('detach_volume', self.driver.detach_volume,
+                                self.connection_info, instance, None)
+
+    def test_destroy(self):
+        self.assertWithinBudget('destroy', self.driver.destroy, self.context,
+                                self._spawned(), None)
+
+
+class VolumeCallBudgetTestCase(CallBudgetTestCase):
+
+    budgets = VOLUME_BUDGETS
+
+    def setUp(self):
+        super(VolumeCallBudgetTestCase, self).setUp()
+        self.workload = bench_volume.Workload(_args())
+        self.driver = self.workload.driver
+        self.backup_driver = self.workload.backup_driver
+        for driver in (self.driver, self.backup_driver):
+            self.record(driver, driver._aws_client, self.workload.db)
+        self.recorder.record_ec2(self.workload.ec2)
+        self.volume = self.workload.new_volume()
+        self.driver.create_volume(self.volume)
+
+    def test_create_delete_volume(self):
+        volume = self.workload.new_volume()
+        self.assertWithinBudget('create_volume', self.driver.create_volume,
+                                volume)
+        self.assertWithinBudget('delete_volume', self.driver.delete_volume,
+                                volume)
+
+    def test_snapshot(self):
+        snapshot = bench_volume.FakeSnapshot(self.volume)
+        self.assertWithinBudget('create_snapshot',
+                                self.driver.create_snapshot, snapshot)
+        self.assertWithinBudget('create_volume_from_snapshot',
+                                self.driver.create_volume_from_snapshot,
+                                self.workload.new_volume(), snapshot)
+        self.assertWithinBudget('delete_snapshot',
+                                self.driver.delete_snapshot, snapshot)
+
+    def test_create_cloned_volume(self):
+        self.assertWithinBudget('create_cloned_volume',
+                                self.driver.create_cloned_volume,
+                                self.workload.new_volume(), self.volume)
+
+    def test_create_cloned_volume_cached(self):
+        self.addCleanup(CONF.clear_override, 'clone_snapshot_cache', 'aws')
+        CONF.set_override('clone_snapshot_cache', True, 'aws')
+        self.driver.create_cloned_volume(self.workload.new_volume(),
+                                         self.volume)
+        self.assertWithinBudget('create_cloned_volume_cached',
+                                self.driver.create_cloned_volume,
+                                self.workload.new_volume(), self.volume)
+
+    def test_extend_volume(self):
+        self.assertWithinBudget('extend_volume', self.workload.extend,
+                                self.volume)
+
+    def test_retype(self):
+        self.assertWithinBudget('retype', self.workload.retype, self.volume)
+
+    def test_backup_restore_delete(self):
+        backup = bench_volume.FakeBackup(self.volume)
+        self.assertWithinBudget('backup', self.backup_driver.backup, backup,
+                                None)
+        self.assertWithinBudget('restore', self.backup_driver.restore,
+                                backup, backup.volume_id, None)
+        self.assertWithinBudget('delete_backup', self.backup_driver.delete,
+                                backup)
+
+    def _attached_volumes(self, count):
+        volumes = [self.workload.new_volume() for _i in range(count)]
+        for volume in volumes:
+            self.driver.create_volume(volume)
+        self.workload.attach(volumes)
+        return volumes
+
+    def test_create_cgsnapshot(self):
+        snapshots = [bench_volume.FakeSnapshot(volume)
+                     for volume in self._attached_volumes(8)]
+        cgsnapshot = mock.Mock(id='cgsnapshot',
+                               project_id=self.volume.project_id)
+        self.assertWithinBudget('create_cgsnapshot',
+                                self.driver.create_cgsnapshot, None,
+                                cgsnapshot, snapshots)
+
+    def test_instance_backup(self):
+        self.addCleanup(CONF.clear_override, 'instance_backups', 'aws')
+        CONF.set_override('instance_backups', True, 'aws')
+        self.addCleanup(CONF.clear_override, 'instance_backup_window', 'aws')
+        CONF.set_override('instance_backup_window', 0.01, 'aws')
+        backups = [bench_volume.FakeBackup(volume)
+                   for volume in self._attached_volumes(8)]
+
+        def _backup_all():
+            threads = [eventlet.spawn(self.backup_driver.backup, backup, None)
+                       for backup in backups]
+            for thread in threads:
+                thread.wait()
+        self.assertWithinBudget('instance_backup', _backup_all)
@@ -0,0 +1,128 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import testtools
+
+from jacket import conf
+from jacket import context
+from jacket.drivers.aws import capacity
+from jacket.drivers.aws.client import AwsClientPlugin
+
+CONF = conf.CONF
+
+
+class CapacityTrackerTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(CapacityTrackerTestCase, self).setUp()
+        self.ctx = context.RequestContext('fake', 'fake', is_admin=True)
+        self.ec2_client = mock.MagicMock()
+        self.quotas_client = mock.MagicMock()
+        self.quotas_client.get_service_quota.return_value = {
+            'Quota': {'Value': 64.0}}
+        managed = [{'Key': 'caa_instance_id', 'Value': 'caa-1'}]
+        self.ec2_client.describe_instances.return_value = {
+            'Reservations': [{'Instances': [
+                {'InstanceType': 'm5.large', 'Tags': managed},
+                {'InstanceType': 'm5.large'},
+                {'InstanceType': 'p3.2xlarge'}]}]}
+        self.ec2_client.describe_instance_types.return_value = {
+            'InstanceTypes': [
+                {'InstanceType': 'm5.large',
+                 'VCpuInfo': {'DefaultVCpus': 2},
+                 'MemoryInfo': {'SizeInMiB': 8192}},
+                {'InstanceType': 'p3.2xlarge',
+                 'VCpuInfo': {'DefaultVCpus': 8},
+                 'MemoryInfo': {'SizeInMiB': 62464}}]}
+        aws_client = mock.MagicMock()
+        aws_client.get_aws_client.return_value = AwsClientPlugin(
+            self.ec2_client, quotas_client=self.quotas_client)
+        self.tracker = capacity.CapacityTracker(aws_client,
+                                                'caa_instance_id')
+
+    def test_get_subtracts_foreign_standard_instances(self):
+        account = self.tracker.get(self.ctx)
+        self.assertEqual(62, account.vcpus)
+        self.assertEqual(62 * 8192, account.memory_mb)
+        self.assertEqual(2, account.vcpus_used)
+        self.assertEqual(8192, account.memory_mb_used)
+        self.quotas_client.get_service_quota.assert_called_once_with(
+            ServiceCode='ec2', QuotaCode=capacity.VCPU_QUOTA_CODE)
+
+    def test_get_reuses_capacity_until_refresh(self):
+        self.tracker.get(self.ctx)
+        self.tracker.get(self.ctx)
+        self.assertEqual(1, self.ec2_client.describe_instances.call_count)
+        with mock.patch('time.time', return_value=10 ** 10):
+            self.tracker.get(self.ctx)
+        self.assertEqual(2, self.ec2_client.describe_instances.call_count)
+        self.assertEqual(1,
+                         self.ec2_client.describe_instance_types.call_count)
+
+    def test_get_unlimited_when_quota_unreadable(self):
+        self.quotas_client.get_service_quota.side_effect = Exception()
+        account = self.tracker.get(self.ctx)
+        self.assertEqual(capacity.UNKNOWN_VCPUS, account.vcpus)
+        self.assertEqual(0, account.vcpus_used)
+
+    def test_is_standard_type(self):
+        self.assertTrue(capacity.is_standard_type('t3.micro'))
+        self.assertFalse(capacity.is_standard_type('inf1.xlarge'))
+        self.assertFalse(capacity.is_standard_type('g4dn.xlarge'))
+
+
+class VolumeCapacityTrackerTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(VolumeCapacityTrackerTestCase, self).setUp()
+        self.ctx = context.RequestContext('fake', 'fake', is_admin=True)
+        self.ec2_client = mock.MagicMock()
+        self.ec2_client.describe_volumes.side_effect = [
+            {'Volumes': [{'VolumeType': 'gp2', 'Size': 100},
+                         {'VolumeType': 'io1', 'Size': 20}],
+             'NextToken': 'next'},
+            {'Volumes': [{'VolumeType': 'gp2', 'Size': 24}]}]
+        self.quotas_client = mock.MagicMock()
+        self.quotas_client.get_service_quota.return_value = {
+            'Quota': {'Value': 1.0}}
+        aws_client = mock.MagicMock()
+        aws_client.get_aws_client.return_value = AwsClientPlugin(
+            self.ec2_client, quotas_client=self.quotas_client)
+        self.tracker = capacity.VolumeCapacityTracker(aws_client)
+        patcher = mock.patch('eventlet.spawn_n')
+        self.spawn_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_before_first_refresh(self):
+        pools = self.tracker.get(self.ctx)
+        self.assertEqual(['gp2', 'gp3'],
+                         [pool['pool_name'] for pool in pools])
+        self.assertEqual('unknown', pools[0]['free_capacity_gb'])
+        self.spawn_mock.assert_called_once_with(self.tracker._refresh,
+                                                self.ctx)
+        self.tracker.get(self.ctx)
+        self.assertEqual(1, self.spawn_mock.call_count)
+
+    def test_refresh_aggregates_provisioned_sizes(self):
+        self.addCleanup(CONF.clear_override, 'ebs_pool_types', 'aws')
+        CONF.set_override('ebs_pool_types', ['gp2', 'io1'], 'aws')
+        self.tracker._refresh(self.ctx)
+        self.spawn_mock.reset_mock()
+        pools = dict((pool['pool_name'], pool)
+                     for pool in self.tracker.get(self.ctx))
+        self.spawn_mock.assert_not_called()
+        self.assertEqual(1024, pools['gp2']['total_capacity_gb'])
+        self.assertEqual(124, pools['gp2']['provisioned_capacity_gb'])
+        self.assertEqual(900, pools['gp2']['free_capacity_gb'])
+        self.assertEqual(1004, pools['io1']['free_capacity_gb'])
+        self.assertEqual(64000, pools['io1']['max_iops'])
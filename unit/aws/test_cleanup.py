@@ -0,0 +1,121 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from botocore.exceptions import ClientError
+import fixtures
+import mock
+import testtools
+
+from jacket import conf
+from jacket.drivers.aws import cleanup
+from jacket.drivers.aws.client import AwsClientPlugin
+from jacket.drivers.aws import exception_ex
+
+
+class CleanupQueueTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(CleanupQueueTestCase, self).setUp()
+        self.plugin = mock.MagicMock()
+        self.aws_client = mock.MagicMock()
+        self.aws_client.get_aws_client.return_value = self.plugin
+        patcher = mock.patch('eventlet.spawn')
+        self.spawn_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(conf.CONF.clear_override, 'cleanup_journal_dir',
+                        'aws')
+        self.queue = cleanup.CleanupQueue(self.aws_client, 'test')
+
+    def _item(self, resource_type, resource_id):
+        return self.queue._items['%s:%s' % (resource_type, resource_id)]
+
+    def test_enqueue_deletes_in_background(self):
+        self.queue.enqueue('fake', cleanup.VOLUME, 'vol-1')
+        self.assertEqual(1, self.spawn_mock.call_count)
+        self.assertFalse(self.plugin.delete_volume.called)
+        self.queue._process(self._item(cleanup.VOLUME, 'vol-1'))
+        self.plugin.delete_volume.assert_called_once_with(VolumeId='vol-1')
+        stats = self.queue.stats()
+        self.assertEqual(0, stats['pending'])
+        self.assertEqual(1, stats['deleted'])
+
+    def test_failed_delete_retried_with_backoff(self):
+        self.plugin.delete_instances.side_effect = Exception()
+        self.queue.enqueue('fake', cleanup.INSTANCE, 'i-1')
+        item = self._item(cleanup.INSTANCE, 'i-1')
+        with mock.patch('time.time', return_value=100):
+            self.queue._process(item)
+            self.assertEqual(110, item['next_attempt'])
+            self.queue._process(item)
+            self.assertEqual(120, item['next_attempt'])
+        self.assertEqual(2, self.queue.stats()['retried'])
+        self.assertEqual(1, self.queue.stats()['pending'])
+
+    def test_give_up_after_max_attempts(self):
+        self.plugin.delete_snapshot.side_effect = Exception()
+        self.queue.enqueue('fake', cleanup.SNAPSHOT, 'snap-1')
+        item = self._item(cleanup.SNAPSHOT, 'snap-1')
+        for i in range(conf.CONF.aws.cleanup_max_attempts):
+            self.queue._process(item)
+        stats = self.queue.stats()
+        self.assertEqual(0, stats['pending'])
+        self.assertEqual(1, stats['leaked'])
+
+    def test_not_found_is_deleted(self):
+        error_response = {'Error': {'Message': "fake",
+                                    'Code': 'InvalidVolume.NotFound'}}
+        self.plugin.delete_volume.side_effect = \
+            exception_ex.ProviderDeleteVolumeFailed(
+                reason='fake', error_code='InvalidVolume.NotFound')
+        self.queue.enqueue('fake', cleanup.VOLUME, 'vol-1')
+        self.queue._process(self._item(cleanup.VOLUME, 'vol-1'))
+        self.assertEqual(1, self.queue.stats()['deleted'])
+        self.assertTrue(cleanup.is_not_found(
+            ClientError(error_response, 'DeleteVolume')))
+
+    def test_journal_resumed(self):
+        journal_dir = self.useFixture(fixtures.TempDir()).path
+        conf.CONF.set_override('cleanup_journal_dir', journal_dir, 'aws')
+        queue = cleanup.CleanupQueue(self.aws_client, 'test')
+        queue.enqueue('fake', cleanup.VOLUME, 'vol-1')
+        self.spawn_mock.reset_mock()
+        resumed = cleanup.CleanupQueue(self.aws_client, 'test')
+        self.assertEqual(1, resumed.stats()['pending'])
+        self.assertEqual(1, self.spawn_mock.call_count)
+
+    def test_journal_resumes_item_in_flight(self):
+        journal_dir = self.useFixture(fixtures.TempDir()).path
+        conf.CONF.set_override('cleanup_journal_dir', journal_dir, 'aws')
+        queue = cleanup.CleanupQueue(self.aws_client, 'test')
+        queue.enqueue('fake', cleanup.VOLUME, 'vol-1')
+        # the worker took vol-1 when vol-2 is journaled
+        queue._items['volume:vol-1']['in_progress'] = True
+        queue.enqueue('fake', cleanup.VOLUME, 'vol-2')
+        resumed = cleanup.CleanupQueue(self.aws_client, 'test')
+        resumed._run()
+        resumed._pool.waitall()
+        self.assertEqual(0, resumed.stats()['pending'])
+        self.assertEqual(2, resumed.stats()['deleted'])
+        self.assertEqual(2, self.plugin.delete_volume.call_count)
+
+    @mock.patch('time.sleep')
+    def test_plugin_enqueues_failed_create(self, sleep_mock):
+        ec2_client = mock.MagicMock()
+        ec2_client.get_waiter.return_value.wait.side_effect = Exception()
+        ec2_client.create_volume.return_value = {'VolumeId': 'vol-1'}
+        queue = mock.MagicMock()
+        plugin = AwsClientPlugin(ec2_client, cleanup_queue=queue,
+                                 project_id='fake')
+        self.assertRaises(Exception, plugin.create_volume, Size=1)
+        queue.enqueue.assert_called_once_with('fake', cleanup.VOLUME,
+                                              'vol-1')
+        self.assertFalse(ec2_client.delete_volume.called)
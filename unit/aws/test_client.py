@@ -0,0 +1,133 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
+import mock
+import testtools
+
+from jacket.drivers.aws import client
+from jacket.drivers.aws.client import AwsClientPlugin
+
+
+class AwsClientPluginTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(AwsClientPluginTestCase, self).setUp()
+        self.ec2_client = mock.MagicMock()
+        self.plugin = AwsClientPlugin(self.ec2_client)
+        patcher = mock.patch('time.sleep')
+        self.sleep_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _network_error(self):
+        return EndpointConnectionError(endpoint_url='https://ec2')
+
+    def test_client_token(self):
+        token = client.client_token('caa-id')
+        self.assertTrue(token.startswith('caa-id-'))
+        self.assertNotEqual(token, client.client_token('caa-id'))
+        self.assertEqual(client.CLIENT_TOKEN_MAX_LEN,
+                         len(client.client_token('x' * 100)))
+
+    def test_create_volume_retried_with_same_token(self):
+        self.ec2_client.create_volume.side_effect = [self._network_error(),
+                                                     {'VolumeId': 'vol-1'}]
+        vol = self.plugin.create_volume(Size=1, ClientToken='token')
+        self.assertEqual({'VolumeId': 'vol-1'}, vol)
+        self.assertEqual(2, self.ec2_client.create_volume.call_count)
+        for call in self.ec2_client.create_volume.call_args_list:
+            self.assertEqual('token', call[1]['ClientToken'])
+
+    def test_create_volume_without_token_not_retried(self):
+        self.ec2_client.create_volume.side_effect = self._network_error()
+        self.assertRaises(EndpointConnectionError,
+                          self.plugin.create_volume, Size=1)
+        self.assertEqual(1, self.ec2_client.create_volume.call_count)
+
+    def test_create_instance_not_retried_on_client_error(self):
+        error_response = {'Error': {'Message': "fake",
+                                    'Code': 'InvalidParameterValue'}}
+        self.ec2_client.run_instances.side_effect = ClientError(
+            error_response, 'RunInstances')
+        self.assertRaises(ClientError, self.plugin.create_instance,
+                          ClientToken='token')
+        self.assertEqual(1, self.ec2_client.run_instances.call_count)
+
+    def test_create_instance_retried_on_throttling(self):
+        error_response = {'Error': {'Message': "fake",
+                                    'Code': 'RequestLimitExceeded'}}
+        self.ec2_client.run_instances.side_effect = [
+            ClientError(error_response, 'RunInstances'),
+            {'Instances': [{'InstanceId': 'i-1'}]}]
+        instances = self.plugin.create_instance(wait=False,
+                                                ClientToken='token')
+        self.assertEqual([{'InstanceId': 'i-1'}], instances)
+
+    def test_create_snapshot_retry_finds_existing(self):
+        self.ec2_client.create_snapshot.side_effect = self._network_error()
+        self.ec2_client.describe_snapshots.return_value = {
+            'Snapshots': [{'SnapshotId': 'snap-1'}]}
+        tags = [{'Key': 'caa_snapshot_id', 'Value': 'caa'}]
+        snapshot = self.plugin.create_snapshot(
+            VolumeId='vol-1',
+            TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': tags}])
+        self.assertEqual({'SnapshotId': 'snap-1'}, snapshot)
+        self.assertEqual(1, self.ec2_client.create_snapshot.call_count)
+        filters = [{'Name': 'volume-id', 'Values': ['vol-1']},
+                   {'Name': 'tag:caa_snapshot_id', 'Values': ['caa']}]
+        self.ec2_client.describe_snapshots.assert_called_once_with(
+            OwnerIds=['self'], Filters=filters)
+
+    def test_describe_snapshots_scoped_and_paginated(self):
+        self.ec2_client.describe_snapshots.side_effect = [
+            {'Snapshots': [{'SnapshotId': 'snap-1', 'State': 'completed'}],
+             'NextToken': 'next'},
+            {'Snapshots': [{'SnapshotId': 'snap-2', 'State': 'pending'}]}]
+        filters = [{'Name': 'tag:caa_snapshot_id', 'Values': ['caa']}]
+        snapshots = self.plugin.describe_snapshots(Filters=filters)
+        self.assertEqual(['snap-1', 'snap-2'],
+                         [s['SnapshotId'] for s in snapshots])
+        self.ec2_client.describe_snapshots.assert_has_calls([
+            mock.call(OwnerIds=['self'], Filters=filters,
+                      MaxResults=client.DESCRIBE_SNAPSHOTS_PAGE_SIZE),
+            mock.call(OwnerIds=['self'], Filters=filters,
+                      MaxResults=client.DESCRIBE_SNAPSHOTS_PAGE_SIZE,
+                      NextToken='next')])
+
+    def test_get_snapshot_state_caches_final_states(self):
+        self.ec2_client.describe_snapshots.return_value = {
+            'Snapshots': [{'SnapshotId': 'snap-1', 'State': 'completed'}]}
+        self.assertEqual('completed',
+                         self.plugin.get_snapshot_state('snap-1'))
+        self.assertEqual('completed',
+                         self.plugin.get_snapshot_state('snap-1'))
+        self.ec2_client.describe_snapshots.assert_called_once_with(
+            OwnerIds=['self'], SnapshotIds=['snap-1'])
+        self.plugin.delete_snapshot(SnapshotId='snap-1')
+        self.ec2_client.describe_snapshots.side_effect = ClientError(
+            {'Error': {'Code': 'InvalidSnapshot.NotFound', 'Message': ''}},
+            'DescribeSnapshots')
+        self.assertIsNone(self.plugin.get_snapshot_state('snap-1'))
+
+    def test_quotas_client_created_on_use(self):
+        aws_client = client.AwsClient()
+        aws_client.create_ec2_client = mock.Mock()
+        aws_client.create_resource_client = mock.Mock()
+        aws_client.create_quotas_client = mock.Mock(
+            side_effect=Exception('no service-quotas endpoint'))
+        ctx = mock.Mock(project_id='fake')
+        plugin = aws_client.get_aws_client(ctx)
+        aws_client.create_quotas_client.assert_not_called()
+        self.assertRaises(Exception, plugin.get_service_quota, 'ec2',
+                          'L-1216C47A')
+        aws_client.create_quotas_client.assert_called_once_with(ctx)
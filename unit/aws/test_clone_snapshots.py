@@ -0,0 +1,175 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import eventlet
+import mock
+import testtools
+
+from jacket import conf
+from jacket import context as req_context
+from jacket.drivers.aws import cleanup
+from jacket.drivers.aws import client
+from jacket.drivers.aws import clone_snapshots
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+from oslo_utils import timeutils
+
+CONF = conf.CONF
+
+
+class _Source(object):
+
+    def __init__(self, id='src-1', attach_status='detached'):
+        self.id = id
+        self.attach_status = attach_status
+        self.updated_at = timeutils.utcnow() - datetime.timedelta(hours=1)
+
+
+class CloneSnapshotCacheTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(CloneSnapshotCacheTestCase, self).setUp()
+        self.addCleanup(CONF.clear_override, 'clone_snapshot_cache', 'aws')
+        CONF.set_override('clone_snapshot_cache', True, 'aws')
+        self.aws = mock.Mock()
+        self.aws.create_snapshot.side_effect = (
+            lambda **kwargs: {'SnapshotId': 'snap-%d' %
+                              self.aws.create_snapshot.call_count})
+        aws_client = mock.Mock()
+        aws_client.get_aws_client.return_value = self.aws
+        self.cleanup_queue = mock.Mock()
+        self.cache = clone_snapshots.CloneSnapshotCache(
+            aws_client, self.cleanup_queue, 'host-1')
+        self.context = req_context.RequestContext(is_admin=True,
+                                                  project_id='fake')
+        spawn_after = mock.patch('eventlet.spawn_after')
+        self.spawn_after = spawn_after.start()
+        self.addCleanup(spawn_after.stop)
+        self.source = _Source()
+
+    def _clone(self, source=None, provider_volume_id='vol-1'):
+        with self.cache.snapshot(self.context, source or self.source,
+                                 provider_volume_id) as snapshot_id:
+            return snapshot_id
+
+    def _deleted(self):
+        return [c[0][2] for c in self.cleanup_queue.enqueue.call_args_list]
+
+    def test_disabled_snapshot_per_clone(self):
+        CONF.set_override('clone_snapshot_cache', False, 'aws')
+        self.assertEqual('snap-1', self._clone(source='fake'))
+        self.assertEqual('snap-2', self._clone(source='fake'))
+        self.aws.create_snapshot.assert_called_with(VolumeId='vol-1')
+        self.assertEqual([mock.call(SnapshotId='snap-1'),
+                          mock.call(SnapshotId='snap-2')],
+                         self.aws.delete_snapshot.call_args_list)
+
+    def test_unmodified_source_shares_snapshot(self):
+        self.assertEqual('snap-1', self._clone())
+        self.assertEqual('snap-1', self._clone())
+        self.assertEqual(1, self.aws.create_snapshot.call_count)
+        tags = self.aws.create_snapshot.call_args[1]['TagSpecifications']
+        self.assertEqual(clone_snapshots.CLONE_SOURCE_TAG,
+                         tags[0]['Tags'][0]['Key'])
+        self.assertTrue(tags[0]['Tags'][0]['Value'].startswith('host-1:'))
+        self.assertFalse(self.aws.delete_snapshot.called)
+        # the timer of the first clone was cancelled by the second
+        self.assertEqual(2, self.spawn_after.call_count)
+        self.spawn_after.return_value.cancel.assert_called_once_with()
+
+    def test_modified_source_gets_new_snapshot(self):
+        self._clone()
+        self.source.updated_at = timeutils.utcnow()
+        self.assertEqual('snap-2', self._clone())
+        self.assertEqual(['snap-1'], self._deleted())
+
+    def test_attached_source_reused_within_max_age(self):
+        self.addCleanup(CONF.clear_override, 'clone_snapshot_max_age', 'aws')
+        CONF.set_override('clone_snapshot_max_age', 300, 'aws')
+        source = _Source(attach_status='attached')
+        self._clone(source)
+        self.assertEqual('snap-1', self._clone(source))
+        CONF.set_override('clone_snapshot_max_age', 0, 'aws')
+        self.assertEqual('snap-2', self._clone(source))
+
+    def test_replaced_provider_volume_gets_new_snapshot(self):
+        self._clone()
+        self.assertEqual('snap-2', self._clone(provider_volume_id='vol-2'))
+
+    def test_expired_snapshot_deleted(self):
+        self._clone()
+        linger, expire, source_id, entry = self.spawn_after.call_args[0]
+        self.assertEqual(CONF.aws.clone_snapshot_linger, linger)
+        expire(source_id, entry)
+        self.assertEqual(['snap-1'], self._deleted())
+        self.cleanup_queue.enqueue.assert_called_once_with(
+            'fake', cleanup.SNAPSHOT, 'snap-1')
+        self.assertEqual('snap-2', self._clone())
+
+    def test_invalidated_snapshot_deleted_after_last_clone(self):
+        with self.cache.snapshot(self.context, self.source, 'vol-1'):
+            self.cache.invalidate(self.source.id)
+            self.assertEqual([], self._deleted())
+        self.assertEqual(['snap-1'], self._deleted())
+        self.assertFalse(self.spawn_after.called)
+
+    def test_concurrent_clones_wait_for_one_snapshot(self):
+        def create_snapshot(**kwargs):
+            eventlet.sleep(0)
+            return {'SnapshotId': 'snap-1'}
+        self.aws.create_snapshot.side_effect = create_snapshot
+        clones = [eventlet.spawn(self._clone) for _i in range(3)]
+        self.assertEqual(['snap-1'] * 3, [c.wait() for c in clones])
+        self.assertEqual(1, self.aws.create_snapshot.call_count)
+
+    def test_failed_snapshot_fails_waiting_clones(self):
+        def create_snapshot(**kwargs):
+            eventlet.sleep(0)
+            raise Exception('boom')
+        self.aws.create_snapshot.side_effect = create_snapshot
+        clones = [eventlet.spawn(self._clone) for _i in range(2)]
+        for clone in clones:
+            self.assertRaises(Exception, clone.wait)
+        self.assertEqual(1, self.aws.create_snapshot.call_count)
+        self.aws.create_snapshot.side_effect = None
+        self.aws.create_snapshot.return_value = {'SnapshotId': 'snap-2'}
+        self.assertEqual('snap-2', self._clone())
+
+    def test_sweep_deletes_snapshots_left_by_restart(self):
+        self._clone()
+        self.aws.describe_snapshots.return_value = [{'SnapshotId': 'snap-1'},
+                                                    {'SnapshotId': 'snap-0'}]
+        self.assertEqual(1, self.cache.sweep(self.context))
+        self.aws.describe_snapshots.assert_called_once_with(
+            Filters=[{'Name': 'tag:%s' % clone_snapshots.CLONE_SOURCE_TAG,
+                      'Values': ['host-1:*']}])
+        self.assertEqual(['snap-0'], self._deleted())
+
+    def test_sweep_keeps_snapshots_of_other_hosts(self):
+        ec2 = fake_ec2.FakeEc2Client(seed=1)
+        aws_client = client.AwsClient()
+        fake_ec2.connect(aws_client, ec2)
+        volume_id = ec2.create_volume(Size=1,
+                                      AvailabilityZone='az')['VolumeId']
+        for host in ('host-1', 'host-2'):
+            ec2.create_snapshot(
+                VolumeId=volume_id,
+                TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': [
+                    {'Key': clone_snapshots.CLONE_SOURCE_TAG,
+                     'Value': '%s:token' % host}]}])
+        cache = clone_snapshots.CloneSnapshotCache(
+            aws_client, self.cleanup_queue, 'host-1')
+        self.assertEqual(1, cache.sweep(self.context))
+        swept = self._deleted()[0]
+        self.assertEqual('host-1:token',
+                         ec2.snapshots[swept]['Tags'][0]['Value'])
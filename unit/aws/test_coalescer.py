@@ -0,0 +1,106 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import mock
+import testtools
+
+from jacket import conf
+from jacket import context
+from jacket.drivers.aws import coalescer
+from jacket.drivers.aws import exception_ex
+
+CONF = conf.CONF
+
+
+class RunInstancesCoalescerTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(RunInstancesCoalescerTestCase, self).setUp()
+        self.ctx = context.RequestContext('fake', 'fake', is_admin=True)
+        self.addCleanup(CONF.clear_override, 'coalesce_window', 'aws')
+        self.addCleanup(CONF.clear_override, 'coalesce_max_count', 'aws')
+        CONF.set_override('coalesce_window', 0.01, 'aws')
+        self.plugin = mock.MagicMock()
+        self.plugin.create_instance.side_effect = self._run_instances
+        aws_client = mock.MagicMock()
+        aws_client.get_aws_client.return_value = self.plugin
+        self.coalescer = coalescer.RunInstancesCoalescer(aws_client)
+        self.launched = None
+
+    def _run_instances(self, wait=True, **kwargs):
+        count = kwargs['MaxCount'] if self.launched is None \
+            else self.launched
+        return [{'InstanceId': 'i-%s' % index, 'AmiLaunchIndex': index}
+                for index in reversed(range(count))]
+
+    def _launch_all(self, launches):
+        pool = eventlet.GreenPool()
+        threads = [pool.spawn(self._launch, caa_id, create_args)
+                   for caa_id, create_args in launches]
+        return [thread.wait() for thread in threads]
+
+    def _launch(self, caa_id, create_args):
+        try:
+            return self.coalescer.launch(self.ctx, caa_id, create_args)
+        except Exception as e:
+            return e
+
+    def test_launch_coalesces_identical_launches(self):
+        results = self._launch_all(
+            [('caa-%s' % i, {'ImageId': 'ami-1', 'ClientToken': 't%s' % i})
+             for i in range(3)])
+        self.plugin.create_instance.assert_called_once_with(
+            wait=True, ImageId='ami-1', ClientToken='t0', MinCount=1,
+            MaxCount=3)
+        self.assertEqual([[{'InstanceId': 'i-%s' % i, 'AmiLaunchIndex': i}]
+                          for i in range(3)], results)
+
+    def test_launch_separates_different_launches(self):
+        results = self._launch_all([('caa-1', {'ImageId': 'ami-1'}),
+                                    ('caa-2', {'ImageId': 'ami-2'})])
+        self.assertEqual(2, self.plugin.create_instance.call_count)
+        self.assertEqual([[{'InstanceId': 'i-0', 'AmiLaunchIndex': 0}]] * 2,
+                         results)
+
+    def test_launch_flushes_full_batch(self):
+        CONF.set_override('coalesce_max_count', 2, 'aws')
+        self._launch_all([('caa-%s' % i, {'ImageId': 'ami-1'})
+                          for i in range(3)])
+        self.assertEqual([2, 1],
+                         [c[1]['MaxCount'] for c in
+                          self.plugin.create_instance.call_args_list])
+
+    def test_launch_fails_launches_left_without_instance(self):
+        self.launched = 1
+        results = self._launch_all([('caa-%s' % i, {'ImageId': 'ami-1'})
+                                    for i in range(2)])
+        self.assertEqual([{'InstanceId': 'i-0', 'AmiLaunchIndex': 0}],
+                         results[0])
+        self.assertIsInstance(results[1],
+                              exception_ex.ProviderCreateInstanceFailed)
+
+    def test_launch_raises_error_to_all_launches(self):
+        self.plugin.create_instance.side_effect = ValueError()
+        results = self._launch_all([('caa-%s' % i, {'ImageId': 'ami-1'})
+                                    for i in range(2)])
+        self.assertEqual([ValueError, ValueError],
+                         [type(result) for result in results])
+
+    def test_launch_raises_error_after_request_to_all_launches(self):
+        # an unexpected response fails while the instances are handed out
+        self.plugin.create_instance.side_effect = None
+        self.plugin.create_instance.return_value = [None, None]
+        results = self._launch_all([('caa-%s' % i, {'ImageId': 'ami-1'})
+                                    for i in range(2)])
+        self.assertEqual([AttributeError, AttributeError],
+                         [type(result) for result in results])
@@ -19,10 +19,13 @@ from botocore.exceptions import WaiterError
 import jacket
 from jacket.compute import exception
 from jacket.compute.virt import fake
+from jacket import conf
 from jacket import context
+from jacket.drivers.aws.cleanup import CleanupQueue
 from jacket.drivers.aws.client import AwsClientPlugin
 from jacket.drivers.aws.compute_driver import AwsComputeDriver
 from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws.tag_index import TagIndex
 from jacket.tests.compute.unit import fake_instance
 import mock
 from oslo_log import log as logging
@@ -263,37 +266,52 @@ class AwsComputeDriverTestCase(testtools.TestCase):
                            'fake')
 
     @mock.patch.object(AwsComputeDriver, "_get_provider_instance_id")
-    @mock.patch.object(AwsClientPlugin, 'describe_instances')
+    @mock.patch.object(TagIndex, 'lookup')
     @mock.patch.object(jacket.db.extend.api, 'instance_mapper_delete')
     def test_destory_not_exist_in_db_and_aws(self, mapper_delete_mock,
-                                             describe_instances_mock,
+                                             lookup_mock,
                                              get_instance_id_mock):
         get_instance_id_mock.return_value = None
-        describe_instances_mock.return_value = []
+        lookup_mock.return_value = []
         instance = self._create_instance()
         self.driver.destroy(self.context, instance, self.network_info)
         get_instance_id_mock.assert_called_once_with(self.context,
                                                      instance.uuid)
-        filters = [{'Name': 'tag:caa_instance_id',
-                    'Values': [instance.uuid]}]
-        describe_instances_mock.assert_called_once_with(Filters=filters)
+        lookup_mock.assert_called_once_with(self.context, 'instance',
+                                            instance.uuid)
         mapper_delete_mock.assert_called_once_with(self.context, instance.uuid,
                                                    instance.project_id)
 
     @mock.patch.object(AwsComputeDriver, "_get_provider_instance_id")
-    @mock.patch.object(AwsClientPlugin, 'describe_instances')
-    @mock.patch.object(AwsClientPlugin, 'delete_instances', mock.MagicMock())
+    @mock.patch.object(TagIndex, 'lookup')
+    @mock.patch.object(AwsClientPlugin, 'delete_instances')
     @mock.patch('jacket.db.extend.api.instance_mapper_delete',
                 mock.MagicMock())
-    def test_destory_not_exist_in_db(self, describe_instances_mock,
+    def test_destory_not_exist_in_db(self, delete_mock, lookup_mock,
                                      get_instance_id_mock):
         get_instance_id_mock.return_value = None
-        aws_instances = [{'InstanceId': 'fake'}]
-        describe_instances_mock.return_value = aws_instances
+        lookup_mock.return_value = ['fake']
         instance = self._create_instance()
         self.driver.destroy(self.context, instance, self.network_info)
         get_instance_id_mock.assert_called_once_with(self.context,
                                                      instance.uuid)
+        lookup_mock.assert_called_once_with(self.context, 'instance',
+                                            instance.uuid)
+        delete_mock.assert_called_once_with(InstanceIds=['fake'])
+
+    @mock.patch.object(AwsComputeDriver, "_get_provider_instance_id",
+                       mock.MagicMock(return_value=None))
+    @mock.patch.object(AwsClientPlugin, 'describe_instances')
+    @mock.patch.object(AwsClientPlugin, 'delete_instances', mock.MagicMock())
+    @mock.patch('jacket.db.extend.api.instance_mapper_delete',
+                mock.MagicMock())
+    def test_destory_not_exist_in_db_without_tag_index(
+            self, describe_instances_mock):
+        conf.CONF.set_override('tag_index_ttl', 0, 'aws')
+        self.addCleanup(conf.CONF.clear_override, 'tag_index_ttl', 'aws')
+        describe_instances_mock.return_value = [{'InstanceId': 'fake'}]
+        instance = self._create_instance()
+        self.driver.destroy(self.context, instance, self.network_info)
         filters = [{'Name': 'tag:caa_instance_id',
                     'Values': [instance.uuid]}]
         describe_instances_mock.assert_called_once_with(Filters=filters)
@@ -429,11 +447,11 @@ class AwsComputeDriverTestCase(testtools.TestCase):
     @mock.patch.object(AwsComputeDriver, "_get_provider_volume_id",
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(AwsComputeDriver, "_get_provider_instance_id")
-    @mock.patch.object(AwsClientPlugin, 'describe_instances')
-    def test_detach_instances_not_exist(self, describe_instances_mock,
+    @mock.patch.object(TagIndex, 'lookup')
+    def test_detach_instances_not_exist(self, lookup_mock,
                                         get_instance_id_mock):
         get_instance_id_mock.return_value = None
-        describe_instances_mock.return_value = []
+        lookup_mock.return_value = []
         instance = self._create_instance()
         self.assertRaises(exception.InstanceNotFound,
                           self.driver.detach_volume,
@@ -443,12 +461,11 @@ class AwsComputeDriverTestCase(testtools.TestCase):
     @mock.patch.object(AwsComputeDriver, "_get_provider_volume_id",
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(AwsComputeDriver, "_get_provider_instance_id")
-    @mock.patch.object(AwsClientPlugin, 'describe_instances')
-    def test_detach_instances_mul_exist(self, describe_instances_mock,
+    @mock.patch.object(TagIndex, 'lookup')
+    def test_detach_instances_mul_exist(self, lookup_mock,
                                         get_instance_id_mock):
         get_instance_id_mock.return_value = None
-        aws_instances = [{'InstanceId': 'fake'}, {'InstanceId': 'fake1'}]
-        describe_instances_mock.return_value = aws_instances
+        lookup_mock.return_value = ['fake', 'fake1']
         instance = self._create_instance()
         self.assertRaises(exception_ex.MultiInstanceConfusion,
                           self.driver.detach_volume,
@@ -458,11 +475,11 @@ class AwsComputeDriverTestCase(testtools.TestCase):
     @mock.patch.object(AwsComputeDriver, "_get_provider_instance_id",
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(AwsComputeDriver, "_get_provider_volume_id")
-    @mock.patch.object(AwsClientPlugin, 'describe_volumes')
-    def test_detach_volume_not_exist(self, describe_volumes_mock,
+    @mock.patch.object(TagIndex, 'lookup')
+    def test_detach_volume_not_exist(self, lookup_mock,
                                      get_volume_id_mock):
         get_volume_id_mock.return_value = None
-        describe_volumes_mock.return_value = []
+        lookup_mock.return_value = []
         instance = self._create_instance()
         self.driver.detach_volume(self.connection_info, instance,
                                   '/dev/vdc')
@@ -470,12 +487,11 @@ class AwsComputeDriverTestCase(testtools.TestCase):
     @mock.patch.object(AwsComputeDriver, "_get_provider_instance_id",
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(AwsComputeDriver, "_get_provider_volume_id")
-    @mock.patch.object(AwsClientPlugin, 'describe_volumes')
-    def test_detach_volume_mul_exist(self, describe_volumes_mock,
+    @mock.patch.object(TagIndex, 'lookup')
+    def test_detach_volume_mul_exist(self, lookup_mock,
                                      get_volume_id_mock):
         get_volume_id_mock.return_value = None
-        aws_volumes = [{'VolumeId': 'fake'}, {'VolumeId': 'fake1'}]
-        describe_volumes_mock.return_value = aws_volumes
+        lookup_mock.return_value = ['fake', 'fake1']
         instance = self._create_instance()
         self.assertRaises(exception_ex.MultiVolumeConfusion,
                           self.driver.detach_volume,
@@ -712,6 +728,7 @@ class AwsComputeDriverTestCase(testtools.TestCase):
     @mock.patch.object(AwsComputeDriver, "_get_provider_base_image_id",
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(AwsComputeDriver, "_get_project_mapper")
+    @mock.patch.object(AwsClientPlugin, 'describe_images', mock.MagicMock())
     def test_spawn_from_image_no_network(self, get_project_mapper_mock):
         get_project_mapper_mock.return_value = self._make_project_mapper(False)
         instance = self._create_instance(image_ref='fake')
@@ -781,8 +798,8 @@ class AwsComputeDriverTestCase(testtools.TestCase):
     @mock.patch.object(AwsClientPlugin, 'describe_images')
     @mock.patch.object(AwsClientPlugin, 'create_instance')
     @mock.patch.object(AwsClientPlugin, 'create_tags')
-    @mock.patch.object(AwsClientPlugin, 'delete_instances')
-    def test_spawn_create_tag_error_on_aws(self, delete_instances_mock,
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    def test_spawn_create_tag_error_on_aws(self, enqueue_mock,
                                            create_tag_mock,
                                            create_instance_mock,
                                            describe_images_mock,
@@ -792,7 +809,7 @@ class AwsComputeDriverTestCase(testtools.TestCase):
         operation_name = 'CreateTage'
         create_tag_mock.side_effect = ClientError(error_response,
                                                   operation_name)
-        create_instance_mock.return_value = ['fake']
+        create_instance_mock.return_value = [{'InstanceId': 'fake'}]
         bdms = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 1}}]
         describe_images_mock.return_value = [{'ImageId': 'fake',
                                               'BlockDeviceMappings': bdms}]
@@ -801,7 +818,8 @@ class AwsComputeDriverTestCase(testtools.TestCase):
         self.assertRaises(ClientError,
                           self.driver.spawn, self.context,
                           instance, None, None, None)
-        delete_instances_mock.assert_called_once_with(InstanceIds=['fake'])
+        enqueue_mock.assert_called_once_with(self.context.project_id,
+                                             'instance', 'fake')
 
     @mock.patch.object(AwsComputeDriver, "_get_provider_flavor_id",
                        mock.MagicMock(return_value='fake'))
@@ -812,8 +830,8 @@ class AwsComputeDriverTestCase(testtools.TestCase):
     @mock.patch.object(AwsClientPlugin, 'create_instance')
     @mock.patch.object(AwsClientPlugin, 'create_tags',
                        mock.MagicMock())
-    @mock.patch.object(AwsClientPlugin, 'delete_instances')
-    def test_spawn_with_bdms_error_on_aws(self, delete_instances_mock,
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    def test_spawn_with_bdms_error_on_aws(self, enqueue_mock,
                                           create_instance_mock,
                                           describe_images_mock,
                                           get_project_mapper_mock):
@@ -826,7 +844,7 @@ class AwsComputeDriverTestCase(testtools.TestCase):
                'connection_info': connection_info}
         block_device_info = {}
         block_device_info['block_device_mapping'] = [bdm]
-        create_instance_mock.return_value = ['fake']
+        create_instance_mock.return_value = [{'InstanceId': 'fake'}]
         bdms = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 1}}]
         describe_images_mock.return_value = [{'ImageId': 'fake',
                                               'BlockDeviceMappings': bdms}]
@@ -836,7 +854,8 @@ class AwsComputeDriverTestCase(testtools.TestCase):
                           self.driver.spawn, self.context,
                           instance, None, None, None,
                           block_device_info=block_device_info)
-        delete_instances_mock.assert_called_once_with(InstanceIds=['fake'])
+        enqueue_mock.assert_called_once_with(self.context.project_id,
+                                             'instance', 'fake')
 
     @mock.patch.object(AwsComputeDriver, "_get_provider_flavor_id",
                        mock.MagicMock(return_value='fake'))
@@ -848,8 +867,8 @@ class AwsComputeDriverTestCase(testtools.TestCase):
     @mock.patch.object(AwsClientPlugin, 'describe_images')
     @mock.patch.object(AwsClientPlugin, 'create_instance')
     @mock.patch.object(AwsClientPlugin, 'attach_volume')
-    @mock.patch.object(AwsClientPlugin, 'delete_instances')
-    def test_spawn_with_bdms_attach_error_on_aws(self, delete_instances_mock,
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    def test_spawn_with_bdms_attach_error_on_aws(self, enqueue_mock,
                                                  attach_volume_mock,
                                                  create_instance_mock,
                                                  describe_images_mock,
@@ -868,7 +887,7 @@ class AwsComputeDriverTestCase(testtools.TestCase):
         operation_name = 'AttachVolume'
         attach_volume_mock.side_effect = ClientError(error_response,
                                                      operation_name)
-        create_instance_mock.return_value = ['fake']
+        create_instance_mock.return_value = [{'InstanceId': 'fake'}]
         bdms = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 1}}]
         describe_images_mock.return_value = [{'ImageId': 'fake',
                                               'BlockDeviceMappings': bdms}]
@@ -878,7 +897,8 @@ class AwsComputeDriverTestCase(testtools.TestCase):
                           self.driver.spawn, self.context,
                           instance, None, None, None,
                           block_device_info=block_device_info)
-        delete_instances_mock.assert_called_once_with(InstanceIds=['fake'])
+        enqueue_mock.assert_called_once_with(self.context.project_id,
+                                             'instance', 'fake')
 
     @mock.patch.object(AwsComputeDriver, "_get_provider_flavor_id",
                        mock.MagicMock(return_value='fake'))
@@ -891,8 +911,8 @@ class AwsComputeDriverTestCase(testtools.TestCase):
                        mock.MagicMock())
     @mock.patch.object(AwsClientPlugin, 'describe_instances')
     @mock.patch.object(jacket.db.extend.api, 'instance_mapper_create')
-    @mock.patch.object(AwsClientPlugin, 'delete_instances')
-    def test_spawn_save_error(self, delete_instances_mock,
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    def test_spawn_save_error(self, enqueue_mock,
                               instance_mapper_create_mock,
                               describe_instances_mock,
                               create_instance_mock,
@@ -902,10 +922,9 @@ class AwsComputeDriverTestCase(testtools.TestCase):
         netWorkInterface = {'SubnetId': 'subnet2',
                             'PrivateIpAddresses':
                             [{'PrivateIpAddress': '192.168.3.5'}]}
-        describe_instances_mock.return_value = [{'NetworkInterfaces':
-                                                 [netWorkInterface],
-                                                 'InstanceId': 'fake'}]
-        create_instance_mock.return_value = ['fake']
+        create_instance_mock.return_value = [{'NetworkInterfaces':
+                                              [netWorkInterface],
+                                              'InstanceId': 'fake'}]
         bdms = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 1}}]
         describe_images_mock.return_value = [{'ImageId': 'fake',
                                               'BlockDeviceMappings': bdms}]
@@ -919,7 +938,8 @@ class AwsComputeDriverTestCase(testtools.TestCase):
         self.assertRaises(exception_ex.ProviderCreateInstanceFailed,
                           self.driver.spawn, self.context,
                           instance, None, None, None)
-        delete_instances_mock.assert_called_once_with(InstanceIds=['fake'])
+        enqueue_mock.assert_called_once_with(self.context.project_id,
+                                             'instance', 'fake')
 
     @mock.patch.object(AwsComputeDriver, "_get_provider_flavor_id",
                        mock.MagicMock(return_value='fake'))
@@ -941,10 +961,9 @@ class AwsComputeDriverTestCase(testtools.TestCase):
         netWorkInterface = {'SubnetId': 'subnet2',
                             'PrivateIpAddresses':
                             [{'PrivateIpAddress': '192.168.3.5'}]}
-        describe_instances_mock.return_value = [{'NetworkInterfaces':
-                                                 [netWorkInterface],
-                                                 'InstanceId': 'fake'}]
-        create_instance_mock.return_value = ['fake']
+        create_instance_mock.return_value = [{'NetworkInterfaces':
+                                              [netWorkInterface],
+                                              'InstanceId': 'fake'}]
         bdms = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 1}}]
         describe_images_mock.return_value = [{'ImageId': 'fake',
                                               'BlockDeviceMappings': bdms}]
@@ -956,6 +975,120 @@ class AwsComputeDriverTestCase(testtools.TestCase):
             pass
         setattr(instance, 'save', _save)
         self.driver.spawn(self.context, instance, None, None, None)
+        self.assertFalse(describe_instances_mock.called)
+        self.assertEqual('192.168.3.5',
+                         instance.system_metadata['management_ip'])
+
+    @mock.patch.object(AwsComputeDriver, "_get_provider_flavor_id",
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsComputeDriver, "_get_provider_base_image_id",
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsClientPlugin, 'create_tags',
+                       mock.MagicMock())
+    @mock.patch.object(jacket.db.extend.api, 'instance_mapper_create')
+    @mock.patch.object(AwsComputeDriver, "_get_project_mapper")
+    @mock.patch.object(AwsClientPlugin, 'describe_images')
+    @mock.patch.object(AwsClientPlugin, 'create_instance')
+    @mock.patch.object(AwsClientPlugin, 'describe_instances')
+    def test_spawn_without_management_ip(self,
+                                         describe_instances_mock,
+                                         create_instance_mock,
+                                         describe_images_mock,
+                                         get_project_mapper_mock,
+                                         instance_mapper_create_mock):
+        netWorkInterface = {'SubnetId': 'other',
+                            'PrivateIpAddresses':
+                            [{'PrivateIpAddress': '192.168.3.5'}]}
+        create_instance_mock.return_value = [{'NetworkInterfaces':
+                                              [netWorkInterface],
+                                              'InstanceId': 'fake'}]
+        describe_images_mock.return_value = [{'ImageId': 'fake',
+                                              'BlockDeviceMappings': []}]
+        get_project_mapper_mock.return_value = self._make_project_mapper()
+        instance = self._create_instance(image_ref='fake', system_metadata={},
+                                         expected_attrs=['system_metadata'])
+        setattr(instance, 'save', mock.MagicMock())
+        self.driver.spawn(self.context, instance, None, None, None)
+        self.assertNotIn('management_ip', instance.system_metadata)
+        self.assertEqual('fake', instance.system_metadata['instance_id'])
+        self.assertTrue(instance_mapper_create_mock.called)
+
+    @mock.patch.object(AwsComputeDriver, "_get_provider_flavor_id",
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsClientPlugin, 'create_tags',
+                       mock.MagicMock())
+    @mock.patch.object(jacket.db.extend.api, 'instance_mapper_create',
+                       mock.MagicMock())
+    @mock.patch.object(AwsComputeDriver, "_get_project_mapper")
+    @mock.patch.object(AwsClientPlugin, 'describe_images')
+    @mock.patch.object(AwsClientPlugin, 'create_instance')
+    @mock.patch.object(AwsClientPlugin, 'describe_instances')
+    def test_spawn_caches_launch_info(self,
+                                      describe_instances_mock,
+                                      create_instance_mock,
+                                      describe_images_mock,
+                                      get_project_mapper_mock):
+        netWorkInterface = {'SubnetId': 'subnet2',
+                            'PrivateIpAddresses':
+                            [{'PrivateIpAddress': '192.168.3.5'}]}
+        create_instance_mock.return_value = [{'NetworkInterfaces':
+                                              [netWorkInterface],
+                                              'InstanceId': 'fake'}]
+        bdms = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 1}}]
+        describe_images_mock.return_value = [{'ImageId': 'fake',
+                                              'BlockDeviceMappings': bdms}]
+        project_mapper = self._make_project_mapper()
+        project_mapper['base_linux_image'] = 'fake'
+        get_project_mapper_mock.return_value = project_mapper
+        for _ in range(2):
+            instance = self._create_instance(
+                image_ref='fake', system_metadata={},
+                expected_attrs=['system_metadata'])
+            setattr(instance, 'save', mock.MagicMock())
+            self.driver.spawn(self.context, instance, None, None, None)
+        get_project_mapper_mock.assert_called_once_with(
+            self.context, self.context.project_id)
+        describe_images_mock.assert_called_once_with(ImageIds=['fake'])
+        self.assertEqual(2, create_instance_mock.call_count)
+
+    @mock.patch.object(AwsComputeDriver, "_get_provider_flavor_id",
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsComputeDriver, "_get_provider_base_image_id",
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsClientPlugin, 'create_tags',
+                       mock.MagicMock())
+    @mock.patch.object(jacket.db.extend.api, 'instance_mapper_create',
+                       mock.MagicMock())
+    @mock.patch.object(AwsComputeDriver, "_get_project_mapper")
+    @mock.patch.object(AwsClientPlugin, 'describe_images')
+    @mock.patch.object(AwsClientPlugin, 'create_instance')
+    @mock.patch('eventlet.spawn_n')
+    def test_spawn_without_waiting_running(self,
+                                           spawn_n_mock,
+                                           create_instance_mock,
+                                           describe_images_mock,
+                                           get_project_mapper_mock):
+        conf.CONF.set_override('spawn_wait_running', False, 'aws')
+        self.addCleanup(conf.CONF.clear_override, 'spawn_wait_running',
+                        'aws')
+        netWorkInterface = {'SubnetId': 'subnet2',
+                            'PrivateIpAddresses':
+                            [{'PrivateIpAddress': '192.168.3.5'}]}
+        create_instance_mock.return_value = [{'NetworkInterfaces':
+                                              [netWorkInterface],
+                                              'InstanceId': 'fake'}]
+        bdms = [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeSize': 1}}]
+        describe_images_mock.return_value = [{'ImageId': 'fake',
+                                              'BlockDeviceMappings': bdms}]
+        get_project_mapper_mock.return_value = self._make_project_mapper()
+        instance = self._create_instance(image_ref='fake', system_metadata={},
+                                         expected_attrs=['system_metadata'])
+        setattr(instance, 'save', mock.MagicMock())
+        self.driver.spawn(self.context, instance, None, None, None)
+        self.assertFalse(create_instance_mock.call_args[1]['wait'])
+        spawn_n_mock.assert_called_once_with(
+            self.driver._wait_instance_running, self.context, instance,
+            ['fake'])
 
     def test_upload_image_not_exist_lxc_volume(self):
         '''Test upload_image in compute_driver
@@ -1123,13 +1256,13 @@ class AwsComputeDriverTestCase(testtools.TestCase):
 
     @mock.patch.object(jacket.db.extend.api, 'volume_mapper_create')
     @mock.patch.object(AwsComputeDriver, "_get_project_mapper")
-    @mock.patch.object(AwsClientPlugin, 'delete_volume')
+    @mock.patch.object(CleanupQueue, 'enqueue')
     @mock.patch.object(AwsClientPlugin, 'create_volume')
     @mock.patch.object(AwsClientPlugin, 'create_tags')
     def test_volume_create_error_mapper_create(self,
                                                create_tags_mock,
                                                create_volume_mock,
-                                               delete_volume_mock,
+                                               enqueue_mock,
                                                get_project_mapper_mock,
                                                volume_mapper_create_mock):
         '''Test volume_create in compute_driver
@@ -1146,12 +1279,13 @@ class AwsComputeDriverTestCase(testtools.TestCase):
         create_tags_mock.return_value = {'code': 200}
         volume_mapper_create_mock.side_effect = \
             exception_ex.ProviderCreateVolumeFailed
-        delete_volume_mock.return_value = {'code': 200}
         self.assertRaises(exception_ex.ProviderCreateVolumeFailed,
                           self.driver.volume_create,
                           self.context,
                           instance,
                           size=size)
+        enqueue_mock.assert_called_once_with(self.context.project_id,
+                                             'volume', 'vol-00001')
 
     @mock.patch.object(jacket.db.extend.api, 'volume_mapper_create')
     @mock.patch.object(AwsComputeDriver, "_get_project_mapper")
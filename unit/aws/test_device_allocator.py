@@ -0,0 +1,81 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import testtools
+
+from jacket.drivers.aws import device_allocator
+from jacket.drivers.aws import exception_ex
+
+
+class DeviceAllocatorTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(DeviceAllocatorTestCase, self).setUp()
+        self.allocator = device_allocator.DeviceAllocator()
+
+    def test_get_device_letter(self):
+        self.assertEqual('a', device_allocator.get_device_letter('/dev/sda1'))
+        self.assertEqual('f', device_allocator.get_device_letter('/dev/xvdf'))
+        self.assertEqual('ba',
+                         device_allocator.get_device_letter('/dev/xvdba'))
+        self.assertEqual('c', device_allocator.get_device_letter('hdc'))
+
+    def test_reserve_loads_once(self):
+        loader = mock.MagicMock(return_value=['/dev/sda1', '/dev/sdb'])
+        self.assertEqual('/dev/sdc',
+                         self.allocator.reserve('i-1', loader=loader))
+        self.assertEqual('/dev/sdd',
+                         self.allocator.reserve('i-1', loader=loader))
+        loader.assert_called_once_with()
+
+    def test_release_reserved_device(self):
+        self.allocator.load('i-1', ['/dev/sda1'])
+        device = self.allocator.reserve('i-1')
+        self.allocator.release('i-1', device)
+        self.assertEqual(device, self.allocator.reserve('i-1'))
+
+    def test_commit_and_release_volume(self):
+        self.allocator.load('i-1', ['/dev/sda1'])
+        device = self.allocator.reserve('i-1')
+        self.allocator.commit('i-1', device, volume_id='vol-1')
+        self.assertEqual('/dev/sdc', self.allocator.reserve('i-1'))
+        self.allocator.release_volume('i-1', 'vol-1')
+        self.assertEqual(device, self.allocator.reserve('i-1'))
+
+    def test_release_unknown_volume_reloads(self):
+        loader = mock.MagicMock(return_value=['/dev/sda1'])
+        self.allocator.load('i-1', ['/dev/sda1', '/dev/sdb'])
+        self.allocator.release_volume('i-1', 'vol-1')
+        self.assertEqual('/dev/sdb',
+                         self.allocator.reserve('i-1', loader=loader))
+        loader.assert_called_once_with()
+
+    def test_reserve_explicit_device(self):
+        self.allocator.load('i-1', ['/dev/sda1'])
+        self.allocator.reserve_device('i-1', '/dev/sdb')
+        self.assertEqual('/dev/sdc', self.allocator.reserve('i-1'))
+
+    def _device_names(self, letters):
+        return [device_allocator.get_device_name(letter)
+                for letter in letters]
+
+    def test_reserve_extended_namespace(self):
+        letters = device_allocator.ALL_LETTERS[:26]
+        self.allocator.load('i-1', self._device_names(letters))
+        self.assertEqual('/dev/xvdaa', self.allocator.reserve('i-1'))
+
+    def test_reserve_exhausted(self):
+        self.allocator.load('i-1',
+                            self._device_names(device_allocator.ALL_LETTERS))
+        self.assertRaises(exception_ex.NoFreeDeviceName,
+                          self.allocator.reserve, 'i-1')
@@ -0,0 +1,148 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import testtools
+
+from botocore import exceptions
+from jacket import conf
+from jacket.drivers.aws.client import AwsClientPlugin
+from jacket.drivers.aws import exception_ex
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+
+CONF = conf.CONF
+
+
+class FakeEc2ClientTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(FakeEc2ClientTestCase, self).setUp()
+        self.addCleanup(CONF.clear_override, 'create_retry_interval', 'aws')
+        CONF.set_override('create_retry_interval', 0, 'aws')
+        self.ec2 = fake_ec2.FakeEc2Client(time_scale=0.0001, seed=1)
+        self.plugin = AwsClientPlugin(self.ec2)
+        self.plugin._waiters.clock = self.ec2.simulated_time
+        self.plugin._waiters.sleep = self.ec2.sleep
+        self.image_id = self.ec2.add_image(name='base')
+
+    def _create_instance(self, **kwargs):
+        return self.plugin.create_instance(ImageId=self.image_id,
+                                           InstanceType='t2.micro', **kwargs)
+
+    def test_create_instance_waits_until_running(self):
+        tags = [{'ResourceType': 'instance',
+                 'Tags': [{'Key': 'caa_instance_id', 'Value': 'caa-1'}]}]
+        instances = self._create_instance(TagSpecifications=tags)
+        self.assertEqual('pending', instances[0]['State']['Name'])
+        described = self.plugin.describe_instances(
+            Filters=[{'Name': 'tag:caa_instance_id', 'Values': ['caa-1']}])
+        self.assertEqual('running', described[0]['State']['Name'])
+        self.assertGreater(self.ec2.calls['describe_instances'], 1)
+
+    def test_run_instances_is_idempotent_per_client_token(self):
+        first = self._create_instance(ClientToken='token', wait=False)
+        again = self._create_instance(ClientToken='token', wait=False)
+        self.assertEqual(first, again)
+        self.assertEqual(1, len(self.ec2.instances))
+
+    def test_run_instances_bounded_by_instance_limit(self):
+        self.ec2.instance_limit = 2
+        instances = self._create_instance(MaxCount=3, wait=False)
+        self.assertEqual([0, 1], [i['AmiLaunchIndex'] for i in instances])
+        e = self.assertRaises(exceptions.ClientError, self._create_instance,
+                              wait=False)
+        self.assertEqual('InsufficientInstanceCapacity',
+                         e.response['Error']['Code'])
+
+    def test_throttled_create_is_retried(self):
+        self.ec2._buckets['run_instances'] = fake_ec2._TokenBucket(
+            0, 1, self.ec2.clock)
+        self._create_instance(ClientToken='a', wait=False)
+        e = self.assertRaises(exceptions.ClientError, self._create_instance,
+                              ClientToken='b', wait=False)
+        self.assertEqual('RequestLimitExceeded', e.response['Error']['Code'])
+        self.assertEqual(1 + 1 + CONF.aws.create_retries,
+                         self.ec2.calls['run_instances'])
+
+    def test_injected_error_fails_one_call(self):
+        self.ec2.inject_error('create_volume', 'InternalError')
+        volume = self.plugin.create_volume(Size=1, ClientToken='t',
+                                           AvailabilityZone='az')
+        self.assertEqual(2, self.ec2.calls['create_volume'])
+        self.assertEqual('available', self.plugin.describe_volumes(
+            VolumeIds=[volume['VolumeId']])[0]['State'])
+
+    def test_volume_attach_detach_and_delete(self):
+        instance = self._create_instance()[0]
+        volume = self.plugin.create_volume(Size=1, AvailabilityZone='az')
+        self.plugin.attach_volume(VolumeId=volume['VolumeId'],
+                                  InstanceId=instance['InstanceId'],
+                                  Device='/dev/sdf')
+        self.assertRaises(exception_ex.ProviderDeleteVolumeFailed,
+                          self.plugin.delete_volume,
+                          VolumeId=volume['VolumeId'])
+        self.plugin.detach_volume(VolumeId=volume['VolumeId'])
+        self.plugin.delete_volume(VolumeId=volume['VolumeId'])
+        self.assertEqual([], self.plugin.describe_volumes())
+
+    def test_snapshot_completes_and_restores(self):
+        volume = self.plugin.create_volume(Size=3, AvailabilityZone='az')
+        tags = [{'ResourceType': 'snapshot',
+                 'Tags': [{'Key': 'caa_snapshot_id', 'Value': 'caa-1'}]}]
+        snapshot = self.plugin.create_snapshot(VolumeId=volume['VolumeId'],
+                                               TagSpecifications=tags)
+        self.assertEqual('pending', snapshot['State'])
+        self.assertEqual('completed',
+                         self.plugin.get_snapshot_state(
+                             snapshot['SnapshotId']))
+        restored = self.plugin.create_volume(
+            SnapshotId=snapshot['SnapshotId'], AvailabilityZone='az')
+        self.assertEqual(3, restored['Size'])
+        self.assertEqual(
+            [snapshot['SnapshotId']],
+            [tag['ResourceId'] for tag in self.plugin.describe_tags(
+                Filters=[{'Name': 'key', 'Values': ['caa_snapshot_id']}])])
+
+    def test_restore_from_pending_snapshot_fails(self):
+        volume = self.ec2.create_volume(Size=1, AvailabilityZone='az')
+        snapshot = self.ec2.create_snapshot(VolumeId=volume['VolumeId'])
+        e = self.assertRaises(exceptions.ClientError, self.ec2.create_volume,
+                              SnapshotId=snapshot['SnapshotId'],
+                              AvailabilityZone='az')
+        self.assertEqual('IncorrectState', e.response['Error']['Code'])
+
+    def test_parameters_validated_like_boto3(self):
+        self.assertRaises(exceptions.ParamValidationError,
+                          self.ec2.describe_snapshots, VolumeIds=['vol-1'])
+        self.assertRaises(exceptions.ParamValidationError,
+                          self.ec2.create_volume, Size=1)
+        self.assertEqual(0, sum(self.ec2.calls.values()))
+
+    def test_waiter_gives_up_after_max_attempts(self):
+        self.ec2.transitions['instance_running'] = 3600
+        instance = self._create_instance(wait=False)[0]
+        waiter = self.ec2.get_waiter('instance_running')
+        self.assertRaises(exceptions.WaiterError, waiter.wait,
+                          InstanceIds=[instance['InstanceId']],
+                          WaiterConfig={'Delay': 0, 'MaxAttempts': 2})
+        self.assertEqual(2, self.ec2.waiter_calls['describe_instances'])
+        self.assertEqual(2, self.ec2.calls['describe_instances'])
+
+    def test_describe_paginates(self):
+        for _i in range(3):
+            self.ec2.create_volume(Size=1, AvailabilityZone='az')
+        pages = list(self.plugin.paginate('describe_volumes', 'Volumes',
+                                          MaxResults=2))
+        self.assertEqual([2, 1], [len(page) for page in pages])
+
+    def test_same_seed_same_ids(self):
+        other = fake_ec2.FakeEc2Client(time_scale=0.0001, seed=1)
+        self.assertEqual(self.image_id, other.add_image())
@@ -0,0 +1,225 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import mock
+import testtools
+
+from jacket import conf
+from jacket.drivers.aws import group_snapshots
+from jacket.drivers.aws import volume_driver
+from jacket.storage import exception as cinder_ex
+from jacket.tests.storage.unit.volume.drivers.aws import bench_volume
+
+CONF = conf.CONF
+
+
+class GroupSnapshotTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(GroupSnapshotTestCase, self).setUp()
+        self.addCleanup(CONF.clear_override, 'async_snapshots', 'aws')
+        CONF.set_override('async_snapshots', False, 'aws')
+        self.addCleanup(CONF.clear_override, 'instance_backup_window', 'aws')
+        CONF.set_override('instance_backup_window', 0.01, 'aws')
+        self.workload = bench_volume.Workload(
+            bench_volume.build_parser().parse_args(
+                ['--latency', '0', '--time-scale', '0.0001']))
+        self.ec2 = self.workload.ec2
+        self.driver = self.workload.driver
+        self.enqueue = mock.patch.object(self.driver._cleanup_queue,
+                                         'enqueue').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _volumes(self, count, attached=0):
+        volumes = [self.workload.new_volume() for _i in range(count)]
+        for volume in volumes:
+            self.driver.create_volume(volume)
+        if attached:
+            self.workload.attach(volumes[:attached])
+        return volumes
+
+    def _cgsnapshot(self, volumes):
+        snapshots = [bench_volume.FakeSnapshot(volume) for volume in volumes]
+        cgsnapshot = mock.Mock(id='cgsnapshot', project_id='bench')
+        return snapshots, self.driver.create_cgsnapshot(None, cgsnapshot,
+                                                        snapshots)
+
+    def _snapshot_volume(self, snapshot):
+        provider_snap = self.workload.db.volume_snapshot_mapper_get(
+            None, snapshot.id)['provider_snapshot_id']
+        return self.ec2.snapshots[provider_snap]['VolumeId']
+
+    def _provider_volume(self, volume):
+        return self.workload.db.volume_mapper_get(
+            None, volume.id)['provider_volume_id']
+
+    def test_attached_volumes_snapshotted_at_once(self):
+        volumes = self._volumes(3, attached=3)
+        self.ec2.calls.clear()
+        snapshots, (model_update, snapshots_update) = \
+            self._cgsnapshot(volumes)
+        self.assertEqual({'status': 'available'}, model_update)
+        self.assertEqual(['available'] * 3,
+                         [s['status'] for s in snapshots_update])
+        self.assertEqual(1, self.ec2.calls['create_snapshots'])
+        self.assertFalse(self.ec2.calls['create_snapshot'])
+        self.assertEqual([self._provider_volume(v) for v in volumes],
+                         [self._snapshot_volume(s) for s in snapshots])
+        provider_snap = self.workload.db.volume_snapshot_mapper_get(
+            None, snapshots[0].id)['provider_snapshot_id']
+        self.assertEqual(
+            [{'Key': group_snapshots.GROUP_TAG, 'Value': 'cgsnapshot'},
+             {'Key': 'caa_snapshot_id', 'Value': snapshots[0].id}],
+            self.ec2.snapshots[provider_snap]['Tags'])
+        self.assertIn(provider_snap, self.driver._tag_index.lookup(
+            self.workload.context, 'snapshot', snapshots[0].id))
+
+    def test_volume_outside_group_excluded(self):
+        volumes = self._volumes(3, attached=3)
+        self.ec2.calls.clear()
+        snapshots, _update = self._cgsnapshot(volumes[:2])
+        self.assertFalse(self.enqueue.called)
+        self.assertEqual(2, len(self.ec2.snapshots))
+        self.assertFalse(self.ec2.calls['create_snapshot'])
+        self.assertEqual([self._provider_volume(v) for v in volumes[:2]],
+                         [self._snapshot_volume(s) for s in snapshots])
+
+    def test_instance_specification(self):
+        instance = {'InstanceId': 'i-1', 'RootDeviceName': '/dev/sda1',
+                    'BlockDeviceMappings': [
+                        {'DeviceName': '/dev/sda1',
+                         'Ebs': {'VolumeId': 'vol-root'}},
+                        {'DeviceName': '/dev/sdb',
+                         'Ebs': {'VolumeId': 'vol-b'}},
+                        {'DeviceName': '/dev/sdc',
+                         'Ebs': {'VolumeId': 'vol-c'}}]}
+        self.assertEqual(
+            {'InstanceId': 'i-1', 'ExcludeBootVolume': True,
+             'ExcludeDataVolumeIds': ['vol-c']},
+            self.driver._instance_specification(instance,
+                                                set(['vol-b'])))
+        self.assertEqual(
+            {'InstanceId': 'i-1', 'ExcludeBootVolume': False},
+            self.driver._instance_specification(
+                instance, set(['vol-root', 'vol-b', 'vol-c'])))
+
+    def test_detached_volumes_snapshotted_one_by_one(self):
+        volumes = self._volumes(3, attached=1)
+        self.ec2.calls.clear()
+        snapshots, _update = self._cgsnapshot(volumes)
+        self.assertFalse(self.ec2.calls['create_snapshots'])
+        self.assertEqual(3, self.ec2.calls['create_snapshot'])
+        self.assertEqual([self._provider_volume(v) for v in volumes],
+                         [self._snapshot_volume(s) for s in snapshots])
+
+    def test_volume_missing_from_request_snapshotted_alone(self):
+        volumes = self._volumes(3, attached=2)
+        # attached as far as cinder knows, but not on aws
+        volumes[2].attach_status = 'attached'
+        volumes[2].volume_attachment = volumes[0].volume_attachment
+        self.ec2.calls.clear()
+        snapshots, _update = self._cgsnapshot(volumes)
+        self.assertEqual(1, self.ec2.calls['create_snapshots'])
+        self.assertEqual(1, self.ec2.calls['create_snapshot'])
+        self.assertEqual(self._provider_volume(volumes[2]),
+                         self._snapshot_volume(snapshots[2]))
+
+    def test_mapper_failure_deletes_snapshots(self):
+        volumes = self._volumes(2, attached=2)
+        with mock.patch.object(self.workload.db,
+                               'volume_snapshot_mapper_create',
+                               side_effect=Exception('db down'),
+                               create=True):
+            self.assertRaises(cinder_ex.VolumeBackendAPIException,
+                              self._cgsnapshot, volumes)
+        self.assertEqual(2, self.enqueue.call_count)
+
+    def test_instance_backups_share_one_request(self):
+        self.addCleanup(CONF.clear_override, 'instance_backups', 'aws')
+        CONF.set_override('instance_backups', True, 'aws')
+        volumes = self._volumes(4, attached=3)
+        backups = [bench_volume.FakeBackup(volume) for volume in volumes]
+        self.ec2.calls.clear()
+        threads = [eventlet.spawn(self.workload.backup_driver.backup, backup,
+                                  None) for backup in backups]
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(1, self.ec2.calls['create_snapshots'])
+        self.assertEqual(1, self.ec2.calls['create_snapshot'])
+
+    def test_backup_drivers_share_one_request(self):
+        # the backup manager builds a driver per backup
+        self.addCleanup(CONF.clear_override, 'instance_backups', 'aws')
+        CONF.set_override('instance_backups', True, 'aws')
+        volumes = self._volumes(2, attached=2)
+        drivers = [volume_driver.get_backup_driver(None) for _i in range(2)]
+        for driver in drivers:
+            driver.db = self.workload.storage_db
+            driver.caa_db_api = self.workload.db
+        self.assertIs(drivers[0]._snapshot_batcher,
+                      drivers[1]._snapshot_batcher)
+        self.assertIs(drivers[0]._snapshot_tracker,
+                      drivers[1]._snapshot_tracker)
+        self.ec2.calls.clear()
+        threads = [eventlet.spawn(driver.backup,
+                                  bench_volume.FakeBackup(volume), None)
+                   for driver, volume in zip(drivers, volumes)]
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(1, self.ec2.calls['create_snapshots'])
+        self.assertFalse(self.ec2.calls['create_snapshot'])
+
+
+class SnapshotBatcherTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(SnapshotBatcherTestCase, self).setUp()
+        self.addCleanup(CONF.clear_override, 'instance_backup_window', 'aws')
+        CONF.set_override('instance_backup_window', 0.01, 'aws')
+        self.create_snapshots = mock.Mock()
+        self.batcher = group_snapshots.SnapshotBatcher(self.create_snapshots)
+        self.context = mock.Mock(project_id='fake')
+
+    def _spawn_all(self, caa_ids, instance_id='i-1'):
+        return [eventlet.spawn(self.batcher.snapshot, self.context,
+                               caa_id, 'volume-%s' % caa_id, instance_id)
+                for caa_id in caa_ids]
+
+    def _snapshot_all(self, caa_ids):
+        return [thread.wait() for thread in self._spawn_all(caa_ids)]
+
+    def _create_snapshots(self, context, volumes, group_id, wait,
+                          instance_id):
+        if instance_id == 'i-bad':
+            raise Exception('boom')
+        return dict((caa_id, {'SnapshotId': 'snap-%s' % caa_id})
+                    for caa_id in volumes)
+
+    def test_concurrent_snapshots_batched(self):
+        self.create_snapshots.side_effect = self._create_snapshots
+        self.assertEqual([{'SnapshotId': 'snap-a'}, {'SnapshotId': 'snap-b'}],
+                         self._snapshot_all(['a', 'b']))
+        self.assertEqual(1, self.create_snapshots.call_count)
+        self.assertEqual({'a': 'volume-a', 'b': 'volume-b'},
+                         self.create_snapshots.call_args[0][1])
+        self.assertEqual('i-1',
+                         self.create_snapshots.call_args[1]['instance_id'])
+
+    def test_failure_fails_only_its_instance(self):
+        self.create_snapshots.side_effect = self._create_snapshots
+        bad = self._spawn_all('ab', instance_id='i-bad')
+        good = self._spawn_all('c')
+        for thread in bad:
+            self.assertRaises(Exception, thread.wait)
+        self.assertEqual({'SnapshotId': 'snap-c'}, good[0].wait())
+        self.assertEqual(2, self.create_snapshots.call_count)
@@ -0,0 +1,182 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+from eventlet import greenthread
+import mock
+import testtools
+
+from jacket.compute.cloud import power_state
+from jacket import conf
+from jacket import context as req_context
+from jacket.drivers.aws import instance_tracker
+from jacket.tests.storage.unit.volume.drivers.aws import bench_compute
+from jacket.tests.storage.unit.volume.drivers.aws import benchmark
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+
+CONF = conf.CONF
+
+
+class InstanceStateTrackerTestCase(fake_ec2.TrackerTestCase):
+
+    def setUp(self):
+        super(InstanceStateTrackerTestCase, self).setUp()
+        self.tracker = instance_tracker.InstanceStateTracker(self.aws_client)
+        self.image_id = self.ec2.add_image()
+
+    def _track(self, target='stopped', project_id='fake'):
+        instance_id = self.ec2.run_instances(
+            ImageId=self.image_id, MinCount=1,
+            MaxCount=1)['Instances'][0]['InstanceId']
+        self.clock.sleep(60)
+        self.ec2.stop_instances(InstanceIds=[instance_id])
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id=project_id)
+        self.tracker.track(context, instance_id, target)
+        return instance_id
+
+    def test_polls_until_stable(self):
+        instance_id = self._track()
+        self.assertEqual(1, self.spawn_mock.call_count)
+        self.assertEqual(1, self.tracker.poll())
+        self.assertEqual('stopping',
+                         self.tracker.state(instance_id)['Name'])
+        self.clock.sleep(60)
+        self.assertEqual(0, self.tracker.poll())
+        self.assertEqual('stopped', self.tracker.state(instance_id)['Name'])
+        self.assertEqual('stopped', self.tracker.wait(instance_id, 0))
+
+    def test_one_request_per_project(self):
+        self._track()
+        self._track()
+        self._track(project_id='other')
+        self.ec2.calls.clear()
+        self.tracker.poll()
+        self.assertEqual(2, self.ec2.calls['describe_instances'])
+
+    def test_wait_gets_final_state(self):
+        instance_id = self._track(target='running')
+        # eventlet.spawn is mocked out
+        waiter = greenthread.spawn(self.tracker.wait, instance_id, 10)
+        eventlet.sleep(0)
+        self.tracker.poll()
+        self.clock.sleep(60)
+        self.tracker.poll()
+        # stopped instead of running, after it was seen stopping
+        self.assertEqual('stopped', waiter.wait())
+
+    def test_state_before_change_not_final(self):
+        instance_id = self.ec2.run_instances(
+            ImageId=self.image_id, MinCount=1,
+            MaxCount=1)['Instances'][0]['InstanceId']
+        self.clock.sleep(60)
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id='fake')
+        # aws accepted the stop but still describes the instance running
+        self.tracker.track(context, instance_id, 'stopped')
+        self.assertEqual(1, self.tracker.poll())
+        self.ec2.stop_instances(InstanceIds=[instance_id])
+        self.clock.sleep(60)
+        self.assertEqual(0, self.tracker.poll())
+        self.assertEqual('stopped', self.tracker.wait(instance_id, 0))
+
+    def test_wait_times_out(self):
+        instance_id = self._track()
+        self.assertIsNone(self.tracker.wait(instance_id, 0.01))
+        self.assertEqual({instance_id: 'stopped'}, self.tracker.tracked())
+
+    def test_gone_instance_no_longer_tracked(self):
+        instance_id = self._track()
+        del self.ec2.instances[instance_id]
+        self.assertEqual(0, self.tracker.poll())
+        self.assertIsNone(self.tracker.state(instance_id))
+
+    def test_forget(self):
+        instance_id = self._track()
+        self.tracker.forget(instance_id)
+        self.ec2.calls.clear()
+        self.assertEqual(0, self.tracker.poll())
+        self.assertFalse(self.ec2.calls['describe_instances'])
+
+
+class PowerActionPolicyTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(PowerActionPolicyTestCase, self).setUp()
+        self.addCleanup(CONF.clear_override, 'power_action_policy', 'aws')
+        args = benchmark.build_parser('').parse_args(
+            ['--latency', '0', '--time-scale', '0.0001'])
+        self.ec2 = benchmark.make_ec2(args)
+        db = benchmark.FakeCaaDb()
+        self.context = req_context.RequestContext(
+            is_admin=True, project_id=bench_compute.PROJECT_ID)
+        bench_compute.setup_project(self.context, self.ec2, db)
+        self.driver = bench_compute.build_driver(self.ec2, db)
+        self.tracker = self.driver._instance_tracker
+        self.instance = bench_compute.FakeInstance()
+        self.driver.spawn(self.context, self.instance, None, [], None)
+        self.instance_id = self.instance.system_metadata['instance_id']
+
+    def _state(self):
+        return self.ec2.instances[self.instance_id]['State']['Name']
+
+    def test_wait(self):
+        self.driver.power_off(self.instance)
+        self.assertEqual('stopped', self._state())
+        self.assertEqual({}, self.tracker.tracked())
+        self.ec2.calls.clear()
+        self.assertEqual(power_state.SHUTDOWN,
+                         self.driver.get_info(self.instance).state)
+        self.assertFalse(self.ec2.calls['describe_instances'])
+
+    @mock.patch('eventlet.spawn')
+    def test_track(self, spawn_mock):
+        CONF.set_override('power_action_policy', 'track', 'aws')
+        self.driver.power_off(self.instance)
+        self.assertEqual('stopping', self._state())
+        self.assertEqual({self.instance_id: 'stopped'},
+                         self.tracker.tracked())
+        self.ec2.sleep(60)
+        self.tracker.poll()
+        self.assertEqual(power_state.SHUTDOWN,
+                         self.driver.get_info(self.instance).state)
+
+    def test_deadline(self):
+        CONF.set_override('power_action_policy', 'deadline', 'aws')
+        self.addCleanup(CONF.clear_override, 'instance_poll_interval', 'aws')
+        CONF.set_override('instance_poll_interval', 0, 'aws')
+        self.driver.power_off(self.instance)
+        self.assertEqual('stopped', self._state())
+        self.assertEqual({}, self.tracker.tracked())
+
+    @mock.patch('eventlet.spawn', mock.Mock())
+    def test_deadline_passed(self):
+        CONF.set_override('power_action_policy', 'deadline', 'aws')
+        self.addCleanup(CONF.clear_override, 'power_action_deadline', 'aws')
+        CONF.set_override('power_action_deadline', 0, 'aws')
+        self.driver.power_off(self.instance)
+        self.assertEqual({self.instance_id: 'stopped'},
+                         self.tracker.tracked())
+
+    def test_power_on_waits_for_power_off(self):
+        CONF.set_override('power_action_policy', 'track', 'aws')
+        self.addCleanup(CONF.clear_override, 'instance_poll_interval', 'aws')
+        CONF.set_override('instance_poll_interval', 0, 'aws')
+        self.driver.power_off(self.instance)
+        self.driver.power_on(self.context, self.instance, None)
+        self.assertIn(self._state(), ('pending', 'running'))
+
+    @mock.patch('eventlet.spawn', mock.Mock())
+    def test_reboot_not_tracked(self):
+        CONF.set_override('power_action_policy', 'track', 'aws')
+        self.driver.reboot(self.context, self.instance, None, 'SOFT')
+        self.assertEqual({}, self.tracker.tracked())
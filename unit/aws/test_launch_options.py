@@ -0,0 +1,168 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from botocore.exceptions import ClientError
+import mock
+import testtools
+
+from jacket import conf
+from jacket import context
+from jacket.drivers.aws.client import AwsClientPlugin
+from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws import launch_options
+
+CONF = conf.CONF
+
+
+class LaunchOptionsTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(LaunchOptionsTestCase, self).setUp()
+        self.ctx = context.RequestContext('fake', 'fake', is_admin=True)
+        self.instance = mock.Mock(uuid='fake-uuid')
+        self.ec2_client = mock.MagicMock()
+        aws_client = mock.MagicMock()
+        aws_client.get_aws_client.return_value = AwsClientPlugin(
+            self.ec2_client)
+        self.placement_groups = launch_options.PlacementGroups(aws_client)
+        self.objects = mock.MagicMock()
+        self.group = mock.Mock(uuid='group-uuid', policies=['affinity'])
+        self.objects.InstanceGroup.get_by_instance_uuid.return_value = \
+            self.group
+        patcher = mock.patch.object(launch_options, 'compute_objects',
+                                    self.objects)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(CONF.clear_override, 'server_group_placement', 'aws')
+        CONF.set_override('server_group_placement', True, 'aws')
+
+    def test_get_options_flavor_wins(self):
+        flavor_specs = {'aws:ebs_optimized': 'True', 'aws:cpu_cores': '4',
+                        'aws:interface_type': 'efa', 'hw:cpu_policy': 'x'}
+        project_mapper = {'ebs_optimized': 'false', 'tenancy': 'dedicated'}
+        options = launch_options.get_options(flavor_specs, project_mapper)
+        self.assertEqual({'ebs_optimized': True, 'cpu_cores': 4,
+                          'interface_type': 'efa', 'tenancy': 'dedicated'},
+                         options)
+
+    def test_get_options_invalid(self):
+        for specs in ({'aws:ebs_optimized': 'maybe'},
+                      {'aws:tenancy': 'shared'},
+                      {'aws:cpu_threads_per_core': '0'},
+                      {'aws:placement_strategy': 'close'}):
+            self.assertRaises(exception_ex.InvalidLaunchOption,
+                              launch_options.get_options, specs, {})
+
+    def test_apply_options(self):
+        create_args = {'Placement': {'AvailabilityZone': 'az'},
+                       'NetworkInterfaces': [{'DeviceIndex': 0}]}
+        options = {'ebs_optimized': True, 'tenancy': 'dedicated',
+                   'cpu_cores': 4, 'cpu_threads_per_core': 1,
+                   'interface_type': 'efa'}
+        launch_options.apply_options(create_args, options, 'caa-group')
+        self.assertEqual(
+            {'EbsOptimized': True,
+             'Placement': {'AvailabilityZone': 'az', 'Tenancy': 'dedicated',
+                           'GroupName': 'caa-group'},
+             'CpuOptions': {'CoreCount': 4, 'ThreadsPerCore': 1},
+             'NetworkInterfaces': [{'DeviceIndex': 0,
+                                    'InterfaceType': 'efa'}]},
+            create_args)
+
+    def test_placement_group_created_once_per_server_group(self):
+        self.assertEqual('caa-group-uuid',
+                         self.placement_groups.get(self.ctx, self.instance))
+        self.assertEqual('caa-group-uuid',
+                         self.placement_groups.get(self.ctx, self.instance))
+        self.ec2_client.create_placement_group.assert_called_once_with(
+            GroupName='caa-group-uuid', Strategy='cluster')
+
+    def test_placement_group_existing_reused(self):
+        self.ec2_client.create_placement_group.side_effect = ClientError(
+            {'Error': {'Code': 'InvalidPlacementGroup.Duplicate',
+                       'Message': ''}}, 'CreatePlacementGroup')
+        self.assertEqual('caa-group-uuid',
+                         self.placement_groups.get(self.ctx, self.instance,
+                                                   'spread'))
+        self.ec2_client.create_placement_group.assert_called_once_with(
+            GroupName='caa-group-uuid', Strategy='spread')
+
+    def test_no_placement_group_without_server_group(self):
+        self.objects.InstanceGroup.get_by_instance_uuid.side_effect = \
+            Exception()
+        self.assertIsNone(self.placement_groups.get(self.ctx, self.instance,
+                                                    'cluster'))
+        self.ec2_client.create_placement_group.assert_not_called()
+
+    def test_no_placement_group_by_default(self):
+        CONF.clear_override('server_group_placement', 'aws')
+        self.assertIsNone(self.placement_groups.get(self.ctx, self.instance,
+                                                    'cluster'))
+        self.objects.InstanceGroup.get_by_instance_uuid.assert_not_called()
+        self.ec2_client.create_placement_group.assert_not_called()
+
+    @mock.patch.object(launch_options.LOG, 'warn')
+    def test_server_groups_unavailable_logged(self, mock_warn):
+        with mock.patch.object(launch_options, 'compute_objects', None):
+            placement_groups = launch_options.PlacementGroups(
+                mock.MagicMock())
+            self.assertIsNone(placement_groups.get(self.ctx, self.instance))
+        self.assertEqual(1, mock_warn.call_count)
+
+    def test_root_options(self):
+        flavor_specs = {'aws:root_volume_type': 'gp3', 'aws:root_iops': '6000',
+                        'aws:root_kms_key_id': 'key'}
+        options = launch_options.get_root_options(flavor_specs)
+        ebs = {'SnapshotId': 'snap-1', 'VolumeSize': 50,
+               'VolumeType': 'io1', 'Iops': 1000}
+        launch_options.apply_root_options(ebs, options)
+        self.assertEqual({'SnapshotId': 'snap-1', 'VolumeSize': 50,
+                          'VolumeType': 'gp3', 'Iops': 6000,
+                          'Encrypted': True, 'KmsKeyId': 'key'}, ebs)
+
+    def test_root_options_out_of_limits(self):
+        options = launch_options.get_root_options(
+            {'aws:root_volume_type': 'io2', 'aws:root_iops': '20000'})
+        self.assertRaises(exception_ex.InvalidLaunchOption,
+                          launch_options.apply_root_options,
+                          {'VolumeSize': 8}, options)
+        self.assertRaises(exception_ex.InvalidLaunchOption,
+                          launch_options.get_root_options,
+                          {'aws:root_volume_type': 'ssd'})
+        options = launch_options.get_root_options(
+            {'aws:root_volume_type': 'st1'})
+        self.assertRaises(exception_ex.InvalidLaunchOption,
+                          launch_options.apply_root_options,
+                          {'VolumeSize': 500}, options)
+
+    def test_root_options_image_size(self):
+        # the size of the image snapshot is left to aws to check
+        options = launch_options.get_root_options(
+            {'aws:root_volume_type': 'io1', 'aws:root_iops': '5000'})
+        ebs = launch_options.apply_root_options({'SnapshotId': 'snap-1'},
+                                                options)
+        self.assertEqual(5000, ebs['Iops'])
+        self.assertRaises(exception_ex.InvalidLaunchOption,
+                          launch_options.apply_root_options,
+                          {'SnapshotId': 'snap-1'},
+                          launch_options.get_root_options(
+                              {'aws:root_volume_type': 'io1'}))
+
+    def test_instance_store_mappings(self):
+        bdms = [{'DeviceName': '/dev/xvda', 'Ebs': {}},
+                {'DeviceName': '/dev/sdb', 'Ebs': {}}]
+        self.assertEqual(
+            [{'DeviceName': '/dev/sdc', 'VirtualName': 'ephemeral0'},
+             {'DeviceName': '/dev/sdd', 'VirtualName': 'ephemeral1'}],
+            launch_options.instance_store_mappings(2, bdms))
+        bdms.append({'DeviceName': '/dev/sdc', 'VirtualName': 'ephemeral0'})
+        self.assertEqual([], launch_options.instance_store_mappings(2, bdms))
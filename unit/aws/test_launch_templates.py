@@ -0,0 +1,115 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from botocore.exceptions import ClientError
+import mock
+import testtools
+
+from jacket import context
+from jacket.drivers.aws.client import AwsClientPlugin
+from jacket.drivers.aws import launch_templates
+
+
+class LaunchTemplatesTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(LaunchTemplatesTestCase, self).setUp()
+        self.ctx = context.RequestContext('fake', 'fake', is_admin=True)
+        self.ec2_client = mock.MagicMock()
+        self.ec2_client.describe_launch_templates.side_effect = ClientError(
+            {'Error': {'Code': 'InvalidLaunchTemplateName.NotFoundException',
+                       'Message': ''}}, 'DescribeLaunchTemplates')
+        self.ec2_client.create_launch_template.return_value = {
+            'LaunchTemplate': {'LaunchTemplateId': 'lt-1',
+                               'LatestVersionNumber': 1}}
+        self.ec2_client.create_launch_template_version.return_value = {
+            'LaunchTemplateVersion': {'VersionNumber': 2}}
+        aws_client = mock.MagicMock()
+        aws_client.get_aws_client.return_value = AwsClientPlugin(
+            self.ec2_client)
+        self.templates = launch_templates.LaunchTemplates(aws_client)
+        self.create_args = {
+            'ImageId': 'ami-1', 'InstanceType': 't2.micro',
+            'Placement': {'AvailabilityZone': 'az'},
+            'NetworkInterfaces': [{'DeviceIndex': 0, 'SubnetId': 's1'}],
+            'BlockDeviceMappings': [{'DeviceName': '/dev/sda1',
+                                     'Ebs': {'VolumeSize': 10}}],
+            'UserData': 'data', 'ClientToken': 'token'}
+
+    def test_prepare_creates_template_once(self):
+        run_args = self.templates.prepare(self.ctx, dict(self.create_args))
+        self.templates.prepare(self.ctx, dict(self.create_args))
+        self.assertEqual(
+            {'LaunchTemplate': {'LaunchTemplateId': 'lt-1', 'Version': '1'},
+             'BlockDeviceMappings': self.create_args['BlockDeviceMappings'],
+             'Placement': {'AvailabilityZone': 'az'},
+             'UserData': 'data', 'ClientToken': 'token'}, run_args)
+        name = launch_templates.template_name('fake', self.create_args)
+        self.ec2_client.create_launch_template.assert_called_once_with(
+            LaunchTemplateName=name, VersionDescription=mock.ANY,
+            LaunchTemplateData={
+                'ImageId': 'ami-1', 'InstanceType': 't2.micro',
+                'NetworkInterfaces': self.create_args['NetworkInterfaces']})
+        self.assertEqual(1,
+                         self.ec2_client.describe_launch_templates.call_count)
+
+    def test_prepare_versions_drifted_config(self):
+        self.templates.prepare(self.ctx, dict(self.create_args))
+        create_args = dict(self.create_args, EbsOptimized=True)
+        run_args = self.templates.prepare(self.ctx, create_args)
+        self.assertEqual({'LaunchTemplateId': 'lt-1', 'Version': '2'},
+                         run_args['LaunchTemplate'])
+        call_kwargs = \
+            self.ec2_client.create_launch_template_version.call_args[1]
+        self.assertEqual('lt-1', call_kwargs['LaunchTemplateId'])
+        self.assertTrue(call_kwargs['LaunchTemplateData']['EbsOptimized'])
+
+    def test_prepare_placement_per_instance(self):
+        self.templates.prepare(self.ctx, dict(self.create_args))
+        placement = {'AvailabilityZone': 'az', 'GroupName': 'caa-group-1',
+                     'Tenancy': 'dedicated'}
+        run_args = self.templates.prepare(
+            self.ctx, dict(self.create_args, Placement=placement))
+        self.assertEqual(placement, run_args['Placement'])
+        self.assertEqual(1, self.ec2_client.create_launch_template.call_count)
+        self.ec2_client.create_launch_template_version.assert_not_called()
+
+    def test_prepare_other_image_uses_other_template(self):
+        self.templates.prepare(self.ctx, dict(self.create_args))
+        self.templates.prepare(self.ctx,
+                               dict(self.create_args, ImageId='ami-2'))
+        self.assertEqual(2, self.ec2_client.create_launch_template.call_count)
+
+    def test_prepare_loads_existing_template(self):
+        self.templates.prepare(self.ctx, dict(self.create_args))
+        digest = self.ec2_client.create_launch_template.call_args[1][
+            'VersionDescription']
+        self.ec2_client.create_launch_template.reset_mock()
+        self.ec2_client.describe_launch_templates.side_effect = None
+        self.ec2_client.describe_launch_templates.return_value = {
+            'LaunchTemplates': [{'LaunchTemplateId': 'lt-9'}]}
+        # aws describes the data in another shape than it was sent
+        self.ec2_client.describe_launch_template_versions.return_value = {
+            'LaunchTemplateVersions': [
+                {'VersionNumber': 4, 'VersionDescription': digest,
+                 'LaunchTemplateData': {
+                     'ImageId': 'ami-1', 'InstanceType': 't2.micro',
+                     'NetworkInterfaces': [{'DeviceIndex': 0,
+                                            'SubnetId': 's1',
+                                            'Groups': []}]}}]}
+        templates = launch_templates.LaunchTemplates(
+            self.templates._aws_client)
+        run_args = templates.prepare(self.ctx, dict(self.create_args))
+        self.assertEqual({'LaunchTemplateId': 'lt-9', 'Version': '4'},
+                         run_args['LaunchTemplate'])
+        self.ec2_client.create_launch_template.assert_not_called()
+        self.ec2_client.create_launch_template_version.assert_not_called()
@@ -0,0 +1,171 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import mock
+import testtools
+
+from botocore import exceptions
+from jacket.compute import exception
+from jacket import conf
+from jacket import context as req_context
+from jacket.drivers.aws import client
+from jacket.drivers.aws import power_batcher
+from jacket.tests.storage.unit.volume.drivers.aws import bench_compute
+from jacket.tests.storage.unit.volume.drivers.aws import benchmark
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+
+CONF = conf.CONF
+
+
+class PowerActionBatcherTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(PowerActionBatcherTestCase, self).setUp()
+        self.addCleanup(CONF.clear_override, 'power_action_window', 'aws')
+        CONF.set_override('power_action_window', 0.01, 'aws')
+        self.ec2 = fake_ec2.FakeEc2Client(seed=1)
+        aws_client = client.AwsClient()
+        fake_ec2.connect(aws_client, self.ec2)
+        self.batcher = power_batcher.PowerActionBatcher(aws_client)
+        self.context = req_context.RequestContext(is_admin=True,
+                                                  project_id='fake')
+        image_id = self.ec2.add_image()
+        self.instance_ids = [
+            instance['InstanceId'] for instance in self.ec2.run_instances(
+                ImageId=image_id, MinCount=4, MaxCount=4)['Instances']]
+        for instance in self.ec2.instances.values():
+            instance['State'] = {'Name': 'running', 'Code': 16}
+        self.ec2.calls.clear()
+
+    def _stop_all(self, instance_ids):
+        threads = [eventlet.spawn(self.batcher.change, self.context,
+                                  instance_id, 'stop_instances')
+                   for instance_id in instance_ids]
+        results = []
+        for thread in threads:
+            try:
+                results.append(thread.wait())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _state(self, instance_id):
+        return self.ec2.instances[instance_id]['State']['Name']
+
+    def test_concurrent_changes_batched(self):
+        self.assertEqual([None] * 4, self._stop_all(self.instance_ids))
+        self.assertEqual(1, self.ec2.calls['stop_instances'])
+        self.assertEqual(['stopping'] * 4,
+                         [self._state(i) for i in self.instance_ids])
+
+    def test_batch_size(self):
+        self.addCleanup(CONF.clear_override, 'power_action_batch_size', 'aws')
+        CONF.set_override('power_action_batch_size', 3, 'aws')
+        self._stop_all(self.instance_ids)
+        self.assertEqual(2, self.ec2.calls['stop_instances'])
+
+    def test_failure_split_per_instance(self):
+        bad = self.instance_ids[1]
+        self.ec2.instances[bad]['State'] = {'Name': 'terminated',
+                                            'Code': 48}
+        results = self._stop_all(self.instance_ids)
+        self.assertIsInstance(results[1], exceptions.ClientError)
+        self.assertEqual('IncorrectInstanceState',
+                         results[1].response['Error']['Code'])
+        self.assertEqual([None, None, None],
+                         [results[0], results[2], results[3]])
+        self.assertEqual(['stopping', 'terminated', 'stopping', 'stopping'],
+                         [self._state(i) for i in self.instance_ids])
+        # the batch, its halves and the halves of the failed half
+        self.assertEqual(5, self.ec2.calls['stop_instances'])
+
+    def test_transient_error_retries_the_batch(self):
+        self.addCleanup(CONF.clear_override, 'create_retry_interval', 'aws')
+        CONF.set_override('create_retry_interval', 0, 'aws')
+        throttled = fake_ec2.client_error('RequestLimitExceeded', 'Slow down',
+                                          'StopInstances')
+        with mock.patch.object(self.ec2, 'stop_instances',
+                               side_effect=[throttled, None]) as stop_mock:
+            results = self._stop_all(self.instance_ids)
+        self.assertEqual([None] * 4, results)
+        self.assertEqual([mock.call(InstanceIds=self.instance_ids)] * 2,
+                         stop_mock.call_args_list)
+
+    def test_other_client_error_fails_the_batch(self):
+        denied = fake_ec2.client_error('UnauthorizedOperation', 'Denied',
+                                       'StopInstances')
+        with mock.patch.object(self.ec2, 'stop_instances',
+                               side_effect=denied) as stop_mock:
+            results = self._stop_all(self.instance_ids)
+        self.assertEqual([denied] * 4, results)
+        self.assertEqual(1, stop_mock.call_count)
+
+    def test_other_error_fails_the_batch(self):
+        with mock.patch.object(self.ec2, 'stop_instances',
+                               side_effect=ValueError('boom')):
+            results = self._stop_all(self.instance_ids[:2])
+        self.assertEqual([ValueError, ValueError],
+                         [type(result) for result in results])
+
+
+class BatchedPowerActionTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(BatchedPowerActionTestCase, self).setUp()
+        for name, value in (('batch_power_actions', True),
+                            ('power_action_window', 0.01),
+                            ('instance_poll_interval', 0)):
+            self.addCleanup(CONF.clear_override, name, 'aws')
+            CONF.set_override(name, value, 'aws')
+        args = benchmark.build_parser('').parse_args(
+            ['--latency', '0', '--time-scale', '0.0001'])
+        self.ec2 = benchmark.make_ec2(args)
+        db = benchmark.FakeCaaDb()
+        context = req_context.RequestContext(
+            is_admin=True, project_id=bench_compute.PROJECT_ID)
+        bench_compute.setup_project(context, self.ec2, db)
+        self.driver = bench_compute.build_driver(self.ec2, db)
+        self.instances = [bench_compute.FakeInstance() for _i in range(3)]
+        for instance in self.instances:
+            self.driver.spawn(context, instance, None, [], None)
+        self.ec2.calls.clear()
+
+    def _power_off_all(self):
+        threads = [eventlet.spawn(self.driver.power_off, instance)
+                   for instance in self.instances]
+        for thread in threads:
+            thread.wait()
+
+    def test_power_off_waits_for_shared_poll(self):
+        self._power_off_all()
+        self.assertEqual(1, self.ec2.calls['stop_instances'])
+        self.assertEqual(
+            ['stopped'] * 3,
+            [self.ec2.instances[i.system_metadata['instance_id']]['State']
+             ['Name'] for i in self.instances])
+
+    def test_power_off_failure_per_instance(self):
+        bad = self.instances[0].system_metadata['instance_id']
+        del self.ec2.instances[bad]
+        self.assertRaises(exception.InstanceNotFound,
+                          self.driver.power_off, self.instances[0])
+        self.instances = self.instances[1:]
+        self._power_off_all()
+
+    @mock.patch('eventlet.spawn', mock.Mock())
+    def test_power_off_wait_bounded(self):
+        # the tracker never polls, the instance is seen stopping forever
+        self.addCleanup(CONF.clear_override, 'waiter_timeout', 'aws')
+        CONF.set_override('waiter_timeout', 0.01, 'aws')
+        self.assertRaises(exception.InstancePowerOffFailure,
+                          self.driver.power_off, self.instances[0])
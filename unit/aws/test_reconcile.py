@@ -0,0 +1,126 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import mock
+import testtools
+
+from jacket import conf
+from jacket import context
+from jacket import exception
+from jacket.drivers.aws.client import AwsClientPlugin
+from jacket.drivers.aws import reconcile
+
+CONF = conf.CONF
+
+
+class ReconcilerTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(ReconcilerTestCase, self).setUp()
+        self.ctx = context.RequestContext('fake', 'fake', is_admin=True)
+        self.addCleanup(CONF.clear_override, 'reconcile_resources', 'aws')
+        self.addCleanup(CONF.clear_override, 'reconcile_api_budget', 'aws')
+        self.addCleanup(CONF.clear_override, 'reconcile_api_rate', 'aws')
+        CONF.set_override('reconcile_resources', ['volume'], 'aws')
+        CONF.set_override('reconcile_api_rate', 0, 'aws')
+
+        self.ec2_client = mock.MagicMock()
+        self.ec2_client.describe_tags.side_effect = [
+            {'Tags': [{'ResourceId': 'vol-1', 'Value': 'caa-1'},
+                      {'ResourceId': 'vol-2', 'Value': 'caa-2'}],
+             'NextToken': 'next'},
+            {'Tags': [{'ResourceId': 'vol-3', 'Value': 'caa-3'}]}]
+        created = datetime.datetime(2020, 1, 1)
+        self.ec2_client.describe_volumes.return_value = {
+            'Volumes': [{'VolumeId': 'vol-untagged', 'CreateTime': created},
+                        {'VolumeId': 'vol-2', 'CreateTime': created}]}
+        aws_client = mock.MagicMock()
+        aws_client.get_aws_client.return_value = AwsClientPlugin(
+            self.ec2_client)
+
+        self.db_api = mock.MagicMock()
+        self.rows = {'caa-1': {'provider_volume_id': 'vol-1'},
+                     'caa-3': {'provider_volume_id': 'vol-gone'},
+                     'caa-4': {'provider_volume_id': 'vol-untagged'},
+                     'caa-5': {'provider_volume_id': 'vol-lost'}}
+        self.db_api.volume_mapper_all.return_value = self.rows
+        self.reconciler = reconcile.Reconciler(aws_client, self.db_api)
+
+    def test_run_reports_drift(self):
+        report = self.reconciler.run(self.ctx)
+        result = report['volume']
+        self.assertTrue(report['complete'])
+        self.assertEqual([('caa-2', ['vol-2'])], result['missing'])
+        self.assertEqual([('volume', 'caa-3', 'vol-gone', ['vol-3'])],
+                         result['stale'])
+        self.assertEqual([('volume', 'caa-5', 'vol-lost')], result['orphan'])
+        self.assertEqual(3, report['api_calls'])
+        self.db_api.volume_mapper_create.assert_not_called()
+        filters = self.ec2_client.describe_volumes.call_args[1]['Filters']
+        self.assertEqual(['vol-2', 'vol-gone', 'vol-lost', 'vol-untagged'],
+                         sorted(filters[0]['Values']))
+
+    def test_young_resource_not_missing(self):
+        self.ec2_client.describe_volumes.return_value = {
+            'Volumes': [{'VolumeId': 'vol-untagged'},
+                        {'VolumeId': 'vol-2',
+                         'CreateTime': datetime.datetime.utcnow()}]}
+        report = self.reconciler.run(self.ctx)
+        self.assertEqual([], report['volume']['missing'])
+
+    def test_run_stops_when_budget_exhausted(self):
+        CONF.set_override('reconcile_api_budget', 1, 'aws')
+        report = self.reconciler.run(self.ctx)
+        self.assertFalse(report['complete'])
+        self.assertNotIn('volume', report)
+        self.assertEqual(1, self.ec2_client.describe_tags.call_count)
+
+    def test_run_reads_rows_without_bulk_mapper_read(self):
+        del self.db_api.volume_mapper_all
+
+        def _get(context, caa_id):
+            if caa_id not in self.rows:
+                raise exception.EntityNotFound(entity='volume_mapper',
+                                               name=caa_id)
+            return self.rows[caa_id]
+        self.db_api.volume_mapper_get.side_effect = _get
+        result = self.reconciler.run(self.ctx)['volume']
+        self.assertEqual([('caa-2', ['vol-2'])], result['missing'])
+        self.assertEqual([('volume', 'caa-3', 'vol-gone', ['vol-3'])],
+                         result['stale'])
+        # no resource is tagged with caa-5
+        self.assertEqual([], result['orphan'])
+        self.assertEqual(3, self.db_api.volume_mapper_get.call_count)
+
+    def test_snapshot_reads_backups_like_the_driver(self):
+        CONF.set_override('reconcile_resources', ['snapshot'], 'aws')
+        self.ec2_client.describe_tags.side_effect = [
+            {'Tags': [{'ResourceId': 'snap-1', 'Value': 'caa-1'}]}]
+        self.db_api = mock.MagicMock(
+            spec=['volume_snapshot_mapper_get', 'backup_mapper_get'])
+        self.db_api.volume_snapshot_mapper_get.return_value = {}
+        self.db_api.backup_mapper_get.return_value = {
+            'provider_backup_id': 'snap-1'}
+        self.reconciler._db_api = self.db_api
+        result = self.reconciler.run(self.ctx)['snapshot']
+        self.assertEqual({'missing': [], 'stale': [], 'orphan': []}, result)
+        self.db_api.backup_mapper_get.assert_called_once_with(self.ctx,
+                                                              'caa-1')
+
+    @mock.patch.object(reconcile.LOG, 'warn')
+    def test_unreadable_table_skipped(self, warn_mock):
+        self.reconciler._db_api = mock.MagicMock(spec=[])
+        result = self.reconciler.run(self.ctx)['volume']
+        self.assertEqual([('caa-2', ['vol-2'])], result['missing'])
+        self.assertTrue(warn_mock.called)
@@ -0,0 +1,103 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from jacket import context as req_context
+from jacket.drivers.aws import snapshot_tracker
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+
+
+class SnapshotTrackerTestCase(fake_ec2.TrackerTestCase):
+
+    def setUp(self):
+        super(SnapshotTrackerTestCase, self).setUp()
+        self.on_update = mock.Mock()
+        self.tracker = snapshot_tracker.SnapshotTracker(self.aws_client,
+                                                        self.on_update)
+
+    def _create_snapshot(self, caa_id=None):
+        volume = self.ec2.create_volume(
+            Size=10, AvailabilityZone=self.ec2.availability_zone)
+        kwargs = {}
+        if caa_id:
+            kwargs['TagSpecifications'] = [{
+                'ResourceType': 'snapshot',
+                'Tags': [{'Key': 'caa_snapshot_id', 'Value': caa_id}]}]
+        return self.ec2.create_snapshot(VolumeId=volume['VolumeId'],
+                                        **kwargs)['SnapshotId']
+
+    def _track(self, caa_id, project_id='fake'):
+        snapshot_id = self._create_snapshot()
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id=project_id)
+        self.tracker.track(context, caa_id, snapshot_id)
+        return snapshot_id
+
+    def _updates(self):
+        return [c[0][1:] for c in self.on_update.call_args_list]
+
+    def test_final_state_only(self):
+        self._track('caa-1')
+        self.assertEqual(1, self.spawn_mock.call_count)
+        self.assertEqual(1, self.tracker.poll())
+        # snapshots of 10 GiB complete in 60 + 10 * 2 seconds
+        self.clock.sleep(40)
+        self.assertEqual(1, self.tracker.poll())
+        self.assertFalse(self.on_update.called)
+        self.clock.sleep(40)
+        self.assertEqual(0, self.tracker.poll())
+        self.assertEqual([('caa-1', 'completed')], self._updates())
+        self.assertEqual({}, self.tracker.tracked())
+
+    def test_resume_pending_snapshots(self):
+        pending = self._create_snapshot('caa-1')
+        self._create_snapshot('caa-2')
+        self._create_snapshot()
+        completed = self._create_snapshot('caa-3')
+        self.ec2.snapshots[completed]['State'] = 'completed'
+        context = req_context.RequestContext(is_admin=True,
+                                             project_id='aws_default')
+        owned = mock.Mock(side_effect=lambda ctx, caa_id: caa_id == 'caa-1')
+        self.assertEqual(1, self.tracker.resume(context, owned))
+        self.assertEqual({'caa-1': pending}, self.tracker.tracked())
+        self.assertEqual(['caa-1', 'caa-2'],
+                         sorted(c[0][1] for c in owned.call_args_list))
+
+    def test_one_request_per_project(self):
+        self._track('caa-1')
+        self._track('caa-2')
+        self._track('caa-3', project_id='other')
+        self.ec2.calls.clear()
+        self.tracker.poll()
+        self.assertEqual(2, self.ec2.calls['describe_snapshots'])
+
+    def test_deleted_snapshot(self):
+        snapshot_id = self._track('caa-1')
+        self.ec2.delete_snapshot(SnapshotId=snapshot_id)
+        self.assertEqual(0, self.tracker.poll())
+        self.assertEqual([('caa-1', None)], self._updates())
+
+    def test_forget(self):
+        self._track('caa-1')
+        self.tracker.forget('caa-1')
+        self.ec2.calls.clear()
+        self.assertEqual(0, self.tracker.poll())
+        self.assertFalse(self.ec2.calls['describe_snapshots'])
+        self.assertFalse(self.on_update.called)
+
+    def test_failed_update_does_not_stop_polling(self):
+        for caa_id in ('caa-1', 'caa-2'):
+            self.ec2.delete_snapshot(SnapshotId=self._track(caa_id))
+        self.on_update.side_effect = [Exception(), None]
+        self.assertEqual(0, self.tracker.poll())
+        self.assertEqual(2, self.on_update.call_count)
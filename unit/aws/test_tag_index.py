@@ -0,0 +1,84 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import testtools
+
+from jacket import context
+from jacket.drivers.aws.client import AwsClientPlugin
+from jacket.drivers.aws import tag_index
+
+
+class TagIndexTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(TagIndexTestCase, self).setUp()
+        self.ctx = context.RequestContext('fake', 'fake', is_admin=False)
+        self.ec2_client = mock.MagicMock()
+        self.ec2_client.describe_tags.side_effect = [
+            {'Tags': [{'ResourceType': 'instance', 'ResourceId': 'i-1',
+                       'Key': 'caa_instance_id', 'Value': 'caa-1'},
+                      {'ResourceType': 'volume', 'ResourceId': 'vol-1',
+                       'Key': 'caa_volume_id', 'Value': 'caa-2'}],
+             'NextToken': 'next'},
+            {'Tags': [{'ResourceType': 'volume', 'ResourceId': 'vol-2',
+                       'Key': 'caa_volume_id', 'Value': 'caa-2'},
+                      {'ResourceType': 'snapshot', 'ResourceId': 'snap-1',
+                       'Key': 'caa_volume_id', 'Value': 'caa-3'}]}]
+        aws_client = mock.MagicMock()
+        aws_client.get_aws_client.return_value = AwsClientPlugin(
+            self.ec2_client)
+        self.index = tag_index.TagIndex(aws_client)
+
+    def test_lookup_builds_index_once(self):
+        self.assertEqual(['i-1'], self.index.lookup(self.ctx, 'instance',
+                                                    'caa-1'))
+        self.assertEqual(['vol-1', 'vol-2'],
+                         self.index.lookup(self.ctx, 'volume', 'caa-2'))
+        self.assertEqual(2, self.ec2_client.describe_tags.call_count)
+        # a miss is looked up on its own
+        self.ec2_client.describe_tags.side_effect = [{'Tags': []}]
+        self.assertEqual([], self.index.lookup(self.ctx, 'snapshot',
+                                               'caa-3'))
+        self.assertEqual(3, self.ec2_client.describe_tags.call_count)
+        second_call = self.ec2_client.describe_tags.call_args_list[1]
+        self.assertEqual('next', second_call[1]['NextToken'])
+
+    def test_add_and_discard(self):
+        self.index.lookup(self.ctx, 'volume', 'caa-2')
+        self.index.add(self.ctx, 'snapshot', 'caa-3', 'snap-2')
+        self.index.discard(self.ctx, 'volume', 'vol-1')
+        self.assertEqual(['snap-2'], self.index.lookup(self.ctx, 'snapshot',
+                                                       'caa-3'))
+        self.assertEqual(['vol-2'], self.index.lookup(self.ctx, 'volume',
+                                                      'caa-2'))
+        self.assertEqual(2, self.ec2_client.describe_tags.call_count)
+
+    def test_expired_index_rebuilt(self):
+        with mock.patch('time.time', return_value=0):
+            self.index.lookup(self.ctx, 'volume', 'caa-2')
+        self.ec2_client.describe_tags.side_effect = [{'Tags': []}]
+        self.assertEqual([], self.index.lookup(self.ctx, 'volume', 'caa-2'))
+        self.assertEqual(3, self.ec2_client.describe_tags.call_count)
+
+    def test_miss_looked_up_and_added(self):
+        self.index.lookup(self.ctx, 'volume', 'caa-2')
+        self.ec2_client.describe_tags.side_effect = [
+            {'Tags': [{'ResourceType': 'instance', 'ResourceId': 'i-2',
+                       'Key': 'caa_instance_id', 'Value': 'caa-4'}]}]
+        self.assertEqual(['i-2'], self.index.lookup(self.ctx, 'instance',
+                                                    'caa-4'))
+        filters = self.ec2_client.describe_tags.call_args[1]['Filters']
+        self.assertIn({'Name': 'value', 'Values': ['caa-4']}, filters)
+        self.assertEqual(['i-2'], self.index.lookup(self.ctx, 'instance',
+                                                    'caa-4'))
+        self.assertEqual(3, self.ec2_client.describe_tags.call_count)
@@ -16,16 +16,23 @@ import mock
 import testtools
 
 import jacket
+from jacket import conf
 from jacket import context
+from jacket.drivers.aws.cleanup import CleanupQueue
 from jacket.drivers.aws.client import AwsClientPlugin
+from jacket.drivers.aws.clone_snapshots import CloneSnapshotCache
 from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws.snapshot_tracker import SnapshotTracker
 from jacket.drivers.aws.volume_driver import AwsVolumeDriver
 from jacket.drivers.aws.volume_driver import BaseDriver
+from jacket.drivers.aws.volume_qos import VolumeTypeArgs
 from jacket.i18n import _
 from jacket.storage import exception as cinder_ex
 from jacket.tests.storage.unit import fake_snapshot
 from jacket.tests.storage.unit import fake_volume
 
+CONF = conf.CONF
+
 
 class TestAwsVolumeDriver(testtools.TestCase):
     """Generic class for the Aws volume driver test case."""
@@ -69,7 +76,8 @@ class TestAwsVolumeDriver(testtools.TestCase):
         self.driver.create_volume(self.volume)
         create_args = {'AvailabilityZone': 'fake',
                        'VolumeType': 'fake',
-                       'Size': self.volume.size}
+                       'Size': self.volume.size,
+                       'ClientToken': mock.ANY}
         mock_create.assert_called_once_with(**create_args)
 
     @mock.patch.object(BaseDriver, '_create_volume')
@@ -92,9 +100,93 @@ class TestAwsVolumeDriver(testtools.TestCase):
         self.driver.create_volume(self.volume)
         create_args = {'AvailabilityZone': 'fake',
                        'VolumeType': 'standard',
-                       'Size': self.volume.size}
+                       'Size': self.volume.size,
+                       'ClientToken': mock.ANY}
+        mock_create.assert_called_once_with(**create_args)
+
+    @mock.patch.object(BaseDriver, '_get_provider_type_name',
+                       mock.MagicMock(return_value=None))
+    @mock.patch.object(AwsClientPlugin, 'create_volume')
+    @mock.patch.object(BaseDriver, '_get_provider_az',
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsClientPlugin, 'create_tags', mock.MagicMock())
+    @mock.patch('jacket.db.extend.api.volume_mapper_create', mock.MagicMock())
+    def test_create_volume_pool_type(self, mock_create):
+        mock_create.return_value = self._fake_ebs
+        self.volume.host = 'fake_host@aws#gp3'
+        self.driver.create_volume(self.volume)
+        create_args = {'AvailabilityZone': 'fake',
+                       'VolumeType': 'gp3',
+                       'Size': self.volume.size,
+                       'ClientToken': mock.ANY}
         mock_create.assert_called_once_with(**create_args)
 
+    @mock.patch.object(BaseDriver, '_get_provider_type_name',
+                       mock.MagicMock(return_value='gp2'))
+    @mock.patch.object(AwsClientPlugin, 'create_volume')
+    @mock.patch.object(BaseDriver, '_get_provider_az',
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsClientPlugin, 'create_tags', mock.MagicMock())
+    @mock.patch('jacket.db.extend.api.volume_mapper_create', mock.MagicMock())
+    @mock.patch.object(VolumeTypeArgs, 'get')
+    def test_create_volume_type_qos(self, mock_type_args, mock_create):
+        mock_type_args.return_value = {'VolumeType': 'gp3', 'Iops': 4000,
+                                       'Throughput': 250}
+        mock_create.return_value = self._fake_ebs
+        self.volume.size = 100
+        self.driver.create_volume(self.volume)
+        create_args = {'AvailabilityZone': 'fake',
+                       'VolumeType': 'gp3',
+                       'Iops': 4000,
+                       'Throughput': 250,
+                       'Size': 100,
+                       'ClientToken': mock.ANY}
+        mock_create.assert_called_once_with(**create_args)
+
+    @mock.patch.object(BaseDriver, '_get_provider_type_name',
+                       mock.MagicMock(return_value=None))
+    @mock.patch.object(AwsClientPlugin, 'create_volume')
+    @mock.patch.object(BaseDriver, '_get_provider_az',
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(VolumeTypeArgs, 'get')
+    def test_create_volume_type_qos_out_of_limits(self, mock_type_args,
+                                                  mock_create):
+        mock_type_args.return_value = {'VolumeType': 'io1', 'Iops': 64000}
+        self.volume.size = 10
+        self.assertRaises(cinder_ex.VolumeBackendAPIException,
+                          self.driver.create_volume,
+                          self.volume)
+        mock_create.assert_not_called()
+
+    @mock.patch.object(BaseDriver, '_get_provider_type_name',
+                       mock.MagicMock(return_value=None))
+    @mock.patch.object(AwsClientPlugin, 'create_volume')
+    @mock.patch.object(BaseDriver, '_get_provider_az',
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsClientPlugin, 'create_tags', mock.MagicMock())
+    @mock.patch('jacket.db.extend.api.volume_mapper_create', mock.MagicMock())
+    def test_create_volume_pool_not_reported(self, mock_create):
+        mock_create.return_value = self._fake_ebs
+        self.volume.host = 'fake_host@aws#io1'
+        self.driver.create_volume(self.volume)
+        self.assertEqual('standard',
+                         mock_create.call_args[1]['VolumeType'])
+
+    @mock.patch('eventlet.spawn_n')
+    def test_get_volume_stats_reports_pools(self, mock_spawn):
+        self.driver.configuration = mock.Mock()
+        self.driver.configuration.safe_get.return_value = None
+        stats = self.driver.get_volume_stats(refresh=True)
+        self.assertEqual('EBS', stats['storage_protocol'])
+        self.assertEqual('AWS', stats['volume_backend_name'])
+        self.assertEqual(['gp2', 'gp3'],
+                         [pool['pool_name'] for pool in stats['pools']])
+        self.assertEqual(['unknown', 'unknown'],
+                         [pool['total_capacity_gb']
+                          for pool in stats['pools']])
+        # the capacity is read in the background
+        self.assertEqual(1, mock_spawn.call_count)
+
     @mock.patch.object(BaseDriver, '_get_provider_az')
     @mock.patch.object(BaseDriver, '_get_provider_type_name',
                        mock.MagicMock(return_value='fake'))
@@ -113,29 +205,35 @@ class TestAwsVolumeDriver(testtools.TestCase):
     @mock.patch.object(BaseDriver, '_get_provider_type_name',
                        mock.MagicMock(return_value='fake'))
     @mock.patch('jacket.db.extend.api.volume_mapper_create', mock.MagicMock())
-    def test_create_volume_tag_error(self, mock_create_vol, mock_tag):
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    def test_create_volume_tag_error(self, mock_enqueue, mock_create_vol,
+                                     mock_tag):
         mock_create_vol.return_value = self._fake_ebs
         msg = (_("create provider volume failed vol:%s") % self.volume.id)
         mock_tag.side_effect = cinder_ex.VolumeBackendAPIException(data=msg)
         self.assertRaises(cinder_ex.VolumeBackendAPIException,
                           self.driver.create_volume,
                           self.volume)
+        mock_enqueue.assert_called_once_with(self.volume.project_id,
+                                             'volume', 'fake')
 
     @mock.patch('jacket.db.extend.api.volume_mapper_create')
     @mock.patch.object(AwsClientPlugin, 'create_volume')
-    @mock.patch.object(AwsClientPlugin, 'delete_volume',
-                       mock.MagicMock())
+    @mock.patch.object(CleanupQueue, 'enqueue')
     @mock.patch.object(BaseDriver, '_get_provider_az',
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(BaseDriver, '_get_provider_type_name',
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(AwsClientPlugin, 'create_tags', mock.MagicMock())
-    def test_create_volume_mapper_error(self, mock_create, mock_mapper):
+    def test_create_volume_mapper_error(self, mock_enqueue, mock_create,
+                                        mock_mapper):
         mock_create.return_value = self._fake_ebs
         mock_mapper.side_effect = cinder_ex.VolumeDriverException(message='')
         self.assertRaises(cinder_ex.VolumeBackendAPIException,
                           self.driver.create_volume,
                           self.volume)
+        mock_enqueue.assert_called_once_with(self.volume.project_id,
+                                             'volume', 'fake')
 
     @mock.patch.object(BaseDriver, '_get_provider_volume_id',
                        mock.MagicMock(return_value='fake'))
@@ -185,12 +283,62 @@ class TestAwsVolumeDriver(testtools.TestCase):
     @mock.patch.object(AwsClientPlugin, 'create_tags', mock.MagicMock())
     @mock.patch('jacket.db.extend.api.volume_snapshot_mapper_create',
                 mock.MagicMock())
+    @mock.patch.object(SnapshotTracker, 'track')
     @mock.patch.object(AwsClientPlugin, 'create_snapshot')
-    def test_create_snapshot(self, mock_create):
+    def test_create_snapshot(self, mock_create, mock_track):
         mock_create.return_value = self._fake_snap
         self.driver.create_snapshot(self.snapshot)
-        create_args = {'VolumeId': 'fake'}
-        mock_create.assert_called_once_with(**create_args)
+        tags = [{'Key': 'caa_snapshot_id', 'Value': self.snapshot.id}]
+        create_args = {'VolumeId': 'fake',
+                       'TagSpecifications': [{'ResourceType': 'snapshot',
+                                              'Tags': tags}]}
+        mock_create.assert_called_once_with(wait=False, **create_args)
+        mock_track.assert_called_once_with(
+            mock.ANY, self.snapshot.id, self._fake_snap['SnapshotId'])
+
+    @mock.patch.object(BaseDriver, '_get_provider_volume_id',
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch.object(AwsClientPlugin, 'create_tags', mock.MagicMock())
+    @mock.patch('jacket.db.extend.api.volume_snapshot_mapper_create',
+                mock.MagicMock())
+    @mock.patch.object(SnapshotTracker, 'track')
+    @mock.patch.object(AwsClientPlugin, 'create_snapshot')
+    def test_create_snapshot_waits_when_not_async(self, mock_create,
+                                                  mock_track):
+        self.addCleanup(CONF.clear_override, 'async_snapshots', 'aws')
+        CONF.set_override('async_snapshots', False, 'aws')
+        mock_create.return_value = self._fake_snap
+        self.driver.create_snapshot(self.snapshot)
+        self.assertTrue(mock_create.call_args[1]['wait'])
+        self.assertFalse(mock_track.called)
+
+    def test_snapshot_updated(self):
+        self.driver.db = mock.MagicMock()
+        self.driver._snapshot_updated(self.ctx, 'snap', 'completed')
+        self.driver._snapshot_updated(self.ctx, 'snap', None)
+        self.assertEqual(
+            [mock.call(self.ctx, 'snap', {'status': 'error'})],
+            self.driver.db.snapshot_update.call_args_list)
+
+    @mock.patch.object(CloneSnapshotCache, 'sweep')
+    @mock.patch.object(SnapshotTracker, 'resume')
+    def test_do_setup_resumes_tracking(self, mock_resume, mock_sweep):
+        self.driver.db = mock.MagicMock()
+        mock_sweep.side_effect = Exception('boom')
+        self.addCleanup(CONF.clear_override,
+                        'clone_snapshot_sweep_projects', 'aws')
+        CONF.set_override('clone_snapshot_sweep_projects',
+                          ['aws_default', 'other'], 'aws')
+        self.driver.do_setup(self.ctx)
+        self.assertEqual(['aws_default', 'other'],
+                         [c[0][0].project_id
+                          for c in mock_sweep.call_args_list])
+        context, owned = mock_resume.call_args[0]
+        self.assertEqual('aws_default', context.project_id)
+        self.assertTrue(owned(context, 'snap'))
+        self.driver.db.snapshot_get.side_effect = \
+            cinder_ex.SnapshotNotFound(snapshot_id='snap')
+        self.assertFalse(owned(context, 'snap'))
 
     @mock.patch.object(BaseDriver, '_create_snapshot')
     @mock.patch.object(BaseDriver, '_get_provider_volume_id',
@@ -204,19 +352,19 @@ class TestAwsVolumeDriver(testtools.TestCase):
 
     @mock.patch('jacket.db.extend.api.volume_snapshot_mapper_create')
     @mock.patch.object(BaseDriver, '_create_snapshot')
-    @mock.patch.object(AwsClientPlugin, 'delete_snapshot')
+    @mock.patch.object(CleanupQueue, 'enqueue')
     @mock.patch.object(BaseDriver, '_get_provider_volume_id',
                        mock.MagicMock(return_value='fake'))
     @mock.patch.object(AwsClientPlugin, 'create_tags', mock.MagicMock())
-    def test_create_snapshot_mapper_error(self, mock_delete, mock_create,
+    def test_create_snapshot_mapper_error(self, mock_enqueue, mock_create,
                                           mock_mapper):
         mock_create.return_value = self._fake_snap
         mock_mapper.side_effect = cinder_ex.VolumeDriverException(message='')
         self.assertRaises(cinder_ex.VolumeBackendAPIException,
                           self.driver.create_snapshot,
                           self.snapshot)
-        calls = [mock.call(SnapshotId='fake')]
-        mock_delete.assert_has_calls(calls)
+        mock_enqueue.assert_called_once_with(self.snapshot.project_id,
+                                             'snapshot', 'fake')
 
     @mock.patch.object(BaseDriver, '_get_provider_snapshot_id',
                        mock.MagicMock(return_value='fake'))
@@ -241,6 +389,16 @@ class TestAwsVolumeDriver(testtools.TestCase):
                           self.driver.delete_snapshot,
                           self.snapshot)
 
+    @mock.patch.object(BaseDriver, '_get_provider_snapshot_id',
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch('jacket.db.extend.api.volume_snapshot_mapper_delete')
+    @mock.patch.object(AwsClientPlugin, 'delete_snapshot')
+    def test_delete_snapshot_already_gone(self, mock_delete, mock_mapper):
+        mock_delete.side_effect = exception_ex.ProviderDeleteSnapshotFailed(
+            reason='fake', error_code='InvalidSnapshot.NotFound')
+        self.driver.delete_snapshot(self.snapshot)
+        self.assertTrue(mock_mapper.called)
+
     @mock.patch.object(BaseDriver, '_get_provider_snapshot_id')
     @mock.patch.object(BaseDriver, '_get_provider_snapshot')
     @mock.patch.object(AwsClientPlugin, 'delete_snapshot')
@@ -275,10 +433,10 @@ class TestAwsVolumeDriver(testtools.TestCase):
     @mock.patch('jacket.db.extend.api.volume_mapper_create')
     @mock.patch.object(AwsClientPlugin, 'delete_snapshot')
     @mock.patch.object(AwsClientPlugin, 'create_snapshot')
-    @mock.patch.object(AwsClientPlugin, 'delete_volume')
+    @mock.patch.object(CleanupQueue, 'enqueue')
     @mock.patch.object(BaseDriver, '_create_volume')
     def test_create_cloned_volume_failed(self, mock_create_vol,
-                                         mock_delete_vol,
+                                         mock_enqueue,
                                          mock_create_snap,
                                          mock_delete_snap,
                                          mock_mapper):
@@ -292,25 +450,51 @@ class TestAwsVolumeDriver(testtools.TestCase):
         mock_delete_snap.assert_called_once_with(
             SnapshotId=self._fake_snap['SnapshotId']
         )
-        mock_delete_vol.assert_called_once_with(
-            VolumeId=self._fake_ebs['VolumeId']
-        )
+        mock_enqueue.assert_called_once_with(self.volume.project_id,
+                                             'volume',
+                                             self._fake_ebs['VolumeId'])
 
     @mock.patch.object(BaseDriver, '_get_provider_snapshot_id',
                        mock.MagicMock(return_value='fake'))
     @mock.patch('jacket.db.extend.api.volume_mapper_create',
                 mock.MagicMock())
     @mock.patch.object(BaseDriver, '_create_volume')
-    def test_create_volume_from_snapshot(self, mock_create_vol):
+    @mock.patch.object(AwsClientPlugin, 'get_snapshot_state',
+                       mock.MagicMock(return_value='pending'))
+    @mock.patch.object(AwsClientPlugin, 'wait_snapshot_completed')
+    def test_create_volume_from_snapshot(self, mock_wait, mock_create_vol):
         mock_create_vol.return_value = self._fake_ebs
         self.driver.create_volume_from_snapshot(self.volume, self.snapshot)
+        mock_wait.assert_called_once_with('fake')
+
+    @mock.patch.object(BaseDriver, '_get_provider_snapshot_id',
+                       mock.MagicMock(return_value='fake'))
+    @mock.patch('jacket.db.extend.api.volume_mapper_create',
+                mock.MagicMock())
+    @mock.patch.object(BaseDriver, '_create_volume')
+    @mock.patch.object(AwsClientPlugin, 'get_snapshot_state')
+    @mock.patch.object(AwsClientPlugin, 'wait_snapshot_completed')
+    def test_create_volume_from_snapshot_state(self, mock_wait, mock_state,
+                                               mock_create_vol):
+        mock_create_vol.return_value = self._fake_ebs
+        mock_state.return_value = 'completed'
+        self.driver.create_volume_from_snapshot(self.volume, self.snapshot)
+        self.assertFalse(mock_wait.called)
+        for state in (None, 'error'):
+            mock_state.return_value = state
+            self.assertRaises(cinder_ex.VolumeBackendAPIException,
+                              self.driver.create_volume_from_snapshot,
+                              self.volume, self.snapshot)
+        self.assertEqual(1, mock_create_vol.call_count)
 
     @mock.patch.object(BaseDriver, '_get_provider_snapshot_id',
                        mock.MagicMock(return_value='fake'))
     @mock.patch('jacket.db.extend.api.volume_mapper_create')
     @mock.patch.object(BaseDriver, '_create_volume')
-    @mock.patch.object(AwsClientPlugin, 'delete_volume')
-    def test_create_volume_from_snapshot_failed(self, mock_delete,
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    @mock.patch.object(AwsClientPlugin, 'get_snapshot_state',
+                       mock.MagicMock(return_value='completed'))
+    def test_create_volume_from_snapshot_failed(self, mock_enqueue,
                                                 mock_create_vol, mock_mapper):
         mock_create_vol.return_value = self._fake_ebs
         mock_mapper.side_effect = cinder_ex.VolumeDriverException(message='')
@@ -318,8 +502,9 @@ class TestAwsVolumeDriver(testtools.TestCase):
                           self.driver.create_volume_from_snapshot,
                           self.volume,
                           self.snapshot)
-        mock_delete.assert_called_once_with(
-            VolumeId=self._fake_ebs['VolumeId'])
+        mock_enqueue.assert_called_once_with(self.volume.project_id,
+                                             'volume',
+                                             self._fake_ebs['VolumeId'])
 
     @mock.patch.object(BaseDriver, '_get_provider_type_name',
                        mock.MagicMock(return_value='standard'))
@@ -341,7 +526,8 @@ class TestAwsVolumeDriver(testtools.TestCase):
         volume_args = {'AvailabilityZone': 'fake',
                        'VolumeType': 'standard',
                        'Size': 10,
-                       'SnapshotId': 'fake'}
+                       'SnapshotId': 'fake',
+                       'ClientToken': mock.ANY}
         mock_create_vol.assert_called_once_with(**volume_args)
         mock_delete_snap.assert_called_once_with(
             SnapshotId=self._fake_snap['SnapshotId']
@@ -359,8 +545,8 @@ class TestAwsVolumeDriver(testtools.TestCase):
     @mock.patch.object(AwsClientPlugin, 'delete_snapshot')
     @mock.patch.object(AwsClientPlugin, 'create_snapshot')
     @mock.patch.object(AwsClientPlugin, 'create_volume')
-    @mock.patch.object(AwsClientPlugin, 'delete_volume')
-    def test_extend_volume_failed(self, mock_delete_vol, mock_create_vol,
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    def test_extend_volume_failed(self, mock_enqueue, mock_create_vol,
                                   mock_create_snap, mock_delete_snap, mapper):
         mock_create_vol.return_value = self._fake_ebs
         mock_create_snap.return_value = self._fake_snap
@@ -372,12 +558,14 @@ class TestAwsVolumeDriver(testtools.TestCase):
         volume_args = {'AvailabilityZone': 'fake',
                        'VolumeType': 'standard',
                        'Size': 10,
-                       'SnapshotId': 'fake'}
+                       'SnapshotId': 'fake',
+                       'ClientToken': mock.ANY}
         mock_create_vol.assert_called_once_with(**volume_args)
         mock_delete_snap.assert_called_once_with(
             SnapshotId=self._fake_snap['SnapshotId']
         )
-        mock_delete_vol.assert_called_once_with(VolumeId='fake')
+        mock_enqueue.assert_called_once_with(self.volume.project_id,
+                                             'volume', 'fake')
 
     @mock.patch.object(BaseDriver, '_get_provider_type_name',
                        mock.MagicMock(return_value='new_type'))
@@ -399,7 +587,8 @@ class TestAwsVolumeDriver(testtools.TestCase):
         volume_args = {'AvailabilityZone': 'fake',
                        'VolumeType': 'new_type',
                        'Size': self.volume.size,
-                       'SnapshotId': 'fake'}
+                       'SnapshotId': 'fake',
+                       'ClientToken': mock.ANY}
         mock_create_vol.assert_called_once_with(**volume_args)
         mock_delete_snap.assert_called_once_with(
             SnapshotId=self._fake_snap['SnapshotId']
@@ -417,8 +606,8 @@ class TestAwsVolumeDriver(testtools.TestCase):
     @mock.patch.object(AwsClientPlugin, 'delete_snapshot')
     @mock.patch.object(AwsClientPlugin, 'create_snapshot')
     @mock.patch.object(AwsClientPlugin, 'create_volume')
-    @mock.patch.object(AwsClientPlugin, 'delete_volume')
-    def test_retype_failed(self, mock_delete_vol, mock_create_vol,
+    @mock.patch.object(CleanupQueue, 'enqueue')
+    def test_retype_failed(self, mock_enqueue, mock_create_vol,
                            mock_create_snap, mock_delete_snap, mapper):
         mock_create_vol.return_value = self._fake_ebs
         mock_create_snap.return_value = self._fake_snap
@@ -433,12 +622,14 @@ class TestAwsVolumeDriver(testtools.TestCase):
         volume_args = {'AvailabilityZone': 'fake',
                        'VolumeType': 'new_type',
                        'Size': self.volume.size,
-                       'SnapshotId': 'fake'}
+                       'SnapshotId': 'fake',
+                       'ClientToken': mock.ANY}
         mock_create_vol.assert_called_once_with(**volume_args)
         mock_delete_snap.assert_called_once_with(
             SnapshotId=self._fake_snap['SnapshotId']
         )
-        mock_delete_vol.assert_called_once_with(VolumeId='fake')
+        mock_enqueue.assert_called_once_with(self.volume.project_id,
+                                             'volume', 'fake')
 
     @mock.patch.object(BaseDriver, "_get_provider_type_name")
     def test_copy_image_to_volume_not_exist_volume_type(self, get_type_mock):
@@ -540,10 +731,10 @@ class TestAwsVolumeDriver(testtools.TestCase):
     @mock.patch.object(BaseDriver, "_get_provider_az")
     @mock.patch.object(jacket.db.extend.api, "image_mapper_get")
     @mock.patch.object(jacket.db.extend.api, "volume_mapper_create")
-    @mock.patch.object(AwsClientPlugin, 'delete_volume')
+    @mock.patch.object(CleanupQueue, 'enqueue')
     @mock.patch.object(AwsClientPlugin, 'create_volume')
     def test_copy_image_to_volume_error_mapper_create(self, create_volume_mock,
-                                                      delete_volume_mock,
+                                                      enqueue_mock,
                                                       mapper_create_mock,
                                                       get_image_mapper_mock,
                                                       get_provider_az_mock):
@@ -561,7 +752,6 @@ class TestAwsVolumeDriver(testtools.TestCase):
         create_volume_mock.return_value = aws_response
         mapper_create_mock.side_effect = \
             exception_ex.ProviderCreateVolumeFailed
-        delete_volume_mock.return_value = {'code': 202}
         volume = self._create_volume()
         self.assertRaises(exception_ex.ProviderCreateVolumeFailed,
                           self.driver.copy_image_to_volume,
@@ -569,6 +759,8 @@ class TestAwsVolumeDriver(testtools.TestCase):
                           volume,
                           '',
                           image_id)
+        enqueue_mock.assert_called_once_with(self.ctx.project_id, 'volume',
+                                             'aws-0001')
 
     @mock.patch.object(BaseDriver, "_get_provider_type_name",
                        mock.MagicMock(return_value='standard'))
@@ -0,0 +1,79 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import testtools
+
+from jacket import context
+from jacket.drivers.aws import exception_ex
+from jacket.drivers.aws import volume_qos
+
+
+class VolumeQosTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(VolumeQosTestCase, self).setUp()
+        self.ctx = context.RequestContext('fake', 'fake', is_admin=True)
+
+    def test_translate_qos_specs_win(self):
+        extra_specs = {'aws:volume_type': 'gp3', 'aws:iops': '4000',
+                       'volume_backend_name': 'AWS'}
+        qos_specs = {'consumer': 'back-end',
+                     'specs': {'aws:iops': '6000', 'aws:throughput': '500'}}
+        args = volume_qos.translate('type', extra_specs, qos_specs)
+        self.assertEqual({'VolumeType': 'gp3', 'Iops': 6000,
+                          'Throughput': 500}, args)
+
+    def test_translate_ignores_front_end_qos(self):
+        qos_specs = {'consumer': 'front-end', 'specs': {'aws:iops': '6000'}}
+        self.assertEqual({}, volume_qos.translate('type', {}, qos_specs))
+
+    def test_translate_invalid(self):
+        self.assertRaises(exception_ex.InvalidVolumeQos,
+                          volume_qos.translate, 'type',
+                          {'aws:volume_type': 'gp9'}, None)
+        self.assertRaises(exception_ex.InvalidVolumeQos,
+                          volume_qos.translate, 'type',
+                          {'aws:iops': 'fast'}, None)
+
+    def test_validate(self):
+        volume_qos.validate('type', 'gp3', {'Iops': 6000,
+                                            'Throughput': 1000}, 100)
+        volume_qos.validate('type', 'io2', {'Iops': 5000}, 10)
+        volume_qos.validate('type', 'gp3', {'Iops': 3000}, 1)
+        invalid = [('gp2', {'Iops': 3000}, 100),
+                   ('gp3', {'Iops': 3001}, 1),
+                   ('io1', {'Iops': 100}, 1),
+                   ('io1', {}, 100),
+                   ('io1', {'Iops': 1000}, 10),
+                   ('gp3', {'Throughput': 1000}, 100),
+                   ('st1', {'Throughput': 200}, 500)]
+        for volume_type, args, size in invalid:
+            self.assertRaises(exception_ex.InvalidVolumeQos,
+                              volume_qos.validate, 'type', volume_type,
+                              args, size)
+
+    @mock.patch('jacket.storage.volume.volume_types.'
+                'get_volume_type_qos_specs')
+    @mock.patch('jacket.storage.volume.volume_types.'
+                'get_volume_type_extra_specs')
+    def test_volume_type_args_cached(self, mock_extra, mock_qos):
+        mock_extra.return_value = {'aws:volume_type': 'io1',
+                                   'aws:iops': '1000'}
+        mock_qos.return_value = {'qos_specs': None}
+        type_args = volume_qos.VolumeTypeArgs()
+        expected = {'VolumeType': 'io1', 'Iops': 1000}
+        self.assertEqual(expected, type_args.get(self.ctx, 'type'))
+        type_args.get(self.ctx, 'type').pop('Iops')
+        self.assertEqual(expected, type_args.get(self.ctx, 'type'))
+        mock_extra.assert_called_once_with('type')
+        self.assertEqual({}, type_args.get(self.ctx, None))
@@ -0,0 +1,94 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from botocore import exceptions
+import mock
+import testtools
+
+from jacket import conf
+from jacket.drivers.aws import waiters
+from jacket.tests.storage.unit.volume.drivers.aws import fake_ec2
+
+CONF = conf.CONF
+
+
+class WaitersTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(WaitersTestCase, self).setUp()
+        self.clock = fake_ec2.FakeClock()
+        self.ec2 = fake_ec2.FakeEc2Client(clock=self.clock.time,
+                                          sleep=self.clock.sleep, seed=1)
+        self.waiters = waiters.Waiters(self.ec2, clock=self.clock.time,
+                                       sleep=self.clock.sleep)
+
+    def _override(self, name, value):
+        self.addCleanup(CONF.clear_override, name, 'aws')
+        CONF.set_override(name, value, 'aws')
+
+    def _wait_volume_created(self):
+        volume = self.ec2.create_volume(
+            Size=1, AvailabilityZone=self.ec2.availability_zone)
+        self.ec2.calls.clear()
+        started = self.clock.now
+        self.waiters.wait('volume_available', VolumeIds=[volume['VolumeId']])
+        return self.clock.now - started
+
+    def test_first_wait_backs_off(self):
+        # volumes are created in 5 seconds, polled after 1, 3 and 7
+        self.assertEqual(7, self._wait_volume_created())
+        self.assertEqual(3, self.ec2.calls['describe_volumes'])
+        self.assertEqual(7, self.waiters.average('volume_available'))
+
+    def test_first_poll_near_average(self):
+        self._wait_volume_created()
+        self.assertAlmostEqual(5.6, self._wait_volume_created())
+        self.assertEqual(1, self.ec2.calls['describe_volumes'])
+        self.assertAlmostEqual(7 + 0.3 * (5.6 - 7),
+                               self.waiters.average('volume_available'))
+
+    def test_first_poll_capped_at_max_delay(self):
+        self._override('waiter_max_delays', {'volume_available': '2'})
+        self.waiters._observe('volume_available', 3600)
+        # polled after 2, 4 and 6 seconds instead of after 48 minutes
+        self.assertEqual(6, self._wait_volume_created())
+        self.assertEqual(3, self.ec2.calls['describe_volumes'])
+
+    def test_timeout_per_waiter(self):
+        self._override('waiter_timeouts', {'volume_available': '4'})
+        self.assertRaises(exceptions.WaiterError, self._wait_volume_created)
+        self.assertEqual(4, self.clock.now)
+        self.assertIsNone(self.waiters.average('volume_available'))
+
+    def test_failure_state_raises_at_once(self):
+        ec2_client = mock.MagicMock()
+        ec2_client.get_waiter.return_value.wait.side_effect = \
+            exceptions.WaiterError(
+                name='volume_in_use',
+                reason='Waiter encountered a terminal failure state',
+                last_response={})
+        waiter = waiters.Waiters(ec2_client, clock=self.clock.time,
+                                 sleep=self.clock.sleep)
+        self.assertRaises(exceptions.WaiterError, waiter.wait,
+                          'volume_in_use', VolumeIds=['vol-1'])
+        self.assertEqual(
+            1, ec2_client.get_waiter.return_value.wait.call_count)
+
+    def test_fixed_delay_when_not_adaptive(self):
+        self._override('adaptive_waiters', False)
+        self._override('waiter_max_delays', {'volume_in_use': '5'})
+        ec2_client = mock.MagicMock()
+        waiters.Waiters(ec2_client).wait('volume_in_use',
+                                         VolumeIds=['vol-1'])
+        ec2_client.get_waiter.return_value.wait.assert_called_once_with(
+            WaiterConfig={'Delay': 5.0, 'MaxAttempts': 120},
+            VolumeIds=['vol-1'])